@@ -21,7 +21,7 @@ try:
     from core.payment_manager import PaymentManager
     from core.routine_manager import RoutineTemplateManager as RoutineManager
     # Services
-    from core.services import UserService, PaymentService, GymService, AttendanceService, TeacherService
+    from core.services import UserService, PaymentService, GymService, AttendanceService, TeacherService, ReceiptService, ReceiptBatchService, ReceiptNumberingService, CatalogService, PaymentExportService, WhatsappRetentionService
     from core.services.admin_service import AdminService
     from core.database.connection import SessionLocal
     from core.database.raw_manager import RawPostgresManager
@@ -35,6 +35,12 @@ except ImportError as e:
     GymService = None
     AttendanceService = None
     TeacherService = None
+    ReceiptService = None
+    ReceiptBatchService = None
+    ReceiptNumberingService = None
+    CatalogService = None
+    PaymentExportService = None
+    WhatsappRetentionService = None
     AdminService = None
 
 logger = logging.getLogger(__name__)
@@ -87,6 +93,26 @@ def get_attendance_service(session = Depends(get_db_session)) -> AttendanceServi
 def get_teacher_service(session = Depends(get_db_session)) -> TeacherService:
     return TeacherService(session)
 
+def get_receipt_service(session = Depends(get_db_session)) -> ReceiptService:
+    return ReceiptService(session, CURRENT_TENANT.get())
+
+def get_receipt_batch_service() -> ReceiptBatchService:
+    # Sesión propia: la descarga en streaming sigue después de cerrar la de la request
+    return ReceiptBatchService(None, CURRENT_TENANT.get())
+
+def get_receipt_numbering_service(session = Depends(get_db_session)) -> ReceiptNumberingService:
+    return ReceiptNumberingService(session)
+
+def get_catalog_service(session = Depends(get_db_session)) -> CatalogService:
+    return CatalogService(session, CURRENT_TENANT.get())
+
+def get_payment_export_service() -> PaymentExportService:
+    # Sesión propia, igual que los recibos en lote: el cursor se lee mientras se emite la respuesta
+    return PaymentExportService(None)
+
+def get_whatsapp_retention_service(session = Depends(get_db_session)) -> WhatsappRetentionService:
+    return WhatsappRetentionService(session)
+
 def get_admin_service() -> Optional[AdminService]:
     try:
         if AdminService is None:
@@ -101,8 +127,12 @@ def get_admin_service() -> Optional[AdminService]:
 # --- Legacy Managers ---
 
 def get_pm() -> Optional[PaymentManager]:
+    # Barato de construir: la configuración y el cliente de WhatsApp se comparten por base (core/whatsapp_clientes.py)
     try:
-        return PaymentManager()
+        db = get_db()
+        if db is None:
+            return None
+        return PaymentManager(db)
     except Exception as e:
         logger.error(f"Error instantiating PaymentManager: {e}")
         return None
@@ -1,3 +1,4 @@
+import hmac
 import logging
 import os
 import json
@@ -8,10 +9,14 @@ from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from pathlib import Path
 
-from apps.webapp.dependencies import get_db, get_admin_db, require_owner
+from apps.webapp.dependencies import get_db, get_admin_db, require_owner, PaymentManager
 from apps.webapp.utils import (
     _circuit_guard_json, _resolve_theme_vars, _resolve_logo_url, get_gym_name
 )
+from core.whatsapp_webhook import WebhookIngestor
+from core.whatsapp_campaigns import MotorCampanias
+from core.services.whatsapp_retention_service import WhatsappRetentionService
+from core.services.attendance_service import AttendanceService
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -316,3 +321,146 @@ async def api_admin_reminder(request: Request):
         return JSONResponse({"active": bool(active), "message": str(msg or "")})
     except Exception:
         return JSONResponse({"active": False, "message": ""})
+
+
+def _cron_autorizado(request: Request) -> bool:
+    """Vercel Cron envía `Authorization: Bearer <CRON_SECRET>`."""
+    secret = (os.getenv("CRON_SECRET") or "").strip()
+    if not secret:
+        return False
+    auth = request.headers.get("authorization") or ""
+    return hmac.compare_digest(auth.encode(), f"Bearer {secret}".encode())
+
+
+@router.get("/admin/cron/daily-reminders")
+async def admin_cron_daily_reminders(request: Request):
+    """Cron diario: recálculo de estados, sincronización de usuarios.telefono_e164 y
+    recordatorios de cuotas vencidas / por vencer.
+
+    `?dry_run=1` calcula destinatarios sin enviar ni registrar.
+    """
+    if not _cron_autorizado(request):
+        raise HTTPException(status_code=401, detail="No autorizado")
+    rid = getattr(getattr(request, 'state', object()), 'request_id', '-')
+    dry_run = str(request.query_params.get("dry_run") or "").strip().lower() in ("1", "true", "yes")
+    db = get_db()
+    if db is None or PaymentManager is None:
+        return JSONResponse({"success": False, "error": "DB no disponible"}, status_code=503)
+    try:
+        pm = PaymentManager(db)
+        resultados = {}
+        if not dry_run:
+            pm.recalcular_estados_usuarios(solo_activos=True)
+            # Teléfonos cargados por fuera del ORM (importaciones, SQL directo)
+            resultados["telefonos"] = db.users.sincronizar_telefonos_e164()
+        for modo in ("vencidos", "por_vencer"):
+            resultados[modo] = pm.ejecutar_recordatorios(modo, dry_run=dry_run)
+        logger.info(f"/admin/cron/daily-reminders: dry_run={dry_run} res={resultados} rid={rid}")
+        return JSONResponse({"success": True, "dry_run": dry_run, **resultados})
+    except Exception as e:
+        logger.exception(f"Error en /admin/cron/daily-reminders rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+@router.get("/admin/cron/whatsapp-outbox")
+async def admin_cron_whatsapp_outbox(request: Request):
+    """Cron: encola las confirmaciones de lista de espera pendientes y el cupo de las campañas
+    en curso, y envía lo pendiente del outbox de WhatsApp (mensajes de instancias que
+    terminaron antes de despacharlos y reintentos con backoff vencido)."""
+    if not _cron_autorizado(request):
+        raise HTTPException(status_code=401, detail="No autorizado")
+    rid = getattr(getattr(request, 'state', object()), 'request_id', '-')
+    db = get_db()
+    if db is None or PaymentManager is None:
+        return JSONResponse({"success": False, "error": "DB no disponible"}, status_code=503)
+    try:
+        wm = getattr(PaymentManager(db), 'whatsapp_manager', None)
+        if wm is None:
+            return JSONResponse({"success": False, "error": "Gestor WhatsApp no disponible"}, status_code=503)
+        confirmaciones = wm.process_pending_sends()
+        try:
+            campanias = MotorCampanias(db, wm).avanzar()
+        except Exception as e:
+            logger.error(f"/admin/cron/whatsapp-outbox: error avanzando campañas: {e} rid={rid}")
+            campanias = {"error": str(e)}
+        resultado = await wm.procesar_outbox_async()
+        logger.info(f"/admin/cron/whatsapp-outbox: confirmaciones={confirmaciones} campanias={campanias} "
+                    f"{resultado} rid={rid}")
+        return JSONResponse({"success": True, "confirmaciones": confirmaciones, "campanias": campanias,
+                             **resultado, **db.whatsapp.resumen_outbox()})
+    except Exception as e:
+        logger.exception(f"Error en /admin/cron/whatsapp-outbox rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+@router.get("/admin/cron/whatsapp-webhooks")
+async def admin_cron_whatsapp_webhooks(request: Request):
+    """Cron: procesa eventos del webhook de WhatsApp que quedaron en cola (instancias que
+    terminaron antes de consumirlos o eventos que fallaron y se reintentan). Antes completa
+    usuarios.telefono_e164 si nunca se calculó con la normalización vigente."""
+    if not _cron_autorizado(request):
+        raise HTTPException(status_code=401, detail="No autorizado")
+    rid = getattr(getattr(request, 'state', object()), 'request_id', '-')
+    db = get_db()
+    if db is None:
+        return JSONResponse({"success": False, "error": "DB no disponible"}, status_code=503)
+    try:
+        telefonos = db.users.sincronizar_telefonos_e164_si_hace_falta()
+        if telefonos:
+            logger.info(f"/admin/cron/whatsapp-webhooks: telefonos={telefonos} rid={rid}")
+        ingestor = WebhookIngestor(db)
+        resultado = ingestor.procesar()
+        logger.info(f"/admin/cron/whatsapp-webhooks: {resultado} rid={rid}")
+        return JSONResponse({"success": True, **resultado, **ingestor.resumen()})
+    except Exception as e:
+        logger.exception(f"Error en /admin/cron/whatsapp-webhooks rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+@router.get("/admin/cron/whatsapp-retencion")
+async def admin_cron_whatsapp_retencion(request: Request):
+    """Cron diario de whatsapp_messages: resumen por teléfono, retención por tipo,
+    compactación de contenido y archivo de particiones viejas (ver WhatsappRetentionService)."""
+    if not _cron_autorizado(request):
+        raise HTTPException(status_code=401, detail="No autorizado")
+    rid = getattr(getattr(request, 'state', object()), 'request_id', '-')
+    try:
+        max_lotes = int(request.query_params.get("max_lotes") or 200)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="max_lotes inválido")
+    try:
+        with WhatsappRetentionService() as svc:
+            resultado = svc.maintain(max_batches=max_lotes)
+        logger.info(
+            f"/admin/cron/whatsapp-retencion: resumen={resultado['resumen']} borradas={resultado['borradas']} "
+            f"compactadas={resultado['compactadas']} archivadas={len(resultado['archivadas'])} "
+            f"fallidas={resultado['fallidas']} rid={rid}"
+        )
+        return JSONResponse({"success": True, **resultado}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error en /admin/cron/whatsapp-retencion rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+@router.get("/admin/cron/asistencias-particiones")
+async def admin_cron_asistencias_particiones(request: Request):
+    """Cron diario de asistencias particionadas: crea las particiones de los próximos meses y
+    archiva las que superan ASISTENCIAS_RETENCION_MESES (ver AttendanceService.maintain_partitions)."""
+    if not _cron_autorizado(request):
+        raise HTTPException(status_code=401, detail="No autorizado")
+    rid = getattr(getattr(request, 'state', object()), 'request_id', '-')
+    try:
+        meses = int(request.query_params.get("meses_futuros") or 3)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="meses_futuros inválido")
+    try:
+        with AttendanceService() as svc:
+            resultado = svc.maintain_partitions(meses)
+        logger.info(
+            f"/admin/cron/asistencias-particiones: creadas={resultado['creadas']} "
+            f"archivadas={len(resultado['archivadas'])} fallidas={resultado['fallidas']} rid={rid}"
+        )
+        return JSONResponse({"success": True, **resultado}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error en /admin/cron/asistencias-particiones rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
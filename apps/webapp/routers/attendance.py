@@ -1,12 +1,18 @@
+import os
+import hmac
+import time
+import hashlib
 import logging
 import secrets
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from typing import Optional, List, Dict, Any
 
 from fastapi import APIRouter, Request, Depends, HTTPException, status
 from fastapi.responses import JSONResponse
 
-from apps.webapp.dependencies import get_db, require_gestion_access, require_owner
+from apps.webapp.dependencies import get_db, get_attendance_service, require_gestion_access, require_owner
+from core.services import AttendanceService
+from core.database.date_ranges import hoy_gym, rango_ultimos_dias
 from apps.webapp.utils import _circuit_guard_json
 
 router = APIRouter()
@@ -125,8 +131,8 @@ async def api_checkin_token_status(request: Request):
                 if usuario_id is not None:
                     cur2 = conn.cursor()
                     cur2.execute(
-                        "SELECT 1 FROM asistencias WHERE usuario_id = %s AND fecha::date = CURRENT_DATE LIMIT 1",
-                        (int(usuario_id),)
+                        "SELECT 1 FROM asistencias WHERE usuario_id = %s AND fecha = %s LIMIT 1",
+                        (int(usuario_id), hoy_gym())
                     )
                     attended_today = cur2.fetchone() is not None
             except Exception:
@@ -149,6 +155,133 @@ async def api_checkin_token_status(request: Request):
             pass
         return JSONResponse({"exists": False, "used": False, "expired": True, "error": str(e)}, status_code=200)
 
+# --- Check-in offline (cola local del kiosco + replay) ---
+# Con conexión, el kiosco obtiene un pase offline firmado para el socio autenticado.
+# Sin conexión, cada escaneo se guarda localmente firmado con la clave del pase
+# (HMAC-SHA256 sobre "usuario_id|token|ts_ms|issued|expires") y se reenvía en bloque
+# a /api/checkin/offline/replay cuando vuelve la conectividad.
+
+OFFLINE_PASS_TTL_SECONDS = 24 * 3600
+OFFLINE_CLOCK_SKEW_SECONDS = 300
+OFFLINE_REPLAY_MAX_SCANS = 5000
+
+
+def _get_checkin_offline_secret() -> Optional[str]:
+    """Secreto de los pases offline; None deja deshabilitado el check-in offline."""
+    for k in ("CHECKIN_OFFLINE_SECRET", "SESSION_SECRET", "SECRET_KEY"):
+        v = os.getenv(k, "").strip()
+        if v:
+            return v
+    return None
+
+
+def _offline_pass_key(usuario_id: int, issued: int, expires: int) -> str:
+    secret = _get_checkin_offline_secret()
+    if not secret:
+        raise RuntimeError("Check-in offline deshabilitado: falta CHECKIN_OFFLINE_SECRET")
+    base = f"{int(usuario_id)}|{int(issued)}|{int(expires)}".encode("utf-8")
+    return hmac.new(secret.encode("utf-8"), base, hashlib.sha256).hexdigest()
+
+
+def _offline_deshabilitado() -> Optional[JSONResponse]:
+    if _get_checkin_offline_secret():
+        return None
+    logging.error("Check-in offline deshabilitado: configure CHECKIN_OFFLINE_SECRET (o SESSION_SECRET/SECRET_KEY)")
+    return JSONResponse({"success": False, "message": "Check-in offline no configurado"}, status_code=503)
+
+
+def _verify_offline_scan(scan: Dict[str, Any], now: float) -> Optional[str]:
+    """Devuelve None si el escaneo es auténtico y está dentro de la vigencia del pase; si no, el motivo."""
+    try:
+        usuario_id = int(scan.get("usuario_id"))
+        issued = int(scan.get("issued"))
+        expires = int(scan.get("expires"))
+        ts_ms = int(scan.get("ts"))
+        token = str(scan.get("token") or "")
+        sig = str(scan.get("sig") or "")
+    except (TypeError, ValueError):
+        return "payload_invalido"
+    key = _offline_pass_key(usuario_id, issued, expires)
+    msg = f"{usuario_id}|{token}|{ts_ms}|{issued}|{expires}".encode("utf-8")
+    expected = hmac.new(key.encode("utf-8"), msg, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, sig):
+        return "firma_invalida"
+    ts = ts_ms / 1000.0
+    if ts < issued or ts > expires or ts > now + OFFLINE_CLOCK_SKEW_SECONDS:
+        return "fuera_de_vigencia"
+    return None
+
+
+@router.get("/api/checkin/offline_pass")
+async def api_checkin_offline_pass(request: Request):
+    """Emite el pase offline para el socio autenticado en el kiosco."""
+    deshabilitado = _offline_deshabilitado()
+    if deshabilitado:
+        return deshabilitado
+    socio_id = request.session.get("checkin_user_id")
+    if not socio_id:
+        return JSONResponse({"success": False, "message": "Sesión de socio no encontrada"}, status_code=401)
+    issued = int(time.time())
+    expires = issued + OFFLINE_PASS_TTL_SECONDS
+    return JSONResponse({
+        "success": True,
+        "usuario_id": int(socio_id),
+        "issued": issued,
+        "expires": expires,
+        "key": _offline_pass_key(int(socio_id), issued, expires),
+    }, status_code=200)
+
+
+@router.post("/api/checkin/offline/replay")
+async def api_checkin_offline_replay(
+    request: Request,
+    attendance_service: AttendanceService = Depends(get_attendance_service)
+):
+    """Reprocesa en bloque los escaneos encolados sin conexión.
+
+    Body: { scans: [{ref, usuario_id, token, ts (epoch ms), issued, expires, sig}], rechazar_vencidos?: bool }
+    La autenticidad se valida con la firma de cada escaneo.
+    """
+    rid = getattr(getattr(request, 'state', object()), 'request_id', '-')
+    deshabilitado = _offline_deshabilitado()
+    if deshabilitado:
+        return deshabilitado
+    payload = await request.json()
+    scans = payload.get("scans") or []
+    if not isinstance(scans, list):
+        raise HTTPException(status_code=400, detail="scans debe ser una lista")
+    if len(scans) > OFFLINE_REPLAY_MAX_SCANS:
+        raise HTTPException(status_code=413, detail=f"Máximo {OFFLINE_REPLAY_MAX_SCANS} escaneos por envío")
+    now = time.time()
+    validos: List[Dict[str, Any]] = []
+    rechazados: List[Dict[str, Any]] = []
+    for i, scan in enumerate(scans):
+        scan = scan if isinstance(scan, dict) else {}
+        ref = str(scan.get("ref") or i)
+        motivo = _verify_offline_scan(scan, now)
+        if motivo:
+            rechazados.append({"ref": ref, "usuario_id": scan.get("usuario_id"), "resultado": "rechazado", "motivo": motivo})
+            continue
+        validos.append({
+            "ref": ref,
+            "usuario_id": int(scan["usuario_id"]),
+            "ts": int(scan["ts"]) / 1000.0,
+            "token": str(scan.get("token") or ""),
+        })
+    try:
+        res = attendance_service.replay_offline_checkins(validos, reject_expired=bool(payload.get("rechazar_vencidos", True)))
+        res["rechazados"] = len(rechazados)
+        res["detalle"] = res.get("detalle", []) + rechazados
+        logging.info(
+            f"/api/checkin/offline/replay: recibidos={len(scans)} registrados={res.get('registrados')} "
+            f"duplicados={res.get('duplicados')} conflictos={res.get('conflictos')} rechazados={len(rechazados)} rid={rid}"
+        )
+        return JSONResponse({"success": True, **res}, status_code=200)
+    except Exception as e:
+        logging.exception(f"Error en /api/checkin/offline/replay rid={rid}")
+        return JSONResponse({"success": False, "message": str(e)}, status_code=500)
+
+
 @router.post("/api/checkin/create_token")
 async def api_checkin_create_token(request: Request, _=Depends(require_gestion_access)):
     rid = getattr(getattr(request,'state',object()), 'request_id', '-')
@@ -229,7 +362,7 @@ async def api_asistencias_eliminar(request: Request, _=Depends(require_gestion_a
             if len(parts) == 3:
                 fecha = date(int(parts[0]), int(parts[1]), int(parts[2]))
         else:
-            fecha = date.today()
+            fecha = hoy_gym()
     except Exception:
         fecha = None
     try:
@@ -245,60 +378,179 @@ async def api_asistencias_eliminar(request: Request, _=Depends(require_gestion_a
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@router.post("/api/clases/horarios/{clase_horario_id}/pase_lista")
+async def api_clase_pase_lista(
+    clase_horario_id: int,
+    request: Request,
+    attendance_service: AttendanceService = Depends(get_attendance_service),
+    _=Depends(require_gestion_access)
+):
+    """Pase de lista: registra en una sola transacción a todos los presentes de una clase.
+
+    Body: { usuario_ids: [...], fecha?: YYYY-MM-DD, marcar_ausentes?: bool, permitir_no_inscriptos?: bool }
+    """
+    rid = getattr(getattr(request,'state',object()), 'request_id', '-')
+    payload = await request.json()
+    usuario_ids = payload.get("usuario_ids") or payload.get("presentes") or []
+    if not isinstance(usuario_ids, list):
+        raise HTTPException(status_code=400, detail="usuario_ids debe ser una lista")
+    fecha = None
+    fecha_str = str(payload.get("fecha") or "").strip()
+    if fecha_str:
+        try:
+            fecha = date.fromisoformat(fecha_str)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="fecha inválida (YYYY-MM-DD)")
+    registrado_por = request.session.get("gestion_profesor_user_id") or request.session.get("user_id")
+    try:
+        res = attendance_service.register_class_roll_call(
+            clase_horario_id,
+            usuario_ids,
+            fecha,
+            int(registrado_por) if registrado_por else None,
+            allow_not_enrolled=bool(payload.get("permitir_no_inscriptos", False)),
+            mark_absent=bool(payload.get("marcar_ausentes", False)),
+        )
+        logging.info(
+            f"/api/clases/horarios/{clase_horario_id}/pase_lista: registrados={res.get('registrados')} "
+            f"rechazados={res.get('rechazados')} rid={rid}"
+        )
+        return JSONResponse({"success": True, **res}, status_code=200)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logging.exception(f"Error en /api/clases/horarios/{clase_horario_id}/pase_lista rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
 @router.get("/api/asistencia_30d")
-async def api_asistencia_30d(request: Request, _=Depends(require_owner)):
-    db = get_db()
+async def api_asistencia_30d(
+    request: Request,
+    attendance_service: AttendanceService = Depends(get_attendance_service),
+    _=Depends(require_owner)
+):
     series: Dict[str, int] = {}
-    if db is None:
-        return series
-    guard = _circuit_guard_json(db, "/api/asistencia_30d")
-    if guard:
-        return guard
     try:
         start = request.query_params.get("start")
         end = request.query_params.get("end")
-        if start and end:
-            data = db.obtener_asistencias_por_rango_diario(start, end)  # type: ignore
-        else:
-            data = db.obtener_asistencias_por_dia(30)  # type: ignore
+        data = attendance_service.get_daily_series(start, end)
         for d, c in (data or []):
             series[str(d)] = int(c or 0)
-        try:
-            from datetime import date, timedelta
+        if not (start and end):
             base: Dict[str, int] = {}
-            hoy = date.today()
+            hoy = hoy_gym()
             for i in range(29, -1, -1):
-                dia = hoy - timedelta(days=i)
-                clave = dia.strftime("%Y-%m-%d")
-                base[clave] = 0
-            base.update(series or {})
+                base[(hoy - timedelta(days=i)).strftime("%Y-%m-%d")] = 0
+            base.update(series)
             series = dict(sorted(base.items()))
-        except Exception:
-            pass
         return series
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
 @router.get("/api/asistencia_por_hora_30d")
-async def api_asistencia_por_hora_30d(request: Request, _=Depends(require_owner)):
-    db = get_db()
+async def api_asistencia_por_hora_30d(
+    request: Request,
+    attendance_service: AttendanceService = Depends(get_attendance_service),
+    _=Depends(require_owner)
+):
     series: Dict[str, int] = {}
-    if db is None:
-        return series
-    guard = _circuit_guard_json(db, "/api/asistencia_por_hora_30d")
-    if guard:
-        return guard
     try:
         start = request.query_params.get("start")
         end = request.query_params.get("end")
-        data = db.obtener_asistencias_por_hora(30, start, end)  # type: ignore
+        data = attendance_service.get_hourly_series(start, end)
         for h, c in (data or []):
             series[str(h)] = int(c or 0)
         return series
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
+
+@router.post("/api/asistencias/rollups/reconstruir")
+async def api_asistencias_rollups_reconstruir(
+    request: Request,
+    attendance_service: AttendanceService = Depends(get_attendance_service),
+    _=Depends(require_owner)
+):
+    """Recalcula los rollups de asistencias (completo, o desde `desde`=YYYY-MM-DD)."""
+    rid = getattr(getattr(request,'state',object()), 'request_id', '-')
+    desde = None
+    desde_str = str(request.query_params.get("desde") or "").strip()
+    if desde_str:
+        try:
+            desde = date.fromisoformat(desde_str)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="desde inválido (YYYY-MM-DD)")
+    try:
+        res = attendance_service.rebuild_rollups(desde)
+        logging.info(f"/api/asistencias/rollups/reconstruir: desde={desde} res={res} rid={rid}")
+        return JSONResponse({"success": True, **res}, status_code=200)
+    except Exception as e:
+        logging.exception(f"Error en /api/asistencias/rollups/reconstruir rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+@router.get("/api/asistencias/particiones")
+async def api_asistencias_particiones(
+    attendance_service: AttendanceService = Depends(get_attendance_service),
+    _=Depends(require_owner)
+):
+    """Estado del particionado mensual de asistencias y particiones archivadas."""
+    try:
+        return attendance_service.list_partitions()
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@router.post("/api/asistencias/particiones/mantener")
+async def api_asistencias_particiones_mantener(
+    request: Request,
+    attendance_service: AttendanceService = Depends(get_attendance_service),
+    _=Depends(require_owner)
+):
+    """Crea particiones futuras y archiva las que superan la retención (`retencion_meses`, `destino`=b2|local)."""
+    rid = getattr(getattr(request,'state',object()), 'request_id', '-')
+    qp = request.query_params
+    try:
+        meses = int(qp.get("meses_futuros") or 3)
+        retencion = int(qp.get("retencion_meses")) if qp.get("retencion_meses") else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Parámetros numéricos inválidos")
+    try:
+        res = attendance_service.maintain_partitions(meses, retencion, qp.get("destino"))
+        logging.info(
+            f"/api/asistencias/particiones/mantener: creadas={res['creadas']} "
+            f"archivadas={len(res['archivadas'])} fallidas={res['fallidas']} rid={rid}"
+        )
+        return JSONResponse({"success": True, **res}, status_code=200)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.exception(f"Error en /api/asistencias/particiones/mantener rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+@router.post("/api/asistencias/particiones/migrar")
+async def api_asistencias_particiones_migrar(
+    request: Request,
+    attendance_service: AttendanceService = Depends(get_attendance_service),
+    _=Depends(require_owner)
+):
+    """Migra asistencias a tabla particionada por lotes; con `max_lotes` devuelve `en_progreso` y se reanuda."""
+    rid = getattr(getattr(request,'state',object()), 'request_id', '-')
+    qp = request.query_params
+    try:
+        lote = max(1000, min(int(qp.get("lote") or 20000), 200000))
+        max_lotes = int(qp.get("max_lotes")) if qp.get("max_lotes") else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Parámetros numéricos inválidos")
+    try:
+        res = attendance_service.migrate_to_partitioned(lote, max_lotes)
+        logging.info(f"/api/asistencias/particiones/migrar: res={res} rid={rid}")
+        return JSONResponse({"success": True, **res}, status_code=200)
+    except Exception as e:
+        logging.exception(f"Error en /api/asistencias/particiones/migrar rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
 @router.get("/api/asistencias_hoy_ids")
 async def api_asistencias_hoy_ids(_=Depends(require_gestion_access)):
     db = get_db()
@@ -307,7 +559,7 @@ async def api_asistencias_hoy_ids(_=Depends(require_gestion_access)):
     try:
         with db.get_connection_context() as conn:  # type: ignore
             cur = conn.cursor()
-            cur.execute("SELECT DISTINCT usuario_id FROM asistencias WHERE fecha::date = CURRENT_DATE")
+            cur.execute("SELECT DISTINCT usuario_id FROM asistencias WHERE fecha = %s", (hoy_gym(),))
             rows = cur.fetchall() or []
             out = []
             for r in rows:
@@ -336,13 +588,14 @@ async def api_asistencias_detalle(request: Request, _=Depends(require_owner)):
         offset = request.query_params.get("offset")
         lim = int(limit) if limit and limit.isdigit() else 500
         off = int(offset) if offset and offset.isdigit() else 0
+        desde_30d = rango_ultimos_dias(30).fecha_inicio
         with db.get_connection_context() as conn:  # type: ignore
             cur = conn.cursor()
             if start and end:
                 if q:
                     cur.execute(
                         """
-                        SELECT a.fecha::date, a.hora_registro, u.nombre
+                        SELECT a.fecha, a.hora_registro, u.nombre
                         FROM asistencias a
                         JOIN usuarios u ON u.id = a.usuario_id
                         WHERE a.fecha BETWEEN %s AND %s AND (u.nombre ILIKE %s)
@@ -354,7 +607,7 @@ async def api_asistencias_detalle(request: Request, _=Depends(require_owner)):
                 else:
                     cur.execute(
                         """
-                        SELECT a.fecha::date, a.hora_registro, u.nombre
+                        SELECT a.fecha, a.hora_registro, u.nombre
                         FROM asistencias a
                         JOIN usuarios u ON u.id = a.usuario_id
                         WHERE a.fecha BETWEEN %s AND %s
@@ -367,26 +620,26 @@ async def api_asistencias_detalle(request: Request, _=Depends(require_owner)):
                 if q:
                     cur.execute(
                         """
-                        SELECT a.fecha::date, a.hora_registro, u.nombre
+                        SELECT a.fecha, a.hora_registro, u.nombre
                         FROM asistencias a
                         JOIN usuarios u ON u.id = a.usuario_id
-                        WHERE a.fecha >= CURRENT_DATE - INTERVAL '30 days' AND (u.nombre ILIKE %s)
+                        WHERE a.fecha >= %s AND (u.nombre ILIKE %s)
                         ORDER BY a.fecha DESC, a.hora_registro DESC
                         LIMIT %s OFFSET %s
                         """,
-                        (f"%{q}%", lim, off)
+                        (desde_30d, f"%{q}%", lim, off)
                     )
                 else:
                     cur.execute(
                         """
-                        SELECT a.fecha::date, a.hora_registro, u.nombre
+                        SELECT a.fecha, a.hora_registro, u.nombre
                         FROM asistencias a
                         JOIN usuarios u ON u.id = a.usuario_id
-                        WHERE a.fecha >= CURRENT_DATE - INTERVAL '30 days'
+                        WHERE a.fecha >= %s
                         ORDER BY a.fecha DESC, a.hora_registro DESC
                         LIMIT %s OFFSET %s
                         """,
-                        (lim, off)
+                        (desde_30d, lim, off)
                     )
         rows = []
         for r in cur.fetchall():
@@ -1,5 +1,6 @@
+import io
+import csv
 import logging
-import os
 import json
 from datetime import datetime, timezone, date
 from typing import Optional, List, Dict, Any
@@ -7,28 +8,38 @@ from typing import Optional, List, Dict, Any
 import psycopg2
 import psycopg2.extras
 from fastapi import APIRouter, Request, Depends, HTTPException, status
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
-from apps.webapp.dependencies import get_db, get_pm, require_gestion_access, require_owner
-from apps.webapp.utils import _circuit_guard_json, _apply_change_idempotent, _filter_existing_columns
-from core.models import MetodoPago, Pago
+from apps.webapp.dependencies import get_db, get_pm, get_payment_service, get_receipt_service, get_receipt_batch_service, get_receipt_numbering_service, get_catalog_service, get_payment_export_service, require_gestion_access, require_owner
+from apps.webapp.utils import _circuit_guard_json
+from core.models import Pago
+from core.services import PaymentService, ReceiptService, ReceiptBatchService, ReceiptNumberingService, CatalogService, PaymentExportService
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
-# --- API Metadatos de pago ---
+# --- API Metadatos de pago (catálogos en memoria, ver CatalogService) ---
+
+def _catalogo_response(request: Request, catalog: CatalogService, name: str, build) -> Response:
+    """Respuesta con ETag de la versión del catálogo; 304 si el cliente ya la tiene."""
+    etag = catalog.etag(name)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in (request.headers.get("if-none-match") or ""):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(build(), headers=headers)
+
+@router.get("/api/catalogs")
+async def api_catalogs(request: Request, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
+    """Tipos de cuota, métodos y conceptos de pago (activos e inactivos) en una sola respuesta."""
+    try:
+        return _catalogo_response(request, catalog, "bundle", catalog.get_bundle)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
 
 @router.get("/api/metodos_pago")
-async def api_metodos_pago(_=Depends(require_gestion_access)):
-    db = get_db()
-    if db is None:
-        return []
-    guard = _circuit_guard_json(db, "/api/metodos_pago")
-    if guard:
-        return guard
+async def api_metodos_pago(request: Request, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
     try:
-        rows = db.obtener_metodos_pago(solo_activos=True)  # type: ignore
-        return [
+        return _catalogo_response(request, catalog, "metodos_pago", lambda: [
             {
                 'id': r.get('id'),
                 'nombre': r.get('nombre'),
@@ -37,37 +48,35 @@ async def api_metodos_pago(_=Depends(require_gestion_access)):
                 'comision': r.get('comision'),
                 'icono': r.get('icono'),
             }
-            for r in (rows or [])
-        ]
+            for r in catalog.get_catalog("metodos_pago", only_active=True)
+        ])
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
+def _datos_metodo_pago(payload: Dict[str, Any], existing: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    existing = existing or {}
+    nombre = (payload.get("nombre") or existing.get("nombre") or "").strip()
+    if not nombre:
+        raise HTTPException(status_code=400, detail="'nombre' es obligatorio")
+    color = (payload.get("color") or existing.get("color") or "#3498db").strip() or "#3498db"
+    comision_raw = payload.get("comision")
+    comision = float(comision_raw) if comision_raw is not None else float(existing.get("comision") or 0.0)
+    if comision < 0 or comision > 100:
+        raise HTTPException(status_code=400, detail="'comision' debe estar entre 0 y 100")
+    return {
+        "nombre": nombre,
+        "icono": payload.get("icono") if ("icono" in payload) else existing.get("icono"),
+        "color": color,
+        "comision": comision,
+        "activo": bool(payload.get("activo")) if ("activo" in payload) else bool(existing.get("activo", True)),
+        "descripcion": payload.get("descripcion") if ("descripcion" in payload) else existing.get("descripcion"),
+    }
+
 @router.post("/api/metodos_pago")
-async def api_metodos_pago_create(request: Request, _=Depends(require_gestion_access)):
-    pm = get_pm()
-    db = get_db()
-    if db is None:
-        raise HTTPException(status_code=503, detail="DB no disponible")
-    guard = _circuit_guard_json(db, "/api/metodos_pago[POST]")
-    if guard:
-        return guard
-    if pm is None or MetodoPago is None:
-        raise HTTPException(status_code=503, detail="PaymentManager o modelo MetodoPago no disponible")
+async def api_metodos_pago_create(request: Request, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
     payload = await request.json()
     try:
-        nombre = (payload.get("nombre") or "").strip()
-        if not nombre:
-            raise HTTPException(status_code=400, detail="'nombre' es obligatorio")
-        icono = payload.get("icono")
-        color = (payload.get("color") or "#3498db").strip() or "#3498db"
-        comision_raw = payload.get("comision")
-        comision = float(comision_raw) if comision_raw is not None else 0.0
-        if comision < 0 or comision > 100:
-            raise HTTPException(status_code=400, detail="'comision' debe estar entre 0 y 100")
-        activo = bool(payload.get("activo", True))
-        descripcion = payload.get("descripcion")
-        metodo = MetodoPago(nombre=nombre, icono=icono, color=color, comision=comision, activo=activo, descripcion=descripcion)  # type: ignore
-        new_id = pm.crear_metodo_pago(metodo)
+        new_id = catalog.create_item("metodos_pago", _datos_metodo_pago(payload))
         return {"ok": True, "id": int(new_id)}
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
@@ -79,31 +88,13 @@ async def api_metodos_pago_create(request: Request, _=Depends(require_gestion_ac
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @router.put("/api/metodos_pago/{metodo_id}")
-async def api_metodos_pago_update(metodo_id: int, request: Request, _=Depends(require_gestion_access)):
-    pm = get_pm()
-    db = get_db()
-    if db is None:
-        raise HTTPException(status_code=503, detail="DB no disponible")
-    guard = _circuit_guard_json(db, f"/api/metodos_pago/{metodo_id}[PUT]")
-    if guard:
-        return guard
-    if pm is None or MetodoPago is None:
-        raise HTTPException(status_code=503, detail="PaymentManager o modelo MetodoPago no disponible")
+async def api_metodos_pago_update(metodo_id: int, request: Request, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
     payload = await request.json()
     try:
-        existing = pm.obtener_metodo_pago(int(metodo_id))
+        existing = catalog.get_payment_method(int(metodo_id))
         if not existing:
             raise HTTPException(status_code=404, detail="Método de pago no encontrado")
-        nombre = (payload.get("nombre") or existing.nombre or "").strip() or existing.nombre
-        icono = payload.get("icono") if ("icono" in payload) else existing.icono
-        color = (payload.get("color") or existing.color or "#3498db").strip() or existing.color
-        comision = float(payload.get("comision")) if (payload.get("comision") is not None) else float(existing.comision or 0.0)
-        if comision < 0 or comision > 100:
-            raise HTTPException(status_code=400, detail="'comision' debe estar entre 0 y 100")
-        activo = bool(payload.get("activo")) if ("activo" in payload) else bool(existing.activo)
-        descripcion = payload.get("descripcion") if ("descripcion" in payload) else existing.descripcion
-        metodo = MetodoPago(id=int(metodo_id), nombre=nombre, icono=icono, color=color, comision=comision, activo=activo, descripcion=descripcion)  # type: ignore
-        updated = pm.actualizar_metodo_pago(metodo)
+        updated = catalog.update_item("metodos_pago", int(metodo_id), _datos_metodo_pago(payload, existing))
         if not updated:
             raise HTTPException(status_code=404, detail="No se pudo actualizar el método de pago")
         return {"ok": True, "id": int(metodo_id)}
@@ -117,36 +108,11 @@ async def api_metodos_pago_update(metodo_id: int, request: Request, _=Depends(re
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @router.delete("/api/metodos_pago/{metodo_id}")
-async def api_metodos_pago_delete(metodo_id: int, _=Depends(require_gestion_access)):
-    pm = get_pm()
-    db = get_db()
-    if db is None:
-        raise HTTPException(status_code=503, detail="DB no disponible")
-    guard = _circuit_guard_json(db, f"/api/metodos_pago/{metodo_id}[DELETE]")
-    if guard:
-        return guard
-    pm_ready = (pm is not None)
+async def api_metodos_pago_delete(metodo_id: int, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
     try:
-        if pm_ready:
-            deleted = pm.eliminar_metodo_pago(int(metodo_id))
-            if not deleted:
-                raise HTTPException(status_code=404, detail="No se pudo eliminar el método de pago")
-            return {"ok": True}
-        else:
-            with db.get_connection_context() as conn:  # type: ignore
-                ok = _apply_change_idempotent(
-                    conn,
-                    schema="public",
-                    table="metodos_pago",
-                    operation="DELETE",
-                    key_column="id",
-                    key_value=int(metodo_id),
-                    where=[("id", int(metodo_id))],
-                )
-                if not ok:
-                    raise HTTPException(status_code=404, detail="No se pudo eliminar el método de pago")
-                conn.commit()
-                return {"ok": True}
+        if not catalog.delete_item("metodos_pago", int(metodo_id)):
+            raise HTTPException(status_code=404, detail="No se pudo eliminar el método de pago")
+        return {"ok": True}
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
     except HTTPException:
@@ -156,120 +122,126 @@ async def api_metodos_pago_delete(metodo_id: int, _=Depends(require_gestion_acce
         traceback.print_exc()
         return JSONResponse({"error": str(e)}, status_code=500)
 
+# --- Conceptos de pago ---
+
+@router.get("/api/conceptos_pago")
+async def api_conceptos_pago(request: Request, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
+    try:
+        return _catalogo_response(request, catalog, "conceptos_pago", lambda: catalog.get_catalog("conceptos_pago"))
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+def _datos_concepto_pago(payload: Dict[str, Any], existing: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    existing = existing or {}
+    nombre = (payload.get("nombre") or existing.get("nombre") or "").strip()
+    if not nombre:
+        raise HTTPException(status_code=400, detail="'nombre' es obligatorio")
+    precio_base = float(payload.get("precio_base")) if (payload.get("precio_base") is not None) else float(existing.get("precio_base") or 0.0)
+    if precio_base < 0:
+        raise HTTPException(status_code=400, detail="'precio_base' no puede ser negativo")
+    return {
+        "nombre": nombre,
+        "precio_base": precio_base,
+        "tipo": (payload.get("tipo") or existing.get("tipo") or "fijo").strip() or "fijo",
+        "activo": bool(payload.get("activo")) if ("activo" in payload) else bool(existing.get("activo", True)),
+        "descripcion": payload.get("descripcion") if ("descripcion" in payload) else existing.get("descripcion"),
+    }
+
+@router.post("/api/conceptos_pago")
+async def api_conceptos_pago_create(request: Request, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
+    payload = await request.json()
+    try:
+        new_id = catalog.create_item("conceptos_pago", _datos_concepto_pago(payload))
+        return {"ok": True, "id": int(new_id)}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@router.put("/api/conceptos_pago/{concepto_id}")
+async def api_conceptos_pago_update(concepto_id: int, request: Request, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
+    payload = await request.json()
+    try:
+        existing = next((c for c in catalog.get_catalog("conceptos_pago") if c["id"] == int(concepto_id)), None)
+        if not existing:
+            raise HTTPException(status_code=404, detail="Concepto de pago no encontrado")
+        if not catalog.update_item("conceptos_pago", int(concepto_id), _datos_concepto_pago(payload, existing)):
+            raise HTTPException(status_code=404, detail="Concepto de pago no encontrado")
+        return {"ok": True, "id": int(concepto_id)}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@router.delete("/api/conceptos_pago/{concepto_id}")
+async def api_conceptos_pago_delete(concepto_id: int, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
+    try:
+        if not catalog.delete_item("conceptos_pago", int(concepto_id)):
+            raise HTTPException(status_code=404, detail="Concepto de pago no encontrado")
+        return {"ok": True}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
 # --- Tipos de Cuota (Planes) ---
 
 @router.get("/api/tipos_cuota_activos")
-async def api_tipos_cuota_activos(_=Depends(require_gestion_access)):
-    db = get_db()
-    if db is None:
-        return []
-    guard = _circuit_guard_json(db, "/api/tipos_cuota_activos")
-    if guard:
-        return guard
-    try:
-        tipos = db.obtener_tipos_cuota_activos()  # type: ignore
-        tipos = sorted(tipos or [], key=lambda t: (float(getattr(t, 'precio', 0.0) or 0.0), (getattr(t, 'nombre', '') or '')))
+async def api_tipos_cuota_activos(request: Request, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
+    def build():
+        tipos = sorted(catalog.get_catalog("tipos_cuota", only_active=True), key=lambda t: (t["precio"], t["nombre"]))
         return [
-            {
-                "id": int(getattr(t, 'id')) if getattr(t, 'id') is not None else None,
-                "nombre": (getattr(t, 'nombre', '') or '').strip(),
-                "precio": float(getattr(t, 'precio', 0.0) or 0.0),
-                "duracion_dias": int(getattr(t, 'duracion_dias', 30) or 30),
-                "activo": bool(getattr(t, 'activo', True)),
-            }
+            {k: t[k] for k in ("id", "nombre", "precio", "duracion_dias", "activo")}
             for t in tipos
         ]
+    try:
+        return _catalogo_response(request, catalog, "tipos_cuota", build)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @router.get("/api/tipos_cuota_catalogo")
-async def api_tipos_cuota_catalogo(_=Depends(require_gestion_access)):
-    db = get_db()
-    if db is None:
-        return []
-    guard = _circuit_guard_json(db, "/api/tipos_cuota_catalogo")
-    if guard:
-        return guard
+async def api_tipos_cuota_catalogo(request: Request, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
+    def build():
+        return sorted(catalog.get_catalog("tipos_cuota"), key=lambda t: (0 if t["activo"] else 1, t["precio"], t["nombre"]))
     try:
-        tipos = db.obtener_tipos_cuota(solo_activos=False)  # type: ignore
-        tipos = sorted(tipos or [], key=lambda t: (
-            0 if bool(getattr(t, 'activo', True)) else 1,
-            float(getattr(t, 'precio', 0.0) or 0.0),
-            (getattr(t, 'nombre', '') or '')
-        ))
-        return [
-            {
-                "id": int(getattr(t, 'id')) if getattr(t, 'id') is not None else None,
-                "nombre": (getattr(t, 'nombre', '') or '').strip(),
-                "precio": float(getattr(t, 'precio', 0.0) or 0.0),
-                "duracion_dias": int(getattr(t, 'duracion_dias', 30) or 30),
-                "activo": bool(getattr(t, 'activo', True)),
-                "descripcion": getattr(t, 'descripcion', None),
-                "icono_path": getattr(t, 'icono_path', None),
-            }
-            for t in tipos
-        ]
+        return _catalogo_response(request, catalog, "tipos_cuota", build)
     except Exception as e:
         import traceback
         traceback.print_exc()
         return JSONResponse({"error": str(e)}, status_code=500)
 
+def _datos_tipo_cuota(payload: Dict[str, Any], existing: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    existing = existing or {}
+    nombre = (payload.get("nombre") or existing.get("nombre") or "").strip()
+    if not nombre:
+        raise HTTPException(status_code=400, detail="'nombre' es obligatorio")
+    precio = float(payload.get("precio")) if (payload.get("precio") is not None) else float(existing.get("precio") or 0.0)
+    if precio < 0:
+        raise HTTPException(status_code=400, detail="'precio' no puede ser negativo")
+    duracion_dias = int(payload.get("duracion_dias")) if (payload.get("duracion_dias") is not None) else int(existing.get("duracion_dias") or 30)
+    if duracion_dias <= 0:
+        raise HTTPException(status_code=400, detail="'duracion_dias' debe ser > 0")
+    return {
+        "nombre": nombre,
+        "precio": precio,
+        "duracion_dias": duracion_dias,
+        "activo": bool(payload.get("activo")) if ("activo" in payload) else bool(existing.get("activo", True)),
+        "descripcion": payload.get("descripcion") if ("descripcion" in payload) else existing.get("descripcion"),
+        "icono_path": payload.get("icono_path") if ("icono_path" in payload) else existing.get("icono_path"),
+    }
+
 @router.post("/api/tipos_cuota")
-async def api_tipos_cuota_create(request: Request, _=Depends(require_gestion_access)):
-    db = get_db()
-    if db is None:
-        raise HTTPException(status_code=503, detail="DB no disponible")
-    guard = _circuit_guard_json(db, "/api/tipos_cuota[POST]")
-    if guard:
-        return guard
+async def api_tipos_cuota_create(request: Request, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
     payload = await request.json()
     try:
-        nombre = (payload.get("nombre") or "").strip()
-        if not nombre:
-            raise HTTPException(status_code=400, detail="'nombre' es obligatorio")
-        precio_raw = payload.get("precio")
-        precio = float(precio_raw) if precio_raw is not None else 0.0
-        if precio < 0:
-            raise HTTPException(status_code=400, detail="'precio' no puede ser negativo")
-        duracion_raw = payload.get("duracion_dias")
-        duracion_dias = int(duracion_raw) if duracion_raw is not None else 30
-        if duracion_dias <= 0:
-            raise HTTPException(status_code=400, detail="'duracion_dias' debe ser > 0")
-        activo = bool(payload.get("activo", True))
-        descripcion = payload.get("descripcion")
-        icono_path = payload.get("icono_path")
-        with db.get_connection_context() as conn:  # type: ignore
-            from psycopg2 import sql as _sql
-            data = {
-                "nombre": nombre,
-                "precio": precio,
-                "duracion_dias": duracion_dias,
-                "activo": activo,
-                "descripcion": descripcion,
-                "icono_path": icono_path,
-            }
-            filtered = _filter_existing_columns(conn, "public", "tipos_cuota", data)
-            if not filtered:
-                raise HTTPException(status_code=400, detail="No hay columnas válidas para insertar")
-            cols = list(filtered.keys())
-            stmt = _sql.SQL("INSERT INTO {}.{} ({}) VALUES ({}) RETURNING id").format(
-                _sql.Identifier("public"),
-                _sql.Identifier("tipos_cuota"),
-                _sql.SQL(", ").join([_sql.Identifier(c) for c in cols]),
-                _sql.SQL(", ").join([_sql.Placeholder() for _ in cols]),
-            )
-            cur = conn.cursor()
-            cur.execute(stmt, [filtered[c] for c in cols])
-            new_id_row = cur.fetchone()
-            new_id = int(new_id_row[0]) if new_id_row else None
-            if new_id is None:
-                raise HTTPException(status_code=500, detail="No se pudo crear el tipo de cuota")
-            conn.commit()
-            try:
-                db.cache.invalidate('tipos')  # type: ignore
-            except Exception:
-                pass
-            return {"ok": True, "id": new_id}
+        new_id = catalog.create_item("tipos_cuota", _datos_tipo_cuota(payload))
+        return {"ok": True, "id": int(new_id)}
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
     except HTTPException:
@@ -280,49 +252,15 @@ async def api_tipos_cuota_create(request: Request, _=Depends(require_gestion_acc
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @router.put("/api/tipos_cuota/{tipo_id}")
-async def api_tipos_cuota_update(tipo_id: int, request: Request, _=Depends(require_gestion_access)):
-    db = get_db()
-    if db is None:
-        raise HTTPException(status_code=503, detail="DB no disponible")
-    guard = _circuit_guard_json(db, f"/api/tipos_cuota/{tipo_id}[PUT]")
-    if guard:
-        return guard
+async def api_tipos_cuota_update(tipo_id: int, request: Request, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
     payload = await request.json()
     try:
-        with db.get_connection_context() as conn:  # type: ignore
-            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cur.execute("SELECT id, nombre, precio, duracion_dias, activo, descripcion, icono_path FROM tipos_cuota WHERE id = %s", (int(tipo_id),))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(status_code=404, detail="Tipo de cuota no encontrado")
-        nombre = (payload.get("nombre") or row.get("nombre") or "").strip() or row.get("nombre")
-        precio = float(payload.get("precio")) if (payload.get("precio") is not None) else float(row.get("precio") or 0.0)
-        if precio < 0:
-            raise HTTPException(status_code=400, detail="'precio' no puede ser negativo")
-        duracion_dias = int(payload.get("duracion_dias")) if (payload.get("duracion_dias") is not None) else int(row.get("duracion_dias") or 30)
-        if duracion_dias <= 0:
-            raise HTTPException(status_code=400, detail="'duracion_dias' debe ser > 0")
-        activo = bool(payload.get("activo")) if ("activo" in payload) else bool(row.get("activo"))
-        descripcion = payload.get("descripcion") if ("descripcion" in payload) else row.get("descripcion")
-        icono_path = payload.get("icono_path") if ("icono_path" in payload) else row.get("icono_path")
-        updates = {
-            "nombre": nombre,
-            "precio": precio,
-            "duracion_dias": duracion_dias,
-            "activo": activo,
-            "descripcion": descripcion,
-            "icono_path": icono_path,
-        }
-        with db.get_connection_context() as conn:  # type: ignore
-            ok = _apply_change_idempotent(conn, "public", "tipos_cuota", "UPDATE", {"id": int(tipo_id)}, updates)
-            if not ok:
-                raise HTTPException(status_code=500, detail="No se pudo actualizar el tipo de cuota")
-            conn.commit()
-            try:
-                db.cache.invalidate('tipos')  # type: ignore
-            except Exception:
-                pass
-            return {"ok": True, "id": int(tipo_id)}
+        existing = next((t for t in catalog.get_catalog("tipos_cuota") if t["id"] == int(tipo_id)), None)
+        if not existing:
+            raise HTTPException(status_code=404, detail="Tipo de cuota no encontrado")
+        if not catalog.update_item("tipos_cuota", int(tipo_id), _datos_tipo_cuota(payload, existing)):
+            raise HTTPException(status_code=404, detail="Tipo de cuota no encontrado")
+        return {"ok": True, "id": int(tipo_id)}
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
     except HTTPException:
@@ -333,24 +271,13 @@ async def api_tipos_cuota_update(tipo_id: int, request: Request, _=Depends(requi
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @router.delete("/api/tipos_cuota/{tipo_id}")
-async def api_tipos_cuota_delete(tipo_id: int, _=Depends(require_gestion_access)):
-    db = get_db()
-    if db is None:
-        raise HTTPException(status_code=503, detail="DB no disponible")
-    guard = _circuit_guard_json(db, f"/api/tipos_cuota/{tipo_id}[DELETE]")
-    if guard:
-        return guard
+async def api_tipos_cuota_delete(tipo_id: int, catalog: CatalogService = Depends(get_catalog_service), _=Depends(require_gestion_access)):
     try:
-        with db.get_connection_context() as conn:  # type: ignore
-            ok = _apply_change_idempotent(conn, "public", "tipos_cuota", "DELETE", {"id": int(tipo_id)}, {})
-            if not ok:
-                raise HTTPException(status_code=500, detail="No se pudo eliminar el tipo de cuota")
-            conn.commit()
-            try:
-                db.cache.invalidate('tipos')  # type: ignore
-            except Exception:
-                pass
-            return {"ok": True}
+        if not catalog.delete_item("tipos_cuota", int(tipo_id)):
+            raise HTTPException(status_code=404, detail="Tipo de cuota no encontrado")
+        return {"ok": True}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
     except HTTPException:
         raise
     except Exception as e:
@@ -360,50 +287,80 @@ async def api_tipos_cuota_delete(tipo_id: int, _=Depends(require_gestion_access)
 
 # --- Pagos y Recibos ---
 
+def _parametros_historial(request: Request) -> Dict[str, Any]:
+    """Filtros comunes de los listados de pagos paginados por cursor."""
+    qp = request.query_params
+    def _fecha(nombre: str) -> Optional[date]:
+        raw = (qp.get(nombre) or "").strip()
+        try:
+            return date.fromisoformat(raw[:10]) if raw else None
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"'{nombre}' debe ser YYYY-MM-DD")
+    def _entero(nombre: str) -> Optional[int]:
+        raw = (qp.get(nombre) or "").strip()
+        return int(raw) if raw.isdigit() else None
+    return {
+        "desde": _fecha("start"),
+        "hasta": _fecha("end"),
+        "usuario_id": _entero("usuario_id"),
+        "metodo_pago_id": _entero("metodo_pago_id"),
+        "q": (qp.get("q") or "").strip() or None,
+        "cursor": (qp.get("cursor") or "").strip() or None,
+        "limit": _entero("limit") or 50,
+    }
+
+@router.get("/api/pagos/export")
+async def api_pagos_export(
+    request: Request,
+    export_service: PaymentExportService = Depends(get_payment_export_service),
+    _=Depends(require_gestion_access)
+):
+    """Historial de pagos completo (mismos filtros que /api/pagos_detalle, sin paginar) como
+    ?formato=csv (por defecto) o xlsx, emitido en streaming."""
+    formato = (request.query_params.get("formato") or "csv").strip().lower()
+    try:
+        params = _parametros_historial(request)
+        if formato not in ("csv", "xlsx"):
+            raise ValueError("formato debe ser 'csv' o 'xlsx'")
+    except HTTPException:
+        export_service.close()
+        raise
+    except ValueError as ve:
+        export_service.close()
+        raise HTTPException(status_code=400, detail=str(ve))
+    params.pop("cursor", None)
+    params.pop("limit", None)
+    desde, hasta = params.get("desde"), params.get("hasta")
+    sufijo = f"_{desde.isoformat() if desde else 'inicio'}_{hasta.isoformat() if hasta else 'hoy'}" if (desde or hasta) else ""
+    return StreamingResponse(
+        export_service.stream(formato, params),
+        media_type=("text/csv; charset=utf-8" if formato == "csv"
+                    else "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        headers={
+            "Content-Disposition": f'attachment; filename="pagos{sufijo}.{formato}"',
+            "Cache-Control": "no-store",
+        },
+    )
+
 @router.get("/api/pagos_detalle")
-async def api_pagos_detalle(request: Request, _=Depends(require_gestion_access)):
-    db = get_db()
-    if db is None:
-        return {"count": 0, "items": []}
-    guard = _circuit_guard_json(db, "/api/pagos_detalle")
-    if guard:
-        return guard
+async def api_pagos_detalle(
+    request: Request,
+    payment_service: PaymentService = Depends(get_payment_service),
+    _=Depends(require_gestion_access)
+):
+    """Pagos más recientes primero. Paginación por cursor: pasar `cursor` = next_cursor de la página
+    anterior. `count` es estimado salvo con ?total=exacto (o ?total=no para omitirlo)."""
     try:
-        start = request.query_params.get("start")
-        end = request.query_params.get("end")
-        q = request.query_params.get("q")
-        limit_q = request.query_params.get("limit")
-        offset_q = request.query_params.get("offset")
-        try:
-            limit = int(limit_q) if (limit_q and str(limit_q).isdigit()) else 50
-        except Exception:
-            limit = 50
-        try:
-            offset = int(offset_q) if (offset_q and str(offset_q).isdigit()) else 0
-        except Exception:
-            offset = 0
-        if start and isinstance(start, str) and start.strip() == "":
-            start = None
-        if end and isinstance(end, str) and end.strip() == "":
-            end = None
-
-        rows = db.obtener_pagos_por_fecha(start, end)  # type: ignore
-        items = rows
-        if q and isinstance(q, str) and q.strip() != "":
-            ql = q.lower()
-            def _match(r: Dict[str, Any]) -> bool:
-                try:
-                    nombre = str(r.get("usuario_nombre") or r.get("nombre") or "").lower()
-                    dni = str(r.get("dni") or "").lower()
-                    metodo = str(r.get("metodo_pago") or r.get("metodo") or "").lower()
-                    concepto = str(r.get("concepto_pago") or r.get("concepto") or "").lower()
-                    return (ql in nombre) or (ql in dni) or (ql in metodo) or (ql in concepto)
-                except Exception:
-                    return False
-            items = [r for r in rows if _match(r)]
-        total = len(items)
-        sliced = items[offset:offset+limit]
-        return {"count": total, "items": sliced}
+        params = _parametros_historial(request)
+        modo_total = (request.query_params.get("total") or "estimado").strip().lower()
+        page = payment_service.search_payments(
+            total=modo_total if modo_total in ("estimado", "exacto") else None, **params
+        )
+        return {"count": page["total"], "items": page["items"], "next_cursor": page["next_cursor"]}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -465,7 +422,14 @@ async def api_pago_resumen(pago_id: int, _=Depends(require_gestion_access)):
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @router.get("/api/pagos/{pago_id}/recibo.pdf")
-async def api_pago_recibo_pdf(pago_id: int, request: Request, _=Depends(require_gestion_access)):
+async def api_pago_recibo_pdf(
+    pago_id: int,
+    request: Request,
+    receipt_service: ReceiptService = Depends(get_receipt_service),
+    numbering: ReceiptNumberingService = Depends(get_receipt_numbering_service),
+    catalog: CatalogService = Depends(get_catalog_service),
+    _=Depends(require_gestion_access)
+):
     pm = get_pm()
     db = get_db()
     if db is None:
@@ -473,28 +437,6 @@ async def api_pago_recibo_pdf(pago_id: int, request: Request, _=Depends(require_
     if pm is None:
         raise HTTPException(status_code=503, detail="PaymentManager no disponible")
     try:
-        pago = pm.obtener_pago(int(pago_id))
-        if not pago:
-            raise HTTPException(status_code=404, detail="Pago no encontrado")
-        usuario = db.obtener_usuario_por_id(int(getattr(pago, 'usuario_id', 0)))  # type: ignore
-        if not usuario:
-            raise HTTPException(status_code=404, detail="Usuario del pago no encontrado")
-
-        try:
-            detalles = pm.obtener_detalles_pago(int(pago_id))
-        except Exception:
-            detalles = []
-        subtotal = 0.0
-        try:
-            subtotal = sum(float(getattr(d, 'subtotal', 0.0) or 0.0) for d in (detalles or [])) if detalles else float(getattr(pago, 'monto', 0.0) or 0.0)
-        except Exception:
-            subtotal = float(getattr(pago, 'monto', 0.0) or 0.0)
-        metodo_id = getattr(pago, 'metodo_pago_id', None)
-        try:
-            totales = pm.calcular_total_con_comision(subtotal, metodo_id)
-        except Exception:
-            totales = {"subtotal": subtotal, "comision": 0.0, "total": subtotal}
-
         qp = request.query_params
         preview_mode = False
         try:
@@ -629,6 +571,45 @@ async def api_pago_recibo_pdf(pago_id: int, request: Request, _=Depends(require_
         except Exception:
             detalles_override = None
 
+        # Firma del pago (1 consulta): si ya hay comprobante emitido, se responde desde caché
+        firma = receipt_service.get_receipt_signature(int(pago_id))
+        render_params = {k: qp.get(k) for k in sorted(qp.keys())}
+        render_params["_emitido_por"] = emitido_por
+        numero_comprobante = None
+        if firma:
+            numero_comprobante = firma.get("numero_comprobante")
+            numero_clave = numero_override if numero_override else numero_comprobante
+            if preview_mode or numero_comprobante:
+                cache_key = receipt_service.cache_key(firma, numero_clave, render_params)
+                etag = receipt_service.etag_for(cache_key)
+                if etag in (request.headers.get("if-none-match") or ""):
+                    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+                cached = receipt_service.get_cached(cache_key)
+                if cached is not None:
+                    return _recibo_pdf_response(cached, pago_id, etag)
+
+        pago = pm.obtener_pago(int(pago_id))
+        if not pago:
+            raise HTTPException(status_code=404, detail="Pago no encontrado")
+        usuario = db.obtener_usuario_por_id(int(getattr(pago, 'usuario_id', 0)))  # type: ignore
+        if not usuario:
+            raise HTTPException(status_code=404, detail="Usuario del pago no encontrado")
+
+        try:
+            detalles = pm.obtener_detalles_pago(int(pago_id))
+        except Exception:
+            detalles = []
+        subtotal = 0.0
+        try:
+            subtotal = sum(float(getattr(d, 'subtotal', 0.0) or 0.0) for d in (detalles or [])) if detalles else float(getattr(pago, 'monto', 0.0) or 0.0)
+        except Exception:
+            subtotal = float(getattr(pago, 'monto', 0.0) or 0.0)
+        metodo_id = getattr(pago, 'metodo_pago_id', None)
+        try:
+            totales = catalog.get_totals_with_commission(subtotal, metodo_id)
+        except Exception:
+            totales = {"subtotal": subtotal, "comision": 0.0, "total": subtotal}
+
         try:
             sub_o = qp.get("subtotal")
             com_o = qp.get("comision")
@@ -641,59 +622,32 @@ async def api_pago_recibo_pdf(pago_id: int, request: Request, _=Depends(require_
         except Exception:
             pass
 
-        numero_comprobante = None
-        comprobante_id = None
-        try:
-            with db.get_connection_context() as conn:  # type: ignore
-                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                cur.execute(
-                    """
-                    SELECT id, numero_comprobante
-                    FROM comprobantes_pago
-                    WHERE pago_id = %s AND estado = 'emitido'
-                    ORDER BY fecha_creacion DESC
-                    LIMIT 1
-                    """,
-                    (int(pago_id),)
-                )
-                row = cur.fetchone()
-                if row:
-                    comprobante_id = int(row.get("id"))
-                    numero_comprobante = row.get("numero_comprobante")
-        except Exception:
-            numero_comprobante = None
-
         if preview_mode:
             if numero_override:
                 numero_comprobante = numero_override
         else:
             try:
                 if not numero_comprobante:
-                    comprobante_id = db.crear_comprobante(
-                        tipo_comprobante='recibo',
-                        pago_id=int(pago_id),
-                        usuario_id=int(getattr(pago, 'usuario_id', 0)),
-                        monto_total=float(getattr(pago, 'monto', 0.0) or 0.0),
-                        plantilla_id=None,
-                        datos_comprobante=None,
-                        emitido_por=emitido_por
+                    # Número y comprobante se confirman antes del render: no queda ningún lock tomado
+                    comp = numbering.issue_receipt(
+                        int(pago_id),
+                        int(getattr(pago, 'usuario_id', 0)),
+                        float(getattr(pago, 'monto', 0.0) or 0.0),
+                        issued_by=emitido_por,
+                        pdf_path=f"/api/pagos/{int(pago_id)}/recibo.pdf",
                     )
-                    comp = db.obtener_comprobante(int(comprobante_id))
-                    if comp:
-                        numero_comprobante = comp.get('numero_comprobante')
+                    numero_comprobante = comp.get('numero_comprobante')
                 if numero_override:
                     numero_comprobante = numero_override
-            except Exception:
+            except Exception as e:
+                logger.error(f"Error emitiendo comprobante del pago {pago_id}: {e}")
                 numero_comprobante = None
 
-        try:
-            from apps.core.pdf_generator import PDFGenerator
-        except ImportError:
-            # If apps.core is not in path directly, assume it is available via sys.path from dependencies
-            from core.pdf_generator import PDFGenerator
+        cache_key = None
+        if firma and numero_comprobante:
+            cache_key = receipt_service.cache_key(firma, numero_comprobante, render_params)
 
-        pdfg = PDFGenerator()
-        filepath = pdfg.generar_recibo(
+        pdf_bytes = receipt_service.render(cache_key, lambda pdfg: pdfg.generar_recibo_bytes(
             pago,
             usuario,
             numero_comprobante,
@@ -705,7 +659,7 @@ async def api_pago_recibo_pdf(pago_id: int, request: Request, _=Depends(require_
             gym_name=gym_name_override,
             gym_address=gym_address_override,
             fecha_emision=fecha_emision_disp,
-            metodo_pago=metodo_override,
+            metodo_pago=metodo_override or (catalog.get_payment_method(metodo_id) or {}).get('nombre'),
             usuario_nombre=usuario_nombre_override,
             usuario_dni=usuario_dni_override,
             detalles_override=detalles_override,
@@ -714,64 +668,161 @@ async def api_pago_recibo_pdf(pago_id: int, request: Request, _=Depends(require_
             mostrar_dni=mostrar_dni,
             tipo_cuota=tipo_cuota_override,
             periodo=periodo_override,
-        )
+        ))
+
+        etag = receipt_service.etag_for(cache_key) if cache_key else None
+        return _recibo_pdf_response(pdf_bytes, pago_id, etag)
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+def _recibo_pdf_response(pdf_bytes: bytes, pago_id: int, etag: Optional[str] = None) -> Response:
+    headers = {
+        "Content-Disposition": f'inline; filename="recibo_{int(pago_id)}.pdf"',
+        "Cache-Control": "private, no-cache",
+    }
+    if etag:
+        headers["ETag"] = etag
+    return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
+
+
+def _filtro_recibos_lote(params: Dict[str, Any]) -> Dict[str, Any]:
+    def _fecha(v):
+        return date.fromisoformat(str(v).strip()) if v not in (None, "") else None
+
+    def _entero(v):
+        return int(v) if v not in (None, "") else None
+
+    try:
+        pago_ids = params.get("pago_ids")
+        if isinstance(pago_ids, str):
+            pago_ids = [x for x in pago_ids.split(",") if x.strip()]
+        filtro = {
+            "desde": _fecha(params.get("desde")),
+            "hasta": _fecha(params.get("hasta")),
+            "usuario_id": _entero(params.get("usuario_id")),
+            "metodo_pago_id": _entero(params.get("metodo_pago_id")),
+            "pago_ids": [int(x) for x in pago_ids] if pago_ids else None,
+        }
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Filtro inválido (fechas YYYY-MM-DD, ids enteros)")
+    if not any(filtro.values()):
+        raise HTTPException(status_code=400, detail="Indicar un rango de fechas o algún filtro de pagos")
+    return filtro
 
-        try:
-            if comprobante_id is not None and filepath:
-                with db.get_connection_context() as conn:  # type: ignore
-                    cur = conn.cursor()
-                    cur.execute(
-                        "UPDATE comprobantes_pago SET archivo_pdf = %s WHERE id = %s",
-                        (str(filepath), int(comprobante_id))
-                    )
-                    conn.commit()
-        except Exception:
-            pass
 
-        filename = os.path.basename(filepath)
-        resp = FileResponse(filepath, media_type="application/pdf")
+@router.api_route("/api/recibos/lote", methods=["GET", "POST"])
+async def api_recibos_lote(
+    request: Request,
+    batch_service: ReceiptBatchService = Depends(get_receipt_batch_service),
+    _=Depends(require_gestion_access)
+):
+    """Descarga de recibos en bloque: ZIP (un PDF por pago) o un único PDF combinado.
+
+    Filtros: desde/hasta (YYYY-MM-DD), usuario_id, metodo_pago_id, pago_ids. El progreso se
+    consulta en /api/recibos/lote/{job_id} (header X-Job-Id, o job_id propio en el pedido).
+    """
+    params: Dict[str, Any] = dict(request.query_params)
+    if request.method == "POST":
         try:
-            resp.headers["Content-Disposition"] = f'inline; filename="{filename}"'
+            body = await request.json()
+            if isinstance(body, dict):
+                params.update(body)
         except Exception:
             pass
-        return resp
+    formato = str(params.get("formato") or "zip").strip().lower()
+    try:
+        filtro = _filtro_recibos_lote(params)
+        trabajo = batch_service.start_job(formato, filtro, (str(params.get("job_id")).strip() or None) if params.get("job_id") else None)
     except HTTPException:
+        batch_service.close()
         raise
+    except ValueError as e:
+        batch_service.close()
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        batch_service.close()
+        logger.error(f"Error iniciando recibos en lote: {e}")
         return JSONResponse({"error": str(e)}, status_code=500)
+    if trabajo.total == 0:
+        batch_service.close()
+        trabajo.finalizar("completado")
+        return JSONResponse({"error": "No hay pagos para el filtro indicado", **trabajo.to_dict()}, status_code=404)
+    nombre = f"recibos_{trabajo.id[:8]}.{formato}"
+    return StreamingResponse(
+        batch_service.stream(trabajo, filtro),
+        media_type="application/zip" if formato == "zip" else "application/pdf",
+        headers={
+            "Content-Disposition": f'attachment; filename="{nombre}"',
+            "Cache-Control": "no-store",
+            "X-Job-Id": trabajo.id,
+            "X-Total-Recibos": str(trabajo.total),
+        },
+    )
+
+
+@router.get("/api/recibos/lote/{job_id}")
+async def api_recibos_lote_progreso(job_id: str, _=Depends(require_gestion_access)):
+    trabajo = ReceiptBatchService.get_job(job_id)
+    if trabajo is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return trabajo.to_dict()
+
+
+@router.post("/api/recibos/lote/{job_id}/cancelar")
+async def api_recibos_lote_cancelar(job_id: str, _=Depends(require_gestion_access)):
+    if not ReceiptBatchService.cancel_job(job_id):
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return ReceiptBatchService.get_job(job_id).to_dict()
 
 @router.get("/api/recibos/numero-proximo")
-async def api_recibos_numero_proximo(_=Depends(require_gestion_access)):
-    db = get_db()
-    if db is None:
-        raise HTTPException(status_code=503, detail="DB no disponible")
+async def api_recibos_numero_proximo(
+    numbering: ReceiptNumberingService = Depends(get_receipt_numbering_service),
+    _=Depends(require_gestion_access)
+):
     try:
-        numero = db.get_next_receipt_number()
-        return {"numero": str(numero)}
+        return {"numero": numbering.peek_next_number()}
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @router.get("/api/recibos/config")
-async def api_recibos_config_get(_=Depends(require_gestion_access)):
-    db = get_db()
-    if db is None:
-        raise HTTPException(status_code=503, detail="DB no disponible")
+async def api_recibos_config_get(
+    numbering: ReceiptNumberingService = Depends(get_receipt_numbering_service),
+    _=Depends(require_gestion_access)
+):
+    try:
+        return numbering.get_config()
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@router.get("/api/recibos/numeracion/huecos")
+async def api_recibos_numeracion_huecos(
+    request: Request,
+    numbering: ReceiptNumberingService = Depends(get_receipt_numbering_service),
+    _=Depends(require_owner)
+):
+    """Control de la numeración: huecos y duplicados del período (?periodo=AAAA, 0 sin reinicio anual)."""
     try:
-        cfg = db.get_receipt_numbering_config()
-        return cfg
+        periodo = request.query_params.get("periodo")
+        return numbering.find_gaps(int(periodo) if periodo not in (None, "") else None)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="periodo inválido")
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @router.put("/api/recibos/config")
-async def api_recibos_config_put(request: Request, _=Depends(require_gestion_access)):
-    db = get_db()
-    if db is None:
-        raise HTTPException(status_code=503, detail="DB no disponible")
+async def api_recibos_config_put(
+    request: Request,
+    numbering: ReceiptNumberingService = Depends(get_receipt_numbering_service),
+    _=Depends(require_gestion_access)
+):
     try:
         payload = await request.json()
-        ok = db.save_receipt_numbering_config(payload)
+        ok = numbering.save_config(payload if isinstance(payload, dict) else {})
         if ok:
             return {"ok": True}
         return JSONResponse({"error": "No se pudo guardar la configuración"}, status_code=400)
@@ -1037,53 +1088,112 @@ async def api_pagos_delete(pago_id: int, _=Depends(require_gestion_access)):
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @router.get("/api/usuario_pagos")
-async def api_usuario_pagos(request: Request, _=Depends(require_owner)):
-    """Lista de pagos reales de un usuario con soporte de búsqueda y paginación."""
-    db = get_db()
-    if db is None:
-        return []
+async def api_usuario_pagos(
+    request: Request,
+    payment_service: PaymentService = Depends(get_payment_service),
+    _=Depends(require_owner)
+):
+    """Pagos de un usuario con búsqueda y paginación por cursor ({items, next_cursor})."""
     try:
-        usuario_id = request.query_params.get("usuario_id")
-        q = request.query_params.get("q")
-        limit = request.query_params.get("limit")
-        offset = request.query_params.get("offset")
-        if not usuario_id:
-            return []
-        lim = int(limit) if limit and limit.isdigit() else 50
-        off = int(offset) if offset and offset.isdigit() else 0
-        with db.get_connection_context() as conn:  # type: ignore
-            cur = conn.cursor()
-            if q:
-                cur.execute(
-                    """
-                    SELECT p.fecha_pago::date, p.monto, COALESCE(u.tipo_cuota,'')
-                    FROM pagos p
-                    JOIN usuarios u ON u.id = p.usuario_id
-                    WHERE p.usuario_id = %s AND (u.tipo_cuota ILIKE %s)
-                    ORDER BY p.fecha_pago DESC
-                    LIMIT %s OFFSET %s
-                    """,
-                    (int(usuario_id), f"%{q}%", lim, off)
-                )
+        params = _parametros_historial(request)
+        if not params["usuario_id"]:
+            return {"items": [], "next_cursor": None}
+        page = payment_service.search_payments(**params)
+        return {
+            "items": [
+                {
+                    "id": r["id"],
+                    "fecha": r["fecha_pago"].date().isoformat() if r.get("fecha_pago") else None,
+                    "monto": r["monto"],
+                    "tipo_cuota": r.get("tipo_cuota") or "",
+                    "metodo_pago": r.get("metodo_pago"),
+                }
+                for r in page["items"]
+            ],
+            "next_cursor": page["next_cursor"],
+        }
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@router.post("/api/usuarios/estados/recalcular")
+async def api_usuarios_estados_recalcular(request: Request, _=Depends(require_owner)):
+    """Recalcula vencimientos, cuotas vencidas y bajas por morosidad en bloque.
+
+    Body opcional: {"usuario_ids": [...], "solo_activos": bool}. Devuelve sólo los usuarios que cambiaron.
+    """
+    pm = get_pm()
+    if pm is None:
+        raise HTTPException(status_code=503, detail="PaymentManager no disponible")
+    try:
+        payload = await request.json()
+    except Exception:
+        payload = {}
+    payload = payload if isinstance(payload, dict) else {}
+    usuario_ids = payload.get("usuario_ids")
+    if usuario_ids is not None:
+        try:
+            usuario_ids = [int(x) for x in usuario_ids]
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="usuario_ids inválido")
+    try:
+        cambios = pm.recalcular_estados_usuarios(usuario_ids, solo_activos=bool(payload.get("solo_activos")))
+        return {
+            "ok": True,
+            "actualizados": len(cambios),
+            "desactivados": sum(1 for c in cambios if c["desactivado"]),
+            "cambios": cambios,
+        }
+    except Exception as e:
+        logger.exception("Error recalculando estados de usuarios")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@router.post("/api/pagos/importar")
+async def api_pagos_importar(
+    request: Request,
+    payment_service: PaymentService = Depends(get_payment_service),
+    _=Depends(require_owner)
+):
+    """Importación masiva de pagos.
+
+    Acepta JSON {"pagos": [...], "omitir_duplicados": bool, "crear_metodos": bool} o un CSV
+    (text/csv) con encabezados usuario_id|dni, monto, mes, año, fecha_pago, metodo_pago.
+    Devuelve contadores y un reporte de errores por fila.
+    """
+    rid = getattr(getattr(request, 'state', object()), 'request_id', '-')
+    ctype = (request.headers.get("content-type") or "").lower()
+    qp = request.query_params
+    omitir = str(qp.get("omitir_duplicados") or "").lower() in ("1", "true", "yes")
+    crear = str(qp.get("crear_metodos") or "").lower() in ("1", "true", "yes")
+    try:
+        if "text/csv" in ctype:
+            raw = (await request.body()).decode("utf-8-sig", errors="replace")
+            items = list(csv.DictReader(io.StringIO(raw)))
+        else:
+            payload = await request.json()
+            if isinstance(payload, dict):
+                items = payload.get("pagos") or []
+                omitir = bool(payload.get("omitir_duplicados", omitir))
+                crear = bool(payload.get("crear_metodos", crear))
             else:
-                cur.execute(
-                    """
-                    SELECT p.fecha_pago::date, p.monto, COALESCE(u.tipo_cuota,'')
-                    FROM pagos p
-                    JOIN usuarios u ON u.id = p.usuario_id
-                    WHERE p.usuario_id = %s
-                    ORDER BY p.fecha_pago DESC
-                    LIMIT %s OFFSET %s
-                    """,
-                    (int(usuario_id), lim, off)
-                )
-            rows = []
-            for r in cur.fetchall():
-                rows.append({
-                    "fecha": str(r[0]) if r[0] is not None else None,
-                    "monto": float(r[1] or 0),
-                    "tipo_cuota": r[2],
-                })
-        return rows
+                items = payload
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cuerpo inválido (JSON o CSV)")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="Sin pagos para importar")
+    if len(items) > 200000:
+        raise HTTPException(status_code=413, detail="Máximo 200000 pagos por importación")
+    try:
+        res = payment_service.import_payments(items, skip_duplicates=omitir, auto_create_methods=crear)
+        logger.info(
+            f"/api/pagos/importar: total={res['total']} insertados={res['insertados']} "
+            f"actualizados={res['actualizados']} errores={len(res['errores'])} rid={rid}"
+        )
+        return JSONResponse({"ok": True, **res})
     except Exception as e:
+        logger.exception(f"Error en /api/pagos/importar rid={rid}")
         return JSONResponse({"error": str(e)}, status_code=500)
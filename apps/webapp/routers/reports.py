@@ -1,10 +1,13 @@
 import logging
-from typing import Optional, Dict, Any
-from fastapi import APIRouter, Request, Depends
+from datetime import date
+from typing import Optional, Dict, Any, List, Tuple
+from fastapi import APIRouter, Request, Depends, HTTPException
 from fastapi.responses import JSONResponse
 
-from apps.webapp.dependencies import get_db, require_gestion_access
+from apps.webapp.dependencies import get_db, get_payment_service, require_gestion_access, require_owner
 from apps.webapp.utils import _circuit_guard_json
+from core.services import PaymentService
+from core.database.date_ranges import hoy_gym, rango_ultimos_meses
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -23,44 +26,45 @@ async def api_kpis(_=Depends(require_gestion_access)):
         # Fallback: use repository if available via db property or method
         if hasattr(db, 'gym') and hasattr(db.gym, 'obtener_kpis_principales'):
              return db.gym.obtener_kpis_principales()
+        if hasattr(db, 'reportes'):
+             return db.reportes.obtener_kpis_generales()
         return {}
     except Exception as e:
         logger.error(f"Error /api/kpis: {e}")
         return JSONResponse({"error": str(e)}, status_code=500)
 
+def _meses_serie(request: Request) -> List[date]:
+    """Primer día de cada mes entre start/end (YYYY-MM-DD) o de los últimos 12 meses."""
+    try:
+        start = date.fromisoformat(str(request.query_params.get("start") or "").strip())
+        end = date.fromisoformat(str(request.query_params.get("end") or "").strip())
+    except ValueError:
+        end = hoy_gym()
+        start = rango_ultimos_meses(12).fecha_inicio
+    if end < start:
+        start, end = end, start
+    inicio, fin = start.year * 12 + start.month - 1, end.year * 12 + end.month - 1
+    return [date(m // 12, m % 12 + 1, 1) for m in range(inicio, fin + 1)][-60:]
+
+
+def _serie_ingresos(request: Request, payment_service: PaymentService) -> Tuple[List[str], Dict[str, Dict[str, Any]]]:
+    meses = _meses_serie(request)
+    filas = payment_service.get_monthly_revenue(meses[0], meses[-1])
+    return [m.strftime("%Y-%m") for m in meses], {f"{f['año']:04d}-{f['mes']:02d}": f for f in filas}
+
+
 @router.get("/api/ingresos12m")
-async def api_ingresos12m(_=Depends(require_gestion_access)):
-    db = get_db()
-    if db is None:
-        return {}
-    guard = _circuit_guard_json(db, "/api/ingresos12m")
-    if guard:
-        return guard
+async def api_ingresos12m(
+    request: Request,
+    payment_service: PaymentService = Depends(get_payment_service),
+    _=Depends(require_gestion_access)
+):
+    """Ingresos por mes desde el resumen de ingresos (ingresos_mensuales)."""
     try:
-        # Logic from legacy server or PaymentManager
-        # Assuming logic was moved to PaymentManager or Repository
-        if hasattr(db, 'obtener_ingresos_ultimos_12_meses'):
-            return db.obtener_ingresos_ultimos_12_meses()
-        # Try payment repository
-        if hasattr(db, 'pagos') and hasattr(db.pagos, 'obtener_ingresos_ultimos_12_meses'):
-             return db.pagos.obtener_ingresos_ultimos_12_meses()
-        # Try PaymentManager if available in dependencies?
-        # For now, return empty dict or implement query directly if repos don't have it
-        # Implementing direct query as fallback based on standard logic
-        with db.get_connection_context() as conn:
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT 
-                    TO_CHAR(fecha_pago, 'YYYY-MM') as mes, 
-                    SUM(monto) as total 
-                FROM pagos 
-                WHERE fecha_pago >= DATE_TRUNC('month', CURRENT_DATE - INTERVAL '11 months')
-                GROUP BY TO_CHAR(fecha_pago, 'YYYY-MM') 
-                ORDER BY mes
-            """)
-            rows = cur.fetchall()
-            return {row[0]: float(row[1]) for row in rows}
+        claves, por_mes = _serie_ingresos(request, payment_service)
+        return {"ingresos": {k: (por_mes[k]["total"] if k in por_mes else 0.0) for k in claves}}
     except Exception as e:
+        logger.error(f"Error /api/ingresos12m: {e}")
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @router.get("/api/nuevos12m")
@@ -89,9 +93,91 @@ async def api_nuevos12m(_=Depends(require_gestion_access)):
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @router.get("/api/arpu12m")
-async def api_arpu12m(_=Depends(require_gestion_access)):
-    # Placeholder for ARPU logic
-    return {}
+async def api_arpu12m(
+    request: Request,
+    payment_service: PaymentService = Depends(get_payment_service),
+    _=Depends(require_gestion_access)
+):
+    """ARPU mensual (ingresos / pagadores distintos del mes) desde el resumen de ingresos."""
+    try:
+        claves, por_mes = _serie_ingresos(request, payment_service)
+        arpu = {}
+        for k in claves:
+            f = por_mes.get(k)
+            arpu[k] = round(f["total"] / f["pagadores"], 2) if f and f["pagadores"] else 0.0
+        return {"arpu": arpu}
+    except Exception as e:
+        logger.error(f"Error /api/arpu12m: {e}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@router.get("/api/ingresos/desglose")
+async def api_ingresos_desglose(
+    request: Request,
+    payment_service: PaymentService = Depends(get_payment_service),
+    _=Depends(require_gestion_access)
+):
+    """Ingresos de un mes (mes=YYYY-MM, por defecto el actual) por método de pago y tipo de cuota."""
+    hoy = hoy_gym()
+    try:
+        año, mes = (int(x) for x in str(request.query_params.get("mes") or hoy.strftime("%Y-%m")).split("-"))
+        date(año, mes, 1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="mes inválido (YYYY-MM)")
+    try:
+        return {"año": año, "mes": mes, "celdas": payment_service.get_revenue_breakdown(año, mes)}
+    except Exception as e:
+        logger.error(f"Error /api/ingresos/desglose: {e}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+def _desde_param(request: Request) -> Optional[date]:
+    desde_str = str(request.query_params.get("desde") or "").strip()
+    if not desde_str:
+        return None
+    try:
+        return date.fromisoformat(desde_str)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="desde inválido (YYYY-MM-DD)")
+
+@router.get("/api/ingresos/resumen/verificar")
+async def api_ingresos_resumen_verificar(
+    request: Request,
+    payment_service: PaymentService = Depends(get_payment_service),
+    _=Depends(require_owner)
+):
+    """Compara el resumen de ingresos contra pagos. Con reparar=1 reconstruye desde el primer mes con diferencias."""
+    rid = getattr(getattr(request,'state',object()), 'request_id', '-')
+    desde = _desde_param(request)
+    reparar = str(request.query_params.get("reparar") or "").lower() in ("1", "true", "yes")
+    try:
+        diferencias = payment_service.verify_revenue_summary(desde)
+        res: Dict[str, Any] = {"consistente": not diferencias, "diferencias": diferencias}
+        if diferencias and reparar:
+            primero = diferencias[0]
+            res["reconstruccion"] = payment_service.rebuild_revenue_summary(date(primero["año"], primero["mes"], 1))
+            res["consistente"] = not payment_service.verify_revenue_summary(desde)
+        if diferencias:
+            logger.warning(f"/api/ingresos/resumen/verificar: {len(diferencias)} diferencias reparar={reparar} rid={rid}")
+        return res
+    except Exception as e:
+        logger.exception(f"Error en /api/ingresos/resumen/verificar rid={rid}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@router.post("/api/ingresos/resumen/reconstruir")
+async def api_ingresos_resumen_reconstruir(
+    request: Request,
+    payment_service: PaymentService = Depends(get_payment_service),
+    _=Depends(require_owner)
+):
+    """Recalcula el resumen de ingresos desde pagos (completo, o desde `desde`=YYYY-MM-DD)."""
+    rid = getattr(getattr(request,'state',object()), 'request_id', '-')
+    desde = _desde_param(request)
+    try:
+        res = payment_service.rebuild_revenue_summary(desde)
+        logger.info(f"/api/ingresos/resumen/reconstruir: desde={desde} res={res} rid={rid}")
+        return JSONResponse({"success": True, **res}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error en /api/ingresos/resumen/reconstruir rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
 
 @router.get("/api/activos_inactivos")
 async def api_activos_inactivos(_=Depends(require_gestion_access)):
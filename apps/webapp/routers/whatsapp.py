@@ -1,15 +1,23 @@
 import logging
 import os
 import json
-from typing import Optional, List, Dict, Any
+from datetime import datetime
+from typing import Optional, List, Dict
 
 import psycopg2
 import psycopg2.extras
-from fastapi import APIRouter, Request, Depends, HTTPException, status, Response
+from fastapi import APIRouter, BackgroundTasks, Request, Depends, HTTPException, status, Response
 from fastapi.responses import JSONResponse
 
-from apps.webapp.dependencies import get_db, get_pm, require_gestion_access, require_owner
+from apps.webapp.dependencies import (
+    get_db, get_pm, require_gestion_access, require_owner, get_whatsapp_retention_service
+)
 from apps.webapp.utils import _circuit_guard_json, get_gym_name
+from core.whatsapp_webhook import WebhookIngestor, verificar_firma
+from core.antispam import MotorAntispam
+from core.whatsapp_campaigns import MotorCampanias
+from core.database.telefonos import ResolutorTelefonos, normalizar_telefono
+from core.services.whatsapp_retention_service import WhatsappRetentionService
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -50,7 +58,7 @@ async def api_whatsapp_stats(_=Depends(require_gestion_access)):
 
 @router.get("/api/whatsapp/pendings")
 async def api_whatsapp_pendings(request: Request, _=Depends(require_gestion_access)):
-    pm = get_pm()
+    """Último mensaje fallido por teléfono en los últimos `dias` días (ver obtener_pendientes_fallidos)."""
     db = get_db()
     if db is None:
         return JSONResponse({"items": []})
@@ -68,45 +76,10 @@ async def api_whatsapp_pendings(request: Request, _=Depends(require_gestion_acce
             limite = int(limite_param) if limite_param else 200
         except Exception:
             limite = 200
-        interval_str = f"{dias} days"
-        items: list[dict[str, Any]] = []
-        with db.get_connection_context() as conn:  # type: ignore
-            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cur.execute(
-                """
-                SELECT DISTINCT ON (wm.phone_number)
-                       wm.id,
-                       wm.user_id,
-                       COALESCE(u.nombre,'') AS usuario_nombre,
-                       COALESCE(u.telefono,'') AS usuario_telefono,
-                       wm.phone_number,
-                       wm.message_type,
-                       wm.template_name,
-                       wm.message_content,
-                       wm.status,
-                       wm.message_id,
-                       wm.sent_at AS fecha_envio
-                FROM whatsapp_messages wm
-                LEFT JOIN usuarios u ON u.id = wm.user_id
-                WHERE wm.status = 'failed'
-                  AND wm.sent_at >= CURRENT_TIMESTAMP - (%s::interval)
-                ORDER BY wm.phone_number, wm.sent_at DESC
-                LIMIT %s
-                """,
-                (interval_str, limite)
-            )
-            for row in cur.fetchall() or []:
-                try:
-                    r = dict(row)
-                except Exception:
-                    r = row  # type: ignore
-                # Asegurar serialización de fecha
-                if r.get("fecha_envio") is not None:
-                    try:
-                        r["fecha_envio"] = str(r["fecha_envio"])  # ISO-like
-                    except Exception:
-                        pass
-                items.append(r)
+        items = db.whatsapp.obtener_pendientes_fallidos(dias, limite)
+        for r in items:
+            if r.get("fecha_envio") is not None:
+                r["fecha_envio"] = str(r["fecha_envio"])
         return {"items": items}
     except Exception as e:
         import traceback; traceback.print_exc()
@@ -194,9 +167,23 @@ async def api_whatsapp_retry(request: Request, _=Depends(require_owner)):
         import traceback; traceback.print_exc()
         return JSONResponse({"success": False, "error": str(e)}, status_code=500)
 
+@router.get("/api/whatsapp/outbox")
+async def api_whatsapp_outbox(_=Depends(require_gestion_access)):
+    """Mensajes del outbox por estado (pendiente, enviando, enviado, fallido)."""
+    db = get_db()
+    if db is None:
+        return JSONResponse({"error": "DB no disponible"}, status_code=503)
+    guard = _circuit_guard_json(db, "/api/whatsapp/outbox")
+    if guard:
+        return guard
+    try:
+        return db.whatsapp.resumen_outbox()
+    except Exception as e:
+        logger.error(f"Error /api/whatsapp/outbox: {e}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
 @router.post("/api/whatsapp/clear_failures")
 async def api_whatsapp_clear_failures(request: Request, _=Depends(require_owner)):
-    pm = get_pm()
     db = get_db()
     if db is None:
         return JSONResponse({"success": False, "message": "DB no disponible"}, status_code=503)
@@ -214,65 +201,199 @@ async def api_whatsapp_clear_failures(request: Request, _=Depends(require_owner)
             dias = int(dias_param) if dias_param is not None else 30
         except Exception:
             dias = 30
-        interval_str = f"{dias} days"
-
-        total_deleted = 0
-        phones: list[str] = []
-        with db.get_connection_context() as conn:  # type: ignore
-            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            if telefono:
-                cur.execute(
-                    """
-                    DELETE FROM whatsapp_messages
-                    WHERE phone_number = %s AND status = 'failed'
-                      AND sent_at >= CURRENT_TIMESTAMP - (%s::interval)
-                    """,
-                    (telefono, interval_str)
-                )
-                try:
-                    total_deleted = int(cur.rowcount or 0)
-                except Exception:
-                    total_deleted = 0
-                try:
-                    conn.commit()
-                except Exception:
-                    pass
-                phones = [telefono] if telefono else []
-            else:
-                # Obtener teléfonos con fallidos recientes y limpiar todos
-                cur.execute(
-                    """
-                    SELECT DISTINCT phone_number
-                    FROM whatsapp_messages
-                    WHERE status = 'failed'
-                      AND sent_at >= CURRENT_TIMESTAMP - (%s::interval)
-                    ORDER BY phone_number
-                    """,
-                    (interval_str,)
-                )
-                phones = [r.get("phone_number") for r in (cur.fetchall() or []) if r.get("phone_number")]
-                for ph in phones:
-                    try:
-                        cur.execute(
-                            """
-                            DELETE FROM whatsapp_messages
-                            WHERE phone_number = %s AND status = 'failed'
-                              AND sent_at >= CURRENT_TIMESTAMP - (%s::interval)
-                            """,
-                            (ph, interval_str)
-                        )
-                        total_deleted += int(cur.rowcount or 0)
-                    except Exception:
-                        pass
-                try:
-                    conn.commit()
-                except Exception:
-                    pass
-        return {"success": True, "deleted": int(total_deleted), "phones": phones}
+        borrados = db.whatsapp.limpiar_fallidos(telefono or None, dias)
+        # Los fallos borrados dejan de contar para el anti-spam de este proceso
+        motor = MotorAntispam(db.whatsapp)
+        for ph in borrados:
+            motor.invalidar(ph)
+        phones = sorted(borrados) or ([telefono] if telefono else [])
+        return {"success": True, "deleted": sum(borrados.values()), "phones": phones}
     except Exception as e:
         import traceback; traceback.print_exc()
         return JSONResponse({"success": False, "error": str(e)}, status_code=500)
 
+@router.get("/api/whatsapp/particiones")
+async def api_whatsapp_particiones(
+    retention_service: WhatsappRetentionService = Depends(get_whatsapp_retention_service),
+    _=Depends(require_owner)
+):
+    """Estado del particionado mensual de whatsapp_messages, retenciones y particiones archivadas."""
+    try:
+        return retention_service.list_partitions()
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@router.post("/api/whatsapp/particiones/mantener")
+async def api_whatsapp_particiones_mantener(
+    request: Request,
+    retention_service: WhatsappRetentionService = Depends(get_whatsapp_retention_service),
+    _=Depends(require_owner)
+):
+    """Resumen por teléfono, particiones futuras, retención por tipo, compactación y archivo
+    (`meses_futuros`, `destino`=b2|local, `max_lotes`)."""
+    rid = getattr(getattr(request,'state',object()), 'request_id', '-')
+    qp = request.query_params
+    try:
+        meses = int(qp.get("meses_futuros") or 3)
+        max_lotes = int(qp.get("max_lotes")) if qp.get("max_lotes") else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Parámetros numéricos inválidos")
+    try:
+        res = retention_service.maintain(meses, qp.get("destino"), max_batches=max_lotes)
+        logger.info(
+            f"/api/whatsapp/particiones/mantener: creadas={res['creadas']} borradas={res['borradas']} "
+            f"archivadas={len(res['archivadas'])} fallidas={res['fallidas']} rid={rid}"
+        )
+        return JSONResponse({"success": True, **res}, status_code=200)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception(f"Error en /api/whatsapp/particiones/mantener rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+@router.post("/api/whatsapp/particiones/migrar")
+async def api_whatsapp_particiones_migrar(
+    request: Request,
+    retention_service: WhatsappRetentionService = Depends(get_whatsapp_retention_service),
+    _=Depends(require_owner)
+):
+    """Migra whatsapp_messages a tabla particionada por lotes; con `max_lotes` devuelve `en_progreso` y se reanuda."""
+    rid = getattr(getattr(request,'state',object()), 'request_id', '-')
+    qp = request.query_params
+    try:
+        lote = max(1000, min(int(qp.get("lote") or 20000), 200000))
+        max_lotes = int(qp.get("max_lotes")) if qp.get("max_lotes") else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Parámetros numéricos inválidos")
+    try:
+        res = retention_service.migrate_to_partitioned(lote, max_lotes)
+        logger.info(f"/api/whatsapp/particiones/migrar: res={res} rid={rid}")
+        return JSONResponse({"success": True, **res}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error en /api/whatsapp/particiones/migrar rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+def _motor_campanias() -> Optional[MotorCampanias]:
+    db = get_db()
+    if db is None:
+        return None
+    pm = get_pm()
+    return MotorCampanias(db, getattr(pm, 'whatsapp_manager', None) if pm is not None else None)
+
+@router.get("/api/whatsapp/campanias")
+async def api_whatsapp_campanias(request: Request, _=Depends(require_gestion_access)):
+    """Últimas campañas con sus destinatarios pendientes, enviados, fallidos y omitidos."""
+    motor = _motor_campanias()
+    if motor is None:
+        return JSONResponse({"error": "DB no disponible"}, status_code=503)
+    try:
+        limite = max(1, min(int(request.query_params.get("limite") or 50), 500))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="limite inválido")
+    try:
+        return {"campanias": motor.listar(limite)}
+    except Exception as e:
+        logger.exception("Error en /api/whatsapp/campanias")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@router.post("/api/whatsapp/campanias")
+async def api_whatsapp_campanias_crear(request: Request, _=Depends(require_owner)):
+    """Crea una campaña y arranca su envío en segundo plano. Body JSON: nombre, contenido o
+    template_name (+ idioma, parametros), segmento {etiquetas, clases, horarios,
+    incluir_lista_espera, usuarios, roles, solo_activos}, mensajes_por_minuto, silencio ("HH:MM-HH:MM")."""
+    rid = getattr(getattr(request,'state',object()), 'request_id', '-')
+    motor = _motor_campanias()
+    if motor is None:
+        return JSONResponse({"success": False, "error": "DB no disponible"}, status_code=503)
+    try:
+        payload = await request.json()
+    except Exception:
+        payload = {}
+    try:
+        creada_por = request.session.get("user_id")
+        res = motor.crear(
+            payload.get("nombre"), payload.get("segmento") or {}, payload.get("contenido"),
+            payload.get("template_name"), payload.get("idioma"), payload.get("parametros"),
+            int(payload["mensajes_por_minuto"]) if payload.get("mensajes_por_minuto") else None,
+            payload.get("silencio"), int(creada_por) if creada_por else None,
+        )
+        logger.info(f"/api/whatsapp/campanias: creada {res} rid={rid}")
+        return {"success": True, **res}
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception(f"Error en /api/whatsapp/campanias rid={rid}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+@router.get("/api/whatsapp/campanias/{campania_id}")
+async def api_whatsapp_campania_progreso(campania_id: int, _=Depends(require_gestion_access)):
+    """Progreso de una campaña: destinatarios por estado, motivos de omisión / fallo y tiempo estimado."""
+    motor = _motor_campanias()
+    if motor is None:
+        return JSONResponse({"error": "DB no disponible"}, status_code=503)
+    try:
+        progreso = motor.progreso(campania_id)
+    except Exception as e:
+        logger.exception("Error en /api/whatsapp/campanias/{id}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+    if progreso is None:
+        raise HTTPException(status_code=404, detail="Campaña no encontrada")
+    return progreso
+
+@router.post("/api/whatsapp/campanias/{campania_id}/{accion}")
+async def api_whatsapp_campania_accion(campania_id: int, accion: str, _=Depends(require_owner)):
+    """pausar | reanudar | cancelar. 409 si la campaña no está en un estado que lo admita."""
+    motor = _motor_campanias()
+    if motor is None:
+        return JSONResponse({"success": False, "error": "DB no disponible"}, status_code=503)
+    try:
+        cambiada = motor.cambiar_estado(campania_id, accion)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception("Error en /api/whatsapp/campanias/{id}/{accion}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+    if not cambiada:
+        return JSONResponse({"success": False, "message": f"No se puede {accion} la campaña en su estado actual"},
+                            status_code=409)
+    return {"success": True, **(motor.progreso(campania_id) or {})}
+
+@router.get("/api/whatsapp/bajas")
+async def api_whatsapp_bajas(_=Depends(require_gestion_access)):
+    """Teléfonos dados de baja de las campañas."""
+    motor = _motor_campanias()
+    if motor is None:
+        return JSONResponse({"error": "DB no disponible"}, status_code=503)
+    try:
+        bajas = motor.repo.listar_bajas()
+        for b in bajas:
+            b["creado"] = b["creado"].isoformat() if b.get("creado") else None
+        return {"bajas": bajas}
+    except Exception as e:
+        logger.exception("Error en /api/whatsapp/bajas")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@router.post("/api/whatsapp/bajas")
+async def api_whatsapp_bajas_guardar(request: Request, _=Depends(require_owner)):
+    """Da de baja (o de alta con `baja`: false) un teléfono de las campañas. Body JSON: telefono, baja."""
+    motor = _motor_campanias()
+    if motor is None:
+        return JSONResponse({"success": False, "error": "DB no disponible"}, status_code=503)
+    try:
+        payload = await request.json()
+    except Exception:
+        payload = {}
+    telefono = normalizar_telefono(payload.get("telefono"))
+    if not telefono:
+        raise HTTPException(status_code=400, detail="telefono inválido")
+    try:
+        usuario_id = ResolutorTelefonos(motor.db.session).resolver(telefono)
+        cambio = motor.repo.guardar_baja(telefono, bool(payload.get("baja", True)), usuario_id)
+        return {"success": True, "telefono": telefono, "cambio": cambio}
+    except Exception as e:
+        logger.exception("Error en /api/whatsapp/bajas")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
 @router.post("/api/whatsapp/server/start")
 async def api_whatsapp_server_start(_=Depends(require_owner)):
     pm = get_pm()
@@ -670,28 +791,43 @@ async def whatsapp_verify(request: Request):
         logging.getLogger(__name__).error(f"WhatsApp verify error: {e}")
     raise HTTPException(status_code=403, detail="Invalid verify token")
 
+def _consumir_webhooks(db) -> None:
+    """Tarea posterior a la respuesta: procesa lo que haya en la cola de eventos y encola las
+    confirmaciones de lista de espera que hayan generado."""
+    try:
+        resultado = WebhookIngestor(db).procesar()
+        if resultado.get('auditorias'):
+            pm = get_pm()
+            wm = getattr(pm, 'whatsapp_manager', None) if pm is not None else None
+            if wm is not None:
+                wm.process_pending_sends()
+    except Exception as e:
+        logging.getLogger(__name__).error(f"WhatsApp webhook consumer error: {e}")
+    finally:
+        # La tarea corre en un hilo del pool: liberar su sesión (scoped_session)
+        try:
+            db.session.remove()
+        except Exception:
+            pass
+
 @router.post("/webhooks/whatsapp")
-async def whatsapp_webhook(request: Request):
-    # Verificación de firma (si se configura WHATSAPP_APP_SECRET)
+async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
+    """Verifica la firma, guarda el evento crudo y responde; el procesamiento es posterior
+    (ver core/whatsapp_webhook.py). Si no se pudo guardar responde 5xx para que Meta reintente."""
     logger = logging.getLogger(__name__)
     try:
         raw = await request.body()
         app_secret = os.getenv("WHATSAPP_APP_SECRET", "")
         if app_secret:
             try:
-                import hmac, hashlib
-                sig_header = request.headers.get("X-Hub-Signature-256") or ""
-                expected = "sha256=" + hmac.new(app_secret.encode("utf-8"), raw, hashlib.sha256).hexdigest()
-                if not hmac.compare_digest(expected, sig_header):
-                    raise HTTPException(status_code=403, detail="Invalid signature")
-            except HTTPException:
-                raise
+                firma_ok = verificar_firma(raw, request.headers.get("X-Hub-Signature-256") or "", app_secret)
             except Exception as e:
                 logger.error(f"WhatsApp signature check error: {e}")
                 raise HTTPException(status_code=400, detail="Signature verification error")
-        import json as _json
+            if not firma_ok:
+                raise HTTPException(status_code=403, detail="Invalid signature")
         try:
-            payload = _json.loads(raw.decode("utf-8"))
+            payload = json.loads(raw.decode("utf-8"))
         except Exception:
             raise HTTPException(status_code=400, detail="Invalid JSON")
     except HTTPException:
@@ -700,191 +836,56 @@ async def whatsapp_webhook(request: Request):
         logger.error(f"WhatsApp webhook read error: {e}")
         raise HTTPException(status_code=400, detail="Bad Request")
 
-    # DB
+    db = get_db()
+    if db is None:
+        return JSONResponse({"status": "error"}, status_code=503)
     try:
-        db = get_db()
-    except Exception:
-        db = None
-
-    # Procesamiento de estados y mensajes
-    try:
-        for entry in (payload.get("entry") or []):
-            for change in (entry.get("changes") or []):
-                value = change.get("value") or {}
-                # Actualizaciones de estado
-                for status in (value.get("statuses") or []):
-                    mid = status.get("id")
-                    st = status.get("status")
-                    if db and mid and st:
-                        try:
-                            db.actualizar_estado_mensaje_whatsapp(mid, st)  # type: ignore
-                        except Exception as e:
-                            logger.error(f"Estado WA update failed id={mid} status={st}: {e}")
-                # Mensajes entrantes
-                for msg in (value.get("messages") or []):
-                    mid = msg.get("id")
-                    mtype = msg.get("type")
-                    wa_from = msg.get("from")
-                    
-                    text = None
-                    button_id = None
-                    button_title = None
-                    list_id = None
-                    list_title = None
-                    try:
-                        if mtype == "text":
-                            text = (msg.get("text") or {}).get("body")
-                        elif mtype == "button":
-                            text = (msg.get("button") or {}).get("text")
-                        elif mtype == "interactive":
-                            ir = msg.get("interactive") or {}
-                            br = ir.get("button_reply") or {}
-                            lr = ir.get("list_reply") or {}
-                            button_id = br.get("id")
-                            button_title = br.get("title")
-                            list_id = lr.get("id")
-                            list_title = lr.get("title")
-                            text = button_title or list_title
-                        elif mtype == "image":
-                            text = "[imagen]"
-                        elif mtype == "audio":
-                            text = "[audio]"
-                        elif mtype == "video":
-                            text = "[video]"
-                        elif mtype == "document":
-                            text = "[documento]"
-                    except Exception:
-                        pass
-
-                    # Registrar en DB (mensaje recibido)
-                    if db:
-                        try:
-                            uid = None
-                            try:
-                                uid = db._obtener_user_id_por_telefono_whatsapp(wa_from)  # type: ignore
-                            except Exception:
-                                uid = None
-                            db.registrar_mensaje_whatsapp(  # type: ignore
-                                user_id=uid,
-                                message_type="welcome",
-                                template_name="incoming",
-                                phone_number=wa_from,
-                                message_content=(text or ""),
-                                status="received",
-                                message_id=mid,
-                            )
-                        except Exception as e:
-                            logger.error(f"WA incoming log failed id={mid}: {e}")
-
-                    # Auto-acciones: promoción/declinación desde lista de espera
-                    try:
-                        import unicodedata as _unic
-                        def _sanitize_text(s: str) -> str:
-                            s = (s or "").strip()
-                            s = "".join(c for c in _unic.normalize("NFD", s) if _unic.category(c) != "Mn")
-                            s = s.lower()
-                            # Quitar signos de puntuación comunes
-                            for ch in [".", ",", ";", "!", "?", "¡", "¿"]:
-                                s = s.replace(ch, "")
-                            return s
-
-                        # Señales de SI/NO desde texto o interacción
-                        tid = button_id or list_id or ""
-                        ttitle = button_title or list_title or text or ""
-                        stext = _sanitize_text(ttitle)
-                        yes_signal = stext == "si"
-                        no_signal = stext == "no"
-
-                        # IDs de interacción con clase_horario_id: WAITLIST_PROMOTE:<id> / WAITLIST_DECLINE:<id>
-                        target_clase_id = None
-                        try:
-                            if isinstance(tid, str):
-                                if tid.startswith("WAITLIST_PROMOTE:"):
-                                    target_clase_id = int(tid.split(":", 1)[1])
-                                    yes_signal = True
-                                elif tid.startswith("WAITLIST_DECLINE:"):
-                                    target_clase_id = int(tid.split(":", 1)[1])
-                                    no_signal = True
-                        except Exception:
-                            target_clase_id = None
-
-                        if db and (yes_signal or no_signal):
-                            # Resolver usuario desde teléfono con normalización mejorada
-                            uid = None
-                            try:
-                                uid = db._obtener_user_id_por_telefono_whatsapp(wa_from)  # type: ignore
-                            except Exception:
-                                uid = None
-                            if uid:
-                                # Fallback para clase objetivo: primera lista de espera activa del usuario
-                                if target_clase_id is None:
-                                    try:
-                                        with db.get_connection_context() as conn:  # type: ignore
-                                            cur = conn.cursor()
-                                            cur.execute(
-                                                """
-                                                SELECT clase_horario_id
-                                                FROM clase_lista_espera
-                                                WHERE usuario_id = %s AND activo = true
-                                                ORDER BY posicion ASC
-                                                LIMIT 1
-                                                """,
-                                                (int(uid),)
-                                            )
-                                            row = cur.fetchone()
-                                            if row:
-                                                try:
-                                                    target_clase_id = int(row[0])
-                                                except Exception:
-                                                    target_clase_id = None
-                                    except Exception:
-                                        target_clase_id = None
-
-                                if target_clase_id:
-                                    if yes_signal:
-                                        # Registrar auditoría de confirmación; desktop realiza inscripción y mensajería
-                                        try:
-                                            ip_addr = (getattr(request, 'client', None).host if getattr(request, 'client', None) else None)
-                                            ua = request.headers.get('user-agent', '')
-                                            sid = getattr(getattr(request, 'session', {}), 'get', lambda *a, **k: None)('session_id')
-                                            db.registrar_audit_log(  # type: ignore
-                                                user_id=int(uid),
-                                                action="auto_promote_waitlist",
-                                                table_name="clase_lista_espera",
-                                                record_id=int(target_clase_id),
-                                                old_values=None,
-                                                new_values=json.dumps({"confirmado": True}),
-                                                ip_address=ip_addr,
-                                                user_agent=ua,
-                                                session_id=sid,
-                                            )
-                                        except Exception as e:
-                                            logger.error(f"WA auto-promote audit log failed uid={uid} clase_id={target_clase_id}: {e}")
-                                        logger.info(f"WA auto-promote: audit registrada usuario_id={uid} clase_horario_id={target_clase_id} from={wa_from} mid={mid}")
-                                    elif no_signal:
-                                        # Declinación explícita: mantener en lista; envío delegado al desktop
-                                        try:
-                                            ip_addr = (getattr(request, 'client', None).host if getattr(request, 'client', None) else None)
-                                            ua = request.headers.get('user-agent', '')
-                                            sid = getattr(getattr(request, 'session', {}), 'get', lambda *a, **k: None)('session_id')
-                                            db.registrar_audit_log(  # type: ignore
-                                                user_id=int(uid),
-                                                action="decline_waitlist_promotion",
-                                                table_name="clase_lista_espera",
-                                                record_id=int(target_clase_id),
-                                                old_values=None,
-                                                new_values=json.dumps({"declinado": True}),
-                                                ip_address=ip_addr,
-                                                user_agent=ua,
-                                                session_id=sid,
-                                            )
-                                        except Exception:
-                                            pass
-                    except Exception:
-                        pass
-        return JSONResponse({"status": "ok"})
-    except HTTPException:
-        raise
+        evento_id = WebhookIngestor(db).encolar(payload)
     except Exception as e:
-        logger.error(f"WhatsApp webhook processing error: {e}")
+        logger.error(f"WhatsApp webhook enqueue error: {e}")
         return JSONResponse({"status": "error"}, status_code=500)
+    background_tasks.add_task(_consumir_webhooks, db)
+    return JSONResponse({"status": "ok", "evento_id": evento_id})
+
+
+@router.get("/api/whatsapp/webhooks")
+async def api_whatsapp_webhooks(_=Depends(require_gestion_access)):
+    """Estado de la cola de eventos del webhook."""
+    db = get_db()
+    if db is None:
+        return JSONResponse({"error": "DB no disponible"}, status_code=503)
+    try:
+        return WebhookIngestor(db).resumen()
+    except Exception as e:
+        logging.exception("Error en /api/whatsapp/webhooks")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@router.post("/api/whatsapp/webhooks/replay")
+async def api_whatsapp_webhooks_replay(request: Request, _=Depends(require_owner)):
+    """Reprocesa eventos guardados del webhook. Body JSON: desde_id, hasta_id y/o desde, hasta (ISO)."""
+    db = get_db()
+    if db is None:
+        return JSONResponse({"error": "DB no disponible"}, status_code=503)
+    try:
+        payload = await request.json()
+    except Exception:
+        payload = {}
+    try:
+        def _entero(k):
+            v = payload.get(k)
+            return int(v) if v not in (None, "") else None
+
+        def _fecha(k):
+            v = payload.get(k)
+            return datetime.fromisoformat(str(v)) if v else None
+
+        resultado = WebhookIngestor(db).reprocesar(
+            desde_id=_entero("desde_id"), hasta_id=_entero("hasta_id"), desde=_fecha("desde"), hasta=_fecha("hasta")
+        )
+        return {"success": True, **resultado}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.exception("Error en /api/whatsapp/webhooks/replay")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Anti-spam de WhatsApp con ventanas deslizantes en memoria
+
+Por teléfono se guardan los envíos y fallos de las últimas 24 h y el último envío de cada
+tipo. Se cargan desde whatsapp_messages en una sola consulta para todos los teléfonos que
+falten (ver WhatsappRepository.obtener_eventos_antispam) y se actualizan con cada envío o
+fallo que registra este proceso. Como otras instancias también envían, una ventana se vuelve
+a cargar cuando pasaron más de ANTISPAM_REVALIDAR_SEG segundos (60 por defecto).
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Dict, Iterable, List, Optional
+
+HORA_S = 3600.0
+DIA_S = 24 * HORA_S
+
+CONFIG_POR_DEFECTO = {
+    'max_mensajes_por_hora': 10,
+    'max_mensajes_por_dia': 50,
+    'intervalo_minimo_minutos': 5,
+    'max_intentos_fallidos': 5,
+}
+
+# Clave de la tabla configuracion para cada regla
+CLAVES_CONFIGURACION = {
+    'max_mensajes_por_hora': 'whatsapp_max_mensajes_hora',
+    'max_mensajes_por_dia': 'whatsapp_max_mensajes_dia',
+    'intervalo_minimo_minutos': 'whatsapp_intervalo_minimo',
+    'max_intentos_fallidos': 'whatsapp_max_intentos_fallidos',
+}
+
+
+def _env_int(nombre: str, defecto: int) -> int:
+    try:
+        return int(os.getenv(nombre, str(defecto)))
+    except Exception:
+        return defecto
+
+
+def _env_float(nombre: str, defecto: float) -> float:
+    try:
+        return float(os.getenv(nombre, str(defecto)))
+    except Exception:
+        return defecto
+
+
+class _Ventana:
+    """Eventos de un teléfono en segundos epoch (time.time)."""
+
+    __slots__ = ('envios', 'fallos', 'ultimo_por_tipo', 'horizonte_s', 'cargada')
+
+    def __init__(self, horizonte_s: float):
+        self.envios: deque = deque()
+        self.fallos: deque = deque()
+        self.ultimo_por_tipo: Dict[str, float] = {}
+        self.horizonte_s = horizonte_s
+        self.cargada = time.monotonic()
+
+    def podar(self, ahora: float) -> None:
+        limite = ahora - DIA_S
+        while self.envios and self.envios[0] < limite:
+            self.envios.popleft()
+        while self.fallos and self.fallos[0] < limite:
+            self.fallos.popleft()
+
+
+# Ventanas por base (tenant) y teléfono, en orden de uso para descartar las más viejas
+_VENTANAS: Dict[str, 'OrderedDict[str, _Ventana]'] = {}
+_LOCK = threading.Lock()
+
+
+class MotorAntispam:
+    """Reglas anti-spam de MessageLogger evaluadas sobre ventanas en memoria.
+
+    Motivos de bloqueo, en orden: 'reciente' (ya se envió ese tipo dentro de `horas_tipo`),
+    'limite_hora', 'limite_dia', 'intervalo_minimo' e 'intentos_fallidos'.
+
+    Configuración por entorno:
+    - ANTISPAM_REVALIDAR_SEG: antigüedad máxima de una ventana antes de recargarla.
+    - ANTISPAM_HORIZONTE_HORAS: cuánto atrás se busca el último envío de cada tipo (720).
+    - ANTISPAM_MAX_TELEFONOS: ventanas en memoria por base (20000).
+    """
+
+    def __init__(self, repo, config: Optional[Dict[str, int]] = None):
+        self.repo = repo
+        self.config = dict(CONFIG_POR_DEFECTO, **(config or {}))
+        self.revalidar_s = _env_float('ANTISPAM_REVALIDAR_SEG', 60.0)
+        self.horizonte_s = max(_env_float('ANTISPAM_HORIZONTE_HORAS', 24 * 30) * HORA_S, DIA_S)
+        self.max_telefonos = max(100, _env_int('ANTISPAM_MAX_TELEFONOS', 20000))
+
+    def _clave(self) -> str:
+        try:
+            return str(self.repo.db.get_bind().url)
+        except Exception:
+            return ''
+
+    def _cargar(self, telefonos: List[str], horizonte_s: float) -> Dict[str, _Ventana]:
+        eventos = self.repo.obtener_eventos_antispam(telefonos, horizonte_s / HORA_S)
+        ahora = time.time()
+        ventanas = {t: _Ventana(horizonte_s) for t in telefonos}
+        for tel, por_tipo in eventos.items():
+            v = ventanas.get(tel)
+            if v is None:
+                continue
+            envios: List[float] = []
+            fallos: List[float] = []
+            for tipo, e in por_tipo.items():
+                envios.extend(ahora - s for s in e['envios'])
+                fallos.extend(ahora - s for s in e['fallos'])
+                if e['ultimo'] is not None:
+                    v.ultimo_por_tipo[tipo] = ahora - e['ultimo']
+            v.envios.extend(sorted(envios))
+            v.fallos.extend(sorted(fallos))
+        return ventanas
+
+    def _ventanas(self, telefonos: List[str], horizonte_s: float) -> Dict[str, _Ventana]:
+        clave = self._clave()
+        limite = time.monotonic() - self.revalidar_s
+        with _LOCK:
+            tabla = _VENTANAS.setdefault(clave, OrderedDict())
+            vigentes = {}
+            for t in telefonos:
+                v = tabla.get(t)
+                if v is not None and v.cargada >= limite and v.horizonte_s >= horizonte_s:
+                    tabla.move_to_end(t)
+                    vigentes[t] = v
+        faltantes = [t for t in telefonos if t not in vigentes]
+        if faltantes:
+            nuevas = self._cargar(faltantes, max(horizonte_s, self.horizonte_s))
+            with _LOCK:
+                tabla = _VENTANAS.setdefault(clave, OrderedDict())
+                for t, v in nuevas.items():
+                    tabla[t] = v
+                    tabla.move_to_end(t)
+                while len(tabla) > self.max_telefonos:
+                    tabla.popitem(last=False)
+            vigentes.update(nuevas)
+        return vigentes
+
+    def _motivo(self, v: _Ventana, ahora: float, tipo_mensaje: Optional[str], horas_tipo: float) -> Optional[str]:
+        cfg = self.config
+        v.podar(ahora)
+        if tipo_mensaje:
+            ultimo = v.ultimo_por_tipo.get(tipo_mensaje)
+            if ultimo is not None and ultimo >= ahora - horas_tipo * HORA_S:
+                return 'reciente'
+        hace_hora = ahora - HORA_S
+        if sum(1 for t in v.envios if t >= hace_hora) >= cfg['max_mensajes_por_hora']:
+            return 'limite_hora'
+        if len(v.envios) >= cfg['max_mensajes_por_dia']:
+            return 'limite_dia'
+        if v.envios and ahora - v.envios[-1] < cfg['intervalo_minimo_minutos'] * 60:
+            return 'intervalo_minimo'
+        if len(v.fallos) >= cfg['max_intentos_fallidos']:
+            return 'intentos_fallidos'
+        return None
+
+    def evaluar(self, telefonos: Iterable[Any], tipo_mensaje: Optional[str] = None,
+                horas_tipo: float = 24) -> Dict[str, Optional[str]]:
+        """Motivo de bloqueo por teléfono (None si se puede enviar).
+
+        Los teléfonos sin ventana vigente se cargan todos juntos en una consulta; sin
+        `tipo_mensaje` no se evalúa la regla 'reciente'.
+        """
+        tels = list(dict.fromkeys(str(t).strip() for t in telefonos if t and str(t).strip()))
+        if not tels:
+            return {}
+        horizonte_s = max(float(horas_tipo) * HORA_S if tipo_mensaje else 0.0, DIA_S)
+        ventanas = self._ventanas(tels, horizonte_s)
+        ahora = time.time()
+        with _LOCK:
+            return {t: self._motivo(ventanas[t], ahora, tipo_mensaje, float(horas_tipo)) for t in tels}
+
+    def motivo(self, telefono: Any, tipo_mensaje: Optional[str] = None, horas_tipo: float = 24) -> Optional[str]:
+        return self.evaluar([telefono], tipo_mensaje, horas_tipo).get(str(telefono).strip())
+
+    def registrar(self, telefono: Any, tipo_mensaje: Optional[str] = None, fallido: bool = False) -> None:
+        """Suma un envío (o fallo) a la ventana del teléfono si ya está en memoria; si no,
+        se leerá de la base en la próxima evaluación."""
+        tel = str(telefono or '').strip()
+        if not tel:
+            return
+        clave, ahora = self._clave(), time.time()
+        with _LOCK:
+            v = _VENTANAS.get(clave, {}).get(tel)
+            if v is None:
+                return
+            if fallido:
+                v.fallos.append(ahora)
+            else:
+                v.envios.append(ahora)
+                if tipo_mensaje:
+                    v.ultimo_por_tipo[tipo_mensaje] = ahora
+
+    def invalidar(self, telefono: Any = None) -> None:
+        clave = self._clave()
+        with _LOCK:
+            tabla = _VENTANAS.get(clave)
+            if tabla is None:
+                return
+            if telefono is None:
+                tabla.clear()
+            else:
+                tabla.pop(str(telefono).strip(), None)
@@ -13,6 +13,8 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, Session, scoped_session
 from sqlalchemy.exc import SQLAlchemyError, OperationalError
 
+from .date_ranges import GYM_TIMEZONE
+
 # Configuración de logs
 logger = logging.getLogger(__name__)
 
@@ -54,7 +56,7 @@ try:
         max_overflow=20,          # Conexiones extra permitidas
         pool_recycle=1800,        # Reciclar conexiones cada 30 mins
         connect_args={
-            "options": "-c timezone=America/Argentina/Buenos_Aires"
+            "options": f"-c timezone={GYM_TIMEZONE}"
         }
     )
 except Exception as e:
@@ -0,0 +1,109 @@
+"""Rangos de fechas semiabiertos [inicio, fin) en la zona horaria del gimnasio.
+
+Los filtros de fecha deben compararse contra la columna desnuda
+(`col >= inicio AND col < fin`) para que el planner pueda usar los índices
+por columna; `DATE(col)`, `col::date`, `EXTRACT(... FROM col)` o
+`date_trunc(...)` sobre la columna impiden usarlos (scripts/verificar_planes.py
+lo comprueba sobre las consultas de los repositorios).
+
+Las columnas DateTime del esquema son naive y se guardan en hora local del
+gimnasio (la sesión de PostgreSQL usa la misma zona, ver connection.py), por
+lo que los límites se devuelven también naive en esa zona.
+"""
+import os
+from datetime import date, datetime, time, timedelta
+from typing import NamedTuple, Optional
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # pragma: no cover
+    ZoneInfo = None
+
+from sqlalchemy import and_
+
+GYM_TIMEZONE = os.getenv("GYM_TIMEZONE", "America/Argentina/Buenos_Aires")
+
+
+class RangoFechas(NamedTuple):
+    inicio: datetime
+    fin: datetime
+
+    @property
+    def fecha_inicio(self) -> date:
+        """Primer día incluido (para columnas Date)."""
+        return self.inicio.date()
+
+    @property
+    def fecha_fin(self) -> date:
+        """Primer día excluido (para columnas Date)."""
+        return self.fin.date()
+
+
+def ahora_gym() -> datetime:
+    """Fecha y hora actual en la zona del gimnasio (naive)."""
+    if ZoneInfo is None:
+        return datetime.now()
+    try:
+        return datetime.now(ZoneInfo(GYM_TIMEZONE)).replace(tzinfo=None)
+    except Exception:
+        return datetime.now()
+
+
+def hoy_gym() -> date:
+    return ahora_gym().date()
+
+
+def _inicio_dia(d: date) -> datetime:
+    return datetime.combine(d, time.min)
+
+
+def rango_dia(d: date) -> RangoFechas:
+    return RangoFechas(_inicio_dia(d), _inicio_dia(d + timedelta(days=1)))
+
+
+def rango_hoy() -> RangoFechas:
+    return rango_dia(hoy_gym())
+
+
+def rango_fechas(desde: date, hasta: date) -> RangoFechas:
+    """Días `desde`..`hasta` ambos incluidos."""
+    return RangoFechas(_inicio_dia(desde), _inicio_dia(hasta + timedelta(days=1)))
+
+
+def rango_ultimos_dias(dias: int, hasta: Optional[date] = None) -> RangoFechas:
+    """Últimos `dias` días incluyendo hoy (o `hasta`)."""
+    hasta = hasta or hoy_gym()
+    return rango_fechas(hasta - timedelta(days=max(int(dias), 1) - 1), hasta)
+
+
+def rango_mes(año: int, mes: int) -> RangoFechas:
+    inicio = date(int(año), int(mes), 1)
+    fin = date(inicio.year + 1, 1, 1) if inicio.month == 12 else date(inicio.year, inicio.month + 1, 1)
+    return RangoFechas(_inicio_dia(inicio), _inicio_dia(fin))
+
+
+def rango_mes_actual() -> RangoFechas:
+    hoy = hoy_gym()
+    return rango_mes(hoy.year, hoy.month)
+
+
+def rango_ultimos_meses(meses: int) -> RangoFechas:
+    """Desde el primer día de hace `meses - 1` meses hasta fin del mes actual."""
+    hoy = hoy_gym()
+    total = hoy.year * 12 + (hoy.month - 1) - (max(int(meses), 1) - 1)
+    return RangoFechas(rango_mes(total // 12, total % 12 + 1).inicio, rango_mes_actual().fin)
+
+
+def rango_anio(año: int) -> RangoFechas:
+    return RangoFechas(_inicio_dia(date(int(año), 1, 1)), _inicio_dia(date(int(año) + 1, 1, 1)))
+
+
+def en_rango(columna, rango: RangoFechas, solo_fecha: bool = False):
+    """Condición sargable `columna >= inicio AND columna < fin`.
+
+    Con `solo_fecha=True` compara contra `date` (columnas Date); comparar una
+    columna Date contra un timestamp obliga a castear la columna.
+    """
+    if solo_fecha:
+        return and_(columna >= rango.fecha_inicio, columna < rango.fecha_fin)
+    return and_(columna >= rango.inicio, columna < rango.fin)
@@ -0,0 +1,223 @@
+"""Estadísticas de WhatsApp en memoria, por base.
+
+Todas las cifras de la pantalla de WhatsApp (hoy, semana, por tipo, por estado, serie diaria y
+tasas de fallo) salen de un mismo tablero: los conteos de whatsapp_messages por día y tipo de
+los últimos WHATSAPP_ESTADISTICAS_DIAS días (30), leídos en una sola consulta GROUP BY con
+FILTER por estado (WhatsappRepository.obtener_agregados_whatsapp).
+
+El tablero se recarga cada WHATSAPP_ESTADISTICAS_TTL_SEG segundos (60) para ver lo que
+registran otras instancias; mientras tanto, WhatsappRepository lo mantiene al día con los
+mensajes que inserta y los cambios de estado del webhook de este proceso.
+"""
+import os
+import time
+import threading
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .date_ranges import hoy_gym
+
+# Columnas de obtener_agregados_whatsapp; 'otro' junta estados fuera de la lista
+ESTADOS = ('sent', 'delivered', 'read', 'failed', 'received', 'otro')
+TIPOS_MENSAJE = ('welcome', 'payment', 'overdue', 'deactivation', 'class_reminder', 'waitlist', 'campaign')
+
+
+def _env_int(nombre: str, defecto: int) -> int:
+    try:
+        return int(os.getenv(nombre, str(defecto)))
+    except Exception:
+        return defecto
+
+
+def _estado(estado: Optional[str]) -> str:
+    return estado if estado in ESTADOS else 'otro'
+
+
+class _Tablero:
+    __slots__ = ('conteos', 'desde', 'total_historico', 'cargado')
+
+    def __init__(self, conteos: Dict[Tuple[date, str], Dict[str, int]], desde: date, total_historico: int):
+        self.conteos = conteos
+        self.desde = desde
+        self.total_historico = total_historico
+        self.cargado = time.monotonic()
+
+
+_TABLEROS: Dict[str, _Tablero] = {}
+_LOCK = threading.Lock()
+
+
+def clave_base(db) -> str:
+    try:
+        return str(db.get_bind().url)
+    except Exception:
+        return ''
+
+
+def invalidar(clave: str) -> None:
+    with _LOCK:
+        _TABLEROS.pop(clave, None)
+
+
+def anotar_mensajes(clave: str, mensajes: Iterable[Tuple[Optional[date], str, Optional[str]]]) -> None:
+    """Suma mensajes nuevos (día, tipo, estado) al tablero de la base si está cargado."""
+    with _LOCK:
+        tablero = _TABLEROS.get(clave)
+        if tablero is None:
+            return
+        hoy = hoy_gym()
+        for dia, tipo, estado in mensajes:
+            dia = dia or hoy
+            if dia < tablero.desde:
+                continue
+            fila = tablero.conteos.setdefault((dia, tipo), dict.fromkeys(ESTADOS, 0))
+            fila[_estado(estado)] += 1
+            tablero.total_historico += 1
+
+
+def anotar_transiciones(clave: str, cambios: Iterable[Tuple[Optional[date], str, Optional[str], str]]) -> None:
+    """Mueve mensajes de un estado a otro (día, tipo, anterior, nuevo) en el tablero cargado."""
+    with _LOCK:
+        tablero = _TABLEROS.get(clave)
+        if tablero is None:
+            return
+        for dia, tipo, anterior, nuevo in cambios:
+            if dia is None or dia < tablero.desde:
+                continue
+            fila = tablero.conteos.setdefault((dia, tipo), dict.fromkeys(ESTADOS, 0))
+            previo = _estado(anterior)
+            if fila[previo] > 0:
+                fila[previo] -= 1
+            fila[_estado(nuevo)] += 1
+
+
+def _vacio() -> Dict[str, Any]:
+    return {'enviados': 0, 'recibidos': 0, 'fallidos': 0, 'total': 0, 'tasa_exito': 0}
+
+
+def _resumir(filas: Iterable[Dict[str, int]]) -> Dict[str, Any]:
+    """Enviados (no fallidos ni recibidos), recibidos, fallidos y tasa de éxito de los envíos."""
+    out = _vacio()
+    for f in filas:
+        out['enviados'] += f['sent'] + f['delivered'] + f['read'] + f['otro']
+        out['recibidos'] += f['received']
+        out['fallidos'] += f['failed']
+    out['total'] = out['enviados'] + out['recibidos']
+    intentos = out['enviados'] + out['fallidos']
+    out['tasa_exito'] = round(out['enviados'] / intentos * 100, 2) if intentos else 0
+    return out
+
+
+class EstadisticasWhatsapp:
+    """Estadísticas de whatsapp_messages servidas desde el tablero en memoria de la base.
+
+    Los períodos que caen fuera de la ventana del tablero se calculan con la misma consulta
+    agregada, sin guardarlos.
+    """
+
+    def __init__(self, db):
+        from .repositories.whatsapp_repository import WhatsappRepository
+        self.db = db
+        self.repo = WhatsappRepository(db, None, None)
+        self.ttl_s = max(0, _env_int('WHATSAPP_ESTADISTICAS_TTL_SEG', 60))
+        self.dias = max(8, _env_int('WHATSAPP_ESTADISTICAS_DIAS', 30))
+
+    def _cargar(self, desde: date, hasta: Optional[date] = None) -> Dict[Tuple[date, str], Dict[str, int]]:
+        return {(f['dia'], f['message_type']): {e: int(f[e] or 0) for e in ESTADOS}
+                for f in self.repo.obtener_agregados_whatsapp(desde, hasta)}
+
+    def _tablero(self) -> _Tablero:
+        clave = clave_base(self.db)
+        with _LOCK:
+            tablero = _TABLEROS.get(clave)
+        desde = hoy_gym() - timedelta(days=self.dias - 1)
+        if tablero is not None and tablero.desde == desde and time.monotonic() - tablero.cargado < self.ttl_s:
+            return tablero
+        tablero = _Tablero(self._cargar(desde), desde, self.repo.contar_mensajes_historico())
+        with _LOCK:
+            _TABLEROS[clave] = tablero
+        return tablero
+
+    def _conteos(self, desde: date, hasta: date) -> List[Tuple[Tuple[date, str], Dict[str, int]]]:
+        """(día, tipo) -> conteos de `desde` a `hasta` (excluido)."""
+        tablero = self._tablero()
+        if desde >= tablero.desde:
+            with _LOCK:
+                return [(k, dict(v)) for k, v in tablero.conteos.items() if desde <= k[0] < hasta]
+        return [(k, v) for k, v in self._cargar(desde, hasta).items()]
+
+    def _dia(self, fecha: Optional[datetime]) -> date:
+        if fecha is None:
+            return hoy_gym()
+        return fecha.date() if isinstance(fecha, datetime) else fecha
+
+    def diarias(self, fecha: Optional[datetime] = None) -> Dict[str, Any]:
+        dia = self._dia(fecha)
+        return _resumir(v for _, v in self._conteos(dia, dia + timedelta(days=1)))
+
+    def semanales(self, fecha: Optional[datetime] = None) -> Dict[str, Any]:
+        """Semana de lunes a domingo que contiene `fecha`."""
+        dia = self._dia(fecha)
+        lunes = dia - timedelta(days=dia.weekday())
+        return _resumir(v for _, v in self._conteos(lunes, lunes + timedelta(days=7)))
+
+    def por_tipo(self, dias: int = 7) -> Dict[str, Dict[str, int]]:
+        hoy = hoy_gym()
+        conteos = self._conteos(hoy - timedelta(days=max(int(dias), 1)), hoy + timedelta(days=1))
+        out = {t: {'enviados': 0, 'fallidos': 0} for t in TIPOS_MENSAJE}
+        for (_, tipo), v in conteos:
+            r = _resumir([v])
+            fila = out.setdefault(tipo, {'enviados': 0, 'fallidos': 0})
+            fila['enviados'] += r['enviados']
+            fila['fallidos'] += r['fallidos']
+        return out
+
+    def resumen(self) -> Dict[str, Any]:
+        """Todas las cifras de la pantalla de WhatsApp en una sola lectura del tablero."""
+        tablero = self._tablero()
+        hoy = hoy_gym()
+        with _LOCK:
+            conteos = [(k, dict(v)) for k, v in tablero.conteos.items()]
+            total = tablero.total_historico
+        por_dia: Dict[date, List[Dict[str, int]]] = {}
+        por_tipo: Dict[str, Dict[str, int]] = {}
+        por_estado = dict.fromkeys(ESTADOS, 0)
+        for (dia, tipo), v in conteos:
+            por_dia.setdefault(dia, []).append(v)
+            acumulado = por_tipo.setdefault(tipo, dict.fromkeys(ESTADOS, 0))
+            for e in ESTADOS:
+                acumulado[e] += v[e]
+                por_estado[e] += v[e]
+        serie = []
+        dia = tablero.desde
+        while dia <= hoy:
+            serie.append({'fecha': dia.isoformat(), **_resumir(por_dia.get(dia, []))})
+            dia += timedelta(days=1)
+        lunes = hoy - timedelta(days=hoy.weekday())
+        tipos = {}
+        for tipo, v in sorted(por_tipo.items()):
+            r = _resumir([v])
+            intentos = r['enviados'] + r['fallidos']
+            tipos[tipo] = {**r, 'tasa_fallo': round(r['fallidos'] / intentos * 100, 2) if intentos else 0}
+        periodo = _resumir(v for _, v in conteos)
+        intentos = periodo['enviados'] + periodo['fallidos']
+        return {
+            'hoy': _resumir(por_dia.get(hoy, [])),
+            'esta_semana': _resumir(v for d, vs in por_dia.items() if lunes <= d <= hoy for v in vs),
+            'periodo_dias': self.dias,
+            'periodo': {**periodo, 'tasa_fallo': round(periodo['fallidos'] / intentos * 100, 2) if intentos else 0},
+            'por_tipo': tipos,
+            'por_estado': {e: n for e, n in por_estado.items() if n},
+            'serie_diaria': serie,
+            'total_historico': total,
+        }
+
+    def totales(self) -> Dict[str, Any]:
+        """Formato de WhatsappRepository.obtener_estadisticas_whatsapp (tipos y estados del período)."""
+        r = self.resumen()
+        return {
+            'total_mensajes': r['total_historico'],
+            'mensajes_ultimo_mes': r['periodo']['total'] + r['periodo']['fallidos'],
+            'mensajes_por_tipo': {t: v['total'] + v['fallidos'] for t, v in r['por_tipo'].items()},
+            'mensajes_por_estado': r['por_estado'],
+        }
@@ -20,6 +20,7 @@ class Usuario(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     nombre: Mapped[str] = mapped_column(String(255), nullable=False)
     dni: Mapped[Optional[str]] = mapped_column(String(20), unique=True)
+    # usuarios.telefono_e164 (sin mapear) lo mantiene core/database/telefonos.py
     telefono: Mapped[str] = mapped_column(String(50), nullable=False)
     pin: Mapped[Optional[str]] = mapped_column(String(10), server_default='1234')
     rol: Mapped[str] = mapped_column(String(50), nullable=False, server_default='socio')
@@ -49,6 +50,7 @@ class Usuario(Base):
         Index('idx_usuarios_rol', 'rol'),
         Index('idx_usuarios_rol_nombre', 'rol', 'nombre'),
         Index('idx_usuarios_activo_rol_nombre', 'activo', 'rol', 'nombre'),
+        Index('idx_usuarios_fecha_registro', 'fecha_registro'),
     )
 
 # --- Pagos ---
@@ -73,9 +75,40 @@ class Pago(Base):
     __table_args__ = (
         UniqueConstraint('usuario_id', 'mes', 'año', name='idx_pagos_usuario_mes_año'),
         Index('idx_pagos_usuario_id', 'usuario_id'),
-        Index('idx_pagos_fecha', 'fecha_pago'),
         Index('idx_pagos_month_year', text('(EXTRACT(MONTH FROM fecha_pago))'), text('(EXTRACT(YEAR FROM fecha_pago))')),
-        Index('idx_pagos_usuario_fecha_desc', 'usuario_id', text('fecha_pago DESC')),
+        # Paginación por cursor (fecha_pago, id); cubren también los rangos por fecha
+        Index('idx_pagos_fecha_id', 'fecha_pago', 'id'),
+        Index('idx_pagos_usuario_fecha_id', 'usuario_id', 'fecha_pago', 'id'),
+        Index('idx_pagos_metodo_fecha_id', 'metodo_pago_id', 'fecha_pago', 'id'),
+    )
+
+# --- Resumen de ingresos (dashboards) ---
+
+class IngresoMensual(Base):
+    __tablename__ = 'ingresos_mensuales'
+
+    año: Mapped[int] = mapped_column(Integer, primary_key=True)
+    mes: Mapped[int] = mapped_column(Integer, primary_key=True)
+    metodo_pago_id: Mapped[int] = mapped_column(Integer, primary_key=True)  # 0 = sin método
+    tipo_cuota: Mapped[str] = mapped_column(String(100), primary_key=True)  # '' = sin tipo
+    total: Mapped[float] = mapped_column(Numeric(14, 2), nullable=False, server_default='0')
+    cantidad: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    pagadores: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    actualizado_en: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
+
+class IngresoPagadorMes(Base):
+    __tablename__ = 'ingresos_pagadores_mes'
+
+    año: Mapped[int] = mapped_column(Integer, primary_key=True)
+    mes: Mapped[int] = mapped_column(Integer, primary_key=True)
+    metodo_pago_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    usuario_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    tipo_cuota: Mapped[str] = mapped_column(String(100), nullable=False, server_default='')
+    pagos: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    total: Mapped[float] = mapped_column(Numeric(14, 2), nullable=False, server_default='0')
+
+    __table_args__ = (
+        Index('idx_ingresos_pagadores_mes_usuario', 'usuario_id'),
     )
 
 class PagoDetalle(Base):
@@ -157,6 +190,55 @@ class Asistencia(Base):
         Index('idx_asistencias_usuario_fecha_desc', 'usuario_id', text('fecha DESC')),
     )
 
+# --- Rollups de asistencias (dashboards) ---
+
+class AsistenciaDiaria(Base):
+    __tablename__ = 'asistencias_diarias'
+
+    fecha: Mapped[date] = mapped_column(Date, primary_key=True)
+    total: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    actualizado_en: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
+
+class AsistenciaHoraria(Base):
+    __tablename__ = 'asistencias_horarias'
+
+    fecha: Mapped[date] = mapped_column(Date, primary_key=True)
+    hora: Mapped[int] = mapped_column(Integer, primary_key=True)
+    dia_semana: Mapped[int] = mapped_column(Integer, nullable=False)
+    total: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+
+    __table_args__ = (
+        CheckConstraint('hora BETWEEN 0 AND 23', name='asistencias_horarias_hora_check'),
+        CheckConstraint('dia_semana BETWEEN 1 AND 7', name='asistencias_horarias_dia_semana_check'),
+        Index('idx_asistencias_horarias_dia_hora', 'dia_semana', 'hora'),
+    )
+
+class AsistenciaUsuarioMes(Base):
+    __tablename__ = 'asistencias_usuario_mes'
+
+    usuario_id: Mapped[int] = mapped_column(ForeignKey('usuarios.id', ondelete='CASCADE'), primary_key=True)
+    año: Mapped[int] = mapped_column(Integer, primary_key=True)
+    mes: Mapped[int] = mapped_column(Integer, primary_key=True)
+    total: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    ultima_fecha: Mapped[Optional[date]] = mapped_column(Date)
+
+    __table_args__ = (
+        Index('idx_asistencias_usuario_mes_periodo', 'año', 'mes'),
+    )
+
+class AsistenciaArchivo(Base):
+    __tablename__ = 'asistencias_archivos'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    particion: Mapped[str] = mapped_column(String(63), unique=True, nullable=False)
+    desde: Mapped[date] = mapped_column(Date, nullable=False)
+    hasta: Mapped[date] = mapped_column(Date, nullable=False)
+    filas: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    destino: Mapped[str] = mapped_column(String(20), nullable=False)
+    ubicacion: Mapped[str] = mapped_column(Text, nullable=False)
+    sha256: Mapped[Optional[str]] = mapped_column(String(64))
+    fecha_archivado: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
+
 # --- Clases ---
 
 class Clase(Base):
@@ -828,9 +910,44 @@ class NumeracionComprobante(Base):
     separador: Mapped[str] = mapped_column(String(5), nullable=False, server_default='-')
     reiniciar_anual: Mapped[Optional[bool]] = mapped_column(Boolean, server_default='false')
     longitud_numero: Mapped[int] = mapped_column(Integer, nullable=False, server_default='8')
+    incluir_año: Mapped[Optional[bool]] = mapped_column(Boolean, server_default='true')
+    incluir_mes: Mapped[Optional[bool]] = mapped_column(Boolean, server_default='false')
+    # Estricto: correlativo sin huecos (contador en contadores_comprobantes). Si no, secuencia de Postgres.
+    modo_estricto: Mapped[Optional[bool]] = mapped_column(Boolean, server_default='false')
     activo: Mapped[Optional[bool]] = mapped_column(Boolean, server_default='true')
     fecha_creacion: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
 
+class ContadorComprobante(Base):
+    __tablename__ = 'contadores_comprobantes'
+
+    tipo_comprobante: Mapped[str] = mapped_column(String(50), primary_key=True)
+    periodo: Mapped[int] = mapped_column(Integer, primary_key=True)  # año si reinicia anual, 0 si no
+    ultimo_numero: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+
+class ComprobantePago(Base):
+    __tablename__ = 'comprobantes_pago'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    tipo_comprobante: Mapped[str] = mapped_column(String(50), nullable=False, server_default='recibo')
+    pago_id: Mapped[Optional[int]] = mapped_column(ForeignKey('pagos.id', ondelete='CASCADE'))
+    usuario_id: Mapped[Optional[int]] = mapped_column(ForeignKey('usuarios.id', ondelete='SET NULL'))
+    numero_comprobante: Mapped[str] = mapped_column(String(50), nullable=False)
+    numero: Mapped[Optional[int]] = mapped_column(Integer)
+    periodo: Mapped[Optional[int]] = mapped_column(Integer)
+    monto_total: Mapped[Optional[float]] = mapped_column(Numeric(10, 2))
+    plantilla_id: Mapped[Optional[int]] = mapped_column(Integer)
+    datos_comprobante: Mapped[Optional[dict]] = mapped_column(JSONB)
+    archivo_pdf: Mapped[Optional[str]] = mapped_column(Text)
+    estado: Mapped[Optional[str]] = mapped_column(String(20), server_default='emitido')
+    emitido_por: Mapped[Optional[str]] = mapped_column(String(255))
+    fecha_creacion: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
+
+    __table_args__ = (
+        UniqueConstraint('tipo_comprobante', 'numero_comprobante', name='uq_comprobantes_pago_tipo_numero'),
+        Index('idx_comprobantes_pago_pago_id', 'pago_id'),
+        Index('idx_comprobantes_pago_numero', 'tipo_comprobante', 'periodo', 'numero'),
+    )
+
 class AuditLog(Base):
     __tablename__ = 'audit_logs'
     
@@ -985,6 +1102,8 @@ class ClaseAsistenciaHistorial(Base):
 # --- WhatsApp ---
 
 class WhatsappMessage(Base):
+    # En tenants migrados es una tabla particionada por mes de sent_at con PK (id, sent_at) y
+    # sin UNIQUE(message_id): la unicidad la da whatsapp_message_ids (ver whatsapp_retention_repository)
     __tablename__ = 'whatsapp_messages'
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -1002,8 +1121,171 @@ class WhatsappMessage(Base):
         Index('idx_whatsapp_messages_user_id', 'user_id'),
         Index('idx_whatsapp_messages_type_date', 'message_type', text('sent_at DESC')),
         Index('idx_whatsapp_messages_phone', 'phone_number'),
+        Index('idx_whatsapp_messages_phone_date', 'phone_number', text('sent_at DESC')),
     )
 
+class WhatsappMessageId(Base):
+    """message_id únicos de whatsapp_messages. Una tabla particionada no admite UNIQUE sin la
+    clave de partición, así que la deduplicación por message_id se hace acá (ver
+    whatsapp_retention_repository)."""
+    __tablename__ = 'whatsapp_message_ids'
+
+    message_id: Mapped[str] = mapped_column(String(100), primary_key=True)
+    sent_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, server_default=func.current_timestamp())
+
+    __table_args__ = (
+        Index('idx_whatsapp_message_ids_sent_at', 'sent_at'),
+    )
+
+class WhatsappResumenTelefono(Base):
+    """Resumen compacto de whatsapp_messages por teléfono, hasta la marca del consumidor
+    'resumen_telefonos' (ver WhatsappRetentionRepository.actualizar_resumen_telefonos)."""
+    __tablename__ = 'whatsapp_resumen_telefonos'
+
+    phone_number: Mapped[str] = mapped_column(String(20), primary_key=True)
+    user_id: Mapped[Optional[int]] = mapped_column(Integer)
+    ultimo_envio: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    ultimo_recibido: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    # Último fallo: (id, sent_at) es la clave de la fila en whatsapp_messages
+    ultimo_fallo: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    ultimo_fallo_id: Mapped[Optional[int]] = mapped_column(Integer)
+    enviados: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    fallidos: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    recibidos: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    actualizado: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
+
+    __table_args__ = (
+        Index('idx_whatsapp_resumen_telefonos_fallo', 'ultimo_fallo', postgresql_where=text("ultimo_fallo IS NOT NULL")),
+    )
+
+class WhatsappMensajeArchivo(Base):
+    __tablename__ = 'whatsapp_mensajes_archivos'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    particion: Mapped[str] = mapped_column(String(63), unique=True, nullable=False)
+    desde: Mapped[date] = mapped_column(Date, nullable=False)
+    hasta: Mapped[date] = mapped_column(Date, nullable=False)
+    filas: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    destino: Mapped[str] = mapped_column(String(20), nullable=False)
+    ubicacion: Mapped[str] = mapped_column(Text, nullable=False)
+    sha256: Mapped[Optional[str]] = mapped_column(String(64))
+    fecha_archivado: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
+
+class WhatsappOutbox(Base):
+    """Mensajes salientes pendientes de envío (ver core/whatsapp_dispatcher.py)."""
+    __tablename__ = 'whatsapp_outbox'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    idempotency_key: Mapped[str] = mapped_column(String(128), unique=True, nullable=False)
+    phone_number_id: Mapped[str] = mapped_column(String(50), nullable=False)
+    telefono: Mapped[str] = mapped_column(String(20), nullable=False)
+    # Cuerpo del mensaje para Graph API sin messaging_product/to (text, template, ...)
+    payload: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    user_id: Mapped[Optional[int]] = mapped_column(ForeignKey('usuarios.id', ondelete='SET NULL'))
+    message_type: Mapped[Optional[str]] = mapped_column(String(50))
+    contenido: Mapped[Optional[str]] = mapped_column(Text)
+    estado: Mapped[str] = mapped_column(String(20), nullable=False, server_default='pendiente')
+    intentos: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    proximo_intento: Mapped[datetime] = mapped_column(DateTime, nullable=False, server_default=func.current_timestamp())
+    bloqueado_hasta: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    message_id: Mapped[Optional[str]] = mapped_column(String(100))
+    ultimo_error: Mapped[Optional[str]] = mapped_column(Text)
+    creado: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
+    enviado: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+    __table_args__ = (
+        CheckConstraint("estado IN ('pendiente', 'enviando', 'enviado', 'fallido')", name='whatsapp_outbox_estado_check'),
+        Index('idx_whatsapp_outbox_pendientes', 'proximo_intento', 'id',
+              postgresql_where=text("estado IN ('pendiente', 'enviando')")),
+    )
+
+class WhatsappWebhookEvento(Base):
+    """Payload crudo de cada POST del webhook de WhatsApp, tal como llegó (ver core/whatsapp_webhook.py)."""
+    __tablename__ = 'whatsapp_webhook_eventos'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    payload: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    recibido: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
+    procesado: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    intentos: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    ultimo_error: Mapped[Optional[str]] = mapped_column(Text)
+
+    __table_args__ = (
+        Index('idx_whatsapp_webhook_eventos_pendientes', 'id', postgresql_where=text("procesado IS NULL")),
+        Index('idx_whatsapp_webhook_eventos_recibido', 'recibido'),
+    )
+
+class WhatsappConsumidor(Base):
+    """Último id procesado por cada consumidor de eventos (ver WhatsAppManager.process_pending_sends)."""
+    __tablename__ = 'whatsapp_consumidores'
+
+    nombre: Mapped[str] = mapped_column(String(50), primary_key=True)
+    ultimo_id: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    actualizado: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
+
+class WhatsappCampania(Base):
+    """Envío masivo de WhatsApp a un segmento de socios (ver core/whatsapp_campaigns.py)."""
+    __tablename__ = 'whatsapp_campanias'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    nombre: Mapped[str] = mapped_column(String(200), nullable=False)
+    estado: Mapped[str] = mapped_column(String(20), nullable=False, server_default='en_curso')
+    # 'texto': contenido con {{variables}}; 'plantilla': template_name + parametros con {{variables}}
+    tipo: Mapped[str] = mapped_column(String(20), nullable=False, server_default='texto')
+    contenido: Mapped[Optional[str]] = mapped_column(Text)
+    template_name: Mapped[Optional[str]] = mapped_column(String(255))
+    idioma: Mapped[Optional[str]] = mapped_column(String(10))
+    parametros: Mapped[Optional[list]] = mapped_column(JSONB)
+    segmento: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    mensajes_por_minuto: Mapped[int] = mapped_column(Integer, nullable=False, server_default='60')
+    silencio_desde: Mapped[Optional[time]] = mapped_column(Time)
+    silencio_hasta: Mapped[Optional[time]] = mapped_column(Time)
+    total: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    creada_por: Mapped[Optional[int]] = mapped_column(ForeignKey('usuarios.id', ondelete='SET NULL'))
+    creado: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
+    # Hasta dónde se usó el cupo de envíos por tasa (reloj de la base)
+    ultimo_avance: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    finalizado: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+    __table_args__ = (
+        CheckConstraint("estado IN ('en_curso', 'pausada', 'cancelada', 'completada')", name='whatsapp_campanias_estado_check'),
+        CheckConstraint("tipo IN ('texto', 'plantilla')", name='whatsapp_campanias_tipo_check'),
+        Index('idx_whatsapp_campanias_activas', 'id', postgresql_where=text("estado = 'en_curso'")),
+    )
+
+class WhatsappCampaniaDestinatario(Base):
+    """Un socio de una campaña y el estado de su mensaje (del outbox y de los webhooks de entrega)."""
+    __tablename__ = 'whatsapp_campania_destinatarios'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    campania_id: Mapped[int] = mapped_column(ForeignKey('whatsapp_campanias.id', ondelete='CASCADE'), nullable=False)
+    usuario_id: Mapped[Optional[int]] = mapped_column(ForeignKey('usuarios.id', ondelete='SET NULL'))
+    telefono: Mapped[Optional[str]] = mapped_column(String(50))
+    estado: Mapped[str] = mapped_column(String(20), nullable=False, server_default='pendiente')
+    motivo: Mapped[Optional[str]] = mapped_column(String(200))
+    outbox_id: Mapped[Optional[int]] = mapped_column(Integer)
+    message_id: Mapped[Optional[str]] = mapped_column(String(100))
+    actualizado: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
+
+    __table_args__ = (
+        CheckConstraint(
+            "estado IN ('pendiente', 'encolado', 'enviado', 'entregado', 'leido', 'fallido', 'omitido', 'cancelado')",
+            name='whatsapp_campania_destinatarios_estado_check'
+        ),
+        UniqueConstraint('campania_id', 'usuario_id', name='whatsapp_campania_destinatarios_campania_usuario_key'),
+        Index('idx_whatsapp_campania_destinatarios_estado', 'campania_id', 'estado', 'id'),
+        Index('idx_whatsapp_campania_destinatarios_outbox', 'outbox_id', postgresql_where=text("outbox_id IS NOT NULL")),
+    )
+
+class WhatsappBaja(Base):
+    """Teléfonos (E.164) que pidieron no recibir campañas: respondiendo BAJA o cargados a mano."""
+    __tablename__ = 'whatsapp_bajas'
+
+    telefono: Mapped[str] = mapped_column(String(20), primary_key=True)
+    usuario_id: Mapped[Optional[int]] = mapped_column(ForeignKey('usuarios.id', ondelete='SET NULL'))
+    origen: Mapped[str] = mapped_column(String(20), nullable=False, server_default='manual')
+    creado: Mapped[datetime] = mapped_column(DateTime, server_default=func.current_timestamp())
+
 class WhatsappTemplate(Base):
     __tablename__ = 'whatsapp_templates'
     
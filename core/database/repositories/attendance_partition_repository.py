@@ -0,0 +1,357 @@
+import io
+import re
+import gzip
+import hashlib
+from typing import List, Optional, Dict, Any, Tuple, Callable
+from datetime import date
+from sqlalchemy import select, text
+from .base import BaseRepository, asegurar_tabla
+from ..date_ranges import rango_mes, hoy_gym
+from ..orm_models import AsistenciaArchivo
+
+# Particiones mensuales de `asistencias` por RANGE (fecha): asistencias_pYYYYMM
+# más asistencias_default para filas fuera de rango. Las consultas que filtran
+# `fecha` con rangos sargables (ver date_ranges) sólo tocan las particiones del
+# período; los dashboards leen de los rollups, que conservan el histórico aunque
+# las particiones viejas se archiven.
+
+TABLA = 'asistencias'
+TABLA_MIGRACION = 'asistencias_part'
+PARTICION_DEFAULT = 'asistencias_default'
+TRIGGER_MIGRACION = 'asistencias_migracion_sync'
+_PATRON_PARTICION = re.compile(r'^asistencias_p(\d{4})(\d{2})$')
+
+
+def nombre_particion(año: int, mes: int) -> str:
+    return f"{TABLA}_p{int(año):04d}{int(mes):02d}"
+
+
+def _sumar_meses(año: int, mes: int, n: int) -> Tuple[int, int]:
+    total = año * 12 + (mes - 1) + n
+    return total // 12, total % 12 + 1
+
+
+class AttendancePartitionRepository(BaseRepository):
+
+    def _asegurar_tablas(self) -> None:
+        asegurar_tabla(self.db, AsistenciaArchivo)
+
+    def _existe_tabla(self, nombre: str) -> bool:
+        return self.db.scalar(text("SELECT to_regclass(:t) IS NOT NULL"), {'t': nombre}) or False
+
+    def esta_particionada(self, tabla: str = TABLA) -> bool:
+        return self.db.scalar(text(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:t))"
+        ), {'t': tabla}) or False
+
+    def listar_particiones(self, tabla: str = TABLA) -> List[Dict[str, Any]]:
+        filas = self.db.execute(text("""
+            SELECT c.relname, c.reltuples::bigint AS filas_estimadas
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(:t)
+            ORDER BY c.relname
+        """), {'t': tabla}).all()
+        return [self._item_particion(nombre, estimadas) for nombre, estimadas in filas]
+
+    def _item_particion(self, nombre: str, estimadas: Any) -> Dict[str, Any]:
+        m = _PATRON_PARTICION.match(nombre)
+        item = {'particion': nombre, 'filas_estimadas': max(int(estimadas or 0), 0), 'desde': None, 'hasta': None}
+        if m:
+            rango = rango_mes(int(m.group(1)), int(m.group(2)))
+            item['desde'] = rango.fecha_inicio
+            item['hasta'] = rango.fecha_fin
+        return item
+
+    def _particiones_desvinculadas(self) -> List[Dict[str, Any]]:
+        """Tablas asistencias_pYYYYMM ya desvinculadas por un archivo que no terminó."""
+        filas = self.db.execute(text("""
+            SELECT c.relname, c.reltuples::bigint
+            FROM pg_class c
+            WHERE c.relkind = 'r' AND NOT c.relispartition AND pg_table_is_visible(c.oid)
+              AND c.relname ~ '^asistencias_p[0-9]{6}$'
+            ORDER BY c.relname
+        """)).all()
+        return [self._item_particion(nombre, estimadas) for nombre, estimadas in filas]
+
+    def _es_particion(self, nombre: str) -> bool:
+        return self.db.scalar(text(
+            "SELECT COALESCE((SELECT relispartition FROM pg_class WHERE oid = to_regclass(:t)), false)"
+        ), {'t': nombre}) or False
+
+    def crear_particion(self, año: int, mes: int, tabla: str = TABLA) -> bool:
+        """Crea la partición del mes si no existe. Si la partición default ya tiene
+        filas de ese mes, las mueve a la nueva partición. No hace commit."""
+        nombre = nombre_particion(año, mes)
+        if self._existe_tabla(nombre):
+            return False
+        rango = rango_mes(año, mes)
+        params = {'desde': rango.fecha_inicio, 'hasta': rango.fecha_fin}
+        ddl = (
+            f"CREATE TABLE {nombre} PARTITION OF {tabla} "
+            f"FOR VALUES FROM ('{rango.fecha_inicio.isoformat()}') TO ('{rango.fecha_fin.isoformat()}')"
+        )
+        pendientes = 0
+        if self._existe_tabla(PARTICION_DEFAULT):
+            pendientes = self.db.scalar(text(
+                f"SELECT COUNT(*) FROM {PARTICION_DEFAULT} WHERE fecha >= :desde AND fecha < :hasta"
+            ), params) or 0
+        if pendientes:
+            self.db.execute(text(
+                f"CREATE TEMP TABLE _asistencias_mover ON COMMIT DROP AS "
+                f"SELECT * FROM {PARTICION_DEFAULT} WHERE fecha >= :desde AND fecha < :hasta"
+            ), params)
+            self.db.execute(text(
+                f"DELETE FROM {PARTICION_DEFAULT} WHERE fecha >= :desde AND fecha < :hasta"
+            ), params)
+            self.db.execute(text(ddl))
+            self.db.execute(text(f"INSERT INTO {tabla} SELECT * FROM _asistencias_mover"))
+            self.db.execute(text("DROP TABLE _asistencias_mover"))
+        else:
+            self.db.execute(text(ddl))
+        return True
+
+    def crear_particiones(self, desde: date, meses_futuros: int = 3, tabla: str = TABLA) -> List[str]:
+        """Asegura particiones desde el mes de `desde` hasta `meses_futuros` después del actual."""
+        hoy = hoy_gym()
+        año, mes = desde.year, desde.month
+        fin_año, fin_mes = _sumar_meses(hoy.year, hoy.month, max(int(meses_futuros), 0))
+        creadas = []
+        while (año, mes) <= (fin_año, fin_mes):
+            if self.crear_particion(año, mes, tabla):
+                creadas.append(nombre_particion(año, mes))
+            año, mes = _sumar_meses(año, mes, 1)
+        if not self._existe_tabla(PARTICION_DEFAULT):
+            self.db.execute(text(f"CREATE TABLE {PARTICION_DEFAULT} PARTITION OF {tabla} DEFAULT"))
+            creadas.append(PARTICION_DEFAULT)
+        return creadas
+
+    def crear_particiones_futuras(self, meses_futuros: int = 3) -> List[str]:
+        if not self.esta_particionada():
+            return []
+        hoy = hoy_gym()
+        creadas = self.crear_particiones(date(hoy.year, hoy.month, 1), meses_futuros)
+        self.db.commit()
+        return creadas
+
+    def particiones_a_archivar(self, retencion_meses: int) -> List[Dict[str, Any]]:
+        hoy = hoy_gym()
+        año, mes = _sumar_meses(hoy.year, hoy.month, -max(int(retencion_meses), 1))
+        limite = date(año, mes, 1)
+        vencidas = [p for p in self.listar_particiones() if p['hasta'] and p['hasta'] <= limite]
+        return vencidas + self._particiones_desvinculadas()
+
+    def _exportar_csv_gz(self, nombre: str) -> Tuple[bytes, int]:
+        filas = self.db.scalar(text(f"SELECT COUNT(*) FROM {nombre}")) or 0
+        buf = io.BytesIO()
+        cur = self.db.connection().connection.cursor()
+        try:
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+                cur.copy_expert(f"COPY (SELECT * FROM {nombre} ORDER BY fecha, id) TO STDOUT WITH CSV HEADER", gz)
+        finally:
+            cur.close()
+        return buf.getvalue(), int(filas)
+
+    def archivar_particion(self, particion: Dict[str, Any], destino: str,
+                           guardar: Callable[[bytes, str], Optional[str]]) -> Optional[Dict[str, Any]]:
+        """Desvincula la partición, la exporta a CSV comprimido y la elimina.
+
+        El DETACH se confirma en su propia transacción: el lock ACCESS EXCLUSIVE sobre
+        `asistencias` dura sólo eso y no la exportación ni la subida. La tabla suelta se
+        exporta, `guardar(datos, nombre_archivo)` la persiste y devuelve su ubicación, y
+        recién entonces se elimina en una segunda transacción. Si `guardar` devuelve None
+        la partición se vuelve a vincular; si el proceso se corta a mitad, la tabla suelta
+        vuelve a aparecer en particiones_a_archivar.
+        """
+        nombre = particion['particion']
+        m = _PATRON_PARTICION.match(nombre)
+        if not m:
+            raise ValueError(f"Partición inválida: {nombre}")
+        self._asegurar_tablas()
+        try:
+            if self._es_particion(nombre):
+                self.db.execute(text(f"ALTER TABLE {TABLA} DETACH PARTITION {nombre}"))
+                self.db.commit()
+                self._invalidate_cache('asistencias')
+            datos, filas = self._exportar_csv_gz(nombre)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        try:
+            ubicacion = guardar(datos, f"{nombre}.csv.gz")
+        except Exception:
+            self._revincular(nombre, int(m.group(1)), int(m.group(2)))
+            raise
+        if not ubicacion:
+            self._revincular(nombre, int(m.group(1)), int(m.group(2)))
+            return None
+        try:
+            self.db.execute(text(f"DROP TABLE {nombre}"))
+            self.db.add(AsistenciaArchivo(
+                particion=nombre,
+                desde=particion['desde'],
+                hasta=particion['hasta'],
+                filas=filas,
+                destino=destino,
+                ubicacion=ubicacion,
+                sha256=hashlib.sha256(datos).hexdigest(),
+            ))
+            self.db.commit()
+            return {'particion': nombre, 'filas': filas, 'destino': destino, 'ubicacion': ubicacion}
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def _revincular(self, nombre: str, año: int, mes: int) -> None:
+        """Vuelve a vincular una partición desvinculada; si falla queda suelta para el próximo archivo."""
+        rango = rango_mes(año, mes)
+        try:
+            self.db.execute(text(
+                f"ALTER TABLE {TABLA} ATTACH PARTITION {nombre} "
+                f"FOR VALUES FROM ('{rango.fecha_inicio.isoformat()}') TO ('{rango.fecha_fin.isoformat()}')"
+            ))
+            self.db.commit()
+            self._invalidate_cache('asistencias')
+        except Exception as e:
+            self.db.rollback()
+            self.logger.error(f"No se pudo volver a vincular {nombre}: {e}")
+
+    def obtener_archivos(self) -> List[Dict[str, Any]]:
+        self._asegurar_tablas()
+        stmt = select(AsistenciaArchivo).order_by(AsistenciaArchivo.desde.desc())
+        return [
+            {'particion': a.particion, 'desde': a.desde, 'hasta': a.hasta, 'filas': a.filas,
+             'destino': a.destino, 'ubicacion': a.ubicacion, 'fecha_archivado': a.fecha_archivado}
+            for a in self.db.scalars(stmt).all()
+        ]
+
+    # --- Migración online de una tabla existente ---
+
+    def preparar_migracion(self, meses_futuros: int = 3) -> bool:
+        """Crea `asistencias_part` particionada con la misma estructura y el trigger que la
+        mantiene al día con las filas ya copiadas. Idempotente."""
+        if self._existe_tabla(TABLA_MIGRACION):
+            if not self.db.scalar(text(
+                "SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = :n AND tgrelid = to_regclass(:t))"
+            ), {'n': TRIGGER_MIGRACION, 't': TABLA}):
+                self._crear_trigger_migracion()
+                self.db.commit()
+            return False
+        self.db.execute(text(f"""
+            CREATE TABLE {TABLA_MIGRACION} (LIKE {TABLA} INCLUDING DEFAULTS)
+            PARTITION BY RANGE (fecha)
+        """))
+        self.db.execute(text(f"ALTER TABLE {TABLA_MIGRACION} ALTER COLUMN fecha SET NOT NULL"))
+        self.db.execute(text(f"ALTER TABLE {TABLA_MIGRACION} ADD PRIMARY KEY (id, fecha)"))
+        self.db.execute(text(f"ALTER TABLE {TABLA_MIGRACION} ADD UNIQUE (usuario_id, fecha)"))
+        self.db.execute(text(
+            f"ALTER TABLE {TABLA_MIGRACION} ADD FOREIGN KEY (usuario_id) REFERENCES usuarios(id) ON DELETE CASCADE"
+        ))
+        self.db.execute(text(f"CREATE INDEX ON {TABLA_MIGRACION} (fecha)"))
+        self.db.execute(text(f"CREATE INDEX ON {TABLA_MIGRACION} (usuario_id, fecha DESC)"))
+        primera = self.db.scalar(text(f"SELECT MIN(fecha) FROM {TABLA}")) or hoy_gym()
+        self.crear_particiones(date(primera.year, primera.month, 1), meses_futuros, tabla=TABLA_MIGRACION)
+        self._crear_trigger_migracion()
+        self.db.commit()
+        return True
+
+    def _crear_trigger_migracion(self) -> None:
+        """Replica en `asistencias_part` los UPDATE y DELETE de filas ya copiadas.
+
+        Las filas todavía no copiadas no se tocan: las trae el lote que les toque. No hace commit.
+        """
+        self.db.execute(text(f"""
+            CREATE OR REPLACE FUNCTION {TRIGGER_MIGRACION}() RETURNS trigger AS $$
+            BEGIN
+                DELETE FROM {TABLA_MIGRACION} WHERE id = OLD.id;
+                IF FOUND AND TG_OP = 'UPDATE' THEN
+                    INSERT INTO {TABLA_MIGRACION} (id, usuario_id, fecha, hora_registro, hora_entrada)
+                    VALUES (NEW.id, NEW.usuario_id, COALESCE(NEW.fecha, NEW.hora_registro::date, CURRENT_DATE),
+                            NEW.hora_registro, NEW.hora_entrada);
+                END IF;
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql
+        """))
+        self.db.execute(text(f"DROP TRIGGER IF EXISTS {TRIGGER_MIGRACION} ON {TABLA}"))
+        self.db.execute(text(f"""
+            CREATE TRIGGER {TRIGGER_MIGRACION} AFTER UPDATE OR DELETE ON {TABLA}
+            FOR EACH ROW EXECUTE FUNCTION {TRIGGER_MIGRACION}()
+        """))
+
+    # Lote por keyset (id > cursor ORDER BY id LIMIT): los huecos de id (filas borradas) no
+    # dejan lotes vacíos. FOR SHARE: un UPDATE concurrente termina antes de que se copie la
+    # fila (y se copia su versión nueva) o espera a que el lote confirme y el trigger lo replica
+    _SQL_COPIAR_LOTE = f"""
+        WITH lote AS (
+            SELECT id, usuario_id, COALESCE(fecha, hora_registro::date, CURRENT_DATE) AS fecha,
+                   hora_registro, hora_entrada
+            FROM {TABLA}
+            WHERE id > :desde
+            ORDER BY id
+            LIMIT :lote
+            FOR SHARE
+        ), copiadas AS (
+            INSERT INTO {TABLA_MIGRACION} (id, usuario_id, fecha, hora_registro, hora_entrada)
+            SELECT id, usuario_id, fecha, hora_registro, hora_entrada FROM lote
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM lote), (SELECT MAX(id) FROM lote), (SELECT COUNT(*) FROM copiadas)
+    """
+
+    # Filas que confirmaron después de que el cursor pasó por su id (transacciones largas)
+    _SQL_COPIAR_FALTANTES = f"""
+        INSERT INTO {TABLA_MIGRACION} (id, usuario_id, fecha, hora_registro, hora_entrada)
+        SELECT a.id, a.usuario_id, COALESCE(a.fecha, a.hora_registro::date, CURRENT_DATE), a.hora_registro, a.hora_entrada
+        FROM {TABLA} a
+        WHERE NOT EXISTS (SELECT 1 FROM {TABLA_MIGRACION} p WHERE p.id = a.id)
+        ON CONFLICT DO NOTHING
+    """
+
+    def copiar_lote_migracion(self, lote: int, desde: Optional[int] = None) -> Tuple[int, Optional[int]]:
+        """Copia hasta `lote` filas con id mayor a `desde` y hace commit.
+
+        Sin `desde` se retoma desde el mayor id ya copiado. Devuelve (filas_copiadas, cursor):
+        el cursor es el último id leído, para pasarlo en la llamada siguiente, o None si no
+        quedan filas.
+        """
+        if desde is None:
+            desde = self.db.scalar(text(f"SELECT COALESCE(MAX(id), 0) FROM {TABLA_MIGRACION}")) or 0
+        lote = max(1, int(lote))
+        leidas, cursor, filas = self.db.execute(text(self._SQL_COPIAR_LOTE), {'desde': int(desde), 'lote': lote}).one()
+        self.db.commit()
+        if not leidas or leidas < lote:
+            return int(filas or 0), None
+        return int(filas or 0), int(cursor)
+
+    def finalizar_migracion(self) -> Dict[str, Any]:
+        """Copia el remanente bajo lock de escritura y hace el swap de tablas en una transacción corta.
+
+        El remanente es un anti-join por id contra toda la tabla: además de las filas nuevas trae
+        las que confirmaron tarde, con id por debajo del cursor de los lotes.
+        """
+        secuencia = self.db.scalar(text("SELECT pg_get_serial_sequence(:t, 'id')"), {'t': TABLA})
+        # Pasada sin lock para que la de abajo, con las escrituras bloqueadas, encuentre poco
+        remanente = self.db.execute(text(self._SQL_COPIAR_FALTANTES)).rowcount
+        self.db.commit()
+        self.db.execute(text(f"LOCK TABLE {TABLA} IN SHARE ROW EXCLUSIVE MODE"))
+        maximo = self.db.scalar(text(f"SELECT COALESCE(MAX(id), 0) FROM {TABLA}")) or 0
+        remanente += self.db.execute(text(self._SQL_COPIAR_FALTANTES)).rowcount
+        eliminadas = self.db.execute(text(f"""
+            DELETE FROM {TABLA_MIGRACION} p
+            WHERE NOT EXISTS (SELECT 1 FROM {TABLA} a WHERE a.id = p.id)
+        """)).rowcount
+        self.db.execute(text(f"DROP TRIGGER IF EXISTS {TRIGGER_MIGRACION} ON {TABLA}"))
+        self.db.execute(text(f"DROP FUNCTION IF EXISTS {TRIGGER_MIGRACION}()"))
+        self.db.execute(text(f"ALTER TABLE {TABLA} RENAME TO {TABLA}_legacy"))
+        self.db.execute(text(f"ALTER TABLE {TABLA_MIGRACION} RENAME TO {TABLA}"))
+        nueva_secuencia = self.db.scalar(text("SELECT pg_get_serial_sequence(:t, 'id')"), {'t': TABLA})
+        if nueva_secuencia:
+            self.db.execute(text("SELECT setval(CAST(:s AS regclass), GREATEST(:m, 1))"),
+                            {'s': nueva_secuencia, 'm': maximo})
+        elif secuencia:
+            self.db.execute(text(f"ALTER SEQUENCE {secuencia} OWNED BY {TABLA}.id"))
+        self.db.commit()
+        self._invalidate_cache('asistencias')
+        return {'remanente': remanente, 'eliminadas': eliminadas, 'tabla_anterior': f"{TABLA}_legacy"}
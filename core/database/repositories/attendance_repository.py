@@ -1,8 +1,26 @@
 from typing import List, Optional, Dict, Any, Tuple, Set
 from datetime import datetime, date, timedelta, time
 from sqlalchemy import select, update, insert, delete, func, text, desc, and_
-from .base import BaseRepository
-from ..orm_models import Asistencia, Usuario, CheckinPending, Pago, ClaseAsistenciaHistorial, ClaseHorario, Clase
+from sqlalchemy.orm import Session
+from .base import BaseRepository, asegurar_tabla
+from ..date_ranges import hoy_gym
+from ..orm_models import (
+    Asistencia, Usuario, CheckinPending, Pago, ClaseAsistenciaHistorial, ClaseHorario, Clase,
+    AsistenciaDiaria, AsistenciaHoraria, AsistenciaUsuarioMes
+)
+
+
+def asegurar_rollups_asistencias(db) -> None:
+    """Tablas de rollups en tenants anteriores a ellas (una vez por proceso y base).
+
+    Si hubo que crear alguna, las puebla desde `asistencias` en una sesión aparte: la
+    transacción de `db` no se toca y lo que tenga sin confirmar lo acumula su propia alta.
+    """
+    creadas = [asegurar_tabla(db, m) for m in (AsistenciaDiaria, AsistenciaHoraria, AsistenciaUsuarioMes)]
+    if any(creadas):
+        with Session(db.get_bind()) as sesion:
+            AttendanceRepository(sesion).reconstruir_rollups_asistencias()
+
 
 class AttendanceRepository(BaseRepository):
     
@@ -19,13 +37,14 @@ class AttendanceRepository(BaseRepository):
             
         asistencia = Asistencia(usuario_id=usuario_id, fecha=fecha, hora_registro=datetime.now())
         self.db.add(asistencia)
+        self._acumular_rollups([(usuario_id, fecha, asistencia.hora_registro)])
         self.db.commit()
         self.db.refresh(asistencia)
         self._invalidate_cache('asistencias')
         return asistencia.id
 
     def obtener_ids_asistencia_hoy(self) -> Set[int]:
-        hoy = date.today()
+        hoy = hoy_gym()
         stmt = select(Asistencia.usuario_id).where(Asistencia.fecha == hoy)
         return set(self.db.scalars(stmt).all())
 
@@ -49,18 +68,19 @@ class AttendanceRepository(BaseRepository):
 
     def registrar_asistencia(self, usuario_id: int, fecha: date = None) -> int:
         if fecha is None:
-            fecha = date.today()
+            fecha = hoy_gym()
         return self.registrar_asistencia_comun(usuario_id, fecha)
 
     def registrar_asistencias_batch(self, asistencias: List[Dict[str, Any]]) -> Dict[str, Any]:
         result = {'insertados': [], 'omitidos': [], 'count': 0}
         now = datetime.now()
+        filas_rollup = []
         
         for item in asistencias:
             try:
                 uid = int(item.get('usuario_id'))
                 f = item.get('fecha')
-                if not f: f = date.today()
+                if not f: f = hoy_gym()
                 elif isinstance(f, str): f = datetime.fromisoformat(f).date()
                 
                 user = self.db.get(Usuario, uid)
@@ -77,10 +97,12 @@ class AttendanceRepository(BaseRepository):
                 self.db.add(new_a)
                 self.db.flush()
                 result['insertados'].append(new_a.id)
+                filas_rollup.append((uid, f, now))
                 
             except Exception as e:
                 result['omitidos'].append({'usuario_id': item.get('usuario_id'), 'motivo': str(e)})
                 
+        self._acumular_rollups(filas_rollup)
         self.db.commit()
         result['count'] = len(result['insertados'])
         self._invalidate_cache('asistencias')
@@ -125,7 +147,7 @@ class AttendanceRepository(BaseRepository):
             return (False, "El token no corresponde al socio autenticado")
             
         try:
-            self.registrar_asistencia(socio_id, date.today())
+            self.registrar_asistencia(socio_id, hoy_gym())
             cp.used = True
             self.db.commit()
             return (True, "Asistencia registrada")
@@ -136,19 +158,153 @@ class AttendanceRepository(BaseRepository):
         except Exception as e:
             return (False, str(e))
 
+    def procesar_checkins_offline(self, escaneos: List[Dict[str, Any]], rechazar_vencidos: bool = True,
+                                  tolerancia_s: int = 300) -> Dict[str, Any]:
+        """Reproduce en bloque check-ins registrados sin conexión (firmas ya verificadas).
+
+        Cada escaneo: {ref, usuario_id, ts (epoch en segundos), token}. La fecha de la
+        asistencia es la del momento del escaneo en la zona horaria de la sesión de la base.
+        El token debe existir en `checkin_pending`, ser del socio, no estar usado y estar
+        vigente al escanear (± `tolerancia_s` por el reloj del kiosco); la misma sentencia
+        que lee los escaneos lo marca usado, así que dos reenvíos concurrentes no pueden
+        consumirlo dos veces. Deduplica contra `asistencias` y dentro del propio lote, y
+        reporta conflictos (token inexistente/usado/vencido/ajeno, usuario inexistente o
+        inactivo, membresía vencida al escanear). Todo en una transacción.
+        """
+        resultados: List[Dict[str, Any]] = []
+        if not escaneos:
+            return {'procesados': 0, 'registrados': 0, 'duplicados': 0, 'conflictos': 0, 'detalle': resultados}
+
+        # expires_at se guarda en UTC (datetime.utcnow) y created_at con la hora de la sesión:
+        # ambos se llevan a UTC para compararlos con el instante del escaneo.
+        filas = self.db.execute(text("""
+            WITH n AS (
+                SELECT s.ref, s.usuario_id, NULLIF(s.token, '') AS token,
+                       to_timestamp(s.ts)::timestamp AS escaneado_en,
+                       to_timestamp(s.ts) AT TIME ZONE 'UTC' AS escaneado_utc
+                FROM unnest(CAST(:refs AS text[]), CAST(:uids AS integer[]),
+                            CAST(:tss AS double precision[]), CAST(:tokens AS text[]))
+                     AS s(ref, usuario_id, ts, token)
+            ),
+            primero AS (
+                SELECT DISTINCT ON (token) token, ref, usuario_id, escaneado_utc
+                FROM n
+                WHERE token IS NOT NULL
+                ORDER BY token, escaneado_en, ref
+            ),
+            reclamados AS (
+                UPDATE checkin_pending cp
+                SET used = TRUE
+                FROM primero p
+                WHERE cp.token = p.token
+                  AND cp.used IS NOT TRUE
+                  AND cp.usuario_id = p.usuario_id
+                  AND p.escaneado_utc <= cp.expires_at + make_interval(secs => :tolerancia)
+                  AND p.escaneado_utc >= (cp.created_at AT TIME ZONE current_setting('TimeZone')) AT TIME ZONE 'UTC'
+                                         - make_interval(secs => :tolerancia)
+                RETURNING cp.token, p.ref
+            )
+            SELECT n.ref, n.usuario_id, n.token, n.escaneado_en, n.escaneado_en::date AS fecha,
+                   u.id IS NOT NULL AS existe, COALESCE(u.activo, FALSE) AS activo,
+                   LOWER(COALESCE(u.rol, 'socio')) AS rol, u.fecha_proximo_vencimiento,
+                   a.id IS NOT NULL AS ya_registrada,
+                   cp.id IS NOT NULL AS token_existe, cp.usuario_id AS token_usuario_id,
+                   COALESCE(cp.used, FALSE) AS token_usado,
+                   r.ref IS NOT NULL AS token_reclamado
+            FROM n
+            LEFT JOIN usuarios u ON u.id = n.usuario_id
+            LEFT JOIN asistencias a ON a.usuario_id = n.usuario_id AND a.fecha = n.escaneado_en::date
+            LEFT JOIN checkin_pending cp ON cp.token = n.token
+            LEFT JOIN reclamados r ON r.token = n.token AND r.ref = n.ref
+            ORDER BY n.escaneado_en, n.ref
+        """), {
+            'refs': [str(e.get('ref') or i) for i, e in enumerate(escaneos)],
+            'uids': [int(e['usuario_id']) for e in escaneos],
+            'tss': [float(e['ts']) for e in escaneos],
+            'tokens': [str(e.get('token') or '') for e in escaneos],
+            'tolerancia': int(tolerancia_s),
+        }).all()
+
+        vistos: Set[Tuple[int, date]] = set()
+        tokens_lote: Set[str] = set()
+        aceptados = []
+        for r in filas:
+            item = {'ref': r.ref, 'usuario_id': r.usuario_id, 'fecha': r.fecha.isoformat(),
+                    'escaneado_en': r.escaneado_en.isoformat()}
+            exento = r.rol in ('profesor', 'owner', 'dueño', 'dueno')
+            clave = (r.usuario_id, r.fecha)
+            if not r.existe:
+                item.update(resultado='conflicto', motivo='usuario_inexistente')
+            elif not r.token_existe:
+                item.update(resultado='conflicto', motivo='token_inexistente')
+            elif r.token_usuario_id != r.usuario_id:
+                item.update(resultado='conflicto', motivo='token_ajeno')
+            elif not r.token_reclamado:
+                # Usado antes de este lote, por otro escaneo del lote o fuera de su vigencia.
+                motivo = 'token_usado' if r.token_usado or r.token in tokens_lote else 'token_vencido'
+                item.update(resultado='conflicto', motivo=motivo)
+            elif r.ya_registrada or clave in vistos:
+                item.update(resultado='duplicado')
+            elif not r.activo and not exento:
+                item.update(resultado='conflicto', motivo='inactivo')
+            elif (rechazar_vencidos and not exento and r.fecha_proximo_vencimiento
+                  and r.fecha_proximo_vencimiento < r.fecha):
+                item.update(resultado='conflicto', motivo='membresia_vencida',
+                            vencimiento=r.fecha_proximo_vencimiento.isoformat())
+            else:
+                item.update(resultado='registrado')
+                aceptados.append((r.usuario_id, r.fecha, r.escaneado_en, item))
+            vistos.add(clave)
+            if r.token:
+                tokens_lote.add(r.token)
+            resultados.append(item)
+
+        if aceptados:
+            insertados = self.db.execute(text("""
+                INSERT INTO asistencias (usuario_id, fecha, hora_registro)
+                SELECT * FROM unnest(CAST(:uids AS integer[]), CAST(:fechas AS date[]), CAST(:horas AS timestamp[]))
+                ON CONFLICT (usuario_id, fecha) DO NOTHING
+                RETURNING usuario_id, fecha
+            """), {
+                'uids': [a[0] for a in aceptados],
+                'fechas': [a[1] for a in aceptados],
+                'horas': [a[2] for a in aceptados],
+            }).all()
+            ok = {(r.usuario_id, r.fecha) for r in insertados}
+            filas_rollup = []
+            for uid, fecha, hora, item in aceptados:
+                if (uid, fecha) in ok:
+                    filas_rollup.append((uid, fecha, hora))
+                else:
+                    item['resultado'] = 'duplicado'
+            self._acumular_rollups(filas_rollup)
+
+        self.db.commit()
+        self._invalidate_cache('asistencias')
+        return {
+            'procesados': len(resultados),
+            'registrados': sum(1 for d in resultados if d['resultado'] == 'registrado'),
+            'duplicados': sum(1 for d in resultados if d['resultado'] == 'duplicado'),
+            'conflictos': sum(1 for d in resultados if d['resultado'] == 'conflicto'),
+            'detalle': resultados,
+        }
+
     def obtener_asistencias_fecha(self, fecha: date) -> List[dict]:
         return self.obtener_asistencias_por_fecha(fecha)
 
     def eliminar_asistencia(self, asistencia_id: int):
         a = self.db.get(Asistencia, asistencia_id)
         if a:
+            fila = (a.usuario_id, a.fecha, a.hora_registro)
             self.db.delete(a)
+            self.db.flush()
+            self._acumular_rollups([fila], signo=-1)
             self.db.commit()
             self._invalidate_cache('asistencias')
 
     def obtener_estadisticas_asistencias(self, fecha_inicio: date = None, fecha_fin: date = None) -> dict:
-        if not fecha_inicio: fecha_inicio = date.today().replace(day=1)
-        if not fecha_fin: fecha_fin = date.today()
+        if not fecha_inicio: fecha_inicio = hoy_gym().replace(day=1)
+        if not fecha_fin: fecha_fin = hoy_gym()
         
         stmt = select(func.count(Asistencia.id), func.count(func.distinct(Asistencia.usuario_id)), func.count(func.distinct(Asistencia.fecha))).where(Asistencia.fecha.between(fecha_inicio, fecha_fin))
         row = self.db.execute(stmt).first()
@@ -163,15 +319,206 @@ class AttendanceRepository(BaseRepository):
         return stats
 
     def obtener_asistencias_por_dia(self, dias: int = 30):
-        fecha_limite = date.today() - timedelta(days=dias)
-        stmt = select(Asistencia.fecha, func.count(Asistencia.id)).where(Asistencia.fecha >= fecha_limite).group_by(Asistencia.fecha).order_by(Asistencia.fecha)
+        asegurar_rollups_asistencias(self.db)
+        fecha_limite = hoy_gym() - timedelta(days=dias)
+        stmt = select(AsistenciaDiaria.fecha, AsistenciaDiaria.total).where(
+            AsistenciaDiaria.fecha >= fecha_limite, AsistenciaDiaria.total > 0
+        ).order_by(AsistenciaDiaria.fecha)
         return list(self.db.execute(stmt).all())
 
+    # --- Rollups de asistencias ---
+    # asistencias_diarias, asistencias_horarias y asistencias_usuario_mes se mantienen
+    # en la misma transacción que el alta/baja de la asistencia; los dashboards leen
+    # sólo de estas tablas. reconstruir_rollups_asistencias() las recalcula desde cero.
+
+    _SQL_ROLLUP_DIARIO = text("""
+        INSERT INTO asistencias_diarias (fecha, total, actualizado_en)
+        VALUES (:fecha, :delta, CURRENT_TIMESTAMP)
+        ON CONFLICT (fecha) DO UPDATE
+        SET total = asistencias_diarias.total + EXCLUDED.total, actualizado_en = CURRENT_TIMESTAMP
+    """)
+    _SQL_ROLLUP_HORARIO = text("""
+        INSERT INTO asistencias_horarias (fecha, hora, dia_semana, total)
+        VALUES (:fecha, :hora, :dia_semana, :delta)
+        ON CONFLICT (fecha, hora) DO UPDATE
+        SET total = asistencias_horarias.total + EXCLUDED.total
+    """)
+    _SQL_ROLLUP_USUARIO_MES = text("""
+        INSERT INTO asistencias_usuario_mes (usuario_id, año, mes, total, ultima_fecha)
+        VALUES (:usuario_id, :anio, :mes, :delta, :ultima_fecha)
+        ON CONFLICT (usuario_id, año, mes) DO UPDATE
+        SET total = asistencias_usuario_mes.total + EXCLUDED.total,
+            ultima_fecha = GREATEST(asistencias_usuario_mes.ultima_fecha, EXCLUDED.ultima_fecha)
+    """)
+
+    def _acumular_rollups(self, filas: List[Tuple[int, date, Optional[datetime]]], signo: int = 1) -> None:
+        """Aplica (usuario_id, fecha, hora_registro) a los rollups. No hace commit."""
+        if not filas:
+            return
+        asegurar_rollups_asistencias(self.db)
+        diario: Dict[date, int] = {}
+        horario: Dict[Tuple[date, int], int] = {}
+        mensual: Dict[Tuple[int, int, int], date] = {}
+        conteo_mensual: Dict[Tuple[int, int, int], int] = {}
+        for usuario_id, fecha, hora_registro in filas:
+            hora = (hora_registro or datetime.now()).hour
+            diario[fecha] = diario.get(fecha, 0) + 1
+            horario[(fecha, hora)] = horario.get((fecha, hora), 0) + 1
+            clave = (int(usuario_id), fecha.year, fecha.month)
+            conteo_mensual[clave] = conteo_mensual.get(clave, 0) + 1
+            if clave not in mensual or fecha > mensual[clave]:
+                mensual[clave] = fecha
+
+        if signo > 0:
+            self.db.execute(self._SQL_ROLLUP_DIARIO, [
+                {'fecha': f, 'delta': n} for f, n in diario.items()
+            ])
+            self.db.execute(self._SQL_ROLLUP_HORARIO, [
+                {'fecha': f, 'hora': h, 'dia_semana': f.isoweekday(), 'delta': n}
+                for (f, h), n in horario.items()
+            ])
+            self.db.execute(self._SQL_ROLLUP_USUARIO_MES, [
+                {'usuario_id': u, 'anio': a, 'mes': m, 'delta': n, 'ultima_fecha': mensual[(u, a, m)]}
+                for (u, a, m), n in conteo_mensual.items()
+            ])
+            return
+
+        # Bajas: descontar sin crear filas nuevas ni dejar totales negativos
+        self.db.execute(text(
+            "UPDATE asistencias_diarias SET total = GREATEST(total - :delta, 0), actualizado_en = CURRENT_TIMESTAMP "
+            "WHERE fecha = :fecha"
+        ), [{'fecha': f, 'delta': n} for f, n in diario.items()])
+        self.db.execute(text(
+            "UPDATE asistencias_horarias SET total = GREATEST(total - :delta, 0) WHERE fecha = :fecha AND hora = :hora"
+        ), [{'fecha': f, 'hora': h, 'delta': n} for (f, h), n in horario.items()])
+        self.db.execute(text("""
+            UPDATE asistencias_usuario_mes um
+            SET total = GREATEST(um.total - :delta, 0),
+                ultima_fecha = (
+                    SELECT MAX(a.fecha) FROM asistencias a
+                    WHERE a.usuario_id = um.usuario_id
+                      AND a.fecha >= make_date(um.año, um.mes, 1)
+                      AND a.fecha < make_date(um.año, um.mes, 1) + INTERVAL '1 month'
+                )
+            WHERE um.usuario_id = :usuario_id AND um.año = :anio AND um.mes = :mes
+        """), [{'usuario_id': u, 'anio': a, 'mes': m, 'delta': n} for (u, a, m), n in conteo_mensual.items()])
+
+    def descontar_usuario_rollups_asistencias(self, usuario_id: int) -> None:
+        """Quita de los rollups todas las asistencias de un usuario (antes de borrarlo: la baja
+        en cascada no pasa por acá). No hace commit."""
+        asegurar_rollups_asistencias(self.db)
+        params = {'usuario_id': int(usuario_id)}
+        self.db.execute(text("""
+            UPDATE asistencias_diarias d
+            SET total = GREATEST(d.total - c.n, 0), actualizado_en = CURRENT_TIMESTAMP
+            FROM (SELECT fecha, COUNT(*) AS n FROM asistencias WHERE usuario_id = :usuario_id GROUP BY fecha) c
+            WHERE d.fecha = c.fecha
+        """), params)
+        self.db.execute(text("""
+            UPDATE asistencias_horarias h
+            SET total = GREATEST(h.total - c.n, 0)
+            FROM (
+                SELECT fecha, EXTRACT(HOUR FROM COALESCE(hora_registro, fecha::timestamp))::int AS hora, COUNT(*) AS n
+                FROM asistencias WHERE usuario_id = :usuario_id
+                GROUP BY 1, 2
+            ) c
+            WHERE h.fecha = c.fecha AND h.hora = c.hora
+        """), params)
+        self.db.execute(text("DELETE FROM asistencias_usuario_mes WHERE usuario_id = :usuario_id"), params)
+
+    def reconstruir_rollups_asistencias(self, desde: Optional[date] = None) -> Dict[str, int]:
+        """Recalcula los rollups desde `asistencias`. Sin `desde` reconstruye todo el histórico."""
+        asegurar_rollups_asistencias(self.db)
+        if desde is not None:
+            desde = desde.replace(day=1)
+        filtro = "WHERE fecha >= :desde" if desde else ""
+        params = {'desde': desde} if desde else {}
+
+        self.db.execute(text(f"DELETE FROM asistencias_diarias {filtro}"), params)
+        self.db.execute(text(f"DELETE FROM asistencias_horarias {filtro}"), params)
+        self.db.execute(text(
+            "DELETE FROM asistencias_usuario_mes"
+            + (" WHERE make_date(año, mes, 1) >= :desde" if desde else "")
+        ), params)
+
+        diarias = self.db.execute(text(f"""
+            INSERT INTO asistencias_diarias (fecha, total, actualizado_en)
+            SELECT fecha, COUNT(*), CURRENT_TIMESTAMP
+            FROM asistencias {filtro}
+            GROUP BY fecha
+        """), params).rowcount
+        horarias = self.db.execute(text(f"""
+            INSERT INTO asistencias_horarias (fecha, hora, dia_semana, total)
+            SELECT fecha, EXTRACT(HOUR FROM COALESCE(hora_registro, fecha::timestamp))::int,
+                   EXTRACT(ISODOW FROM fecha)::int, COUNT(*)
+            FROM asistencias {filtro}
+            GROUP BY 1, 2, 3
+        """), params).rowcount
+        mensuales = self.db.execute(text(f"""
+            INSERT INTO asistencias_usuario_mes (usuario_id, año, mes, total, ultima_fecha)
+            SELECT usuario_id, EXTRACT(YEAR FROM fecha)::int, EXTRACT(MONTH FROM fecha)::int, COUNT(*), MAX(fecha)
+            FROM asistencias {filtro}
+            GROUP BY 1, 2, 3
+        """), params).rowcount
+
+        self.db.commit()
+        self._invalidate_cache('asistencias')
+        return {'diarias': diarias, 'horarias': horarias, 'usuario_mes': mensuales}
+
+    @staticmethod
+    def _como_fecha(valor) -> Optional[date]:
+        if valor is None or isinstance(valor, date):
+            return valor
+        try:
+            return datetime.fromisoformat(str(valor).strip()).date()
+        except ValueError:
+            return None
+
+    def _rango_rollup(self, dias: int, fecha_inicio=None, fecha_fin=None) -> Tuple[date, date]:
+        inicio = self._como_fecha(fecha_inicio)
+        fin = self._como_fecha(fecha_fin)
+        if not inicio or not fin:
+            fin = hoy_gym()
+            inicio = fin - timedelta(days=dias - 1)
+        return inicio, fin
+
+    def obtener_asistencias_por_rango_diario(self, fecha_inicio, fecha_fin) -> List[Tuple[date, int]]:
+        asegurar_rollups_asistencias(self.db)
+        inicio, fin = self._rango_rollup(30, fecha_inicio, fecha_fin)
+        stmt = select(AsistenciaDiaria.fecha, AsistenciaDiaria.total).where(
+            AsistenciaDiaria.fecha >= inicio, AsistenciaDiaria.fecha <= fin, AsistenciaDiaria.total > 0
+        ).order_by(AsistenciaDiaria.fecha)
+        return list(self.db.execute(stmt).all())
+
+    def obtener_asistencias_por_hora(self, dias: int = 30, fecha_inicio=None, fecha_fin=None) -> List[Tuple[int, int]]:
+        asegurar_rollups_asistencias(self.db)
+        inicio, fin = self._rango_rollup(dias, fecha_inicio, fecha_fin)
+        stmt = select(AsistenciaHoraria.hora, func.sum(AsistenciaHoraria.total)).where(
+            AsistenciaHoraria.fecha >= inicio, AsistenciaHoraria.fecha <= fin
+        ).group_by(AsistenciaHoraria.hora).order_by(AsistenciaHoraria.hora)
+        return [(int(h), int(t or 0)) for h, t in self.db.execute(stmt).all()]
+
+    def obtener_asistencias_usuario_por_mes(self, usuario_id: int, meses: int = 12) -> List[Dict]:
+        asegurar_rollups_asistencias(self.db)
+        stmt = select(AsistenciaUsuarioMes).where(
+            AsistenciaUsuarioMes.usuario_id == usuario_id
+        ).order_by(AsistenciaUsuarioMes.año.desc(), AsistenciaUsuarioMes.mes.desc()).limit(meses)
+        return [
+            {'año': r.año, 'mes': r.mes, 'total': r.total, 'ultima_fecha': r.ultima_fecha}
+            for r in self.db.scalars(stmt).all()
+        ]
+
+    def obtener_total_asistencias_dia(self, fecha: date = None) -> int:
+        asegurar_rollups_asistencias(self.db)
+        return int(self.db.scalar(
+            select(AsistenciaDiaria.total).where(AsistenciaDiaria.fecha == (fecha or hoy_gym()))
+        ) or 0)
+
     # --- Class Attendance (Restored) ---
 
     def registrar_asistencia_clase(self, clase_horario_id: int, usuario_id: int, fecha_clase: date = None, estado: str = 'presente', observaciones: str = None, registrado_por: int = None) -> int:
         if not fecha_clase:
-            fecha_clase = date.today()
+            fecha_clase = hoy_gym()
             
         existing = self.db.scalar(select(ClaseAsistenciaHistorial).where(
             ClaseAsistenciaHistorial.clase_horario_id == clase_horario_id,
@@ -200,6 +547,105 @@ class AttendanceRepository(BaseRepository):
         self.db.refresh(hist)
         return hist.id
 
+    def registrar_pase_lista_clase(self, clase_horario_id: int, usuario_ids: List[int], fecha_clase: date = None,
+                                   registrado_por: int = None, permitir_no_inscriptos: bool = False,
+                                   marcar_ausentes: bool = False, registrar_asistencia_gym: bool = True) -> Dict[str, Any]:
+        """Pase de lista de una clase en una sola transacción.
+
+        Valida existencia, estado e inscripción (clase_usuarios) de todos los socios con una
+        única consulta y registra los presentes con inserts por conjunto. Devuelve el
+        resultado por socio: registrado | actualizado | no_encontrado | inactivo | no_inscripto.
+        """
+        if not fecha_clase:
+            fecha_clase = hoy_gym()
+        horario = self.db.get(ClaseHorario, clase_horario_id)
+        if not horario:
+            raise ValueError("Horario de clase no encontrado")
+
+        ids = []
+        for uid in usuario_ids or []:
+            try:
+                uid = int(uid)
+            except (TypeError, ValueError):
+                continue
+            if uid not in ids:
+                ids.append(uid)
+
+        resultados: Dict[int, Dict[str, Any]] = {}
+        validos: List[int] = []
+        if ids:
+            filas = self.db.execute(text("""
+                SELECT ids.usuario_id, u.id IS NOT NULL AS existe, u.nombre,
+                       COALESCE(u.activo, FALSE) AS activo,
+                       LOWER(COALESCE(u.rol, 'socio')) AS rol,
+                       cu.id IS NOT NULL AS inscripto
+                FROM unnest(CAST(:ids AS integer[])) AS ids(usuario_id)
+                LEFT JOIN usuarios u ON u.id = ids.usuario_id
+                LEFT JOIN clase_usuarios cu
+                       ON cu.usuario_id = ids.usuario_id AND cu.clase_horario_id = :hid
+            """), {'ids': ids, 'hid': clase_horario_id}).all()
+            for r in filas:
+                item = {'usuario_id': r.usuario_id, 'nombre': r.nombre}
+                exento = r.rol in ('profesor', 'owner', 'dueño', 'dueno')
+                if not r.existe:
+                    item['resultado'] = 'no_encontrado'
+                elif not r.activo and not exento:
+                    item['resultado'] = 'inactivo'
+                elif not r.inscripto and not permitir_no_inscriptos:
+                    item['resultado'] = 'no_inscripto'
+                else:
+                    validos.append(r.usuario_id)
+                resultados[r.usuario_id] = item
+
+        ahora = datetime.now()
+        ausentes = 0
+        if validos:
+            filas = self.db.execute(text("""
+                INSERT INTO clase_asistencia_historial
+                    (clase_horario_id, usuario_id, fecha_clase, estado_asistencia, hora_llegada, registrado_por)
+                SELECT :hid, x, :fecha, 'presente', :hora, :reg
+                FROM unnest(CAST(:ids AS integer[])) AS x
+                ON CONFLICT (clase_horario_id, usuario_id, fecha_clase) DO UPDATE
+                SET estado_asistencia = EXCLUDED.estado_asistencia,
+                    hora_llegada = COALESCE(clase_asistencia_historial.hora_llegada, EXCLUDED.hora_llegada),
+                    registrado_por = EXCLUDED.registrado_por
+                RETURNING usuario_id, (xmax = 0) AS insertado
+            """), {'hid': clase_horario_id, 'fecha': fecha_clase, 'hora': ahora.time(),
+                   'reg': registrado_por, 'ids': validos}).all()
+            for r in filas:
+                resultados[r.usuario_id]['resultado'] = 'registrado' if r.insertado else 'actualizado'
+
+            if registrar_asistencia_gym:
+                nuevos = self.db.execute(text("""
+                    INSERT INTO asistencias (usuario_id, fecha, hora_registro)
+                    SELECT x, :fecha, :ahora FROM unnest(CAST(:ids AS integer[])) AS x
+                    ON CONFLICT (usuario_id, fecha) DO NOTHING
+                    RETURNING usuario_id
+                """), {'fecha': fecha_clase, 'ahora': ahora, 'ids': validos}).scalars().all()
+                self._acumular_rollups([(uid, fecha_clase, ahora) for uid in nuevos])
+
+        if marcar_ausentes:
+            ausentes = self.db.execute(text("""
+                INSERT INTO clase_asistencia_historial
+                    (clase_horario_id, usuario_id, fecha_clase, estado_asistencia, registrado_por)
+                SELECT cu.clase_horario_id, cu.usuario_id, :fecha, 'ausente', :reg
+                FROM clase_usuarios cu
+                WHERE cu.clase_horario_id = :hid AND cu.usuario_id <> ALL(CAST(:ids AS integer[]))
+                ON CONFLICT (clase_horario_id, usuario_id, fecha_clase) DO NOTHING
+            """), {'hid': clase_horario_id, 'fecha': fecha_clase, 'reg': registrado_por, 'ids': validos}).rowcount
+
+        self.db.commit()
+        self._invalidate_cache('asistencias')
+        detalle = [resultados[uid] for uid in ids]
+        return {
+            'clase_horario_id': clase_horario_id,
+            'fecha_clase': fecha_clase.isoformat(),
+            'registrados': sum(1 for d in detalle if d.get('resultado') in ('registrado', 'actualizado')),
+            'rechazados': sum(1 for d in detalle if d.get('resultado') not in ('registrado', 'actualizado')),
+            'ausentes_marcados': ausentes,
+            'detalle': detalle,
+        }
+
     def obtener_historial_asistencia_clase(self, clase_horario_id: int, limit: int = 50) -> List[Dict]:
         stmt = select(ClaseAsistenciaHistorial, Usuario).join(Usuario, ClaseAsistenciaHistorial.usuario_id == Usuario.id).where(
             ClaseAsistenciaHistorial.clase_horario_id == clase_horario_id
@@ -27,6 +27,38 @@ class AuditRepository(BaseRepository):
             self.logger.error(f"Error registrando audit log: {e}")
             return None
 
+    @staticmethod
+    def filas_audit_log(entradas: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Filas para insert(AuditLog) con las claves de registrar_audit_log."""
+        filas = []
+        for e in entradas or []:
+            user_id = e.get('user_id')
+            if user_id is not None and user_id <= 1:
+                user_id = None
+            filas.append({
+                'user_id': user_id, 'action': e['action'], 'table_name': e['table_name'],
+                'record_id': e.get('record_id'),
+                'old_values': str(e['old_values']) if e.get('old_values') else None,
+                'new_values': str(e['new_values']) if e.get('new_values') else None,
+                'ip_address': e.get('ip_address'), 'user_agent': e.get('user_agent'),
+                'session_id': e.get('session_id'),
+            })
+        return filas
+
+    def registrar_audit_logs_batch(self, entradas: List[Dict[str, Any]]) -> int:
+        """Inserta varios audit logs en un solo INSERT. Cada entrada usa las claves de registrar_audit_log."""
+        filas = self.filas_audit_log(entradas)
+        if not filas:
+            return 0
+        try:
+            self.db.execute(insert(AuditLog), filas)
+            self.db.commit()
+            return len(filas)
+        except Exception as e:
+            self.db.rollback()
+            self.logger.error(f"Error registrando audit logs en lote: {e}")
+            return 0
+
     def obtener_audit_logs(self, limit: int = 100, offset: int = 0, user_id: int = None, 
                           table_name: str = None, action: str = None, fecha_inicio: str = None, 
                           fecha_fin: str = None) -> List[Dict]:
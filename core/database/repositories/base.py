@@ -1,8 +1,32 @@
-from typing import Any, Optional
+from typing import Any, Optional, Set
 import logging
+from sqlalchemy import inspect
 from sqlalchemy.orm import Session
 from ..connection import CacheManager
 
+# (base, tabla) ya verificadas en este proceso para las tablas creadas a demanda
+_ESQUEMAS: Set[str] = set()
+
+
+def asegurar_tabla(db, modelo) -> bool:
+    """Crea la tabla de `modelo` en tenants anteriores a ella (una vez por proceso y base).
+
+    Devuelve True si la creó en esta llamada (p.ej. para poblar un resumen desde cero).
+    """
+    try:
+        clave = f"{db.get_bind().url}|{modelo.__tablename__}"
+    except Exception:
+        clave = modelo.__tablename__
+    if clave in _ESQUEMAS:
+        return False
+    bind = db.get_bind()
+    creada = not inspect(bind).has_table(modelo.__tablename__)
+    if creada:
+        modelo.__table__.create(bind, checkfirst=True)
+    _ESQUEMAS.add(clave)
+    return creada
+
+
 class BaseRepository:
     def __init__(self, db: Session, cache: Optional[CacheManager] = None, logger: Optional[logging.Logger] = None):
         self.db = db
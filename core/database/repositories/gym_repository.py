@@ -2,13 +2,15 @@ from typing import List, Optional, Dict, Any, Tuple
 from sqlalchemy import select, update, insert, delete, func, text, desc, and_
 from sqlalchemy.orm import Session, joinedload
 from .base import BaseRepository
+from .payment_repository import asegurar_resumen_ingresos
+from ..date_ranges import hoy_gym
 from ..orm_models import (
     GymConfig, Configuracion, Ejercicio, Rutina, Clase, 
-    Pago, Usuario, AccionMasivaPendiente, ClaseHorario, ClaseUsuario,
+    Usuario, AccionMasivaPendiente, ClaseHorario, ClaseUsuario,
     ClaseListaEspera, ClaseBloque, ClaseBloqueItem, RutinaEjercicio,
     ClaseEjercicio
 )
-from datetime import datetime, date, time
+from datetime import datetime, time
 
 class GymRepository(BaseRepository):
     
@@ -253,9 +255,10 @@ class GymRepository(BaseRepository):
 
     # --- Stats & Legacy ---
     def obtener_arpu_y_morosos_mes_actual(self) -> Tuple[float, int]:
-        mes = date.today().month
-        año = date.today().year
-        
+        # Ingresos y pagadores del mes salen del resumen de ingresos (no se agrega `pagos`)
+        hoy = hoy_gym()
+        periodo = {'anio': hoy.year, 'mes': hoy.month}
+
         total_activos = self.db.scalar(
             select(func.count(Usuario.id)).where(
                 Usuario.activo == True, 
@@ -263,27 +266,21 @@ class GymRepository(BaseRepository):
             )
         ) or 0
         
-        ingresos = self.db.scalar(
-            select(func.sum(Pago.monto)).where(
-                func.extract('month', Pago.fecha_pago) == mes,
-                func.extract('year', Pago.fecha_pago) == año
-            )
-        ) or 0.0
+        asegurar_resumen_ingresos(self.db)
+        ingresos = self.db.scalar(text(
+            'SELECT COALESCE(SUM(total), 0) FROM ingresos_mensuales WHERE "año" = :anio AND mes = :mes'
+        ), periodo) or 0.0
         
         arpu = (float(ingresos) / total_activos) if total_activos > 0 else 0.0
         
-        subq = select(Pago.usuario_id).where(
-            func.extract('month', Pago.fecha_pago) == mes,
-            func.extract('year', Pago.fecha_pago) == año
-        )
-        
-        morosos = self.db.scalar(
-            select(func.count(Usuario.id)).where(
-                Usuario.activo == True,
-                Usuario.rol.in_(['socio', 'miembro']),
-                Usuario.id.not_in(subq)
-            )
-        ) or 0
+        morosos = self.db.scalar(text("""
+            SELECT COUNT(*) FROM usuarios u
+            WHERE u.activo = TRUE AND u.rol IN ('socio', 'miembro')
+              AND NOT EXISTS (
+                  SELECT 1 FROM ingresos_pagadores_mes h
+                  WHERE h.usuario_id = u.id AND h."año" = :anio AND h.mes = :mes AND h.pagos > 0
+              )
+        """), periodo) or 0
         
         return arpu, morosos
 
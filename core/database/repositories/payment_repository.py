@@ -1,11 +1,63 @@
-from typing import List, Optional, Dict, Any, Tuple
+import io
+import re
+import csv
+import json
+import base64
+from typing import List, Optional, Dict, Any, Tuple, Set, Iterator
 from datetime import datetime, date, timedelta
 from sqlalchemy import select, update, delete, func, text, desc
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from .base import BaseRepository
-from ..orm_models import Pago, TipoCuota, MetodoPago, ConceptoPago, Usuario, Configuracion
+from .base import BaseRepository, asegurar_tabla
+from ..date_ranges import rango_mes, rango_anio, rango_fechas, en_rango, hoy_gym
+from ..orm_models import Pago, TipoCuota, MetodoPago, ConceptoPago, Usuario, Configuracion, IngresoMensual, IngresoPagadorMes
+
+# Índices de la paginación por cursor (ver orm_models.Pago) y bases ya verificadas en este proceso
+_INDICES_PAGOS = {
+    'idx_pagos_fecha_id': '(fecha_pago, id)',
+    'idx_pagos_usuario_fecha_id': '(usuario_id, fecha_pago, id)',
+    'idx_pagos_metodo_fecha_id': '(metodo_pago_id, fecha_pago, id)',
+}
+_ESQUEMAS: Set[str] = set()
+
+
+def asegurar_resumen_ingresos(db) -> None:
+    """Tablas del resumen de ingresos en tenants anteriores a ellas (una vez por proceso y base).
+
+    Si hubo que crear alguna, las puebla desde `pagos` en una sesión aparte y sin el LOCK de
+    reconstruir_resumen_ingresos: quien llama puede tener ya pagos escritos en su transacción,
+    que después suma su propia alta.
+    """
+    creadas = [asegurar_tabla(db, m) for m in (IngresoMensual, IngresoPagadorMes)]
+    if any(creadas):
+        with Session(db.get_bind()) as sesion:
+            PaymentRepository(sesion).reconstruir_resumen_ingresos(bloquear=False)
 
 class PaymentRepository(BaseRepository):
+
+    def _clave_base(self) -> str:
+        try:
+            return str(self.db.get_bind().url)
+        except Exception:
+            return ''
+
+    def _asegurar_indices(self) -> None:
+        """Índices (…, fecha_pago, id) en tenants creados antes de que existieran (una vez por proceso).
+
+        Sólo crea los que faltan: CREATE INDEX toma un lock que bloquea escrituras en pagos
+        aun con IF NOT EXISTS, así que no se ejecuta si ya están todos.
+        """
+        clave = self._clave_base()
+        if clave in _ESQUEMAS:
+            return
+        existentes = set(self.db.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'pagos' AND indexname = ANY(:nombres)"
+        ), {'nombres': list(_INDICES_PAGOS)}).scalars().all())
+        for nombre, columnas in _INDICES_PAGOS.items():
+            if nombre not in existentes:
+                self.db.execute(text(f"CREATE INDEX IF NOT EXISTS {nombre} ON pagos {columnas}"))
+        self.db.commit()
+        _ESQUEMAS.add(clave)
     
     def obtener_ultimos_pagos(self, usuario_id: int, limit: int = 10) -> List[Dict]:
         stmt = select(Pago).where(Pago.usuario_id == usuario_id).order_by(Pago.fecha_pago.desc()).limit(limit)
@@ -56,11 +108,118 @@ class PaymentRepository(BaseRepository):
             for c in self.db.scalars(stmt).all()
         ]
 
+    def obtener_tipos_cuota(self, solo_activos: bool = False) -> List[Dict]:
+        stmt = select(TipoCuota).order_by(TipoCuota.nombre)
+        if solo_activos:
+            stmt = stmt.where(TipoCuota.activo == True)
+
+        return [
+            {'id': t.id, 'nombre': (t.nombre or '').strip(), 'precio': float(t.precio or 0.0),
+             'duracion_dias': int(t.duracion_dias or 30), 'activo': bool(t.activo),
+             'descripcion': t.descripcion, 'icono_path': t.icono_path}
+            for t in self.db.scalars(stmt).all()
+        ]
+
+    # --- Catálogos: altas/bajas/modificaciones con sello de versión ---
+    # Cada escritura incrementa configuracion['catalogos_version'] en la misma transacción;
+    # CatalogService compara ese número para saber si su copia en memoria sigue vigente.
+
+    _MODELOS_CATALOGO = {'metodos_pago': MetodoPago, 'tipos_cuota': TipoCuota, 'conceptos_pago': ConceptoPago}
+    _NOMBRES_CATALOGO = {'metodos_pago': 'método de pago', 'tipos_cuota': 'tipo de cuota', 'conceptos_pago': 'concepto de pago'}
+    CLAVE_VERSION_CATALOGOS = 'catalogos_version'
+
+    def obtener_version_catalogos(self) -> int:
+        valor = self.db.scalar(select(Configuracion.valor).where(Configuracion.clave == self.CLAVE_VERSION_CATALOGOS))
+        try:
+            return int(valor or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def _incrementar_version_catalogos(self) -> None:
+        self.db.execute(text("""
+            INSERT INTO configuracion (clave, valor, tipo, descripcion)
+            VALUES (:clave, '1', 'integer', 'Versión de tipos de cuota, métodos y conceptos de pago')
+            ON CONFLICT (clave) DO UPDATE
+            SET valor = CAST(COALESCE(NULLIF(configuracion.valor, ''), '0') AS integer) + 1
+        """), {'clave': self.CLAVE_VERSION_CATALOGOS})
+
+    def _campos_catalogo(self, catalogo: str, datos: Dict[str, Any]) -> Tuple[Any, Dict[str, Any]]:
+        modelo = self._MODELOS_CATALOGO.get(catalogo)
+        if modelo is None:
+            raise ValueError(f"Catálogo desconocido: {catalogo}")
+        columnas = set(modelo.__table__.columns.keys()) - {'id', 'fecha_creacion', 'fecha_modificacion'}
+        return modelo, {k: v for k, v in datos.items() if k in columnas}
+
+    def _error_catalogo(self, catalogo: str, e: Exception) -> ValueError:
+        codigo = getattr(getattr(e, 'orig', None), 'pgcode', None)
+        nombre = self._NOMBRES_CATALOGO.get(catalogo, 'elemento')
+        if codigo == '23505':
+            return ValueError(f"Ya existe un {nombre} con ese nombre.")
+        if codigo == '23503':
+            return ValueError(f"No se puede eliminar el {nombre} porque está en uso.")
+        return ValueError(str(e))
+
+    def crear_item_catalogo(self, catalogo: str, datos: Dict[str, Any]) -> int:
+        modelo, campos = self._campos_catalogo(catalogo, datos)
+        try:
+            item = modelo(**campos)
+            self.db.add(item)
+            self.db.flush()
+            self._incrementar_version_catalogos()
+            self.db.commit()
+        except IntegrityError as e:
+            self.db.rollback()
+            raise self._error_catalogo(catalogo, e)
+        except Exception:
+            self.db.rollback()
+            raise
+        self._invalidate_cache(catalogo)
+        return int(item.id)
+
+    def actualizar_item_catalogo(self, catalogo: str, item_id: int, datos: Dict[str, Any]) -> bool:
+        modelo, campos = self._campos_catalogo(catalogo, datos)
+        if modelo is TipoCuota:
+            campos['fecha_modificacion'] = datetime.now()
+        try:
+            res = self.db.execute(update(modelo).where(modelo.id == int(item_id)).values(**campos))
+            if not res.rowcount:
+                self.db.rollback()
+                return False
+            self._incrementar_version_catalogos()
+            self.db.commit()
+        except IntegrityError as e:
+            self.db.rollback()
+            raise self._error_catalogo(catalogo, e)
+        except Exception:
+            self.db.rollback()
+            raise
+        self._invalidate_cache(catalogo)
+        return True
+
+    def eliminar_item_catalogo(self, catalogo: str, item_id: int) -> bool:
+        modelo, _ = self._campos_catalogo(catalogo, {})
+        try:
+            res = self.db.execute(delete(modelo).where(modelo.id == int(item_id)))
+            if not res.rowcount:
+                self.db.rollback()
+                return False
+            self._incrementar_version_catalogos()
+            self.db.commit()
+        except IntegrityError as e:
+            self.db.rollback()
+            raise self._error_catalogo(catalogo, e)
+        except Exception:
+            self.db.rollback()
+            raise
+        self._invalidate_cache(catalogo)
+        return True
+
     def registrar_pagos_batch(self, pagos_items: List[Dict[str, Any]], skip_duplicates: bool = False, validate_data: bool = True, auto_crear_metodos_pago: bool = False) -> Dict[str, Any]:
         result = {'insertados': [], 'actualizados': [], 'omitidos': [], 'count': 0}
         
         # Cache local de metodos
         metodos_cache = {m.nombre.lower(): m for m in self.db.scalars(select(MetodoPago)).all()}
+        metodos_creados = False
         
         for item in pagos_items:
             try:
@@ -92,6 +251,7 @@ class PaymentRepository(BaseRepository):
                         self.db.flush()
                         metodos_cache[key] = new_m
                         metodo_id = new_m.id
+                        metodos_creados = True
 
                 # Check duplicado
                 existing = self.db.scalar(
@@ -102,9 +262,13 @@ class PaymentRepository(BaseRepository):
                     if skip_duplicates:
                         result['omitidos'].append(item)
                     else:
+                        anterior = self._fila_resumen(existing)
                         existing.monto = monto
                         existing.fecha_pago = fecha_pago
                         existing.metodo_pago_id = metodo_id
+                        self.db.flush()
+                        self._acumular_resumen_ingresos([anterior], signo=-1)
+                        self._acumular_resumen_ingresos([self._fila_resumen(existing)])
                         result['actualizados'].append((uid, mes, año))
                 else:
                     new_pago = Pago(
@@ -117,6 +281,7 @@ class PaymentRepository(BaseRepository):
                     )
                     self.db.add(new_pago)
                     self.db.flush()
+                    self._acumular_resumen_ingresos([self._fila_resumen(new_pago)])
                     result['insertados'].append(new_pago.id)
                     
                     # Actualizar usuario vencimiento
@@ -126,11 +291,308 @@ class PaymentRepository(BaseRepository):
                 result['omitidos'].append(item)
                 self.logger.error(f"Error batch pago: {e}")
 
+        if metodos_creados:
+            self._incrementar_version_catalogos()
         self.db.commit()
         result['count'] = len(result['insertados']) + len(result['actualizados'])
         self._invalidate_cache('pagos')
         return result
 
+    # --- Importación masiva (COPY + SQL por conjuntos) ---
+
+    _COLUMNAS_IMPORTACION = ('fila', 'usuario_id', 'dni', 'monto', 'mes', 'año', 'fecha_pago', 'metodo_pago_id', 'metodo_pago')
+
+    @staticmethod
+    def _normalizar_fila_importacion(n: int, item: Dict[str, Any]) -> Tuple[Optional[tuple], Optional[str]]:
+        """Valida una fila de importación. Devuelve (tupla para COPY, None) o (None, motivo)."""
+        uid = item.get('usuario_id')
+        dni = str(item.get('dni') or '').strip() or None
+        try:
+            uid = int(uid) if uid not in (None, '') else None
+        except (TypeError, ValueError):
+            return None, 'usuario_id inválido'
+        if uid is None and dni is None:
+            return None, 'falta usuario_id o dni'
+        try:
+            monto = round(float(str(item.get('monto')).replace(',', '.')), 2)
+        except (TypeError, ValueError):
+            return None, 'monto inválido'
+        if monto < 0:
+            return None, 'monto negativo'
+        fecha_pago = item.get('fecha_pago')
+        if isinstance(fecha_pago, str) and fecha_pago.strip():
+            try:
+                fecha_pago = datetime.fromisoformat(fecha_pago.strip())
+            except ValueError:
+                return None, 'fecha_pago inválida'
+        elif isinstance(fecha_pago, date) and not isinstance(fecha_pago, datetime):
+            fecha_pago = datetime.combine(fecha_pago, datetime.min.time())
+        elif not isinstance(fecha_pago, datetime):
+            fecha_pago = datetime.now()
+        try:
+            mes = int(item.get('mes') or item.get('mes_pagado') or fecha_pago.month)
+            año = int(item.get('año') or item.get('año_pagado') or fecha_pago.year)
+        except (TypeError, ValueError):
+            return None, 'mes/año inválido'
+        if not 1 <= mes <= 12 or not 1900 <= año <= 9999:
+            return None, 'mes/año fuera de rango'
+        metodo_id = item.get('metodo_pago_id')
+        try:
+            metodo_id = int(metodo_id) if metodo_id not in (None, '') else None
+        except (TypeError, ValueError):
+            return None, 'metodo_pago_id inválido'
+        metodo = str(item.get('metodo_pago') or '').strip() or None
+        return (n, uid, dni, monto, mes, año, fecha_pago.isoformat(sep=' '), metodo_id, metodo), None
+
+    def importar_pagos_masivo(self, pagos_items: List[Dict[str, Any]], skip_duplicates: bool = False,
+                              auto_crear_metodos_pago: bool = False) -> Dict[str, Any]:
+        """Importa pagos en bloque: COPY a una tabla temporal, resolución de usuarios por DNI en un
+        join, anti-join de duplicados e INSERT ... ON CONFLICT. Luego recalcula vencimientos de los
+        usuarios afectados con una sola sentencia (recalcular_estados_usuarios).
+
+        Las filas con usuario o método de pago sin match no se importan (sin
+        `auto_crear_metodos_pago`, un nombre de método desconocido es un error).
+        Devuelve contadores y `errores`: lista de {'fila', 'motivo'} (fila = índice 1-based del item).
+        """
+        errores: List[Dict[str, Any]] = []
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        validas = 0
+        for n, item in enumerate(pagos_items or [], start=1):
+            fila, motivo = self._normalizar_fila_importacion(n, item if isinstance(item, dict) else {})
+            if motivo:
+                errores.append({'fila': n, 'motivo': motivo})
+                continue
+            writer.writerow(['' if v is None else v for v in fila])
+            validas += 1
+        result = {'total': len(pagos_items or []), 'insertados': 0, 'actualizados': 0, 'omitidos': 0,
+                  'usuarios_afectados': 0, 'errores': errores}
+        if not validas:
+            result['errores'] = sorted(errores, key=lambda e: e['fila'])
+            return result
+
+        try:
+            self.db.execute(text("""
+                CREATE TEMP TABLE _pagos_import (
+                    fila integer, usuario_id integer, dni text, monto numeric(10,2), mes integer,
+                    "año" integer, fecha_pago timestamp, metodo_pago_id integer, metodo_pago text
+                ) ON COMMIT DROP
+            """))
+            buf.seek(0)
+            cur = self.db.connection().connection.cursor()
+            try:
+                cur.copy_expert(
+                    'COPY _pagos_import (fila, usuario_id, dni, monto, mes, "año", fecha_pago, metodo_pago_id, metodo_pago) '
+                    "FROM STDIN WITH (FORMAT csv, NULL '')", buf
+                )
+            finally:
+                cur.close()
+
+            # Usuarios: por id o por DNI, en un solo join; sin match -> error
+            self.db.execute(text("""
+                UPDATE _pagos_import s SET usuario_id = u.id
+                FROM usuarios u
+                WHERE s.usuario_id IS NULL AND u.dni = s.dni
+            """))
+            sin_usuario = self.db.execute(text("""
+                DELETE FROM _pagos_import s
+                WHERE NOT EXISTS (SELECT 1 FROM usuarios u WHERE u.id = s.usuario_id)
+                RETURNING s.fila, s.dni
+            """)).all()
+            errores.extend({'fila': f, 'motivo': f"usuario inexistente{f' (dni {d})' if d else ''}"} for f, d in sin_usuario)
+
+            # Métodos de pago por nombre (opcionalmente creándolos)
+            if auto_crear_metodos_pago:
+                creados = self.db.execute(text("""
+                    INSERT INTO metodos_pago (nombre, icono, color, comision, activo)
+                    SELECT DISTINCT ON (lower(s.metodo_pago)) s.metodo_pago, '💳', '#9b59b6', 0, TRUE
+                    FROM _pagos_import s
+                    WHERE s.metodo_pago_id IS NULL AND s.metodo_pago IS NOT NULL
+                      AND NOT EXISTS (SELECT 1 FROM metodos_pago m WHERE lower(m.nombre) = lower(s.metodo_pago))
+                    ON CONFLICT (nombre) DO NOTHING
+                """)).rowcount
+                if creados:
+                    # Los catálogos en memoria (CatalogService) se recargan al cambiar la versión
+                    self._incrementar_version_catalogos()
+            self.db.execute(text("""
+                UPDATE _pagos_import s SET metodo_pago_id = m.id
+                FROM metodos_pago m
+                WHERE s.metodo_pago_id IS NULL AND s.metodo_pago IS NOT NULL AND lower(m.nombre) = lower(s.metodo_pago)
+            """))
+            sin_metodo = self.db.execute(text("""
+                DELETE FROM _pagos_import s
+                WHERE s.metodo_pago_id IS NULL AND s.metodo_pago IS NOT NULL
+                RETURNING s.fila, s.metodo_pago
+            """)).all()
+            errores.extend({'fila': f, 'motivo': f"método de pago inexistente ({m})"} for f, m in sin_metodo)
+
+            # Duplicados dentro del archivo: gana la última fila de cada (usuario, mes, año)
+            repetidas = self.db.execute(text("""
+                DELETE FROM _pagos_import s
+                USING (
+                    SELECT fila, ROW_NUMBER() OVER (PARTITION BY usuario_id, mes, "año" ORDER BY fila DESC) AS rn
+                    FROM _pagos_import
+                ) d
+                WHERE d.fila = s.fila AND d.rn > 1
+                RETURNING s.fila
+            """)).scalars().all()
+            errores.extend({'fila': f, 'motivo': 'duplicado en el archivo (se usa la última fila)'} for f in repetidas)
+
+            if skip_duplicates:
+                existentes = self.db.execute(text("""
+                    DELETE FROM _pagos_import s
+                    USING pagos p
+                    WHERE p.usuario_id = s.usuario_id AND p.mes = s.mes AND p."año" = s."año"
+                    RETURNING s.fila
+                """)).scalars().all()
+                result['omitidos'] = len(existentes)
+                errores.extend({'fila': f, 'motivo': 'pago existente (omitido)'} for f in existentes)
+                conflicto = 'DO NOTHING'
+            else:
+                conflicto = """DO UPDATE SET monto = EXCLUDED.monto, fecha_pago = EXCLUDED.fecha_pago,
+                               metodo_pago_id = COALESCE(EXCLUDED.metodo_pago_id, pagos.metodo_pago_id)"""
+                # Los pagos que se van a pisar salen del resumen de ingresos con sus valores actuales
+                self._acumular_resumen_ingresos([tuple(r) for r in self.db.execute(text("""
+                    SELECT p.usuario_id, p.fecha_pago, p.metodo_pago_id, p.monto
+                    FROM pagos p
+                    JOIN _pagos_import s ON s.usuario_id = p.usuario_id AND s.mes = p.mes AND s."año" = p."año"
+                    FOR UPDATE OF p
+                """)).all()], signo=-1)
+
+            filas = self.db.execute(text(f"""
+                INSERT INTO pagos (usuario_id, monto, mes, "año", fecha_pago, metodo_pago_id)
+                SELECT usuario_id, monto, mes, "año", fecha_pago, metodo_pago_id
+                FROM _pagos_import
+                ON CONFLICT (usuario_id, mes, "año") {conflicto}
+                RETURNING usuario_id, (xmax = 0) AS insertado, fecha_pago, metodo_pago_id, monto
+            """)).all()
+            self._acumular_resumen_ingresos([(r[0], r[2], r[3], r[4]) for r in filas])
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+        afectados = sorted({r[0] for r in filas})
+        result['insertados'] = sum(1 for r in filas if r[1])
+        result['actualizados'] = len(filas) - result['insertados']
+        result['usuarios_afectados'] = len(afectados)
+        result['errores'] = sorted(errores, key=lambda e: e['fila'])
+        self._invalidate_cache('pagos')
+        if afectados:
+            self.recalcular_estados_usuarios(afectados)
+        return result
+
+    def obtener_firma_recibo(self, pago_id: int) -> Optional[Dict[str, Any]]:
+        """Datos que determinan el contenido del recibo, en una consulta (clave de caché del PDF).
+        None si el pago no existe."""
+        row = self.db.execute(text("""
+            SELECT p.id, p.usuario_id, p.monto, p.mes, p."año", p.fecha_pago, p.metodo_pago_id,
+                   u.nombre, u.dni, u.tipo_cuota,
+                   c.id AS comprobante_id, c.numero_comprobante,
+                   (SELECT COUNT(*) || ':' || COALESCE(SUM(d.subtotal), 0) FROM pago_detalles d WHERE d.pago_id = p.id) AS detalles
+            FROM pagos p
+            JOIN usuarios u ON u.id = p.usuario_id
+            LEFT JOIN LATERAL (
+                SELECT cp.id, cp.numero_comprobante FROM comprobantes_pago cp
+                WHERE cp.pago_id = p.id AND cp.estado = 'emitido'
+                ORDER BY cp.fecha_creacion DESC
+                LIMIT 1
+            ) c ON TRUE
+            WHERE p.id = :pago_id
+        """), {'pago_id': int(pago_id)}).mappings().first()
+        return dict(row) if row else None
+
+    @staticmethod
+    def _filtro_recibos_lote(desde: Optional[date] = None, hasta: Optional[date] = None,
+                             usuario_id: Optional[int] = None, metodo_pago_id: Optional[int] = None,
+                             pago_ids: Optional[List[int]] = None) -> Tuple[str, Dict[str, Any]]:
+        condiciones, params = [], {}
+        if desde or hasta:
+            rango = rango_fechas(desde or date(1900, 1, 1), hasta or hoy_gym())
+            condiciones.append("p.fecha_pago >= :inicio AND p.fecha_pago < :fin")
+            params.update(inicio=rango.inicio, fin=rango.fin)
+        if usuario_id:
+            condiciones.append("p.usuario_id = :usuario_id")
+            params['usuario_id'] = int(usuario_id)
+        if metodo_pago_id:
+            condiciones.append("p.metodo_pago_id = :metodo_pago_id")
+            params['metodo_pago_id'] = int(metodo_pago_id)
+        if pago_ids:
+            condiciones.append("p.id = ANY(:pago_ids)")
+            params['pago_ids'] = [int(x) for x in pago_ids]
+        return (" AND ".join(condiciones) or "TRUE"), params
+
+    def contar_pagos_recibos(self, **filtro) -> int:
+        where, params = self._filtro_recibos_lote(**filtro)
+        return int(self.db.execute(text(f"SELECT COUNT(*) FROM pagos p WHERE {where}"), params).scalar() or 0)
+
+    def iterar_pagos_recibos(self, tamano_lote: int = 500, **filtro):
+        """Datos completos para emitir recibos en bloque, por lotes de `tamano_lote` pagos.
+
+        Dos consultas por lote (pagos+usuario+método+comprobante y sus detalles), paginando por
+        (fecha_pago, id) para no cargar todo el rango en memoria. Cada pago trae 'detalles' y
+        'totales' (con la comisión del método) ya resueltos.
+        """
+        self._asegurar_indices()
+        where, params = self._filtro_recibos_lote(**filtro)
+        cursor_fecha, cursor_id = None, 0
+        while True:
+            q = dict(params, limite=int(tamano_lote), cursor_fecha=cursor_fecha, cursor_id=cursor_id)
+            filas = self.db.execute(text(f"""
+                SELECT p.id, p.usuario_id, p.monto, p.mes, p."año", p.fecha_pago, p.metodo_pago_id,
+                       u.nombre AS usuario_nombre, u.dni AS usuario_dni, u.tipo_cuota,
+                       COALESCE(mp.nombre, p.metodo_pago) AS metodo_pago_nombre,
+                       CASE WHEN mp.activo THEN COALESCE(mp.comision, 0) ELSE 0 END AS comision_pct,
+                       c.numero_comprobante
+                FROM pagos p
+                JOIN usuarios u ON u.id = p.usuario_id
+                LEFT JOIN metodos_pago mp ON mp.id = p.metodo_pago_id
+                LEFT JOIN LATERAL (
+                    SELECT cp.numero_comprobante FROM comprobantes_pago cp
+                    WHERE cp.pago_id = p.id AND cp.estado = 'emitido'
+                    ORDER BY cp.fecha_creacion DESC
+                    LIMIT 1
+                ) c ON TRUE
+                WHERE {where}
+                  AND (CAST(:cursor_fecha AS timestamp) IS NULL
+                       OR (p.fecha_pago, p.id) > (CAST(:cursor_fecha AS timestamp), :cursor_id))
+                ORDER BY p.fecha_pago, p.id
+                LIMIT :limite
+            """), q).mappings().all()
+            if not filas:
+                return
+            ids = [int(f['id']) for f in filas]
+            detalles: Dict[int, List[Dict[str, Any]]] = {}
+            for d in self.db.execute(text("""
+                SELECT d.pago_id, COALESCE(cp.nombre, d.descripcion) AS concepto_nombre,
+                       d.cantidad, d.precio_unitario, d.subtotal
+                FROM pago_detalles d
+                LEFT JOIN conceptos_pago cp ON cp.id = d.concepto_id
+                WHERE d.pago_id = ANY(:ids)
+                ORDER BY d.pago_id, d.id
+            """), {'ids': ids}).mappings():
+                detalles.setdefault(int(d['pago_id']), []).append({
+                    'concepto_nombre': d['concepto_nombre'],
+                    'cantidad': float(d['cantidad'] or 1),
+                    'precio_unitario': float(d['precio_unitario'] or 0),
+                    'subtotal': float(d['subtotal'] or 0),
+                })
+            lote = []
+            for f in filas:
+                item = dict(f)
+                item['monto'] = float(item['monto'] or 0)
+                item['detalles'] = detalles.get(int(f['id']), [])
+                subtotal = sum(d['subtotal'] for d in item['detalles']) if item['detalles'] else item['monto']
+                pct = float(item.pop('comision_pct') or 0)
+                comision = round(subtotal * (pct / 100.0), 2) if pct > 0 else 0.0
+                item['totales'] = {'subtotal': round(subtotal, 2), 'comision': comision,
+                                   'total': round(subtotal + comision, 2)}
+                lote.append(item)
+            yield lote
+            if len(filas) < int(tamano_lote):
+                return
+            cursor_fecha, cursor_id = filas[-1]['fecha_pago'], int(filas[-1]['id'])
+
     def actualizar_fecha_proximo_vencimiento(self, usuario_id: int, fecha_pago: date = None) -> bool:
         if fecha_pago is None:
             fecha_pago = date.today()
@@ -154,6 +616,102 @@ class PaymentRepository(BaseRepository):
         self._invalidate_cache('usuarios', usuario_id)
         return True
 
+    # Recalcula vencimiento, cuotas vencidas y baja por morosidad en una sola sentencia.
+    # Misma regla que PaymentManager: base = último pago (o fecha de registro), se avanza
+    # por ciclos de duracion_dias hasta el próximo vencimiento futuro; profesores y dueños
+    # no acumulan cuotas; con 3 o más cuotas vencidas se desactiva (nunca se reactiva).
+    _SQL_RECALCULO_ESTADOS = """
+        WITH ultimos AS (
+            SELECT usuario_id, MAX(fecha_pago) AS ultimo
+            FROM pagos
+            WHERE (CAST(:ids AS integer[]) IS NULL OR usuario_id = ANY(CAST(:ids AS integer[])))
+            GROUP BY usuario_id
+        ),
+        base AS (
+            SELECT u.id,
+                   u.activo AS activo_prev,
+                   COALESCE(u.cuotas_vencidas, 0) AS cuotas_prev,
+                   u.fecha_proximo_vencimiento AS vencimiento_prev,
+                   u.ultimo_pago AS ultimo_pago_prev,
+                   lower(COALESCE(u.rol, '')) IN ('profesor', 'dueño', 'owner') AS exento,
+                   CAST(ul.ultimo AS date) AS ultimo_pago,
+                   GREATEST(COALESCE(tc.duracion_dias, 30), 1) AS dur,
+                   COALESCE(CAST(ul.ultimo AS date), CAST(u.fecha_registro AS date), CAST(:hoy AS date))
+                       + GREATEST(COALESCE(tc.duracion_dias, 30), 1) AS primer_venc
+            FROM usuarios u
+            LEFT JOIN ultimos ul ON ul.usuario_id = u.id
+            LEFT JOIN LATERAL (
+                SELECT t.duracion_dias FROM tipos_cuota t
+                WHERE t.nombre = u.tipo_cuota OR t.id::text = u.tipo_cuota
+                ORDER BY (t.nombre = u.tipo_cuota) DESC
+                LIMIT 1
+            ) tc ON TRUE
+            WHERE (CAST(:ids AS integer[]) IS NULL OR u.id = ANY(CAST(:ids AS integer[])))
+              AND (NOT :solo_activos OR u.activo)
+        ),
+        ciclos AS (
+            SELECT b.*,
+                   CASE WHEN CAST(:hoy AS date) <= b.primer_venc THEN 0
+                        ELSE (CAST(:hoy AS date) - b.primer_venc + b.dur - 1) / b.dur END AS vencidos
+            FROM base b
+        ),
+        calc AS (
+            SELECT c.*,
+                   c.primer_venc + c.dur * c.vencidos AS vencimiento,
+                   CASE WHEN c.exento THEN 0 ELSE c.vencidos END AS cuotas,
+                   CASE WHEN NOT c.exento AND c.vencidos >= 3 THEN FALSE ELSE c.activo_prev END AS activo
+            FROM ciclos c
+        )
+        UPDATE usuarios u
+        SET fecha_proximo_vencimiento = c.vencimiento,
+            ultimo_pago = c.ultimo_pago,
+            cuotas_vencidas = c.cuotas,
+            activo = c.activo
+        FROM calc c
+        WHERE u.id = c.id
+          AND (u.fecha_proximo_vencimiento IS DISTINCT FROM c.vencimiento
+               OR u.ultimo_pago IS DISTINCT FROM c.ultimo_pago
+               OR COALESCE(u.cuotas_vencidas, 0) IS DISTINCT FROM c.cuotas
+               OR u.activo IS DISTINCT FROM c.activo)
+        RETURNING u.id, c.activo_prev, u.activo, c.cuotas_prev, u.cuotas_vencidas,
+                  c.vencimiento_prev, u.fecha_proximo_vencimiento, c.ultimo_pago_prev, u.ultimo_pago
+    """
+
+    def recalcular_estados_usuarios(self, usuario_ids: Optional[List[int]] = None, solo_activos: bool = False,
+                                    hoy: Optional[date] = None) -> List[Dict[str, Any]]:
+        """Recalcula el estado de cuota de todos los usuarios (o de `usuario_ids`) con un UPDATE ... FROM.
+
+        Devuelve sólo los usuarios que cambiaron, con valores anteriores y nuevos, para emitir
+        auditoría y notificaciones en bloque. `desactivado` indica que cruzó el umbral de morosidad.
+        """
+        ids = None
+        if usuario_ids is not None:
+            ids = sorted({int(i) for i in usuario_ids})
+            if not ids:
+                return []
+        filas = self.db.execute(text(self._SQL_RECALCULO_ESTADOS), {
+            'ids': ids, 'hoy': hoy or hoy_gym(), 'solo_activos': bool(solo_activos)
+        }).all()
+        self.db.commit()
+        cambios = []
+        for (uid, activo_prev, activo, cuotas_prev, cuotas, venc_prev, venc, up_prev, up) in filas:
+            cambios.append({
+                'usuario_id': uid,
+                'activo_anterior': activo_prev,
+                'activo': activo,
+                'cuotas_vencidas_anteriores': int(cuotas_prev or 0),
+                'cuotas_vencidas': int(cuotas or 0),
+                'fecha_proximo_vencimiento_anterior': venc_prev,
+                'fecha_proximo_vencimiento': venc,
+                'ultimo_pago_anterior': up_prev,
+                'ultimo_pago': up,
+                'desactivado': bool(activo_prev) and not activo,
+            })
+        if cambios:
+            self._invalidate_cache('usuarios')
+            self._invalidate_cache('reportes')
+        return cambios
+
     def incrementar_cuotas_vencidas(self, usuario_id: int) -> bool:
         user = self.db.get(Usuario, usuario_id)
         if not user:
@@ -208,33 +766,386 @@ class PaymentRepository(BaseRepository):
 
     def obtener_pagos_mes(self, mes: int, año: int) -> List[Pago]:
         stmt = select(Pago).where(
-            func.extract('month', Pago.fecha_pago) == mes,
-            func.extract('year', Pago.fecha_pago) == año
+            en_rango(Pago.fecha_pago, rango_mes(año, mes))
         ).order_by(Pago.fecha_pago.desc())
         return list(self.db.scalars(stmt).all())
 
+    # --- Historial de pagos paginado por cursor ---
+    # Orden estable (fecha_pago DESC, id DESC). El cursor codifica la posición del último pago
+    # devuelto, no un desplazamiento: cada página es un rango del índice (usuario_id|metodo_pago_id,
+    # fecha_pago, id) y cuesta lo mismo a cualquier profundidad, y los pagos que entran después
+    # quedan antes del cursor sin correr las páginas siguientes.
+
+    @staticmethod
+    def codificar_cursor(fecha_pago: datetime, pago_id: int) -> str:
+        crudo = f"{fecha_pago.isoformat()}|{int(pago_id)}"
+        return base64.urlsafe_b64encode(crudo.encode('utf-8')).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def decodificar_cursor(cursor: str) -> Tuple[datetime, int]:
+        try:
+            crudo = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+            fecha, pago_id = crudo.rsplit('|', 1)
+            return datetime.fromisoformat(fecha), int(pago_id)
+        except Exception:
+            raise ValueError("cursor inválido")
+
+    @classmethod
+    def _filtro_historial(cls, q: Optional[str] = None, **filtro) -> Tuple[str, Dict[str, Any]]:
+        """_filtro_recibos_lote más la búsqueda libre por usuario, DNI, método o concepto (alias p/u/mp)."""
+        where, params = cls._filtro_recibos_lote(**filtro)
+        if q and q.strip():
+            where += (" AND (u.nombre ILIKE :q OR u.dni ILIKE :q OR mp.nombre ILIKE :q"
+                      " OR p.metodo_pago ILIKE :q OR p.concepto ILIKE :q)")
+            params['q'] = f"%{q.strip()}%"
+        return where, params
+
+    def buscar_pagos(self, cursor: Optional[str] = None, limite: int = 50, total: Optional[str] = None,
+                     q: Optional[str] = None, **filtro) -> Dict[str, Any]:
+        """Página de pagos más recientes primero, con los filtros de _filtro_recibos_lote y búsqueda libre.
+
+        total: None (no se calcula), 'estimado' (filas estimadas por el planificador, sin recorrer
+        la tabla) o 'exacto' (COUNT(*)). Devuelve {'items', 'next_cursor', 'total'}; next_cursor es
+        None en la última página.
+        """
+        self._asegurar_indices()
+        where, params = self._filtro_historial(q, **filtro)
+        desde_sql = f"""
+            FROM pagos p
+            JOIN usuarios u ON u.id = p.usuario_id
+            LEFT JOIN metodos_pago mp ON mp.id = p.metodo_pago_id
+            WHERE {where}
+        """
+        limite = min(max(int(limite), 1), 500)
+        pagina = dict(params, limite=limite + 1)
+        condicion_cursor = ""
+        if cursor:
+            pagina['cursor_fecha'], pagina['cursor_id'] = self.decodificar_cursor(cursor)
+            condicion_cursor = " AND (p.fecha_pago, p.id) < (:cursor_fecha, :cursor_id)"
+        filas = self.db.execute(text(f"""
+            SELECT p.id, p.usuario_id, u.nombre AS usuario_nombre, u.dni, u.tipo_cuota,
+                   p.monto, p.mes, p."año", p.fecha_pago, p.metodo_pago_id,
+                   COALESCE(mp.nombre, p.metodo_pago) AS metodo_pago,
+                   COALESCE(p.concepto, (
+                       SELECT string_agg(DISTINCT COALESCE(cp.nombre, d.descripcion), ', ')
+                       FROM pago_detalles d
+                       LEFT JOIN conceptos_pago cp ON cp.id = d.concepto_id
+                       WHERE d.pago_id = p.id
+                   )) AS concepto_pago
+            {desde_sql}{condicion_cursor}
+            ORDER BY p.fecha_pago DESC, p.id DESC
+            LIMIT :limite
+        """), pagina).mappings().all()
+        items = [dict(f, monto=float(f['monto'] or 0)) for f in filas[:limite]]
+        siguiente = None
+        if len(filas) > limite and items:
+            siguiente = self.codificar_cursor(items[-1]['fecha_pago'], items[-1]['id'])
+        out: Dict[str, Any] = {'items': items, 'next_cursor': siguiente, 'total': None}
+        if total == 'exacto':
+            out['total'] = int(self.db.execute(text(f"SELECT COUNT(*) {desde_sql}"), params).scalar() or 0)
+        elif total == 'estimado':
+            plan = self.db.execute(text(f"EXPLAIN (FORMAT JSON) SELECT 1 {desde_sql}"), params).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            out['total'] = int(plan[0]['Plan']['Plan Rows'])
+        return out
+
+    def iterar_pagos_exportacion(self, tamano_lote: int = 2000, q: Optional[str] = None,
+                                 **filtro) -> Iterator[List[Dict[str, Any]]]:
+        """Pagos del historial para exportar, en orden cronológico y por lotes de `tamano_lote` filas.
+
+        Una sola consulta con usuario, método y concepto resueltos en SQL, leída con un cursor del
+        lado del servidor (stream_results: cursor con nombre en psycopg2), así en memoria sólo vive
+        el lote actual. Necesita la transacción abierta hasta agotar el iterador.
+        """
+        self._asegurar_indices()
+        where, params = self._filtro_historial(q, **filtro)
+        resultado = self.db.execute(text(f"""
+            SELECT p.id, p.fecha_pago, p.mes, p."año", p.usuario_id, u.nombre AS usuario_nombre, u.dni,
+                   u.tipo_cuota, COALESCE(mp.nombre, p.metodo_pago) AS metodo_pago,
+                   COALESCE(p.concepto, (
+                       SELECT string_agg(DISTINCT COALESCE(cp.nombre, d.descripcion), ', ')
+                       FROM pago_detalles d
+                       LEFT JOIN conceptos_pago cp ON cp.id = d.concepto_id
+                       WHERE d.pago_id = p.id
+                   )) AS concepto_pago,
+                   p.monto
+            FROM pagos p
+            JOIN usuarios u ON u.id = p.usuario_id
+            LEFT JOIN metodos_pago mp ON mp.id = p.metodo_pago_id
+            WHERE {where}
+            ORDER BY p.fecha_pago, p.id
+        """).execution_options(stream_results=True, max_row_buffer=int(tamano_lote)), params)
+        try:
+            for filas in resultado.mappings().partitions(int(tamano_lote)):
+                yield [dict(f) for f in filas]
+        finally:
+            resultado.close()
+
     def eliminar_pago(self, pago_id: int):
         pago = self.db.get(Pago, pago_id)
         if pago:
+            fila = self._fila_resumen(pago)
             self.db.delete(pago)
+            self.db.flush()
+            self._acumular_resumen_ingresos([fila], signo=-1)
             self.db.commit()
             self._invalidate_cache('pagos')
 
     def modificar_pago(self, pago: Pago):
         existing = self.db.get(Pago, pago.id)
         if existing:
+            anterior = self._fila_resumen(existing)
             existing.usuario_id = pago.usuario_id
             existing.monto = pago.monto
             existing.fecha_pago = pago.fecha_pago
             existing.metodo_pago_id = pago.metodo_pago_id
+            self.db.flush()
+            self._acumular_resumen_ingresos([anterior], signo=-1)
+            self._acumular_resumen_ingresos([self._fila_resumen(existing)])
             self.db.commit()
             self._invalidate_cache('pagos')
 
+    # --- Resumen de ingresos mensual ---
+    # ingresos_mensuales (año, mes, método, tipo de cuota) e ingresos_pagadores_mes (lo mismo
+    # por usuario, para contar pagadores distintos) se mantienen en la misma transacción que
+    # el alta/modificación/baja del pago; los gráficos de ingresos/ARPU leen sólo de acá.
+    # El tipo de cuota es el del usuario al registrar su primer pago del mes con ese método.
+    # verificar_resumen_ingresos() lo compara contra `pagos` y reconstruir_resumen_ingresos()
+    # lo recalcula desde cero (o desde un mes).
+
+    _SQL_RESUMEN_DELTAS = """
+        d AS (
+            SELECT anio AS "año", mes, metodo_pago_id, usuario_id, COUNT(*) AS n, SUM(monto) AS total
+            FROM unnest(CAST(:usuario_ids AS integer[]), CAST(:anios AS integer[]), CAST(:meses AS integer[]),
+                        CAST(:metodos AS integer[]), CAST(:montos AS numeric[]))
+                 AS t(usuario_id, anio, mes, metodo_pago_id, monto)
+            GROUP BY 1, 2, 3, 4
+        )
+    """
+    _SQL_RESUMEN_ALTA = """
+        WITH """ + _SQL_RESUMEN_DELTAS + """,
+        pagador AS (
+            INSERT INTO ingresos_pagadores_mes AS h ("año", mes, metodo_pago_id, usuario_id, tipo_cuota, pagos, total)
+            SELECT d."año", d.mes, d.metodo_pago_id, d.usuario_id, COALESCE(u.tipo_cuota, ''), d.n, d.total
+            FROM d LEFT JOIN usuarios u ON u.id = d.usuario_id
+            ON CONFLICT ("año", mes, metodo_pago_id, usuario_id) DO UPDATE
+            SET pagos = h.pagos + EXCLUDED.pagos, total = h.total + EXCLUDED.total
+            RETURNING h."año", h.mes, h.metodo_pago_id, h.usuario_id, h.tipo_cuota, h.pagos
+        )
+        INSERT INTO ingresos_mensuales AS r ("año", mes, metodo_pago_id, tipo_cuota, total, cantidad, pagadores, actualizado_en)
+        SELECT p."año", p.mes, p.metodo_pago_id, p.tipo_cuota, SUM(d.total), SUM(d.n),
+               COUNT(*) FILTER (WHERE p.pagos = d.n), CURRENT_TIMESTAMP
+        FROM pagador p
+        JOIN d ON d."año" = p."año" AND d.mes = p.mes AND d.metodo_pago_id = p.metodo_pago_id AND d.usuario_id = p.usuario_id
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT ("año", mes, metodo_pago_id, tipo_cuota) DO UPDATE
+        SET total = r.total + EXCLUDED.total, cantidad = r.cantidad + EXCLUDED.cantidad,
+            pagadores = r.pagadores + EXCLUDED.pagadores, actualizado_en = EXCLUDED.actualizado_en
+    """
+    # Bajas: se descuenta de la celda en la que se sumó el pago (tipo de cuota guardado por pagador)
+    _SQL_RESUMEN_BAJA = """
+        WITH """ + _SQL_RESUMEN_DELTAS + """,
+        pagador AS (
+            UPDATE ingresos_pagadores_mes h
+            SET pagos = GREATEST(h.pagos - d.n, 0), total = h.total - d.total
+            FROM d
+            WHERE h."año" = d."año" AND h.mes = d.mes AND h.metodo_pago_id = d.metodo_pago_id AND h.usuario_id = d.usuario_id
+            RETURNING h."año", h.mes, h.metodo_pago_id, h.tipo_cuota, h.pagos, d.n, d.total
+        ),
+        c AS (
+            SELECT "año", mes, metodo_pago_id, tipo_cuota, SUM(total) AS total, SUM(n) AS n,
+                   COUNT(*) FILTER (WHERE pagos = 0) AS salen
+            FROM pagador
+            GROUP BY 1, 2, 3, 4
+        )
+        UPDATE ingresos_mensuales r
+        SET total = r.total - c.total, cantidad = GREATEST(r.cantidad - c.n, 0),
+            pagadores = GREATEST(r.pagadores - c.salen, 0), actualizado_en = CURRENT_TIMESTAMP
+        FROM c
+        WHERE r."año" = c."año" AND r.mes = c.mes AND r.metodo_pago_id = c.metodo_pago_id AND r.tipo_cuota = c.tipo_cuota
+    """
+
+    @staticmethod
+    def _fila_resumen(pago) -> Tuple[int, datetime, Optional[int], float]:
+        return (int(pago.usuario_id), pago.fecha_pago or datetime.now(), pago.metodo_pago_id, float(pago.monto or 0))
+
+    @staticmethod
+    def _parametros_resumen(filas: List[Tuple[int, datetime, Optional[int], float]]) -> Dict[str, list]:
+        """(usuario_id, fecha_pago, metodo_pago_id, monto) -> arrays para unnest."""
+        return {
+            'usuario_ids': [int(f[0]) for f in filas],
+            'anios': [f[1].year for f in filas],
+            'meses': [f[1].month for f in filas],
+            'metodos': [int(f[2] or 0) for f in filas],
+            'montos': [float(f[3] or 0) for f in filas],
+        }
+
+    def _acumular_resumen_ingresos(self, filas: List[Tuple[int, datetime, Optional[int], float]], signo: int = 1) -> None:
+        """Aplica altas (signo=1) o bajas (signo=-1) de pagos al resumen. No hace commit."""
+        if not filas:
+            return
+        asegurar_resumen_ingresos(self.db)
+        sql = self._SQL_RESUMEN_ALTA if signo > 0 else self._SQL_RESUMEN_BAJA
+        self.db.execute(text(sql), self._parametros_resumen(filas))
+
+    @classmethod
+    def acumular_resumen_ingresos_cursor(cls, cursor, filas: List[Tuple[int, datetime, Optional[int], float]], signo: int = 1) -> None:
+        """Igual que _acumular_resumen_ingresos pero sobre un cursor psycopg2 (transacciones del PaymentManager).
+
+        No crea las tablas: quien abre la transacción llama antes a asegurar_resumen_ingresos.
+        """
+        if not filas:
+            return
+        sql = cls._SQL_RESUMEN_ALTA if signo > 0 else cls._SQL_RESUMEN_BAJA
+        cursor.execute(re.sub(r':(\w+)', r'%(\1)s', sql), cls._parametros_resumen(filas))
+
+    def descontar_usuario_resumen_ingresos(self, usuario_id: int) -> None:
+        """Quita del resumen todos los pagos de un usuario (antes de borrarlo: la baja en cascada no pasa por acá)."""
+        asegurar_resumen_ingresos(self.db)
+        self.db.execute(text("""
+            WITH c AS (
+                SELECT "año", mes, metodo_pago_id, tipo_cuota, SUM(total) AS total, SUM(pagos) AS n, COUNT(*) AS salen
+                FROM ingresos_pagadores_mes
+                WHERE usuario_id = :usuario_id AND pagos > 0
+                GROUP BY 1, 2, 3, 4
+            )
+            UPDATE ingresos_mensuales r
+            SET total = r.total - c.total, cantidad = GREATEST(r.cantidad - c.n, 0),
+                pagadores = GREATEST(r.pagadores - c.salen, 0), actualizado_en = CURRENT_TIMESTAMP
+            FROM c
+            WHERE r."año" = c."año" AND r.mes = c.mes AND r.metodo_pago_id = c.metodo_pago_id AND r.tipo_cuota = c.tipo_cuota
+        """), {'usuario_id': int(usuario_id)})
+        self.db.execute(text("DELETE FROM ingresos_pagadores_mes WHERE usuario_id = :usuario_id"),
+                        {'usuario_id': int(usuario_id)})
+
+    def reconstruir_resumen_ingresos(self, desde: Optional[date] = None, bloquear: bool = True) -> Dict[str, int]:
+        """Recalcula el resumen desde `pagos` (completo, o desde el mes de `desde`).
+
+        Con `bloquear` toma un lock SHARE sobre `pagos` mientras dura para no perder altas concurrentes.
+        """
+        asegurar_resumen_ingresos(self.db)
+        params = {'desde': (desde.year * 12 + desde.month) if desde else None}
+        filtro_resumen = 'WHERE "año" * 12 + mes >= :desde' if desde else ''
+        filtro_pagos = ('WHERE p.fecha_pago >= :inicio' if desde else '')
+        if desde:
+            params['inicio'] = rango_mes(desde.year, desde.month).inicio
+        try:
+            if bloquear:
+                self.db.execute(text("LOCK TABLE pagos IN SHARE MODE"))
+            self.db.execute(text(f"DELETE FROM ingresos_mensuales {filtro_resumen}"), params)
+            self.db.execute(text(f"DELETE FROM ingresos_pagadores_mes {filtro_resumen}"), params)
+            pagadores = self.db.execute(text(f"""
+                INSERT INTO ingresos_pagadores_mes ("año", mes, metodo_pago_id, usuario_id, tipo_cuota, pagos, total)
+                SELECT EXTRACT(YEAR FROM p.fecha_pago)::int, EXTRACT(MONTH FROM p.fecha_pago)::int,
+                       COALESCE(p.metodo_pago_id, 0), p.usuario_id, COALESCE(MAX(u.tipo_cuota), ''),
+                       COUNT(*), SUM(p.monto)
+                FROM pagos p
+                LEFT JOIN usuarios u ON u.id = p.usuario_id
+                {filtro_pagos}
+                GROUP BY 1, 2, 3, 4
+            """), params).rowcount
+            celdas = self.db.execute(text(f"""
+                INSERT INTO ingresos_mensuales ("año", mes, metodo_pago_id, tipo_cuota, total, cantidad, pagadores, actualizado_en)
+                SELECT "año", mes, metodo_pago_id, tipo_cuota, SUM(total), SUM(pagos), COUNT(*), CURRENT_TIMESTAMP
+                FROM ingresos_pagadores_mes
+                {filtro_resumen}
+                GROUP BY 1, 2, 3, 4
+            """), params).rowcount
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        self._invalidate_cache('pagos')
+        return {'celdas': celdas, 'pagadores': pagadores}
+
+    def verificar_resumen_ingresos(self, desde: Optional[date] = None) -> List[Dict[str, Any]]:
+        """Diferencias entre el resumen y `pagos` por (año, mes, método): total, cantidad y pagadores.
+
+        El desglose por tipo de cuota no se compara (se atribuye al registrar el pago).
+        Lista vacía = consistente.
+        """
+        asegurar_resumen_ingresos(self.db)
+        params: Dict[str, Any] = {}
+        filtro_pagos = filtro_resumen = ''
+        if desde:
+            params = {'inicio': rango_mes(desde.year, desde.month).inicio, 'desde': desde.year * 12 + desde.month}
+            filtro_pagos = 'WHERE fecha_pago >= :inicio'
+            filtro_resumen = 'WHERE "año" * 12 + mes >= :desde'
+        filas = self.db.execute(text(f"""
+            WITH crudo AS (
+                SELECT EXTRACT(YEAR FROM fecha_pago)::int AS "año", EXTRACT(MONTH FROM fecha_pago)::int AS mes,
+                       COALESCE(metodo_pago_id, 0) AS metodo_pago_id,
+                       SUM(monto) AS total, COUNT(*) AS cantidad, COUNT(DISTINCT usuario_id) AS pagadores
+                FROM pagos
+                {filtro_pagos}
+                GROUP BY 1, 2, 3
+            ),
+            resumen AS (
+                SELECT "año", mes, metodo_pago_id, SUM(total) AS total, SUM(cantidad) AS cantidad, SUM(pagadores) AS pagadores
+                FROM ingresos_mensuales
+                {filtro_resumen}
+                GROUP BY 1, 2, 3
+            )
+            SELECT COALESCE(c."año", r."año") AS "año", COALESCE(c.mes, r.mes) AS mes,
+                   COALESCE(c.metodo_pago_id, r.metodo_pago_id) AS metodo_pago_id,
+                   COALESCE(c.total, 0) AS total_pagos, COALESCE(r.total, 0) AS total_resumen,
+                   COALESCE(c.cantidad, 0) AS cantidad_pagos, COALESCE(r.cantidad, 0) AS cantidad_resumen,
+                   COALESCE(c.pagadores, 0) AS pagadores_pagos, COALESCE(r.pagadores, 0) AS pagadores_resumen
+            FROM crudo c
+            FULL JOIN resumen r ON r."año" = c."año" AND r.mes = c.mes AND r.metodo_pago_id = c.metodo_pago_id
+            WHERE COALESCE(c.total, 0) <> COALESCE(r.total, 0)
+               OR COALESCE(c.cantidad, 0) <> COALESCE(r.cantidad, 0)
+               OR COALESCE(c.pagadores, 0) <> COALESCE(r.pagadores, 0)
+            ORDER BY 1, 2, 3
+        """), params).mappings().all()
+        return [
+            {**dict(f), 'total_pagos': float(f['total_pagos']), 'total_resumen': float(f['total_resumen'])}
+            for f in filas
+        ]
+
+    def obtener_ingresos_mensuales(self, desde: date, hasta: date) -> List[Dict[str, Any]]:
+        """Por mes entre `desde` y `hasta` (inclusive): total, cantidad y pagadores distintos."""
+        asegurar_resumen_ingresos(self.db)
+        filas = self.db.execute(text("""
+            SELECT r."año", r.mes, SUM(r.total) AS total, SUM(r.cantidad) AS cantidad,
+                   (SELECT COUNT(DISTINCT h.usuario_id) FROM ingresos_pagadores_mes h
+                    WHERE h."año" = r."año" AND h.mes = r.mes AND h.pagos > 0) AS pagadores
+            FROM ingresos_mensuales r
+            WHERE r."año" * 12 + r.mes BETWEEN :desde AND :hasta
+            GROUP BY r."año", r.mes
+            ORDER BY r."año", r.mes
+        """), {'desde': desde.year * 12 + desde.month, 'hasta': hasta.year * 12 + hasta.month}).mappings().all()
+        return [
+            {'año': int(f['año']), 'mes': int(f['mes']), 'total': float(f['total'] or 0),
+             'cantidad': int(f['cantidad'] or 0), 'pagadores': int(f['pagadores'] or 0)}
+            for f in filas
+        ]
+
+    def obtener_desglose_ingresos(self, año: int, mes: int) -> List[Dict[str, Any]]:
+        """Celdas del mes por método de pago y tipo de cuota."""
+        asegurar_resumen_ingresos(self.db)
+        filas = self.db.execute(text("""
+            SELECT r.metodo_pago_id, COALESCE(mp.nombre, 'Sin método') AS metodo_pago,
+                   NULLIF(r.tipo_cuota, '') AS tipo_cuota, r.total, r.cantidad, r.pagadores
+            FROM ingresos_mensuales r
+            LEFT JOIN metodos_pago mp ON mp.id = r.metodo_pago_id
+            WHERE r."año" = :anio AND r.mes = :mes AND r.cantidad > 0
+            ORDER BY r.total DESC
+        """), {'anio': int(año), 'mes': int(mes)}).mappings().all()
+        return [{**dict(f), 'total': float(f['total'] or 0)} for f in filas]
+
+    def obtener_pagadores_mes(self, año: int, mes: int) -> Set[int]:
+        asegurar_resumen_ingresos(self.db)
+        return set(self.db.execute(text("""
+            SELECT DISTINCT usuario_id FROM ingresos_pagadores_mes
+            WHERE "año" = :anio AND mes = :mes AND pagos > 0
+        """), {'anio': int(año), 'mes': int(mes)}).scalars().all())
+
     def verificar_pago_existe(self, usuario_id: int, mes: int, año: int) -> bool:
         stmt = select(func.count(Pago.id)).where(
             Pago.usuario_id == usuario_id,
-            func.extract('month', Pago.fecha_pago) == mes,
-            func.extract('year', Pago.fecha_pago) == año
+            en_rango(Pago.fecha_pago, rango_mes(año, mes))
         )
         return (self.db.scalar(stmt) or 0) > 0
 
@@ -248,7 +1159,7 @@ class PaymentRepository(BaseRepository):
             func.avg(Pago.monto),
             func.min(Pago.monto),
             func.max(Pago.monto)
-        ).where(func.extract('year', Pago.fecha_pago) == año)
+        ).where(en_rango(Pago.fecha_pago, rango_anio(año)))
         
         row = self.db.execute(stmt).first()
         
@@ -267,7 +1178,7 @@ class PaymentRepository(BaseRepository):
             func.count(Pago.id),
             func.sum(Pago.monto)
         ).where(
-            func.extract('year', Pago.fecha_pago) == año
+            en_rango(Pago.fecha_pago, rango_anio(año))
         ).group_by('mes').order_by('mes')
         
         for r in self.db.execute(stmt_mes).all():
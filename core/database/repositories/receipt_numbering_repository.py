@@ -0,0 +1,339 @@
+import re
+import threading
+from collections import deque
+from datetime import date
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from .base import BaseRepository
+from ..date_ranges import hoy_gym
+from ..orm_models import NumeracionComprobante, ContadorComprobante, ComprobantePago
+
+# Numeración de comprobantes, por tipo (numeracion_comprobantes.modo_estricto):
+# - secuencia (por defecto): nextval sobre una secuencia de Postgres por tipo y período.
+#   nextval no toma locks ni se deshace con el rollback, y cada proceso reserva bloques
+#   de números para no ir a la base en cada emisión. Puede dejar huecos (bloques de
+#   procesos que terminaron, inserts fallidos): obtener_huecos los lista.
+# - estricto: correlativo sin huecos con UPDATE ... RETURNING sobre contadores_comprobantes
+#   en la misma transacción corta que inserta el comprobante. Serializa las emisiones del
+#   tipo mientras dura el INSERT; el PDF se renderiza siempre después del commit.
+
+TIPO_RECIBO = 'recibo'
+
+CONFIG_DEFECTO: Dict[str, Any] = {
+    'prefijo': 'REC', 'separador': '-', 'numero_inicial': 1, 'longitud_numero': 6,
+    'reiniciar_anual': False, 'incluir_año': True, 'incluir_mes': False, 'modo_estricto': False,
+}
+
+# Números reservados por este proceso y todavía sin usar: (base, tipo, período) -> cola
+_BLOQUES: Dict[Tuple[str, str, int], Deque[int]] = {}
+_BLOQUES_LOCK = threading.Lock()
+# Secuencias y esquemas ya verificados en este proceso (por base)
+_SECUENCIAS: Set[Tuple[str, str]] = set()
+_ESQUEMAS: Set[str] = set()
+
+
+class ReceiptNumberingRepository(BaseRepository):
+
+    def _clave_base(self) -> str:
+        try:
+            return str(self.db.get_bind().url)
+        except Exception:
+            return ''
+
+    def _asegurar_esquema(self) -> None:
+        """Tablas y columnas de numeración en tenants creados antes de que existieran (una vez por proceso)."""
+        clave = self._clave_base()
+        if clave in _ESQUEMAS:
+            return
+        bind = self.db.get_bind()
+        for modelo in (NumeracionComprobante, ContadorComprobante, ComprobantePago):
+            modelo.__table__.create(bind, checkfirst=True)
+        self.db.execute(text("""
+            ALTER TABLE numeracion_comprobantes
+                ADD COLUMN IF NOT EXISTS "incluir_año" BOOLEAN DEFAULT true,
+                ADD COLUMN IF NOT EXISTS incluir_mes BOOLEAN DEFAULT false,
+                ADD COLUMN IF NOT EXISTS modo_estricto BOOLEAN DEFAULT false
+        """))
+        self.db.execute(text("""
+            ALTER TABLE comprobantes_pago
+                ADD COLUMN IF NOT EXISTS numero INTEGER,
+                ADD COLUMN IF NOT EXISTS periodo INTEGER
+        """))
+        self.db.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_comprobantes_pago_numero ON comprobantes_pago (tipo_comprobante, periodo, numero)"
+        ))
+        self.db.commit()
+        _ESQUEMAS.add(clave)
+
+    # --- Configuración ---
+
+    def obtener_config(self, tipo: str = TIPO_RECIBO) -> Dict[str, Any]:
+        self._asegurar_esquema()
+        row = self.db.execute(text("""
+            SELECT prefijo, separador, numero_inicial, longitud_numero, reiniciar_anual,
+                   "incluir_año", incluir_mes, modo_estricto
+            FROM numeracion_comprobantes
+            WHERE tipo_comprobante = :tipo AND COALESCE(activo, true)
+        """), {'tipo': tipo}).mappings().first()
+        config = dict(CONFIG_DEFECTO, tipo_comprobante=tipo)
+        if row:
+            config.update({k: v for k, v in row.items() if v is not None})
+        return config
+
+    def guardar_config(self, datos: Dict[str, Any], tipo: str = TIPO_RECIBO) -> bool:
+        config = self.obtener_config(tipo)
+        for clave in CONFIG_DEFECTO:
+            if clave in datos and datos[clave] is not None:
+                config[clave] = datos[clave]
+        params = {
+            'tipo': tipo,
+            'prefijo': str(config['prefijo'])[:10],
+            'separador': str(config['separador'])[:5],
+            'numero_inicial': max(1, int(config['numero_inicial'])),
+            'longitud_numero': min(max(1, int(config['longitud_numero'])), 12),
+            'reiniciar_anual': bool(config['reiniciar_anual']),
+            'incluir_anio': bool(config['incluir_año']),
+            'incluir_mes': bool(config['incluir_mes']),
+            'modo_estricto': bool(config['modo_estricto']),
+        }
+        try:
+            self.db.execute(text("""
+                INSERT INTO numeracion_comprobantes
+                    (tipo_comprobante, prefijo, separador, numero_inicial, longitud_numero,
+                     reiniciar_anual, "incluir_año", incluir_mes, modo_estricto, activo)
+                VALUES (:tipo, :prefijo, :separador, :numero_inicial, :longitud_numero,
+                        :reiniciar_anual, :incluir_anio, :incluir_mes, :modo_estricto, true)
+                ON CONFLICT (tipo_comprobante) DO UPDATE SET
+                    prefijo = EXCLUDED.prefijo, separador = EXCLUDED.separador,
+                    numero_inicial = EXCLUDED.numero_inicial, longitud_numero = EXCLUDED.longitud_numero,
+                    reiniciar_anual = EXCLUDED.reiniciar_anual, "incluir_año" = EXCLUDED."incluir_año",
+                    incluir_mes = EXCLUDED.incluir_mes, modo_estricto = EXCLUDED.modo_estricto, activo = true
+            """), params)
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            self.logger.error(f"Error guardando numeración de {tipo}: {e}")
+            return False
+        self._sincronizar_inicio(tipo, self.obtener_config(tipo))
+        return True
+
+    @staticmethod
+    def periodo(config: Dict[str, Any], hoy: date) -> int:
+        return hoy.year if config.get('reiniciar_anual') else 0
+
+    @staticmethod
+    def formatear(config: Dict[str, Any], numero: int, hoy: date) -> str:
+        sep = config.get('separador') or ''
+        partes = [p for p in [config.get('prefijo') or ''] if p]
+        if config.get('incluir_año'):
+            partes.append(f"{hoy.year:04d}")
+        if config.get('incluir_mes'):
+            partes.append(f"{hoy.month:02d}")
+        partes.append(str(int(numero)).zfill(int(config.get('longitud_numero') or 1)))
+        return sep.join(partes)
+
+    # --- Asignación ---
+
+    @staticmethod
+    def _nombre_secuencia(tipo: str, periodo: int) -> str:
+        return f"seq_comprobantes_{re.sub(r'[^a-z0-9_]', '_', tipo.lower())}_{int(periodo)}"
+
+    def _max_emitido(self, tipo: str, periodo: int) -> int:
+        return int(self.db.execute(text("""
+            SELECT COALESCE(MAX(numero), 0) FROM comprobantes_pago
+            WHERE tipo_comprobante = :tipo AND periodo = :periodo
+        """), {'tipo': tipo, 'periodo': periodo}).scalar() or 0)
+
+    def _asegurar_secuencia(self, tipo: str, periodo: int, inicio: int) -> str:
+        """Crea la secuencia del período si falta. Hace commit: llamar antes de abrir la transacción de emisión."""
+        nombre = self._nombre_secuencia(tipo, periodo)
+        clave = (self._clave_base(), nombre)
+        if clave in _SECUENCIAS:
+            return nombre
+        if not self.db.scalar(text("SELECT to_regclass(:s) IS NOT NULL"), {'s': nombre}):
+            inicio = max(int(inicio), self._max_emitido(tipo, periodo) + 1)
+            try:
+                self.db.execute(text(f"CREATE SEQUENCE IF NOT EXISTS {nombre} MINVALUE 1 START WITH {inicio}"))
+                self.db.commit()
+            except DBAPIError:
+                # Otro proceso la creó a la vez (IF NOT EXISTS no cubre la carrera en pg_class)
+                self.db.rollback()
+                if not self.db.scalar(text("SELECT to_regclass(:s) IS NOT NULL"), {'s': nombre}):
+                    raise
+        _SECUENCIAS.add(clave)
+        return nombre
+
+    def reservar_numeros(self, secuencia: str, cantidad: int) -> List[int]:
+        """`cantidad` números de la secuencia, sin locks; no se devuelven aunque la transacción falle."""
+        return [int(n) for n in self.db.execute(text(
+            "SELECT nextval(CAST(:s AS regclass)) FROM generate_series(1, :n)"
+        ), {'s': secuencia, 'n': max(1, int(cantidad))}).scalars().all()]
+
+    def _numero_secuencia(self, tipo: str, periodo: int, secuencia: str, tamano_bloque: int) -> int:
+        clave = (self._clave_base(), tipo, periodo)
+        with _BLOQUES_LOCK:
+            bloque = _BLOQUES.get(clave)
+            if bloque:
+                return bloque.popleft()
+        numeros = self.reservar_numeros(secuencia, tamano_bloque)
+        with _BLOQUES_LOCK:
+            _BLOQUES.setdefault(clave, deque()).extend(numeros[1:])
+        return numeros[0]
+
+    def _numero_estricto(self, tipo: str, periodo: int, inicio: int) -> int:
+        """Siguiente correlativo; el lock de la fila queda hasta el commit del llamador."""
+        self.db.execute(text("""
+            INSERT INTO contadores_comprobantes (tipo_comprobante, periodo, ultimo_numero)
+            SELECT :tipo, :periodo, GREATEST(:inicio - 1, COALESCE(MAX(numero), 0))
+            FROM comprobantes_pago WHERE tipo_comprobante = :tipo AND periodo = :periodo
+            ON CONFLICT (tipo_comprobante, periodo) DO NOTHING
+        """), {'tipo': tipo, 'periodo': periodo, 'inicio': int(inicio)})
+        return int(self.db.execute(text("""
+            UPDATE contadores_comprobantes SET ultimo_numero = ultimo_numero + 1
+            WHERE tipo_comprobante = :tipo AND periodo = :periodo
+            RETURNING ultimo_numero
+        """), {'tipo': tipo, 'periodo': periodo}).scalar())
+
+    def emitir_comprobante(self, pago_id: Optional[int], usuario_id: Optional[int], monto_total: float,
+                           tipo: str = TIPO_RECIBO, emitido_por: Optional[str] = None,
+                           plantilla_id: Optional[int] = None, datos_comprobante: Optional[str] = None,
+                           archivo_pdf: Optional[str] = None, tamano_bloque: int = 1) -> Dict[str, Any]:
+        """Asigna número e inserta el comprobante en una transacción corta (commit al volver).
+
+        Si el pago ya tiene un comprobante emitido del tipo se devuelve ese ('nuevo': False);
+        un advisory lock por pago evita que dos emisiones simultáneas creen dos.
+        """
+        config = self.obtener_config(tipo)
+        hoy = hoy_gym()
+        periodo = self.periodo(config, hoy)
+        inicio = int(config['numero_inicial'])
+        estricto = bool(config['modo_estricto'])
+        secuencia = None if estricto else self._asegurar_secuencia(tipo, periodo, inicio)
+        try:
+            if pago_id is not None:
+                self.db.execute(text("SELECT pg_advisory_xact_lock(hashtext(:tipo), :pago_id)"),
+                                {'tipo': f"comprobante:{tipo}", 'pago_id': int(pago_id)})
+                existente = self.db.execute(text("""
+                    SELECT id, numero_comprobante, numero FROM comprobantes_pago
+                    WHERE pago_id = :pago_id AND tipo_comprobante = :tipo AND estado = 'emitido'
+                    ORDER BY fecha_creacion DESC
+                    LIMIT 1
+                """), {'pago_id': int(pago_id), 'tipo': tipo}).mappings().first()
+                if existente:
+                    self.db.commit()
+                    return dict(existente, nuevo=False)
+            if estricto:
+                numero = self._numero_estricto(tipo, periodo, inicio)
+            else:
+                numero = self._numero_secuencia(tipo, periodo, secuencia, tamano_bloque)
+            numero_comprobante = self.formatear(config, numero, hoy)
+            comprobante_id = self.db.execute(text("""
+                INSERT INTO comprobantes_pago
+                    (tipo_comprobante, pago_id, usuario_id, numero_comprobante, numero, periodo,
+                     monto_total, plantilla_id, datos_comprobante, archivo_pdf, estado, emitido_por)
+                VALUES (:tipo, :pago_id, :usuario_id, :numero_comprobante, :numero, :periodo,
+                        :monto_total, :plantilla_id, CAST(:datos AS jsonb), :archivo_pdf, 'emitido', :emitido_por)
+                RETURNING id
+            """), {
+                'tipo': tipo, 'pago_id': pago_id, 'usuario_id': usuario_id,
+                'numero_comprobante': numero_comprobante, 'numero': numero, 'periodo': periodo,
+                'monto_total': monto_total, 'plantilla_id': plantilla_id, 'datos': datos_comprobante,
+                'archivo_pdf': archivo_pdf, 'emitido_por': emitido_por,
+            }).scalar()
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        return {'id': int(comprobante_id), 'numero_comprobante': numero_comprobante, 'numero': numero, 'nuevo': True}
+
+    def proximo_numero(self, tipo: str = TIPO_RECIBO) -> str:
+        """Vista previa del próximo número; no reserva nada (con secuencia es aproximado)."""
+        config = self.obtener_config(tipo)
+        hoy = hoy_gym()
+        periodo = self.periodo(config, hoy)
+        siguiente = max(int(config['numero_inicial']), self._max_emitido(tipo, periodo) + 1)
+        if config['modo_estricto']:
+            actual = self.db.execute(text("""
+                SELECT ultimo_numero FROM contadores_comprobantes
+                WHERE tipo_comprobante = :tipo AND periodo = :periodo
+            """), {'tipo': tipo, 'periodo': periodo}).scalar()
+            if actual is not None:
+                siguiente = max(siguiente, int(actual) + 1)
+        else:
+            with _BLOQUES_LOCK:
+                bloque = _BLOQUES.get((self._clave_base(), tipo, periodo))
+                local = bloque[0] if bloque else None
+            if local is not None:
+                siguiente = local
+            else:
+                nombre = self._nombre_secuencia(tipo, periodo)
+                if self.db.scalar(text("SELECT to_regclass(:s) IS NOT NULL"), {'s': nombre}):
+                    siguiente = int(self.db.execute(text(
+                        f"SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END FROM {nombre}"
+                    )).scalar())
+        return self.formatear(config, siguiente, hoy)
+
+    def _sincronizar_inicio(self, tipo: str, config: Dict[str, Any]) -> None:
+        """Tras cambiar la configuración, lleva contador y secuencia del período actual al
+        mayor entre numero_inicial - 1 y el último emitido (nunca los baja)."""
+        periodo = self.periodo(config, hoy_gym())
+        piso = max(int(config['numero_inicial']) - 1, self._max_emitido(tipo, periodo))
+        nombre = self._nombre_secuencia(tipo, periodo)
+        try:
+            self.db.execute(text("""
+                UPDATE contadores_comprobantes SET ultimo_numero = GREATEST(ultimo_numero, :piso)
+                WHERE tipo_comprobante = :tipo AND periodo = :periodo
+            """), {'tipo': tipo, 'periodo': periodo, 'piso': piso})
+            if piso >= 1 and self.db.scalar(text("SELECT to_regclass(:s) IS NOT NULL"), {'s': nombre}):
+                self.db.execute(text(f"""
+                    SELECT setval(CAST(:s AS regclass), :piso)
+                    WHERE :piso >= (SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END FROM {nombre})
+                """), {'s': nombre, 'piso': piso})
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            self.logger.error(f"Error sincronizando numeración de {tipo}: {e}")
+        # Los bloques reservados antes del cambio podrían quedar por debajo del nuevo inicio
+        with _BLOQUES_LOCK:
+            _BLOQUES.pop((self._clave_base(), tipo, periodo), None)
+
+    # --- Control ---
+
+    def obtener_huecos(self, tipo: str = TIPO_RECIBO, periodo: Optional[int] = None,
+                       limite: int = 1000) -> Dict[str, Any]:
+        """Números sin comprobante entre el primero y el último emitidos del período, y duplicados.
+
+        Los que este proceso tiene reservados sin usar se informan aparte: no son huecos todavía.
+        """
+        if periodo is None:
+            periodo = self.periodo(self.obtener_config(tipo), hoy_gym())
+        params = {'tipo': tipo, 'periodo': int(periodo), 'limite': int(limite)}
+        resumen = self.db.execute(text("""
+            SELECT MIN(numero) AS desde, MAX(numero) AS hasta,
+                   COUNT(*) AS emitidos, COUNT(DISTINCT numero) AS distintos
+            FROM comprobantes_pago
+            WHERE tipo_comprobante = :tipo AND periodo = :periodo AND numero IS NOT NULL
+        """), params).mappings().first()
+        with _BLOQUES_LOCK:
+            reservados = sorted(_BLOQUES.get((self._clave_base(), tipo, int(periodo))) or [])
+        out = {
+            'tipo_comprobante': tipo, 'periodo': int(periodo),
+            'desde': resumen['desde'], 'hasta': resumen['hasta'], 'emitidos': int(resumen['emitidos'] or 0),
+            'duplicados': int(resumen['emitidos'] or 0) - int(resumen['distintos'] or 0),
+            'total_huecos': 0, 'huecos': [], 'reservados_locales': reservados,
+        }
+        if resumen['desde'] is None:
+            return out
+        out['total_huecos'] = int(resumen['hasta']) - int(resumen['desde']) + 1 - int(resumen['distintos'])
+        if out['total_huecos']:
+            out['huecos'] = [int(n) for n in self.db.execute(text("""
+                SELECT g FROM generate_series(CAST(:desde AS integer), CAST(:hasta AS integer)) g
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM comprobantes_pago c
+                    WHERE c.tipo_comprobante = :tipo AND c.periodo = :periodo AND c.numero = g
+                )
+                ORDER BY g
+                LIMIT :limite
+            """), dict(params, desde=resumen['desde'], hasta=resumen['hasta'])).scalars().all()]
+        return out
@@ -3,7 +3,10 @@ from datetime import datetime, date, timedelta
 import logging
 from sqlalchemy import select, func, text, or_, and_
 from .base import BaseRepository
-from ..orm_models import Usuario, Pago, Asistencia, Clase, Rutina, Profesor, UsuarioEstado, HistorialEstado
+from .attendance_repository import asegurar_rollups_asistencias
+from .payment_repository import asegurar_resumen_ingresos
+from ..date_ranges import rango_ultimos_dias, rango_fechas, hoy_gym, en_rango
+from ..orm_models import Usuario, Pago, Asistencia, AsistenciaDiaria, IngresoMensual, Clase, Rutina, Profesor, UsuarioEstado, HistorialEstado
 
 class ReportsRepository(BaseRepository):
     
@@ -16,21 +19,26 @@ class ReportsRepository(BaseRepository):
         ) or 0
         
         # Nuevos usuarios en los últimos 30 días
-        fecha_limite = datetime.now() - timedelta(days=30)
         nuevos_30_dias = self.db.scalar(
-            select(func.count(Usuario.id)).where(Usuario.fecha_registro >= fecha_limite, Usuario.rol.in_(['socio', 'miembro', 'profesor']))
+            select(func.count(Usuario.id)).where(
+                en_rango(Usuario.fecha_registro, rango_ultimos_dias(30)),
+                Usuario.rol.in_(['socio', 'miembro', 'profesor'])
+            )
         ) or 0
         
-        # Ingresos del mes actual
+        # Ingresos del mes actual (resumen de ingresos)
+        asegurar_resumen_ingresos(self.db)
+        hoy = hoy_gym()
         ingresos_mes = self.db.scalar(
-            select(func.coalesce(func.sum(Pago.monto), 0)).where(
-                func.date_trunc('month', Pago.fecha_pago) == func.date_trunc('month', func.current_date())
+            select(func.coalesce(func.sum(IngresoMensual.total), 0)).where(
+                IngresoMensual.año == hoy.year, IngresoMensual.mes == hoy.month
             )
         ) or 0.0
         
-        # Asistencias de hoy
+        # Asistencias de hoy (rollup diario)
+        asegurar_rollups_asistencias(self.db)
         asistencias_hoy = self.db.scalar(
-            select(func.count(Asistencia.id)).where(Asistencia.fecha == func.current_date())
+            select(AsistenciaDiaria.total).where(AsistenciaDiaria.fecha == hoy_gym())
         ) or 0
         
         return {
@@ -42,12 +50,13 @@ class ReportsRepository(BaseRepository):
 
     def generar_reporte_automatico_periodo(self, tipo_reporte: str, fecha_inicio: date, fecha_fin: date) -> dict:
         """Genera reportes automáticos por período"""
+        rango = rango_fechas(fecha_inicio, fecha_fin)
         try:
             if tipo_reporte == 'usuarios_nuevos':
                 stmt = select(
                     func.count(Usuario.id).label('total'),
                     func.count(func.distinct(Usuario.id)).label('usuarios_unicos')
-                ).where(func.date(Usuario.fecha_registro).between(fecha_inicio, fecha_fin))
+                ).where(en_rango(Usuario.fecha_registro, rango))
                 
                 row = self.db.execute(stmt).first()
                 datos = {
@@ -64,7 +73,7 @@ class ReportsRepository(BaseRepository):
                     func.sum(Pago.monto).label('ingresos_totales'),
                     func.avg(Pago.monto).label('promedio_pago'),
                     func.count(func.distinct(Pago.usuario_id)).label('usuarios_unicos')
-                ).where(func.date(Pago.fecha_pago).between(fecha_inicio, fecha_fin))
+                ).where(en_rango(Pago.fecha_pago, rango))
                 
                 row = self.db.execute(stmt).first()
                 datos = {
@@ -79,7 +88,7 @@ class ReportsRepository(BaseRepository):
                 stmt = select(
                     func.count(Asistencia.id).label('total'),
                     func.count(func.distinct(Asistencia.usuario_id)).label('usuarios_unicos')
-                ).where(Asistencia.fecha.between(fecha_inicio, fecha_fin))
+                ).where(en_rango(Asistencia.fecha, rango, solo_fecha=True))
                 
                 row = self.db.execute(stmt).first()
                 datos = {
@@ -108,7 +117,8 @@ class ReportsRepository(BaseRepository):
         try:
             total_users = self.db.scalar(select(func.count(Usuario.id))) or 0
             active_users = self.db.scalar(select(func.count(Usuario.id)).where(Usuario.activo == True)) or 0
-            total_revenue = self.db.scalar(select(func.sum(Pago.monto))) or 0.0
+            asegurar_resumen_ingresos(self.db)
+            total_revenue = self.db.scalar(select(func.sum(IngresoMensual.total))) or 0.0
             classes_today = self.db.scalar(select(func.count(Clase.id)).where(Clase.activa == True)) or 0
             
             return {
@@ -166,7 +176,7 @@ class ReportsRepository(BaseRepository):
             estados_activos = {r[0]: r[1] for r in self.db.execute(stmt_states).all()}
             
             # Alertas
-            today = date.today()
+            today = hoy_gym()
             proximos_vencer = self.db.scalar(
                 select(func.count(UsuarioEstado.id)).join(Usuario).where(
                     UsuarioEstado.activo == True,
@@ -4,11 +4,15 @@ import logging
 from sqlalchemy import select, update, delete, func, text, or_, and_
 from sqlalchemy.orm import Session
 from .base import BaseRepository
+from .payment_repository import PaymentRepository
+from .attendance_repository import AttendanceRepository
 from ..orm_models import (
     Usuario, Pago, Asistencia, Rutina, ClaseUsuario, ClaseListaEspera,
     UsuarioNota, UsuarioEtiqueta, UsuarioEstado, Profesor, NotificacionCupo,
-    AuditLog, CheckinPending, TipoCuota, Etiqueta, UsuarioEtiqueta, HistorialEstado
+    AuditLog, CheckinPending, TipoCuota, Etiqueta, UsuarioEtiqueta, HistorialEstado,
+    Configuracion
 )
+from ..telefonos import VERSION_NORMALIZACION, asegurar_columna_e164, invalidar_indice, normalizar_telefono
 
 class UserRepository(BaseRepository):
     
@@ -152,9 +156,14 @@ class UserRepository(BaseRepository):
             
         if user:
             # Eliminar referencias manuales si necesario (aunque cascade debería manejarlo)
+            # Los pagos se borran en cascada sin pasar por el repositorio: descontarlos del resumen de ingresos
+            PaymentRepository(self.db, self.cache, self.logger).descontar_usuario_resumen_ingresos(usuario_id)
+            # Ídem con las asistencias y sus rollups
+            AttendanceRepository(self.db, self.cache, self.logger).descontar_usuario_rollups_asistencias(usuario_id)
             self.db.delete(user)
             self.db.commit()
             self._invalidate_cache('usuarios')
+            self._invalidate_cache('asistencias')
 
     # --- Search & Filters ---
     def buscar_usuarios(self, query: str) -> List[Dict]:
@@ -435,3 +444,78 @@ class UserRepository(BaseRepository):
         self.db.commit()
         self._invalidate_cache('usuarios')
         return result
+
+    # --- Teléfonos normalizados (usuarios.telefono_e164, ver core/database/telefonos.py) ---
+    CLAVE_VERSION_TELEFONOS = 'telefonos_e164_version'
+
+    def _asegurar_telefono_e164(self) -> None:
+        """Crea la columna si falta (una vez por proceso). No la completa ni hace commit: las
+        lecturas corren dentro de transacciones ajenas (lotes del webhook); el relleno lo hacen
+        los crons con sincronizar_telefonos_e164 / sincronizar_telefonos_e164_si_hace_falta."""
+        asegurar_columna_e164(self.db.connection())
+
+    def sincronizar_telefonos_e164_si_hace_falta(self) -> Optional[Dict[str, int]]:
+        """Completa la columna si nunca se calculó con la normalización vigente; None si ya estaba."""
+        asegurar_columna_e164(self.db.connection())
+        valor = self.db.scalar(select(Configuracion.valor).where(Configuracion.clave == self.CLAVE_VERSION_TELEFONOS))
+        if str(valor or '') == str(VERSION_NORMALIZACION):
+            self.db.commit()
+            return None
+        return self.sincronizar_telefonos_e164()
+
+    def sincronizar_telefonos_e164(self, lote: int = 1000) -> Dict[str, int]:
+        """Recalcula telefono_e164 de toda la tabla y escribe sólo las filas que cambian.
+
+        Cubre lo que no pasa por los eventos del ORM (SQL directo, importaciones) y los
+        cambios de VERSION_NORMALIZACION."""
+        asegurar_columna_e164(self.db.connection())
+        filas = self.db.execute(text("SELECT id, telefono, telefono_e164 FROM usuarios")).all()
+        cambios = []
+        for uid, telefono, actual in filas:
+            e164 = normalizar_telefono(telefono)
+            if e164 != actual:
+                cambios.append((int(uid), e164))
+        for i in range(0, len(cambios), lote):
+            parte = cambios[i:i + lote]
+            valores = ", ".join(f"(CAST(:i{n} AS integer), CAST(:t{n} AS varchar))" for n in range(len(parte)))
+            params: Dict[str, Any] = {}
+            for n, (uid, e164) in enumerate(parte):
+                params[f"i{n}"] = uid
+                params[f"t{n}"] = e164
+            self.db.execute(text(f"""
+                UPDATE usuarios u SET telefono_e164 = v.t
+                FROM (VALUES {valores}) AS v(i, t)
+                WHERE u.id = v.i
+            """), params)
+        self.db.execute(text("""
+            INSERT INTO configuracion (clave, valor, tipo, descripcion)
+            VALUES (:clave, :valor, 'integer', 'Versión de la normalización de usuarios.telefono_e164')
+            ON CONFLICT (clave) DO UPDATE SET valor = EXCLUDED.valor
+        """), {'clave': self.CLAVE_VERSION_TELEFONOS, 'valor': str(VERSION_NORMALIZACION)})
+        self.db.commit()
+        invalidar_indice(str(self.db.get_bind().url))
+        return {'usuarios': len(filas), 'actualizados': len(cambios)}
+
+    def obtener_indice_telefonos_e164(self) -> Dict[str, int]:
+        """{telefono_e164: usuario_id}; con teléfonos compartidos gana el activo de menor id."""
+        self._asegurar_telefono_e164()
+        filas = self.db.execute(text("""
+            SELECT DISTINCT ON (telefono_e164) telefono_e164, id
+            FROM usuarios
+            WHERE telefono_e164 IS NOT NULL
+            ORDER BY telefono_e164, activo DESC, id
+        """)).all()
+        return {r[0]: int(r[1]) for r in filas}
+
+    def obtener_ids_por_telefono_e164(self, telefonos: List[str]) -> Dict[str, int]:
+        tels = sorted({t for t in telefonos or [] if t})
+        if not tels:
+            return {}
+        self._asegurar_telefono_e164()
+        filas = self.db.execute(text("""
+            SELECT DISTINCT ON (telefono_e164) telefono_e164, id
+            FROM usuarios
+            WHERE telefono_e164 = ANY(:tels)
+            ORDER BY telefono_e164, activo DESC, id
+        """), {'tels': tels}).all()
+        return {r[0]: int(r[1]) for r in filas}
@@ -0,0 +1,319 @@
+from typing import List, Optional, Dict, Any, Tuple
+from datetime import datetime
+from sqlalchemy import text, delete
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from .base import BaseRepository, asegurar_tabla
+from .whatsapp_repository import WhatsappRepository
+from ..telefonos import asegurar_columna_e164
+from ..orm_models import WhatsappCampania, WhatsappCampaniaDestinatario, WhatsappBaja, WhatsappOutbox
+
+# Campañas de WhatsApp (ver core/whatsapp_campaigns.py). Los destinatarios se materializan al
+# crear la campaña con un solo INSERT ... SELECT; después avanzan pendiente -> encolado
+# (fila en whatsapp_outbox, clave 'campania:<id>:<destinatario>') -> enviado / fallido
+# (WhatsappRepository.registrar_resultados_outbox) -> entregado / leido (webhook).
+# Los omitidos (sin teléfono, repetidos, de baja, anti-spam, allowlist) quedan con su motivo.
+
+ESTADOS_CAMPANIA = ('en_curso', 'pausada', 'cancelada', 'completada')
+
+
+def clave_envio(campania_id: int, destinatario_id: int) -> str:
+    return f"campania:{int(campania_id)}:{int(destinatario_id)}"
+
+
+class WhatsappCampaignRepository(BaseRepository):
+
+    def _asegurar_tablas(self) -> None:
+        for modelo in (WhatsappCampania, WhatsappCampaniaDestinatario, WhatsappBaja, WhatsappOutbox):
+            asegurar_tabla(self.db, modelo)
+
+    # --- Alta y selección de destinatarios ---
+
+    @staticmethod
+    def _filtro_segmento(segmento: Dict[str, Any], params: Dict[str, Any]) -> str:
+        """Condición sobre `u` (usuarios): socios que cumplen alguno de los criterios del segmento
+        (etiquetas, clases, horarios de clase, usuarios puntuales); sin criterios, todos."""
+        partes = []
+        etiquetas = [int(x) for x in segmento.get('etiquetas') or []]
+        clases = [int(x) for x in segmento.get('clases') or []]
+        horarios = [int(x) for x in segmento.get('horarios') or []]
+        usuarios = [int(x) for x in segmento.get('usuarios') or []]
+        if etiquetas:
+            params['etiquetas'] = etiquetas
+            partes.append("EXISTS (SELECT 1 FROM usuario_etiquetas ue "
+                          "WHERE ue.usuario_id = u.id AND ue.etiqueta_id = ANY(:etiquetas))")
+        if clases:
+            params['clases'] = clases
+            partes.append("EXISTS (SELECT 1 FROM clase_usuarios cu JOIN clases_horarios ch ON ch.id = cu.clase_horario_id "
+                          "WHERE cu.usuario_id = u.id AND ch.clase_id = ANY(:clases))")
+        if horarios:
+            params['horarios'] = horarios
+            partes.append("EXISTS (SELECT 1 FROM clase_usuarios cu "
+                          "WHERE cu.usuario_id = u.id AND cu.clase_horario_id = ANY(:horarios))")
+            if segmento.get('incluir_lista_espera'):
+                partes.append("EXISTS (SELECT 1 FROM clase_lista_espera le WHERE le.usuario_id = u.id "
+                              "AND le.activo AND le.clase_horario_id = ANY(:horarios))")
+        if usuarios:
+            params['usuarios'] = usuarios
+            partes.append("u.id = ANY(:usuarios)")
+        filtro = f"({' OR '.join(partes)})" if partes else "TRUE"
+        if segmento.get('solo_activos', True):
+            filtro += " AND u.activo"
+        params['roles'] = [str(r) for r in segmento.get('roles') or ['socio']]
+        return filtro + " AND u.rol = ANY(:roles)"
+
+    def crear_campania(self, campania: Dict[str, Any], segmento: Dict[str, Any]) -> Dict[str, Any]:
+        """Crea la campaña y sus destinatarios en una transacción. Los socios del segmento se
+        eligen en una sola consulta; un teléfono repetido, vacío o dado de baja queda omitido."""
+        self._asegurar_tablas()
+        params: Dict[str, Any] = {}
+        filtro = self._filtro_segmento(segmento, params)
+        try:
+            asegurar_columna_e164(self.db.connection())
+            campania_id = self.db.execute(
+                pg_insert(WhatsappCampania).values(segmento=segmento, **campania).returning(WhatsappCampania.id)
+            ).scalar()
+            params['c'] = int(campania_id)
+            filas = self.db.execute(text(f"""
+                WITH candidatos AS (
+                    SELECT u.id, NULLIF(trim(u.telefono), '') AS telefono, u.telefono_e164,
+                           row_number() OVER (
+                               PARTITION BY COALESCE(u.telefono_e164, NULLIF(trim(u.telefono), ''), 'u' || u.id)
+                               ORDER BY u.id
+                           ) AS n
+                    FROM usuarios u
+                    WHERE {filtro}
+                ), insertados AS (
+                    INSERT INTO whatsapp_campania_destinatarios (campania_id, usuario_id, telefono, estado, motivo)
+                    SELECT :c, c.id, c.telefono,
+                           CASE WHEN c.telefono IS NULL OR b.telefono IS NOT NULL OR c.n > 1
+                                THEN 'omitido' ELSE 'pendiente' END,
+                           CASE WHEN c.telefono IS NULL THEN 'sin_telefono'
+                                WHEN b.telefono IS NOT NULL THEN 'baja'
+                                WHEN c.n > 1 THEN 'telefono_repetido' END
+                    FROM candidatos c
+                    LEFT JOIN whatsapp_bajas b ON b.telefono = c.telefono_e164
+                    ORDER BY c.id
+                    RETURNING motivo
+                )
+                SELECT motivo, COUNT(*) FROM insertados GROUP BY motivo
+            """), params).all()
+            total = sum(int(n) for _, n in filas)
+            self.db.execute(text("UPDATE whatsapp_campanias SET total = :t WHERE id = :c"), {'t': total, 'c': params['c']})
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        omitidos = {m: int(n) for m, n in filas if m}
+        return {'id': params['c'], 'total': total, 'pendientes': total - sum(omitidos.values()), 'omitidos': omitidos}
+
+    # --- Avance (ver MotorCampanias.avanzar) ---
+
+    def obtener_campanias_activas(self) -> List[int]:
+        self._asegurar_tablas()
+        return [int(i) for i in self.db.execute(text(
+            "SELECT id FROM whatsapp_campanias WHERE estado = 'en_curso' ORDER BY id"
+        )).scalars().all()]
+
+    def bloquear_campania(self, campania_id: int) -> Optional[Dict[str, Any]]:
+        """Abre la transacción del paso de una campaña en curso y la bloquea; None si no está
+        en curso o si otra instancia la está avanzando. `ahora` es el reloj de la base."""
+        fila = self.db.execute(text("""
+            SELECT id, nombre, tipo, contenido, template_name, idioma, parametros, mensajes_por_minuto,
+                   silencio_desde, silencio_hasta, ultimo_avance, CAST(clock_timestamp() AS timestamp) AS ahora
+            FROM whatsapp_campanias
+            WHERE id = :c AND estado = 'en_curso'
+            FOR UPDATE SKIP LOCKED
+        """), {'c': int(campania_id)}).mappings().first()
+        if fila is None:
+            self.db.rollback()
+            return None
+        return dict(fila)
+
+    def tomar_destinatarios(self, campania_id: int, limite: int) -> List[Dict[str, Any]]:
+        """Próximos destinatarios pendientes con los datos del socio para el render y si el
+        teléfono se dio de baja después de crear la campaña (`baja`). No hace commit."""
+        asegurar_columna_e164(self.db.connection())
+        filas = self.db.execute(text("""
+            SELECT d.id, d.usuario_id, d.telefono, u.nombre, u.dni, u.tipo_cuota,
+                   EXISTS (SELECT 1 FROM whatsapp_bajas b WHERE b.telefono = u.telefono_e164) AS baja
+            FROM whatsapp_campania_destinatarios d
+            LEFT JOIN usuarios u ON u.id = d.usuario_id
+            WHERE d.campania_id = :c AND d.estado = 'pendiente'
+            ORDER BY d.id
+            LIMIT :limite
+        """), {'c': int(campania_id), 'limite': int(limite)}).mappings().all()
+        return [dict(f) for f in filas]
+
+    def cerrar_paso(self, campania_id: int, ultimo_avance: datetime, envios: List[Dict[str, Any]] = None,
+                    omitidos: List[Tuple[int, str]] = None, posponer_s: Optional[float] = None) -> int:
+        """Cierra la transacción de bloquear_campania: encola los envíos (claves de encolar_outbox
+        más 'destinatario_id'), marca los omitidos con su motivo, mueve la marca del cupo y, en
+        horario de silencio, posterga lo que quedó pendiente en el outbox. Devuelve los encolados."""
+        c = int(campania_id)
+        try:
+            encolados = 0
+            if envios:
+                self.db.execute(pg_insert(WhatsappOutbox).values([
+                    {k: e.get(k) for k in ('idempotency_key', 'phone_number_id', 'telefono', 'payload',
+                                           'user_id', 'message_type', 'contenido')}
+                    for e in envios
+                ]).on_conflict_do_nothing(index_elements=['idempotency_key']))
+                # Por la clave y no por lo insertado: una clave que ya estaba también cuenta
+                encolados = int(self.db.execute(text("""
+                    UPDATE whatsapp_campania_destinatarios d
+                    SET estado = 'encolado', outbox_id = o.id, actualizado = CURRENT_TIMESTAMP
+                    FROM whatsapp_outbox o
+                    WHERE d.campania_id = :c AND d.id = ANY(:ids) AND d.estado = 'pendiente'
+                      AND o.idempotency_key = 'campania:' || d.campania_id || ':' || d.id
+                """), {'c': c, 'ids': [int(e['destinatario_id']) for e in envios]}).rowcount or 0)
+            if omitidos:
+                self.db.execute(text("""
+                    UPDATE whatsapp_campania_destinatarios
+                    SET estado = 'omitido', motivo = :motivo, actualizado = CURRENT_TIMESTAMP
+                    WHERE id = :id AND campania_id = :c AND estado = 'pendiente'
+                """), [{'id': int(d), 'motivo': m, 'c': c} for d, m in omitidos])
+            if posponer_s:
+                self.db.execute(text("""
+                    UPDATE whatsapp_outbox o
+                    SET proximo_intento = CURRENT_TIMESTAMP + make_interval(secs => :s)
+                    FROM whatsapp_campania_destinatarios d
+                    WHERE d.campania_id = :c AND d.estado = 'encolado' AND o.id = d.outbox_id
+                      AND o.estado = 'pendiente' AND o.proximo_intento < CURRENT_TIMESTAMP + make_interval(secs => :s)
+                """), {'c': c, 's': float(posponer_s)})
+            self.db.execute(text("UPDATE whatsapp_campanias SET ultimo_avance = :u WHERE id = :c"),
+                            {'u': ultimo_avance, 'c': c})
+            self.db.commit()
+            return encolados
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def cerrar_completadas(self) -> List[int]:
+        """Da por completadas las campañas en curso sin destinatarios pendientes ni encolados."""
+        ids = self.db.execute(text("""
+            UPDATE whatsapp_campanias c SET estado = 'completada', finalizado = CURRENT_TIMESTAMP
+            WHERE c.id IN (SELECT id FROM whatsapp_campanias WHERE estado = 'en_curso' FOR UPDATE SKIP LOCKED)
+              AND NOT EXISTS (
+                SELECT 1 FROM whatsapp_campania_destinatarios d
+                WHERE d.campania_id = c.id AND d.estado IN ('pendiente', 'encolado')
+            )
+            RETURNING c.id
+        """)).scalars().all()
+        self.db.commit()
+        return [int(i) for i in ids]
+
+    # --- Pausa, reanudación y cancelación ---
+
+    def cambiar_estado(self, campania_id: int, accion: str) -> bool:
+        """'pausar' | 'reanudar' | 'cancelar'. Al pausar o cancelar se retira del outbox lo que
+        todavía no se tomó para enviar (vuelve a pendiente o queda cancelado); lo que ya se está
+        enviando termina y se registra. False si la campaña no estaba en un estado compatible."""
+        desde, hacia = {
+            'pausar': (('en_curso',), 'pausada'),
+            'reanudar': (('pausada',), 'en_curso'),
+            'cancelar': (('en_curso', 'pausada'), 'cancelada'),
+        }[accion]
+        c = int(campania_id)
+        self._asegurar_tablas()
+        try:
+            # Espera a que termine un paso en curso de MotorCampanias (FOR UPDATE de bloquear_campania)
+            cambiada = self.db.execute(text("""
+                UPDATE whatsapp_campanias
+                SET estado = :hacia, ultimo_avance = NULL,
+                    finalizado = CASE WHEN :hacia = 'cancelada' THEN CURRENT_TIMESTAMP ELSE finalizado END
+                WHERE id = :c AND estado = ANY(:desde)
+            """), {'c': c, 'hacia': hacia, 'desde': list(desde)}).rowcount
+            if not cambiada:
+                self.db.rollback()
+                return False
+            if accion != 'reanudar':
+                self.db.execute(text("""
+                    WITH retirados AS (
+                        DELETE FROM whatsapp_outbox o
+                        USING whatsapp_campania_destinatarios d
+                        WHERE d.campania_id = :c AND d.estado = 'encolado' AND o.id = d.outbox_id AND o.estado = 'pendiente'
+                        RETURNING o.id
+                    )
+                    UPDATE whatsapp_campania_destinatarios
+                    SET estado = 'pendiente', outbox_id = NULL, actualizado = CURRENT_TIMESTAMP
+                    WHERE campania_id = :c AND outbox_id IN (SELECT id FROM retirados)
+                """), {'c': c})
+            if accion == 'cancelar':
+                self.db.execute(text("""
+                    UPDATE whatsapp_campania_destinatarios SET estado = 'cancelado', actualizado = CURRENT_TIMESTAMP
+                    WHERE campania_id = :c AND estado = 'pendiente'
+                """), {'c': c})
+            self.db.commit()
+            return True
+        except Exception:
+            self.db.rollback()
+            raise
+
+    # --- Consulta ---
+
+    def obtener_progreso(self, campania_id: int) -> Optional[Dict[str, Any]]:
+        """Campaña con sus destinatarios por estado y los motivos de omisión / fallo más frecuentes."""
+        self._asegurar_tablas()
+        c = int(campania_id)
+        campania = self.db.execute(text("""
+            SELECT id, nombre, estado, tipo, template_name, mensajes_por_minuto, silencio_desde, silencio_hasta,
+                   total, creada_por, creado, finalizado
+            FROM whatsapp_campanias WHERE id = :c
+        """), {'c': c}).mappings().first()
+        if campania is None:
+            return None
+        por_estado = {r[0]: int(r[1]) for r in self.db.execute(text("""
+            SELECT estado, COUNT(*) FROM whatsapp_campania_destinatarios WHERE campania_id = :c GROUP BY estado
+        """), {'c': c}).all()}
+        motivos = {f"{r[0]}:{r[1]}": int(r[2]) for r in self.db.execute(text("""
+            SELECT estado, motivo, COUNT(*) FROM whatsapp_campania_destinatarios
+            WHERE campania_id = :c AND estado IN ('omitido', 'fallido') AND motivo IS NOT NULL
+            GROUP BY estado, motivo ORDER BY COUNT(*) DESC LIMIT 20
+        """), {'c': c}).all()}
+        return {**dict(campania), 'por_estado': por_estado, 'motivos': motivos}
+
+    def listar_campanias(self, limite: int = 50) -> List[Dict[str, Any]]:
+        self._asegurar_tablas()
+        filas = self.db.execute(text("""
+            SELECT c.id, c.nombre, c.estado, c.tipo, c.total, c.mensajes_por_minuto, c.creado, c.finalizado,
+                   COUNT(d.id) FILTER (WHERE d.estado IN ('pendiente', 'encolado')) AS pendientes,
+                   COUNT(d.id) FILTER (WHERE d.estado IN ('enviado', 'entregado', 'leido')) AS enviados,
+                   COUNT(d.id) FILTER (WHERE d.estado = 'fallido') AS fallidos,
+                   COUNT(d.id) FILTER (WHERE d.estado IN ('omitido', 'cancelado')) AS omitidos
+            FROM (SELECT * FROM whatsapp_campanias ORDER BY id DESC LIMIT :limite) c
+            LEFT JOIN whatsapp_campania_destinatarios d ON d.campania_id = c.id
+            GROUP BY c.id, c.nombre, c.estado, c.tipo, c.total, c.mensajes_por_minuto, c.creado, c.finalizado
+            ORDER BY c.id DESC
+        """), {'limite': int(limite)}).mappings().all()
+        return [dict(f) for f in filas]
+
+    # --- Bajas ---
+
+    def guardar_baja(self, telefono: str, baja: bool = True, usuario_id: Optional[int] = None) -> bool:
+        """Agrega (o quita) un teléfono E.164 de las bajas de campañas y retira al socio de las
+        campañas en curso. True si cambió algo."""
+        self._asegurar_tablas()
+        try:
+            if baja:
+                cambios = self.db.execute(
+                    pg_insert(WhatsappBaja).values(telefono=telefono, usuario_id=usuario_id, origen='manual')
+                    .on_conflict_do_nothing(index_elements=['telefono'])
+                ).rowcount
+            else:
+                cambios = self.db.execute(delete(WhatsappBaja).where(WhatsappBaja.telefono == telefono)).rowcount
+            if baja:
+                WhatsappRepository(self.db, None, None).retirar_bajas_de_campanias([telefono])
+            self.db.commit()
+            return bool(cambios)
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def listar_bajas(self, limite: int = 500) -> List[Dict[str, Any]]:
+        self._asegurar_tablas()
+        filas = self.db.execute(text("""
+            SELECT b.telefono, b.usuario_id, u.nombre, b.origen, b.creado
+            FROM whatsapp_bajas b LEFT JOIN usuarios u ON u.id = b.usuario_id
+            ORDER BY b.creado DESC LIMIT :limite
+        """), {'limite': int(limite)}).mappings().all()
+        return [dict(f) for f in filas]
@@ -1,13 +1,44 @@
-from typing import List, Optional, Dict, Any
-from datetime import datetime, timedelta
+from typing import List, Optional, Dict, Any, Set, Tuple
+from datetime import date, datetime, timedelta
 import logging
-from sqlalchemy import select, update, delete, func, text, or_, and_
-from .base import BaseRepository
+from sqlalchemy import select, update, delete, insert, func, text, or_, and_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from .base import BaseRepository, asegurar_tabla
+from .audit_repository import AuditRepository
+from ..date_ranges import ahora_gym, hoy_gym
+from .. import estadisticas_whatsapp
+from ..telefonos import asegurar_columna_e164
 from ..orm_models import (
-    WhatsappMessage, WhatsappTemplate, WhatsappConfig, 
-    Usuario, ProfesorNotificacion, NotificacionCupo
+    WhatsappMessage, WhatsappTemplate, WhatsappConfig, WhatsappOutbox, WhatsappWebhookEvento, WhatsappConsumidor,
+    WhatsappMessageId, WhatsappResumenTelefono, WhatsappCampania, WhatsappCampaniaDestinatario, WhatsappBaja,
+    Configuracion, AuditLog, Usuario, ProfesorNotificacion, NotificacionCupo
 )
 
+# Orden de los estados de entrega: un webhook atrasado no pisa un estado posterior
+ESTADOS_ENTREGA = ('sent', 'delivered', 'read', 'failed')
+
+# Clave del advisory lock que serializa el consumo de whatsapp_webhook_eventos
+_LOCK_WEBHOOK = 0x5741_4857
+
+# Auditorías de lista de espera que generan una confirmación por WhatsApp
+ACCIONES_LISTA_ESPERA = ('auto_promote_waitlist', 'decline_waitlist_promotion')
+CONSUMIDOR_LISTA_ESPERA = 'confirmaciones_lista_espera'
+
+# Marca hasta la que whatsapp_resumen_telefonos incluye whatsapp_messages (ver whatsapp_retention_repository)
+CONSUMIDOR_RESUMEN = 'resumen_telefonos'
+
+# message_type de los envíos de campañas (ver core/whatsapp_campaigns.py)
+TIPO_CAMPANIA = 'campaign'
+
+# Envíos del outbox que se registran en whatsapp_messages recién cuando el dispatcher los
+# envía (con el message_id real), según el prefijo de su idempotency_key
+PREFIJOS_REGISTRO_AL_ENVIAR = ('recordatorio:',)
+
+# Estado de un destinatario de campaña por estado de entrega; tampoco retrocede
+ESTADO_DESTINATARIO = {'sent': 'enviado', 'delivered': 'entregado', 'read': 'leido', 'failed': 'fallido'}
+ORDEN_DESTINATARIO = ('encolado', 'enviado', 'entregado', 'leido', 'fallido')
+
+
 class WhatsappRepository(BaseRepository):
 
     def marcar_notificacion_leida(self, notificacion_id: int) -> bool:
@@ -80,6 +111,7 @@ class WhatsappRepository(BaseRepository):
             )
             self.db.add(msg)
             self.db.commit()
+            self._anotar_estadisticas([{'message_type': message_type, 'status': status}])
             return True
         except Exception as e:
             self.logger.error(f"Error registrando mensaje WhatsApp: {e}")
@@ -173,26 +205,50 @@ class WhatsappRepository(BaseRepository):
             self.logger.error(f"Error en _enviar_mensaje_bienvenida_automatico: {e}")
 
     def obtener_estadisticas_whatsapp(self) -> Dict:
+        """Totales por tipo y estado del período de EstadisticasWhatsapp (tablero en memoria)."""
         try:
-            total = self.db.scalar(select(func.count(WhatsappMessage.id))) or 0
-            ultimo_mes = self.db.scalar(select(func.count(WhatsappMessage.id)).where(WhatsappMessage.sent_at > datetime.now() - timedelta(days=30))) or 0
-            
-            stmt_type = select(WhatsappMessage.message_type, func.count(WhatsappMessage.id)).group_by(WhatsappMessage.message_type)
-            by_type = {r[0]: r[1] for r in self.db.execute(stmt_type).all()}
-            
-            stmt_status = select(WhatsappMessage.status, func.count(WhatsappMessage.id)).group_by(WhatsappMessage.status)
-            by_status = {r[0]: r[1] for r in self.db.execute(stmt_status).all()}
-            
-            return {
-                'total_mensajes': total,
-                'mensajes_ultimo_mes': ultimo_mes,
-                'mensajes_por_tipo': by_type,
-                'mensajes_por_estado': by_status
-            }
+            return estadisticas_whatsapp.EstadisticasWhatsapp(self.db).totales()
         except Exception as e:
             self.logger.error(f"Error stats whatsapp: {e}")
             return {}
 
+    def obtener_agregados_whatsapp(self, desde: date, hasta: Optional[date] = None) -> List[Dict[str, Any]]:
+        """Conteos por día y tipo de mensaje, una columna por estado (estadisticas_whatsapp.ESTADOS),
+        en una sola pasada por whatsapp_messages desde `desde` (y hasta `hasta`, excluido)."""
+        filtro = "AND sent_at < :hasta" if hasta else ""
+        filas = self.db.execute(text(f"""
+            SELECT CAST(sent_at AS date) AS dia, message_type,
+                   COUNT(*) FILTER (WHERE status = 'sent') AS sent,
+                   COUNT(*) FILTER (WHERE status = 'delivered') AS delivered,
+                   COUNT(*) FILTER (WHERE status = 'read') AS read,
+                   COUNT(*) FILTER (WHERE status = 'failed') AS failed,
+                   COUNT(*) FILTER (WHERE status = 'received') AS received,
+                   COUNT(*) FILTER (WHERE status IS NULL
+                                    OR status NOT IN ('sent', 'delivered', 'read', 'failed', 'received')) AS otro
+            FROM whatsapp_messages
+            WHERE sent_at >= :desde {filtro}
+            GROUP BY 1, 2
+        """), {'desde': desde, 'hasta': hasta}).mappings().all()
+        return [dict(f) for f in filas]
+
+    def contar_mensajes_historico(self) -> int:
+        """Mensajes registrados desde siempre: los contados en whatsapp_resumen_telefonos (incluye
+        los ya archivados) más los posteriores a su marca."""
+        self._asegurar_tabla(WhatsappResumenTelefono)
+        self._asegurar_tabla(WhatsappConsumidor)
+        return int(self.db.scalar(text("""
+            SELECT (SELECT COALESCE(SUM(enviados + fallidos + recibidos), 0) FROM whatsapp_resumen_telefonos)
+                 + (SELECT COUNT(*) FROM whatsapp_messages
+                    WHERE id > COALESCE((SELECT ultimo_id FROM whatsapp_consumidores WHERE nombre = :consumidor), 0))
+        """), {'consumidor': CONSUMIDOR_RESUMEN}) or 0)
+
+    def _anotar_estadisticas(self, filas: List[Dict[str, Any]]) -> None:
+        """Suma mensajes recién insertados al tablero de estadisticas_whatsapp."""
+        estadisticas_whatsapp.anotar_mensajes(
+            estadisticas_whatsapp.clave_base(self.db),
+            [(None, f.get('message_type'), f.get('status', 'sent')) for f in filas]
+        )
+
     def limpiar_mensajes_antiguos_whatsapp(self, dias_antiguedad: int = 90) -> int:
         stmt = delete(WhatsappMessage).where(WhatsappMessage.sent_at < datetime.now() - timedelta(days=dias_antiguedad))
         result = self.db.execute(stmt)
@@ -281,6 +337,66 @@ class WhatsappRepository(BaseRepository):
         stmt = select(func.distinct(WhatsappMessage.phone_number)).where(WhatsappMessage.status == 'failed', WhatsappMessage.sent_at >= fecha_limite)
         return list(self.db.scalars(stmt).all())
 
+    def obtener_pendientes_fallidos(self, dias: int = 30, limite: int = 200) -> List[Dict[str, Any]]:
+        """Último mensaje fallido de cada teléfono en los últimos `dias` días.
+
+        Sale de whatsapp_resumen_telefonos más los mensajes posteriores a su marca, y cada
+        fallo se lee por su clave (id, sent_at): no recorre whatsapp_messages por estado."""
+        self._asegurar_tabla(WhatsappResumenTelefono)
+        self._asegurar_tabla(WhatsappConsumidor)
+        filas = self.db.execute(text("""
+            WITH marca AS (
+                SELECT COALESCE((SELECT ultimo_id FROM whatsapp_consumidores WHERE nombre = :consumidor), 0) AS id
+            ), candidatos AS (
+                SELECT phone_number, ultimo_fallo AS sent_at, ultimo_fallo_id AS id
+                FROM whatsapp_resumen_telefonos
+                WHERE ultimo_fallo >= LOCALTIMESTAMP - make_interval(days => :dias)
+                UNION ALL
+                SELECT m.phone_number, m.sent_at, m.id
+                FROM whatsapp_messages m, marca
+                WHERE m.id > marca.id AND m.status = 'failed' AND m.sent_at >= LOCALTIMESTAMP - make_interval(days => :dias)
+            ), ultimos AS (
+                SELECT DISTINCT ON (phone_number) phone_number, sent_at, id
+                FROM candidatos
+                ORDER BY phone_number, sent_at DESC, id DESC
+            )
+            SELECT wm.id, wm.user_id, COALESCE(u.nombre, '') AS usuario_nombre,
+                   COALESCE(u.telefono, '') AS usuario_telefono, wm.phone_number, wm.message_type,
+                   wm.template_name, wm.message_content, wm.status, wm.message_id, wm.sent_at AS fecha_envio
+            FROM ultimos x
+            JOIN whatsapp_messages wm ON wm.id = x.id AND wm.sent_at = x.sent_at
+            LEFT JOIN usuarios u ON u.id = wm.user_id
+            WHERE wm.status = 'failed'
+            ORDER BY wm.phone_number
+            LIMIT :limite
+        """), {'consumidor': CONSUMIDOR_RESUMEN, 'dias': max(int(dias), 1), 'limite': int(limite)}).mappings().all()
+        return [dict(f) for f in filas]
+
+    def limpiar_fallidos(self, telefono: Optional[str] = None, dias: int = 30) -> Dict[str, int]:
+        """Borra los mensajes fallidos de los últimos `dias` días (de un teléfono o de todos) y
+        quita ese fallo del resumen por teléfono. Devuelve {teléfono: filas borradas}."""
+        self._asegurar_tabla(WhatsappResumenTelefono)
+        filtro = "AND phone_number = :telefono" if telefono else ""
+        try:
+            filas = self.db.execute(text(f"""
+                WITH borradas AS (
+                    DELETE FROM whatsapp_messages
+                    WHERE status = 'failed' AND sent_at >= LOCALTIMESTAMP - make_interval(days => :dias) {filtro}
+                    RETURNING phone_number
+                ), resumen AS (
+                    UPDATE whatsapp_resumen_telefonos r SET ultimo_fallo = NULL, ultimo_fallo_id = NULL,
+                                                          actualizado = CURRENT_TIMESTAMP
+                    WHERE r.phone_number IN (SELECT phone_number FROM borradas)
+                      AND r.ultimo_fallo >= LOCALTIMESTAMP - make_interval(days => :dias)
+                )
+                SELECT phone_number, COUNT(*) FROM borradas GROUP BY phone_number ORDER BY phone_number
+            """), {'dias': max(int(dias), 1), 'telefono': telefono}).all()
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        return {r[0]: int(r[1]) for r in filas}
+
     def actualizar_estado_mensaje_whatsapp(self, message_id: str, nuevo_estado: str) -> bool:
         stmt = update(WhatsappMessage).where(WhatsappMessage.message_id == message_id).values(status=nuevo_estado)
         result = self.db.execute(stmt)
@@ -298,3 +414,688 @@ class WhatsappRepository(BaseRepository):
         result = self.db.execute(stmt)
         self.db.commit()
         return result.rowcount > 0
+
+    # --- Pipeline de recordatorios (consultas en bloque) ---
+
+    def obtener_candidatos_recordatorio(self, modo: str = 'vencidos', dias_anticipacion: int = 3,
+                                        limite: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Socios activos con cuota vencida (`vencidos`) o por vencer en `dias_anticipacion` días (`por_vencer`).
+        Incluye el precio de su tipo de cuota para la plantilla."""
+        hoy = hoy_gym()
+        if modo == 'por_vencer':
+            filtro = "u.fecha_proximo_vencimiento >= :hoy AND u.fecha_proximo_vencimiento <= :hasta"
+        else:
+            filtro = "u.fecha_proximo_vencimiento < :hoy"
+        sql = f"""
+            SELECT u.id, u.nombre, u.telefono, u.fecha_proximo_vencimiento,
+                   COALESCE(u.cuotas_vencidas, 0) AS cuotas_vencidas, COALESCE(tc.precio, 0) AS monto
+            FROM usuarios u
+            LEFT JOIN LATERAL (
+                SELECT t.precio FROM tipos_cuota t
+                WHERE t.nombre = u.tipo_cuota OR t.id::text = u.tipo_cuota
+                ORDER BY (t.nombre = u.tipo_cuota) DESC
+                LIMIT 1
+            ) tc ON TRUE
+            WHERE u.activo = TRUE AND u.rol = 'socio' AND {filtro}
+            ORDER BY u.fecha_proximo_vencimiento, u.id
+        """
+        params = {'hoy': hoy, 'hasta': hoy + timedelta(days=max(int(dias_anticipacion), 0))}
+        if limite:
+            sql += " LIMIT :limite"
+            params['limite'] = int(limite)
+        return [
+            {'id': r[0], 'nombre': r[1], 'telefono': r[2], 'fecha_vencimiento': r[3],
+             'cuotas_vencidas': int(r[4] or 0), 'monto': float(r[5] or 0)}
+            for r in self.db.execute(text(sql), params).all()
+        ]
+
+    def obtener_eventos_antispam(self, telefonos: List[str], horizonte_horas: float = 24) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Eventos anti-spam de todos los teléfonos en una sola consulta (ver core/antispam.py).
+
+        Por teléfono y tipo de mensaje: antigüedad en segundos de los envíos y de los fallos de
+        las últimas 24 h, y del último envío dentro de `horizonte_horas`. Las antigüedades se
+        miden con el reloj de la base, el mismo que completa sent_at.
+        """
+        telefonos = sorted({str(t) for t in telefonos if t})
+        if not telefonos:
+            return {}
+        filas = self.db.execute(text("""
+            SELECT phone_number, message_type,
+                   array_agg(EXTRACT(EPOCH FROM LOCALTIMESTAMP - sent_at))
+                       FILTER (WHERE status <> 'failed' AND sent_at >= LOCALTIMESTAMP - INTERVAL '1 day') AS envios,
+                   array_agg(EXTRACT(EPOCH FROM LOCALTIMESTAMP - sent_at))
+                       FILTER (WHERE status = 'failed' AND sent_at >= LOCALTIMESTAMP - INTERVAL '1 day') AS fallos,
+                   MIN(EXTRACT(EPOCH FROM LOCALTIMESTAMP - sent_at)) FILTER (WHERE status <> 'failed') AS ultimo
+            FROM whatsapp_messages
+            WHERE phone_number = ANY(:telefonos) AND status <> 'received'
+              AND sent_at >= LOCALTIMESTAMP - make_interval(secs => :horizonte)
+            GROUP BY phone_number, message_type
+        """), {'telefonos': telefonos, 'horizonte': max(float(horizonte_horas), 24.0) * 3600}).all()
+        eventos: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        for tel, tipo, envios, fallos, ultimo in filas:
+            eventos.setdefault(tel, {})[tipo] = {
+                'envios': [float(x) for x in envios or []],
+                'fallos': [float(x) for x in fallos or []],
+                'ultimo': float(ultimo) if ultimo is not None else None,
+            }
+        return eventos
+
+    def obtener_valores_configuracion(self, claves: List[str]) -> Dict[str, str]:
+        """Valores de la tabla configuracion para las claves pedidas (las ausentes no aparecen)."""
+        if not claves:
+            return {}
+        filas = self.db.execute(
+            select(Configuracion.clave, Configuracion.valor).where(Configuracion.clave.in_(list(claves)))
+        ).all()
+        return {r[0]: r[1] for r in filas}
+
+    def obtener_configuracion_whatsapp_completa(self, claves: List[str] = ()) -> Dict[str, Any]:
+        """phone_id, waba_id y access_token (tal como está guardado) de la fila activa más reciente
+        de whatsapp_config, más los valores de `configuracion` para `claves`."""
+        cfg: Dict[str, Any] = self.obtener_valores_configuracion(list(claves))
+        fila = self.db.execute(
+            select(WhatsappConfig.phone_id, WhatsappConfig.waba_id, WhatsappConfig.access_token)
+            .where(WhatsappConfig.active.is_(True)).order_by(WhatsappConfig.id.desc()).limit(1)
+        ).first()
+        if fila:
+            cfg.update({'phone_id': fila[0], 'waba_id': fila[1], 'access_token': fila[2]})
+        return cfg
+
+    def guardar_configuracion_whatsapp(self, credenciales: Dict[str, str], valores: Dict[str, str] = None) -> None:
+        """Actualiza la fila activa de whatsapp_config con `credenciales` (phone_id, waba_id,
+        access_token; la crea si no hay) y guarda `valores` en `configuracion`, en una transacción."""
+        try:
+            if credenciales:
+                activa = self.db.scalar(
+                    select(WhatsappConfig.id).where(WhatsappConfig.active.is_(True))
+                    .order_by(WhatsappConfig.id.desc()).limit(1).with_for_update()
+                )
+                if activa is not None:
+                    self.db.execute(update(WhatsappConfig).where(WhatsappConfig.id == activa).values(**credenciales))
+                else:
+                    self.db.execute(insert(WhatsappConfig).values(
+                        phone_id=credenciales.get('phone_id') or '', waba_id=credenciales.get('waba_id') or '',
+                        access_token=credenciales.get('access_token'), active=True,
+                    ))
+            if valores:
+                stmt = pg_insert(Configuracion).values([{'clave': k, 'valor': str(v)} for k, v in valores.items()])
+                self.db.execute(stmt.on_conflict_do_update(index_elements=['clave'], set_={'valor': stmt.excluded.valor}))
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def contar_destinatarios_24h(self) -> int:
+        """Destinatarios distintos con envíos en las últimas 24 h (límite de tier de la Cloud API)."""
+        return self.db.scalar(text("""
+            SELECT COUNT(DISTINCT phone_number) FROM whatsapp_messages
+            WHERE sent_at >= :desde AND status NOT IN ('failed', 'received')
+        """), {'desde': ahora_gym() - timedelta(days=1)}) or 0
+
+    def registrar_mensajes_whatsapp_batch(self, mensajes: List[Dict[str, Any]]) -> int:
+        """Inserta varios mensajes en un solo INSERT (claves de registrar_mensaje_whatsapp)."""
+        filas = [
+            {
+                'user_id': m.get('user_id'), 'message_type': m['message_type'],
+                'template_name': m['template_name'], 'phone_number': m['phone_number'],
+                'message_content': m.get('message_content'), 'status': m.get('status', 'sent'),
+                'message_id': m.get('message_id') or None,
+            }
+            for m in mensajes or []
+        ]
+        if not filas:
+            return 0
+        try:
+            self.db.execute(insert(WhatsappMessage), filas)
+            self.db.commit()
+            self._anotar_estadisticas(filas)
+            return len(filas)
+        except Exception as e:
+            self.db.rollback()
+            self.logger.error(f"Error registrando mensajes WhatsApp en lote: {e}")
+            return 0
+
+    # --- Outbox de envíos (ver core/whatsapp_dispatcher.py) ---
+
+    def _asegurar_tabla(self, modelo) -> None:
+        asegurar_tabla(self.db, modelo)
+
+    def _asegurar_outbox(self) -> None:
+        self._asegurar_tabla(WhatsappOutbox)
+
+    def encolar_outbox(self, mensajes: List[Dict[str, Any]]) -> int:
+        """Inserta mensajes en el outbox; los idempotency_key repetidos se ignoran.
+
+        Claves: idempotency_key, phone_number_id, telefono, payload y opcionales user_id,
+        message_type, contenido. Devuelve cuántos se encolaron efectivamente.
+        """
+        return len(self.encolar_outbox_claves(mensajes))
+
+    def encolar_outbox_claves(self, mensajes: List[Dict[str, Any]]) -> Set[str]:
+        """Como encolar_outbox, pero devuelve las idempotency_key que se insertaron en esta llamada."""
+        filas = [
+            {
+                'idempotency_key': str(m['idempotency_key'])[:128], 'phone_number_id': str(m['phone_number_id']),
+                'telefono': str(m['telefono']), 'payload': m['payload'], 'user_id': m.get('user_id'),
+                'message_type': m.get('message_type'), 'contenido': m.get('contenido'),
+            }
+            for m in mensajes or []
+        ]
+        if not filas:
+            return set()
+        self._asegurar_outbox()
+        try:
+            claves = self.db.execute(
+                pg_insert(WhatsappOutbox).values(filas)
+                .on_conflict_do_nothing(index_elements=['idempotency_key'])
+                .returning(WhatsappOutbox.idempotency_key)
+            ).scalars().all()
+            self.db.commit()
+            return set(claves)
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def reclamar_outbox(self, limite: int, lease_segundos: int = 120) -> List[Dict[str, Any]]:
+        """Toma hasta `limite` mensajes listos para enviar y los marca 'enviando' por `lease_segundos`.
+
+        FOR UPDATE SKIP LOCKED reparte el trabajo entre instancias; si un proceso muere con
+        mensajes tomados, vuelven a estar disponibles cuando vence su bloqueo.
+        """
+        self._asegurar_outbox()
+        filas = self.db.execute(text("""
+            UPDATE whatsapp_outbox o
+            SET estado = 'enviando', intentos = o.intentos + 1,
+                bloqueado_hasta = CURRENT_TIMESTAMP + make_interval(secs => :lease)
+            WHERE o.id IN (
+                SELECT id FROM whatsapp_outbox
+                WHERE (estado = 'pendiente' AND proximo_intento <= CURRENT_TIMESTAMP)
+                   OR (estado = 'enviando' AND bloqueado_hasta < CURRENT_TIMESTAMP)
+                ORDER BY proximo_intento, id
+                LIMIT :limite
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING o.id, o.idempotency_key, o.phone_number_id, o.telefono, o.payload, o.user_id,
+                      o.message_type, o.contenido, o.intentos
+        """), {'limite': int(limite), 'lease': int(lease_segundos)}).mappings().all()
+        self.db.commit()
+        return [dict(f) for f in filas]
+
+    def registrar_resultados_outbox(self, resultados: List[Dict[str, Any]]) -> None:
+        """Aplica el resultado de cada envío: 'enviado' (message_id), 'pendiente' (reintento en
+        `demora_s` segundos) o 'fallido' (definitivo; además queda como failed en whatsapp_messages).
+
+        Los enviados de campañas y los de PREFIJOS_REGISTRO_AL_ENVIAR se registran como sent en
+        whatsapp_messages con el message_id de la API, que es el que traen los webhooks de estado."""
+        if not resultados:
+            return
+        enviados = [{'id': r['id'], 'message_id': r.get('message_id')} for r in resultados if r['estado'] == 'enviado']
+        reintentos = [{'id': r['id'], 'error': r.get('error'), 'demora': float(r.get('demora_s') or 0)}
+                      for r in resultados if r['estado'] == 'pendiente']
+        fallidos = [r for r in resultados if r['estado'] == 'fallido']
+        try:
+            if enviados:
+                self.db.execute(text("""
+                    UPDATE whatsapp_outbox SET estado = 'enviado', message_id = :message_id,
+                           enviado = CURRENT_TIMESTAMP, bloqueado_hasta = NULL, ultimo_error = NULL
+                    WHERE id = :id
+                """), enviados)
+            if reintentos:
+                self.db.execute(text("""
+                    UPDATE whatsapp_outbox SET estado = 'pendiente', ultimo_error = :error, bloqueado_hasta = NULL,
+                           proximo_intento = CURRENT_TIMESTAMP + make_interval(secs => :demora)
+                    WHERE id = :id
+                """), reintentos)
+            if fallidos:
+                self.db.execute(text("""
+                    UPDATE whatsapp_outbox SET estado = 'fallido', ultimo_error = :error, bloqueado_hasta = NULL
+                    WHERE id = :id
+                """), [{'id': r['id'], 'error': r.get('error')} for r in fallidos])
+                self.db.execute(insert(WhatsappMessage), [
+                    {
+                        'user_id': r.get('user_id'), 'message_type': r.get('message_type') or 'outbox',
+                        'template_name': r.get('template_name') or 'failed', 'phone_number': r['telefono'],
+                        'message_content': f"{r.get('contenido') or ''} - Error: {r.get('error')}".strip(' -'),
+                        'status': 'failed', 'message_id': None,
+                    }
+                    for r in fallidos
+                ])
+            campanias = [r for r in resultados if r.get('message_type') == TIPO_CAMPANIA]
+            registros = self._registrar_envios_campania(campanias) if campanias else []
+            registros += self._registrar_enviados([
+                r for r in resultados
+                if r['estado'] == 'enviado' and str(r.get('idempotency_key') or '').startswith(PREFIJOS_REGISTRO_AL_ENVIAR)
+            ])
+            self.db.commit()
+            self._anotar_estadisticas(registros + [{'message_type': r.get('message_type') or 'outbox', 'status': 'failed'}
+                                                   for r in fallidos])
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def _registrar_enviados(self, enviados: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Registra como sent en whatsapp_messages los enviados que todavía no tienen fila con su
+        message_id. No hace commit (va en la transacción de registrar_resultados_outbox)."""
+        nuevos = self._reservar_message_ids([r.get('message_id') for r in enviados if r.get('message_id')])
+        registros = [
+            {
+                'user_id': r.get('user_id'), 'message_type': r.get('message_type') or 'outbox',
+                'template_name': r.get('template_name') or 'outbox', 'phone_number': r['telefono'],
+                'message_content': r.get('contenido'), 'status': 'sent', 'message_id': r['message_id'],
+            }
+            for r in enviados if r.get('message_id') in nuevos
+        ]
+        if registros:
+            self.db.execute(pg_insert(WhatsappMessage).values(registros).on_conflict_do_nothing())
+        return registros
+
+    def _asegurar_campanias(self) -> None:
+        for modelo in (WhatsappCampania, WhatsappCampaniaDestinatario, WhatsappBaja):
+            self._asegurar_tabla(modelo)
+
+    def _registrar_envios_campania(self, resultados: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Pasa el resultado del outbox a los destinatarios de campaña y registra los enviados
+        en whatsapp_messages (anti-spam, estadísticas y estados del webhook). No hace commit:
+        va en la transacción de registrar_resultados_outbox. Devuelve las filas registradas."""
+        self._asegurar_campanias()
+        enviados = [r for r in resultados if r['estado'] == 'enviado']
+        fallidos = [r for r in resultados if r['estado'] == 'fallido']
+        if enviados:
+            # Un webhook puede haber llegado antes que este resultado: el estado no retrocede
+            self.db.execute(text("""
+                UPDATE whatsapp_campania_destinatarios
+                SET estado = CASE WHEN estado = 'encolado' THEN 'enviado' ELSE estado END,
+                    message_id = COALESCE(message_id, :message_id), actualizado = CURRENT_TIMESTAMP
+                WHERE outbox_id = :id
+            """), [{'id': r['id'], 'message_id': r.get('message_id')} for r in enviados])
+        if fallidos:
+            self.db.execute(text("""
+                UPDATE whatsapp_campania_destinatarios
+                SET estado = 'fallido', motivo = left(:error, 200), actualizado = CURRENT_TIMESTAMP
+                WHERE outbox_id = :id AND estado IN ('encolado', 'enviado')
+            """), [{'id': r['id'], 'error': r.get('error')} for r in fallidos])
+        nuevos = self._reservar_message_ids([r.get('message_id') for r in enviados])
+        registros = [
+            {
+                'user_id': r.get('user_id'), 'message_type': TIPO_CAMPANIA,
+                'template_name': r.get('template_name') or TIPO_CAMPANIA, 'phone_number': r['telefono'],
+                'message_content': r.get('contenido'), 'status': 'sent', 'message_id': r['message_id'],
+            }
+            for r in enviados if r.get('message_id') in nuevos
+        ]
+        if registros:
+            self.db.execute(pg_insert(WhatsappMessage).values(registros).on_conflict_do_nothing())
+        return registros
+
+    def resumen_outbox(self) -> Dict[str, Any]:
+        """Cantidad de mensajes por estado y antigüedad del pendiente más viejo."""
+        self._asegurar_outbox()
+        filas = self.db.execute(text("""
+            SELECT estado, COUNT(*), MIN(creado) FILTER (WHERE estado IN ('pendiente', 'enviando'))
+            FROM whatsapp_outbox GROUP BY estado
+        """)).all()
+        por_estado = {r[0]: int(r[1]) for r in filas}
+        pendientes_desde = min((r[2] for r in filas if r[2] is not None), default=None)
+        return {
+            'por_estado': por_estado,
+            'pendientes': por_estado.get('pendiente', 0) + por_estado.get('enviando', 0),
+            'pendiente_mas_antiguo': pendientes_desde.isoformat() if pendientes_desde else None,
+        }
+
+    # --- Ingesta de webhooks (ver core/whatsapp_webhook.py) ---
+    # Los métodos de lote no hacen commit: el lote entero es una transacción que cierra
+    # cerrar_lote_webhook, y el advisory lock de tomar_lote_webhook dura lo mismo que ella.
+
+    def guardar_evento_webhook(self, payload: Dict[str, Any]) -> int:
+        """Persiste el payload crudo de un POST del webhook y devuelve su id."""
+        self._asegurar_tabla(WhatsappWebhookEvento)
+        try:
+            evento_id = self.db.execute(
+                insert(WhatsappWebhookEvento).values(payload=payload).returning(WhatsappWebhookEvento.id)
+            ).scalar()
+            self.db.commit()
+            return int(evento_id)
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def tomar_lote_webhook(self, limite: int, max_intentos: int) -> Optional[List[Dict[str, Any]]]:
+        """Abre la transacción del lote: toma el advisory lock del consumidor y devuelve los
+        eventos pendientes más antiguos en orden de llegada. None si otro consumidor está activo."""
+        self._asegurar_tabla(WhatsappWebhookEvento)
+        if not self.db.scalar(text("SELECT pg_try_advisory_xact_lock(:k)"), {'k': _LOCK_WEBHOOK}):
+            self.db.rollback()
+            return None
+        filas = self.db.execute(text("""
+            SELECT id, payload FROM whatsapp_webhook_eventos
+            WHERE procesado IS NULL AND intentos < :max_intentos
+            ORDER BY id
+            LIMIT :limite
+        """), {'limite': int(limite), 'max_intentos': int(max_intentos)}).all()
+        return [{'id': r[0], 'payload': r[1]} for r in filas]
+
+    def aplicar_estados_entrega(self, estados: Dict[str, str]) -> int:
+        """Actualiza el estado de varios mensajes en un solo UPDATE ... FROM (VALUES ...),
+        sin retroceder estados (ESTADOS_ENTREGA)."""
+        estados = {mid: st for mid, st in (estados or {}).items() if mid and st in ESTADOS_ENTREGA}
+        if not estados:
+            return 0
+        valores, params = [], {'orden': list(ESTADOS_ENTREGA)}
+        for i, (mid, st) in enumerate(estados.items()):
+            valores.append(f"(:m{i}, :s{i})")
+            params[f"m{i}"] = str(mid)
+            params[f"s{i}"] = st
+        self._asegurar_tabla(WhatsappResumenTelefono)
+        # Un fallo también mueve el último fallo del resumen por teléfono (los contadores los
+        # suma actualizar_resumen_telefonos al pasar la marca)
+        # `o` es la fila antes del UPDATE: da el estado anterior para el tablero de estadísticas
+        cambios = self.db.execute(text(f"""
+            WITH actualizados AS (
+                UPDATE whatsapp_messages m SET status = v.status
+                FROM (VALUES {', '.join(valores)}) AS v(message_id, status), whatsapp_messages o
+                WHERE m.message_id = v.message_id AND o.id = m.id
+                  AND COALESCE(array_position(CAST(:orden AS text[]), m.status::text), 0)
+                      < array_position(CAST(:orden AS text[]), v.status::text)
+                RETURNING m.id, m.sent_at, m.phone_number, m.status, m.message_type, o.status AS anterior
+            ), fallos AS (
+                INSERT INTO whatsapp_resumen_telefonos AS r (phone_number, ultimo_fallo, ultimo_fallo_id)
+                SELECT DISTINCT ON (phone_number) phone_number, sent_at, id
+                FROM actualizados WHERE status = 'failed'
+                ORDER BY phone_number, sent_at DESC, id DESC
+                ON CONFLICT (phone_number) DO UPDATE SET
+                    ultimo_fallo_id = CASE WHEN r.ultimo_fallo IS NULL OR EXCLUDED.ultimo_fallo >= r.ultimo_fallo
+                                           THEN EXCLUDED.ultimo_fallo_id ELSE r.ultimo_fallo_id END,
+                    ultimo_fallo = GREATEST(r.ultimo_fallo, EXCLUDED.ultimo_fallo),
+                    actualizado = CURRENT_TIMESTAMP
+            )
+            SELECT CAST(sent_at AS date), message_type, anterior, status FROM actualizados
+        """), params).all()
+        estadisticas_whatsapp.anotar_transiciones(estadisticas_whatsapp.clave_base(self.db), cambios)
+        return len(cambios)
+
+    def aplicar_estados_campanias(self, estados: Dict[int, str]) -> int:
+        """Estados de entrega de destinatarios de campaña (por id, del biz_opaque_callback_data
+        de los webhooks) en un solo UPDATE, sin retroceder (ORDEN_DESTINATARIO). No hace commit."""
+        estados = {int(d): ESTADO_DESTINATARIO[st] for d, st in (estados or {}).items() if st in ESTADO_DESTINATARIO}
+        if not estados:
+            return 0
+        valores, params = [], {'orden': list(ORDEN_DESTINATARIO)}
+        for i, (did, st) in enumerate(estados.items()):
+            valores.append(f"(:d{i}, :s{i})")
+            params[f"d{i}"] = did
+            params[f"s{i}"] = st
+        self._asegurar_campanias()
+        return int(self.db.execute(text(f"""
+            UPDATE whatsapp_campania_destinatarios d SET estado = v.estado, actualizado = CURRENT_TIMESTAMP
+            FROM (VALUES {', '.join(valores)}) AS v(id, estado)
+            WHERE d.id = v.id
+              AND array_position(CAST(:orden AS text[]), d.estado::text)
+                  < array_position(CAST(:orden AS text[]), v.estado::text)
+        """), params).rowcount or 0)
+
+    def anotar_bajas(self, bajas: Dict[str, Optional[int]], alta: Set[str] = None) -> None:
+        """Registra las bajas de campañas pedidas por WhatsApp ({teléfono E.164: usuario_id}) y
+        quita las de quienes pidieron volver (`alta`). No hace commit."""
+        self._asegurar_campanias()
+        if bajas:
+            self.db.execute(
+                pg_insert(WhatsappBaja).values([
+                    {'telefono': t, 'usuario_id': u, 'origen': 'whatsapp'} for t, u in bajas.items()
+                ]).on_conflict_do_nothing(index_elements=['telefono'])
+            )
+        if alta:
+            self.db.execute(delete(WhatsappBaja).where(WhatsappBaja.telefono.in_(sorted(alta))))
+        if bajas:
+            self.retirar_bajas_de_campanias(list(bajas))
+
+    def retirar_bajas_de_campanias(self, telefonos: List[str]) -> int:
+        """Saca de las campañas en curso o pausadas a los socios con esos teléfonos E.164: lo
+        pendiente y lo encolado que todavía no se tomó para enviar queda omitido por 'baja' y
+        sus filas del outbox se borran. Devuelve los destinatarios retirados. No hace commit."""
+        tels = sorted({t for t in telefonos or [] if t})
+        if not tels:
+            return 0
+        asegurar_columna_e164(self.db.connection())
+        return int(self.db.execute(text("""
+            WITH afectados AS (
+                SELECT d.id, d.outbox_id
+                FROM whatsapp_campania_destinatarios d
+                JOIN whatsapp_campanias c ON c.id = d.campania_id AND c.estado IN ('en_curso', 'pausada')
+                JOIN usuarios u ON u.id = d.usuario_id
+                WHERE u.telefono_e164 = ANY(:tels) AND d.estado IN ('pendiente', 'encolado')
+            ), retirados AS (
+                DELETE FROM whatsapp_outbox o
+                USING afectados a
+                WHERE o.id = a.outbox_id AND o.estado = 'pendiente'
+                RETURNING o.id
+            )
+            UPDATE whatsapp_campania_destinatarios d
+            SET estado = 'omitido', motivo = 'baja', outbox_id = NULL, actualizado = CURRENT_TIMESTAMP
+            FROM afectados a
+            WHERE d.id = a.id
+              AND (d.estado = 'pendiente' OR a.outbox_id IN (SELECT id FROM retirados))
+        """), {'tels': tels}).rowcount or 0)
+
+    def _reservar_message_ids(self, message_ids: List[str]) -> Set[str]:
+        """Registra los message_id en whatsapp_message_ids y devuelve los que no estaban.
+
+        Reemplaza al UNIQUE(message_id) de whatsapp_messages, que la tabla particionada no
+        puede tener. No hace commit: va en la misma transacción que el INSERT de los mensajes."""
+        ids = sorted({str(m) for m in message_ids if m})
+        if not ids:
+            return set()
+        self._asegurar_tabla(WhatsappMessageId)
+        return set(self.db.execute(
+            pg_insert(WhatsappMessageId).values([{'message_id': m} for m in ids])
+            .on_conflict_do_nothing(index_elements=['message_id'])
+            .returning(WhatsappMessageId.message_id)
+        ).scalars().all())
+
+    def insertar_mensajes_recibidos(self, mensajes: List[Dict[str, Any]]) -> Set[str]:
+        """Registra mensajes entrantes (claves de registrar_mensaje_whatsapp) ignorando los
+        message_id ya guardados. Devuelve los message_id efectivamente nuevos."""
+        if not mensajes:
+            return set()
+        nuevos = self._reservar_message_ids([m['message_id'] for m in mensajes])
+        filas = {}
+        for m in mensajes:
+            if m['message_id'] in nuevos and m['message_id'] not in filas:
+                filas[m['message_id']] = {
+                    'user_id': m.get('user_id'), 'message_type': m['message_type'],
+                    'template_name': m['template_name'], 'phone_number': m['phone_number'],
+                    'message_content': m.get('message_content'), 'status': 'received',
+                    'message_id': m['message_id'],
+                }
+        if not filas:
+            return set()
+        # Sin particionar, el UNIQUE(message_id) sigue cubriendo los mensajes anteriores a whatsapp_message_ids
+        insertados = set(self.db.execute(
+            pg_insert(WhatsappMessage).values(list(filas.values()))
+            .on_conflict_do_nothing().returning(WhatsappMessage.message_id)
+        ).scalars().all())
+        self._anotar_estadisticas([filas[m] for m in insertados])
+        return insertados
+
+    def obtener_primera_lista_espera(self, usuario_ids: List[int]) -> Dict[int, int]:
+        """clase_horario_id de la primera lista de espera activa de cada usuario."""
+        ids = sorted({int(u) for u in usuario_ids or [] if u})
+        if not ids:
+            return {}
+        filas = self.db.execute(text("""
+            SELECT DISTINCT ON (usuario_id) usuario_id, clase_horario_id
+            FROM clase_lista_espera
+            WHERE usuario_id = ANY(:ids) AND activo = true
+            ORDER BY usuario_id, posicion ASC
+        """), {'ids': ids}).all()
+        return {int(r[0]): int(r[1]) for r in filas}
+
+    def cerrar_lote_webhook(self, evento_ids: List[int], auditorias: List[Dict[str, Any]] = None) -> None:
+        """Marca los eventos como procesados, inserta sus audit logs y confirma el lote."""
+        try:
+            filas = AuditRepository.filas_audit_log(auditorias)
+            if filas:
+                self.db.execute(insert(AuditLog), filas)
+            if evento_ids:
+                self.db.execute(text("""
+                    UPDATE whatsapp_webhook_eventos SET procesado = CURRENT_TIMESTAMP, ultimo_error = NULL
+                    WHERE id = ANY(:ids)
+                """), {'ids': [int(i) for i in evento_ids]})
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def marcar_error_webhook(self, evento_ids: List[int], error: str) -> None:
+        """Deshace el lote en curso y suma un intento fallido a sus eventos."""
+        self.db.rollback()
+        if not evento_ids:
+            return
+        try:
+            self.db.execute(text("""
+                UPDATE whatsapp_webhook_eventos SET intentos = intentos + 1, ultimo_error = :error
+                WHERE id = ANY(:ids)
+            """), {'ids': [int(i) for i in evento_ids], 'error': str(error)[:2000]})
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def reabrir_eventos_webhook(self, desde_id: Optional[int] = None, hasta_id: Optional[int] = None,
+                                desde: Optional[datetime] = None, hasta: Optional[datetime] = None) -> int:
+        """Vuelve a dejar pendientes (con intentos en cero) los eventos del rango para reprocesarlos."""
+        self._asegurar_tabla(WhatsappWebhookEvento)
+        condiciones, params = [], {}
+        if desde_id is not None:
+            condiciones.append("id >= :desde_id")
+            params['desde_id'] = int(desde_id)
+        if hasta_id is not None:
+            condiciones.append("id <= :hasta_id")
+            params['hasta_id'] = int(hasta_id)
+        if desde is not None:
+            condiciones.append("recibido >= :desde")
+            params['desde'] = desde
+        if hasta is not None:
+            condiciones.append("recibido <= :hasta")
+            params['hasta'] = hasta
+        if not condiciones:
+            raise ValueError("Indicar un rango de ids o de fechas para reprocesar")
+        try:
+            result = self.db.execute(text(f"""
+                UPDATE whatsapp_webhook_eventos SET procesado = NULL, intentos = 0, ultimo_error = NULL
+                WHERE {' AND '.join(condiciones)}
+            """), params)
+            self.db.commit()
+            return int(result.rowcount or 0)
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def resumen_webhook(self, max_intentos: int) -> Dict[str, Any]:
+        """Eventos pendientes, descartados por errores y antigüedad del pendiente más viejo."""
+        self._asegurar_tabla(WhatsappWebhookEvento)
+        r = self.db.execute(text("""
+            SELECT COUNT(*) FILTER (WHERE procesado IS NULL AND intentos < :max_intentos),
+                   COUNT(*) FILTER (WHERE procesado IS NULL AND intentos >= :max_intentos),
+                   MIN(recibido) FILTER (WHERE procesado IS NULL AND intentos < :max_intentos)
+            FROM whatsapp_webhook_eventos
+        """), {'max_intentos': int(max_intentos)}).one()
+        return {
+            'pendientes': int(r[0] or 0),
+            'con_error': int(r[1] or 0),
+            'pendiente_mas_antiguo': r[2].isoformat() if r[2] else None,
+        }
+
+    # --- Confirmaciones de lista de espera (ver WhatsAppManager.process_pending_sends) ---
+    # Como en el webhook, tomar_lote_confirmaciones abre la transacción del lote y
+    # cerrar_lote_confirmaciones la confirma; la fila del consumidor queda bloqueada entre ambas.
+
+    def tomar_lote_confirmaciones(self, limite: int, gracia_s: float) -> Optional[Tuple[int, List[Dict[str, Any]]]]:
+        """Bloquea la marca del consumidor (FOR UPDATE SKIP LOCKED) y devuelve (marca, auditorías
+        pendientes posteriores a ella). None si otra instancia está procesando.
+
+        Las auditorías con message_id 'audit:<id>' en whatsapp_messages ya se atendieron y se
+        omiten; 'asentada' indica si tiene más de `gracia_s` segundos (ver process_pending_sends).
+        """
+        self._asegurar_tabla(WhatsappConsumidor)
+        # Un consumidor nuevo arranca en la última auditoría existente: no confirma acciones viejas
+        self.db.execute(text("""
+            INSERT INTO whatsapp_consumidores (nombre, ultimo_id)
+            SELECT :nombre, COALESCE(MAX(id), 0) FROM audit_logs
+            ON CONFLICT (nombre) DO NOTHING
+        """), {'nombre': CONSUMIDOR_LISTA_ESPERA})
+        desde = self.db.scalar(text("""
+            SELECT ultimo_id FROM whatsapp_consumidores WHERE nombre = :nombre FOR UPDATE SKIP LOCKED
+        """), {'nombre': CONSUMIDOR_LISTA_ESPERA})
+        if desde is None:
+            self.db.rollback()
+            return None
+        filas = self.db.execute(text("""
+            SELECT a.id, a.user_id, a.action, a.record_id, a.new_values,
+                   a.timestamp < LOCALTIMESTAMP - make_interval(secs => :gracia) AS asentada,
+                   u.nombre, u.telefono, c.nombre AS clase_nombre, ch.dia_semana, ch.hora_inicio
+            FROM audit_logs a
+            LEFT JOIN usuarios u ON u.id = a.user_id
+            LEFT JOIN clases_horarios ch ON ch.id = a.record_id
+            LEFT JOIN clases c ON c.id = ch.clase_id
+            WHERE a.id > :desde AND a.action = ANY(:acciones)
+              AND NOT EXISTS (SELECT 1 FROM whatsapp_messages m WHERE m.message_id = 'audit:' || a.id)
+            ORDER BY a.id
+            LIMIT :limite
+        """), {'desde': int(desde), 'acciones': list(ACCIONES_LISTA_ESPERA),
+               'gracia': float(gracia_s), 'limite': int(limite)}).mappings().all()
+        return int(desde), [dict(f) for f in filas]
+
+    def promover_lista_espera(self, usuario_id: int, clase_horario_id: int) -> bool:
+        """Inscribe al usuario en el horario si hay cupo y lo quita de la lista de espera.
+        No confirma: es parte del lote de confirmaciones. True si quedó inscripto."""
+        cupo = self.db.scalar(text("SELECT cupo_maximo FROM clases_horarios WHERE id = :c FOR UPDATE"),
+                              {'c': int(clase_horario_id)})
+        if cupo is None:
+            return False
+        inscritos, ya_inscripto = self.db.execute(text("""
+            SELECT COUNT(*), COALESCE(bool_or(usuario_id = :u), false)
+            FROM clase_usuarios WHERE clase_horario_id = :c
+        """), {'c': int(clase_horario_id), 'u': int(usuario_id)}).one()
+        if not ya_inscripto:
+            if int(inscritos) >= int(cupo or 0):
+                return False
+            self.db.execute(text("""
+                INSERT INTO clase_usuarios (clase_horario_id, usuario_id) VALUES (:c, :u)
+                ON CONFLICT (clase_horario_id, usuario_id) DO NOTHING
+            """), {'c': int(clase_horario_id), 'u': int(usuario_id)})
+        self.db.execute(text("DELETE FROM clase_lista_espera WHERE clase_horario_id = :c AND usuario_id = :u"),
+                        {'c': int(clase_horario_id), 'u': int(usuario_id)})
+        return True
+
+    def cerrar_lote_confirmaciones(self, ultimo_id: int, envios: List[Dict[str, Any]],
+                                   registros: List[Dict[str, Any]]) -> None:
+        """Encola los envíos (claves de encolar_outbox y opcional demora_s), registra el resultado
+        de cada auditoría en whatsapp_messages, avanza la marca a `ultimo_id` y confirma el lote."""
+        try:
+            if envios:
+                self._asegurar_outbox()
+                self.db.execute(pg_insert(WhatsappOutbox).values([
+                    {k: e.get(k) for k in ('idempotency_key', 'phone_number_id', 'telefono', 'payload',
+                                           'user_id', 'message_type', 'contenido')}
+                    for e in envios
+                ]).on_conflict_do_nothing(index_elements=['idempotency_key']))
+                demorados = [{'clave': e['idempotency_key'], 'demora': float(e['demora_s'])}
+                             for e in envios if e.get('demora_s')]
+                if demorados:
+                    self.db.execute(text("""
+                        UPDATE whatsapp_outbox SET proximo_intento = CURRENT_TIMESTAMP + make_interval(secs => :demora)
+                        WHERE idempotency_key = :clave AND estado = 'pendiente'
+                    """), demorados)
+            nuevos = self._reservar_message_ids([r['message_id'] for r in registros or []])
+            registros = [r for r in registros or [] if r['message_id'] in nuevos]
+            if registros:
+                self.db.execute(pg_insert(WhatsappMessage).values(registros).on_conflict_do_nothing())
+            self.db.execute(text("""
+                UPDATE whatsapp_consumidores SET ultimo_id = GREATEST(ultimo_id, :u), actualizado = CURRENT_TIMESTAMP
+                WHERE nombre = :nombre
+            """), {'u': int(ultimo_id), 'nombre': CONSUMIDOR_LISTA_ESPERA})
+            self.db.commit()
+            self._anotar_estadisticas(registros)
+        except Exception:
+            self.db.rollback()
+            raise
@@ -0,0 +1,527 @@
+import io
+import re
+import gzip
+import hashlib
+from typing import List, Optional, Dict, Any, Tuple, Callable
+from datetime import date, timedelta
+from sqlalchemy import select, text
+from .base import BaseRepository, asegurar_tabla
+from .attendance_partition_repository import _sumar_meses
+from .whatsapp_repository import CONSUMIDOR_RESUMEN
+from ..date_ranges import rango_mes, hoy_gym, ahora_gym
+from ..orm_models import WhatsappMensajeArchivo, WhatsappMessageId, WhatsappResumenTelefono, WhatsappConsumidor
+
+# Particiones mensuales de `whatsapp_messages` por RANGE (sent_at): whatsapp_messages_pYYYYMM
+# más whatsapp_messages_default, igual que asistencias (ver attendance_partition_repository).
+# Cada partición tiene sus índices locales por message_id (UPDATE de estados del webhook) y
+# por (phone_number, sent_at DESC) (anti-spam, acotado por sent_at). La unicidad global de
+# message_id vive en whatsapp_message_ids; el historial por teléfono que consultan las
+# pantallas y el seguimiento de fallos sale de whatsapp_resumen_telefonos.
+# Las funciones de este módulo sirven con la tabla particionada o sin particionar.
+
+TABLA = 'whatsapp_messages'
+TABLA_MIGRACION = 'whatsapp_messages_part'
+PARTICION_DEFAULT = 'whatsapp_messages_default'
+_PATRON_PARTICION = re.compile(r'^whatsapp_messages_p(\d{4})(\d{2})$')
+
+_COLUMNAS = ('id, user_id, message_type, template_name, phone_number, message_id, sent_at, status, '
+             'message_content, created_at')
+
+
+def nombre_particion(año: int, mes: int) -> str:
+    return f"{TABLA}_p{int(año):04d}{int(mes):02d}"
+
+
+class WhatsappRetentionRepository(BaseRepository):
+
+    def _asegurar_tablas(self) -> None:
+        for modelo in (WhatsappMessageId, WhatsappResumenTelefono, WhatsappMensajeArchivo, WhatsappConsumidor):
+            asegurar_tabla(self.db, modelo)
+
+    # --- Particiones ---
+
+    def _existe_tabla(self, nombre: str) -> bool:
+        return self.db.scalar(text("SELECT to_regclass(:t) IS NOT NULL"), {'t': nombre}) or False
+
+    def esta_particionada(self, tabla: str = TABLA) -> bool:
+        return self.db.scalar(text(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:t))"
+        ), {'t': tabla}) or False
+
+    def listar_particiones(self, tabla: str = TABLA) -> List[Dict[str, Any]]:
+        filas = self.db.execute(text("""
+            SELECT c.relname, c.reltuples::bigint AS filas_estimadas
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(:t)
+            ORDER BY c.relname
+        """), {'t': tabla}).all()
+        return [self._item_particion(nombre, estimadas) for nombre, estimadas in filas]
+
+    def _item_particion(self, nombre: str, estimadas: Any) -> Dict[str, Any]:
+        m = _PATRON_PARTICION.match(nombre)
+        item = {'particion': nombre, 'filas_estimadas': max(int(estimadas or 0), 0), 'desde': None, 'hasta': None}
+        if m:
+            rango = rango_mes(int(m.group(1)), int(m.group(2)))
+            item['desde'] = rango.fecha_inicio
+            item['hasta'] = rango.fecha_fin
+        return item
+
+    def _particiones_desvinculadas(self) -> List[Dict[str, Any]]:
+        """Tablas whatsapp_messages_pYYYYMM ya desvinculadas por un archivo que no terminó."""
+        filas = self.db.execute(text("""
+            SELECT c.relname, c.reltuples::bigint
+            FROM pg_class c
+            WHERE c.relkind = 'r' AND NOT c.relispartition AND pg_table_is_visible(c.oid)
+              AND c.relname ~ '^whatsapp_messages_p[0-9]{6}$'
+            ORDER BY c.relname
+        """)).all()
+        return [self._item_particion(nombre, estimadas) for nombre, estimadas in filas]
+
+    def _es_particion(self, nombre: str) -> bool:
+        return self.db.scalar(text(
+            "SELECT COALESCE((SELECT relispartition FROM pg_class WHERE oid = to_regclass(:t)), false)"
+        ), {'t': nombre}) or False
+
+    def crear_particion(self, año: int, mes: int, tabla: str = TABLA) -> bool:
+        """Crea la partición del mes si no existe, moviendo las filas de ese mes que hubieran
+        caído en la partición default. No hace commit."""
+        nombre = nombre_particion(año, mes)
+        if self._existe_tabla(nombre):
+            return False
+        rango = rango_mes(año, mes)
+        params = {'desde': rango.inicio, 'hasta': rango.fin}
+        ddl = (
+            f"CREATE TABLE {nombre} PARTITION OF {tabla} "
+            f"FOR VALUES FROM ('{rango.inicio.isoformat(sep=' ')}') TO ('{rango.fin.isoformat(sep=' ')}')"
+        )
+        pendientes = 0
+        if self._existe_tabla(PARTICION_DEFAULT):
+            pendientes = self.db.scalar(text(
+                f"SELECT COUNT(*) FROM {PARTICION_DEFAULT} WHERE sent_at >= :desde AND sent_at < :hasta"
+            ), params) or 0
+        if pendientes:
+            self.db.execute(text(
+                f"CREATE TEMP TABLE _whatsapp_mover ON COMMIT DROP AS "
+                f"SELECT * FROM {PARTICION_DEFAULT} WHERE sent_at >= :desde AND sent_at < :hasta"
+            ), params)
+            self.db.execute(text(
+                f"DELETE FROM {PARTICION_DEFAULT} WHERE sent_at >= :desde AND sent_at < :hasta"
+            ), params)
+            self.db.execute(text(ddl))
+            self.db.execute(text(f"INSERT INTO {tabla} SELECT * FROM _whatsapp_mover"))
+            self.db.execute(text("DROP TABLE _whatsapp_mover"))
+        else:
+            self.db.execute(text(ddl))
+        return True
+
+    def crear_particiones(self, desde: date, meses_futuros: int = 3, tabla: str = TABLA) -> List[str]:
+        """Asegura particiones desde el mes de `desde` hasta `meses_futuros` después del actual."""
+        hoy = hoy_gym()
+        año, mes = desde.year, desde.month
+        fin_año, fin_mes = _sumar_meses(hoy.year, hoy.month, max(int(meses_futuros), 0))
+        creadas = []
+        while (año, mes) <= (fin_año, fin_mes):
+            if self.crear_particion(año, mes, tabla):
+                creadas.append(nombre_particion(año, mes))
+            año, mes = _sumar_meses(año, mes, 1)
+        if not self._existe_tabla(PARTICION_DEFAULT):
+            self.db.execute(text(f"CREATE TABLE {PARTICION_DEFAULT} PARTITION OF {tabla} DEFAULT"))
+            creadas.append(PARTICION_DEFAULT)
+        return creadas
+
+    def crear_particiones_futuras(self, meses_futuros: int = 3) -> List[str]:
+        if not self.esta_particionada():
+            return []
+        hoy = hoy_gym()
+        creadas = self.crear_particiones(date(hoy.year, hoy.month, 1), meses_futuros)
+        self.db.commit()
+        return creadas
+
+    def particiones_a_archivar(self, retencion_dias: int) -> List[Dict[str, Any]]:
+        """Particiones cuyo mes terminó antes de `retencion_dias` días atrás."""
+        limite = hoy_gym() - timedelta(days=max(int(retencion_dias), 1))
+        vencidas = [p for p in self.listar_particiones() if p['hasta'] and p['hasta'] <= limite]
+        return vencidas + self._particiones_desvinculadas()
+
+    def _exportar_csv_gz(self, nombre: str) -> Tuple[bytes, int]:
+        filas = self.db.scalar(text(f"SELECT COUNT(*) FROM {nombre}")) or 0
+        buf = io.BytesIO()
+        cur = self.db.connection().connection.cursor()
+        try:
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+                cur.copy_expert(f"COPY (SELECT * FROM {nombre} ORDER BY sent_at, id) TO STDOUT WITH CSV HEADER", gz)
+        finally:
+            cur.close()
+        return buf.getvalue(), int(filas)
+
+    def archivar_particion(self, particion: Dict[str, Any], destino: str,
+                           guardar: Callable[[bytes, str], Optional[str]]) -> Optional[Dict[str, Any]]:
+        """Desvincula la partición, la exporta a CSV comprimido, la elimina y borra sus
+        message_id de whatsapp_message_ids.
+
+        Igual que en asistencias, el DETACH se confirma solo, así el lock sobre whatsapp_messages
+        no dura la exportación ni la subida; la tabla suelta se elimina en una segunda transacción
+        después de que `guardar(datos, nombre_archivo)` devuelva su ubicación. Si devuelve None la
+        partición se vuelve a vincular.
+        """
+        nombre = particion['particion']
+        m = _PATRON_PARTICION.match(nombre)
+        if not m:
+            raise ValueError(f"Partición inválida: {nombre}")
+        self._asegurar_tablas()
+        try:
+            if self._es_particion(nombre):
+                self.db.execute(text(f"ALTER TABLE {TABLA} DETACH PARTITION {nombre}"))
+                self.db.commit()
+            datos, filas = self._exportar_csv_gz(nombre)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        try:
+            ubicacion = guardar(datos, f"{nombre}.csv.gz")
+        except Exception:
+            self._revincular(nombre, int(m.group(1)), int(m.group(2)))
+            raise
+        if not ubicacion:
+            self._revincular(nombre, int(m.group(1)), int(m.group(2)))
+            return None
+        try:
+            self.db.execute(text(f"DROP TABLE {nombre}"))
+            self.db.execute(text("""
+                DELETE FROM whatsapp_message_ids WHERE sent_at >= :desde AND sent_at < :hasta
+            """), {'desde': particion['desde'], 'hasta': particion['hasta']})
+            self.db.add(WhatsappMensajeArchivo(
+                particion=nombre,
+                desde=particion['desde'],
+                hasta=particion['hasta'],
+                filas=filas,
+                destino=destino,
+                ubicacion=ubicacion,
+                sha256=hashlib.sha256(datos).hexdigest(),
+            ))
+            self.db.commit()
+            return {'particion': nombre, 'filas': filas, 'destino': destino, 'ubicacion': ubicacion}
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def _revincular(self, nombre: str, año: int, mes: int) -> None:
+        """Vuelve a vincular una partición desvinculada; si falla queda suelta para el próximo archivo."""
+        rango = rango_mes(año, mes)
+        try:
+            self.db.execute(text(
+                f"ALTER TABLE {TABLA} ATTACH PARTITION {nombre} "
+                f"FOR VALUES FROM ('{rango.inicio.isoformat(sep=' ')}') TO ('{rango.fin.isoformat(sep=' ')}')"
+            ))
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            self.logger.error(f"No se pudo volver a vincular {nombre}: {e}")
+
+    def obtener_archivos(self) -> List[Dict[str, Any]]:
+        self._asegurar_tablas()
+        stmt = select(WhatsappMensajeArchivo).order_by(WhatsappMensajeArchivo.desde.desc())
+        return [
+            {'particion': a.particion, 'desde': a.desde, 'hasta': a.hasta, 'filas': a.filas,
+             'destino': a.destino, 'ubicacion': a.ubicacion, 'fecha_archivado': a.fecha_archivado}
+            for a in self.db.scalars(stmt).all()
+        ]
+
+    # --- Retención por tipo y compactación ---
+
+    def purgar_por_tipo(self, retenciones: Dict[str, int], defecto: int, lote: int = 5000,
+                        max_lotes: Optional[int] = None) -> Dict[str, int]:
+        """Borra los mensajes más viejos que la retención de su tipo (`defecto` para los tipos
+        sin retención propia), en lotes con commit por lote. Con la tabla particionada los
+        meses enteros fuera de la retención más larga se archivan con archivar_particion; acá
+        sólo se borra lo que vence antes. Devuelve filas borradas por regla."""
+        self._asegurar_tablas()
+        horizonte = max([int(defecto)] + [int(d) for d in retenciones.values()])
+        particionada = self.esta_particionada()
+        reglas = [(f"tipo:{t}", "message_type = :tipo", {'tipo': t}, int(d)) for t, d in sorted(retenciones.items())]
+        reglas.append(('defecto', "NOT (message_type = ANY(:tipos))", {'tipos': sorted(retenciones)}, int(defecto)))
+        borradas: Dict[str, int] = {}
+        lotes = 0
+        for nombre, condicion, params, dias in reglas:
+            if particionada and dias >= horizonte:
+                continue
+            total = 0
+            while max_lotes is None or lotes < max_lotes:
+                n = self.db.scalar(text(f"""
+                    WITH borradas AS (
+                        DELETE FROM whatsapp_messages
+                        WHERE (id, sent_at) IN (
+                            SELECT id, sent_at FROM whatsapp_messages
+                            WHERE sent_at < LOCALTIMESTAMP - make_interval(days => :dias) AND {condicion}
+                            LIMIT :lote
+                        )
+                        RETURNING message_id
+                    ), ids AS (
+                        DELETE FROM whatsapp_message_ids i USING borradas b WHERE i.message_id = b.message_id
+                    )
+                    SELECT COUNT(*) FROM borradas
+                """), {**params, 'dias': max(dias, 1), 'lote': int(lote)}) or 0
+                self.db.commit()
+                lotes += 1
+                total += int(n)
+                if n < lote:
+                    break
+            borradas[nombre] = total
+        return borradas
+
+    def compactar_contenido(self, dias: int, lote: int = 5000, max_lotes: Optional[int] = None) -> int:
+        """Vacía message_content de los mensajes no fallidos con más de `dias` días.
+
+        Avanza por id desde la marca del consumidor 'compactacion' y se detiene en el primer
+        mensaje todavía reciente, así cada corrida sólo recorre lo nuevo."""
+        self._asegurar_tablas()
+        self.db.execute(text("""
+            INSERT INTO whatsapp_consumidores (nombre, ultimo_id) VALUES ('compactacion', 0)
+            ON CONFLICT (nombre) DO NOTHING
+        """))
+        total = lotes = 0
+        while max_lotes is None or lotes < max_lotes:
+            marca = self.db.scalar(text("""
+                SELECT ultimo_id FROM whatsapp_consumidores WHERE nombre = 'compactacion' FOR UPDATE SKIP LOCKED
+            """))
+            if marca is None:
+                self.db.rollback()
+                break
+            leidas, compactadas, hasta = self.db.execute(text("""
+                WITH lote AS (
+                    SELECT id, sent_at, sent_at < LOCALTIMESTAMP - make_interval(days => :dias) AS vencido
+                    FROM whatsapp_messages WHERE id > :marca
+                    ORDER BY id LIMIT :lote
+                ), corte AS (
+                    SELECT MIN(id) FILTER (WHERE NOT vencido) AS id FROM lote
+                ), filas AS (
+                    SELECT l.id, l.sent_at FROM lote l, corte c WHERE c.id IS NULL OR l.id < c.id
+                ), compactadas AS (
+                    UPDATE whatsapp_messages m SET message_content = NULL
+                    FROM filas f
+                    WHERE m.id = f.id AND m.sent_at = f.sent_at
+                      AND m.message_content IS NOT NULL AND m.status IS DISTINCT FROM 'failed'
+                    RETURNING 1
+                )
+                SELECT (SELECT COUNT(*) FROM lote), (SELECT COUNT(*) FROM compactadas), (SELECT MAX(id) FROM filas)
+            """), {'marca': int(marca), 'dias': max(int(dias), 1), 'lote': int(lote)}).one()
+            if hasta is not None:
+                self.db.execute(text("""
+                    UPDATE whatsapp_consumidores SET ultimo_id = :u, actualizado = CURRENT_TIMESTAMP
+                    WHERE nombre = 'compactacion'
+                """), {'u': int(hasta)})
+            self.db.commit()
+            lotes += 1
+            total += int(compactadas or 0)
+            if hasta is None or leidas < lote:
+                break
+        return total
+
+    # --- Resumen por teléfono ---
+
+    def actualizar_resumen_telefonos(self, lote: int = 5000, gracia_s: float = 60,
+                                     max_lotes: Optional[int] = None) -> Dict[str, Any]:
+        """Suma a whatsapp_resumen_telefonos los mensajes posteriores a la marca del consumidor
+        CONSUMIDOR_RESUMEN, en lotes con commit por lote.
+
+        Un lote se corta en el primer mensaje con menos de `gracia_s` segundos: un id más bajo
+        todavía puede estar en una transacción sin confirmar y no debe quedar detrás de la marca.
+        """
+        self._asegurar_tablas()
+        self.db.execute(text("""
+            INSERT INTO whatsapp_consumidores (nombre, ultimo_id) VALUES (:nombre, 0)
+            ON CONFLICT (nombre) DO NOTHING
+        """), {'nombre': CONSUMIDOR_RESUMEN})
+        self.db.commit()
+        resumen = {'mensajes': 0, 'lotes': 0, 'marca': None, 'ocupado': False}
+        while max_lotes is None or resumen['lotes'] < max_lotes:
+            marca = self.db.scalar(text("""
+                SELECT ultimo_id FROM whatsapp_consumidores WHERE nombre = :nombre FOR UPDATE SKIP LOCKED
+            """), {'nombre': CONSUMIDOR_RESUMEN})
+            if marca is None:
+                self.db.rollback()
+                resumen['ocupado'] = True
+                break
+            leidas, sumadas, hasta = self.db.execute(text("""
+                WITH lote AS (
+                    SELECT id, sent_at, phone_number, user_id, status,
+                           sent_at < LOCALTIMESTAMP - make_interval(secs => :gracia) AS asentada
+                    FROM whatsapp_messages WHERE id > :marca
+                    ORDER BY id LIMIT :lote
+                ), corte AS (
+                    SELECT MIN(id) FILTER (WHERE NOT asentada) AS id FROM lote
+                ), filas AS (
+                    SELECT l.* FROM lote l, corte c WHERE c.id IS NULL OR l.id < c.id
+                ), agregado AS (
+                    SELECT phone_number,
+                           (array_agg(user_id ORDER BY id DESC) FILTER (WHERE user_id IS NOT NULL))[1] AS user_id,
+                           MAX(sent_at) FILTER (WHERE status NOT IN ('failed', 'received')) AS ultimo_envio,
+                           MAX(sent_at) FILTER (WHERE status = 'received') AS ultimo_recibido,
+                           (array_agg(sent_at ORDER BY sent_at DESC, id DESC) FILTER (WHERE status = 'failed'))[1] AS ultimo_fallo,
+                           (array_agg(id ORDER BY sent_at DESC, id DESC) FILTER (WHERE status = 'failed'))[1] AS ultimo_fallo_id,
+                           COUNT(*) FILTER (WHERE status NOT IN ('failed', 'received')) AS enviados,
+                           COUNT(*) FILTER (WHERE status = 'failed') AS fallidos,
+                           COUNT(*) FILTER (WHERE status = 'received') AS recibidos
+                    FROM filas GROUP BY phone_number
+                ), sumadas AS (
+                    INSERT INTO whatsapp_resumen_telefonos AS r
+                        (phone_number, user_id, ultimo_envio, ultimo_recibido, ultimo_fallo, ultimo_fallo_id,
+                         enviados, fallidos, recibidos, actualizado)
+                    SELECT phone_number, user_id, ultimo_envio, ultimo_recibido, ultimo_fallo, ultimo_fallo_id,
+                           enviados, fallidos, recibidos, CURRENT_TIMESTAMP
+                    FROM agregado
+                    ON CONFLICT (phone_number) DO UPDATE SET
+                        user_id = COALESCE(EXCLUDED.user_id, r.user_id),
+                        ultimo_envio = GREATEST(r.ultimo_envio, EXCLUDED.ultimo_envio),
+                        ultimo_recibido = GREATEST(r.ultimo_recibido, EXCLUDED.ultimo_recibido),
+                        ultimo_fallo_id = CASE
+                            WHEN EXCLUDED.ultimo_fallo IS NOT NULL
+                                 AND (r.ultimo_fallo IS NULL OR EXCLUDED.ultimo_fallo >= r.ultimo_fallo)
+                            THEN EXCLUDED.ultimo_fallo_id ELSE r.ultimo_fallo_id END,
+                        ultimo_fallo = GREATEST(r.ultimo_fallo, EXCLUDED.ultimo_fallo),
+                        enviados = r.enviados + EXCLUDED.enviados,
+                        fallidos = r.fallidos + EXCLUDED.fallidos,
+                        recibidos = r.recibidos + EXCLUDED.recibidos,
+                        actualizado = CURRENT_TIMESTAMP
+                    RETURNING 1
+                )
+                SELECT (SELECT COUNT(*) FROM lote), (SELECT COUNT(*) FROM filas), (SELECT MAX(id) FROM filas)
+            """), {'marca': int(marca), 'gracia': float(gracia_s), 'lote': int(lote)}).one()
+            if hasta is not None:
+                self.db.execute(text("""
+                    UPDATE whatsapp_consumidores SET ultimo_id = :u, actualizado = CURRENT_TIMESTAMP
+                    WHERE nombre = :nombre
+                """), {'u': int(hasta), 'nombre': CONSUMIDOR_RESUMEN})
+            self.db.commit()
+            resumen['lotes'] += 1
+            resumen['mensajes'] += int(sumadas or 0)
+            resumen['marca'] = int(hasta) if hasta is not None else int(marca)
+            if hasta is None or sumadas < leidas or leidas < lote:
+                break
+        return resumen
+
+    # --- Migración online de una tabla existente ---
+
+    def preparar_migracion(self, meses_futuros: int = 3) -> bool:
+        """Crea `whatsapp_messages_part` particionada con la misma estructura. Idempotente."""
+        if self._existe_tabla(TABLA_MIGRACION):
+            return False
+        self._asegurar_tablas()
+        self.db.execute(text(f"""
+            CREATE TABLE {TABLA_MIGRACION} (LIKE {TABLA} INCLUDING DEFAULTS)
+            PARTITION BY RANGE (sent_at)
+        """))
+        self.db.execute(text(f"ALTER TABLE {TABLA_MIGRACION} ALTER COLUMN sent_at SET NOT NULL"))
+        self.db.execute(text(f"ALTER TABLE {TABLA_MIGRACION} ADD PRIMARY KEY (id, sent_at)"))
+        self.db.execute(text(
+            f"ALTER TABLE {TABLA_MIGRACION} ADD FOREIGN KEY (user_id) REFERENCES usuarios(id)"
+        ))
+        self.db.execute(text(f"CREATE INDEX ON {TABLA_MIGRACION} (message_id)"))
+        self.db.execute(text(f"CREATE INDEX ON {TABLA_MIGRACION} (phone_number, sent_at DESC)"))
+        self.db.execute(text(f"CREATE INDEX ON {TABLA_MIGRACION} (user_id, sent_at DESC)"))
+        self.db.execute(text(f"CREATE INDEX ON {TABLA_MIGRACION} (message_type, sent_at DESC)"))
+        primera = self.db.scalar(text(f"SELECT MIN(sent_at) FROM {TABLA}")) or ahora_gym()
+        self.crear_particiones(date(primera.year, primera.month, 1), meses_futuros, tabla=TABLA_MIGRACION)
+        self.db.commit()
+        return True
+
+    # Lote por keyset (id > cursor ORDER BY id LIMIT): los huecos de id (filas purgadas) no
+    # dejan lotes vacíos. Los message_id copiados se registran en whatsapp_message_ids, que
+    # reemplaza al UNIQUE
+    _SQL_COPIAR_LOTE = f"""
+        WITH lote AS (
+            SELECT id, user_id, message_type, template_name, phone_number, message_id,
+                   COALESCE(sent_at, created_at, CURRENT_TIMESTAMP) AS sent_at, status, message_content, created_at
+            FROM {TABLA}
+            WHERE id > :desde
+            ORDER BY id
+            LIMIT :lote
+        ), copiadas AS (
+            INSERT INTO {TABLA_MIGRACION} ({_COLUMNAS})
+            SELECT {_COLUMNAS} FROM lote
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        ), ids AS (
+            INSERT INTO whatsapp_message_ids (message_id, sent_at)
+            SELECT message_id, sent_at FROM lote WHERE message_id IS NOT NULL
+            ON CONFLICT DO NOTHING
+        )
+        SELECT (SELECT COUNT(*) FROM lote), (SELECT MAX(id) FROM lote), (SELECT COUNT(*) FROM copiadas)
+    """
+
+    # Filas que confirmaron después de que el cursor pasó por su id (transacciones largas)
+    _SQL_COPIAR_FALTANTES = f"""
+        WITH faltantes AS (
+            SELECT a.id, a.user_id, a.message_type, a.template_name, a.phone_number, a.message_id,
+                   COALESCE(a.sent_at, a.created_at, CURRENT_TIMESTAMP) AS sent_at, a.status,
+                   a.message_content, a.created_at
+            FROM {TABLA} a
+            WHERE NOT EXISTS (SELECT 1 FROM {TABLA_MIGRACION} p WHERE p.id = a.id)
+        ), copiadas AS (
+            INSERT INTO {TABLA_MIGRACION} ({_COLUMNAS})
+            SELECT {_COLUMNAS} FROM faltantes
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        ), ids AS (
+            INSERT INTO whatsapp_message_ids (message_id, sent_at)
+            SELECT message_id, sent_at FROM faltantes WHERE message_id IS NOT NULL
+            ON CONFLICT DO NOTHING
+        )
+        SELECT COUNT(*) FROM copiadas
+    """
+
+    def copiar_lote_migracion(self, lote: int, desde: Optional[int] = None) -> Tuple[int, Optional[int]]:
+        """Copia hasta `lote` filas con id mayor a `desde` y hace commit.
+
+        Sin `desde` se retoma desde el mayor id ya copiado. Devuelve (filas_copiadas, cursor):
+        el cursor es el último id leído, para la llamada siguiente, o None si no quedan filas.
+        """
+        if desde is None:
+            desde = self.db.scalar(text(f"SELECT COALESCE(MAX(id), 0) FROM {TABLA_MIGRACION}")) or 0
+        lote = max(1, int(lote))
+        leidas, cursor, filas = self.db.execute(text(self._SQL_COPIAR_LOTE), {'desde': int(desde), 'lote': lote}).one()
+        self.db.commit()
+        if not leidas or leidas < lote:
+            return int(filas or 0), None
+        return int(filas or 0), int(cursor)
+
+    def finalizar_migracion(self) -> Dict[str, Any]:
+        """Copia el remanente bajo lock de escritura y hace el swap de tablas en una transacción corta.
+
+        El remanente es un anti-join por id contra toda la tabla: además de las filas nuevas trae
+        las que confirmaron tarde, con id por debajo del cursor de los lotes.
+        """
+        secuencia = self.db.scalar(text("SELECT pg_get_serial_sequence(:t, 'id')"), {'t': TABLA})
+        # Los estados de entrega cambian en los días siguientes al envío: sólo esas filas
+        # pueden haber quedado desactualizadas en la copia por lotes
+        desde_estados = self.db.scalar(text(f"""
+            SELECT COALESCE(MIN(id), 0) FROM {TABLA_MIGRACION}
+            WHERE sent_at >= LOCALTIMESTAMP - INTERVAL '7 days'
+        """)) or 0
+        # Pasada sin lock para que la de abajo, con las escrituras bloqueadas, encuentre poco
+        remanente = int(self.db.execute(text(self._SQL_COPIAR_FALTANTES)).scalar() or 0)
+        self.db.commit()
+        self.db.execute(text(f"LOCK TABLE {TABLA} IN SHARE ROW EXCLUSIVE MODE"))
+        maximo = self.db.scalar(text(f"SELECT COALESCE(MAX(id), 0) FROM {TABLA}")) or 0
+        remanente += int(self.db.execute(text(self._SQL_COPIAR_FALTANTES)).scalar() or 0)
+        eliminadas = self.db.execute(text(f"""
+            DELETE FROM {TABLA_MIGRACION} p
+            WHERE NOT EXISTS (SELECT 1 FROM {TABLA} a WHERE a.id = p.id)
+        """)).rowcount
+        self.db.execute(text(f"""
+            UPDATE {TABLA_MIGRACION} p SET status = a.status
+            FROM {TABLA} a
+            WHERE a.id = p.id AND a.id >= :desde AND p.id >= :desde AND a.status IS DISTINCT FROM p.status
+        """), {'desde': int(desde_estados)})
+        self.db.execute(text(f"ALTER TABLE {TABLA} RENAME TO {TABLA}_legacy"))
+        self.db.execute(text(f"ALTER TABLE {TABLA_MIGRACION} RENAME TO {TABLA}"))
+        nueva_secuencia = self.db.scalar(text("SELECT pg_get_serial_sequence(:t, 'id')"), {'t': TABLA})
+        if nueva_secuencia:
+            self.db.execute(text("SELECT setval(CAST(:s AS regclass), GREATEST(:m, 1))"),
+                            {'s': nueva_secuencia, 'm': maximo})
+        elif secuencia:
+            self.db.execute(text(f"ALTER SEQUENCE {secuencia} OWNED BY {TABLA}.id"))
+        self.db.commit()
+        return {'remanente': remanente, 'eliminadas': eliminadas, 'tabla_anterior': f"{TABLA}_legacy"}
@@ -0,0 +1,219 @@
+"""Teléfonos normalizados a E.164 y resolución teléfono -> usuario.
+
+usuarios.telefono se guarda como lo cargó el gimnasio ("11 1234-5678", "011 15 ...",
+"+54 9 11 ..."). usuarios.telefono_e164 guarda la misma línea en el formato en que la
+reporta WhatsApp ("+5491112345678") y tiene índice parcial, así que buscar un usuario por
+teléfono es una igualdad indexada en vez de un recorte de cadenas sobre toda la tabla.
+
+La columna no está mapeada en el ORM: en tenants anteriores se crea a demanda y un
+select(Usuario) no puede depender de ella. La mantienen:
+- los eventos after_insert / after_update de Usuario (toda escritura por el ORM);
+- UserRepository.sincronizar_telefonos_e164, que recorre la tabla (escrituras con SQL
+  directo y cambios de VERSION_NORMALIZACION). Sólo la llaman los crons: el diario siempre
+  y el de webhooks de WhatsApp cuando la versión guardada no es la vigente. Las lecturas no
+  la disparan porque corren dentro de transacciones ajenas.
+
+ResolutorTelefonos guarda en memoria, por base, el índice teléfono normalizado -> id; los
+mismos eventos lo mantienen al día y lo que no encuentra lo busca en el índice de la base.
+"""
+import os
+import time
+import threading
+from typing import Any, Dict, Iterable, Optional, Set
+
+from sqlalchemy import event, inspect, text
+
+from .orm_models import Usuario
+
+# Subir al cambiar normalizar_telefono: la próxima sincronización recalcula toda la columna
+VERSION_NORMALIZACION = 1
+
+CODIGO_PAIS = os.getenv("TELEFONO_CODIGO_PAIS", "54")
+
+
+def _nacional_ar(n: str) -> Optional[str]:
+    """Número nacional argentino en formato móvil de WhatsApp: 9 + área + abonado (11 dígitos)."""
+    if len(n) == 11 and n.startswith('9'):
+        return n
+    if n.startswith('0'):
+        n = n[1:]
+    if len(n) == 12:
+        # Área (2 a 4 dígitos) + 15 + abonado: se quita el 15
+        for largo in (2, 3, 4):
+            if largo == 2 and not n.startswith('11'):
+                continue
+            if n[largo:largo + 2] == '15':
+                n = n[:largo] + n[largo + 2:]
+                break
+    return '9' + n if len(n) == 10 else None
+
+
+def normalizar_telefono(telefono: Any, codigo_pais: Optional[str] = None) -> Optional[str]:
+    """E.164 ("+5491112345678") o None si el número no alcanza para armarlo.
+
+    Sin prefijo internacional se asume `codigo_pais` (TELEFONO_CODIGO_PAIS, 54). Para
+    Argentina se quitan el 0 y el 15 y se agrega el 9 de móvil, como lo envía WhatsApp.
+    """
+    cp = str(codigo_pais or CODIGO_PAIS)
+    s = str(telefono or '').strip()
+    digitos = ''.join(c for c in s if c.isdigit())
+    if s.startswith('00'):
+        digitos = digitos[2:]
+    if not digitos:
+        return None
+    internacional = s.startswith('+') or s.startswith('00') or (digitos.startswith(cp) and len(digitos) > 11)
+    if internacional and not digitos.startswith(cp):
+        # Otro país: se respeta tal cual
+        return '+' + digitos if 8 <= len(digitos) <= 15 else None
+    nacional = digitos[len(cp):] if internacional else digitos
+    if cp == '54':
+        nacional = _nacional_ar(nacional)
+    elif nacional.startswith('0'):
+        nacional = nacional[1:]
+    if not nacional:
+        return None
+    e164 = cp + nacional
+    return '+' + e164 if 8 <= len(e164) <= 15 else None
+
+
+# --- Columna usuarios.telefono_e164 ---
+
+_COLUMNA_OK: Set[str] = set()
+
+
+def asegurar_columna_e164(conexion) -> bool:
+    """Crea usuarios.telefono_e164 y su índice si faltan (una vez por proceso y base).
+    Devuelve True si hubo que crearla."""
+    clave = str(conexion.engine.url)
+    if clave in _COLUMNA_OK:
+        return False
+    existe = conexion.execute(text("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'usuarios' AND column_name = 'telefono_e164'
+    """)).first() is not None
+    if not existe:
+        conexion.execute(text("ALTER TABLE usuarios ADD COLUMN IF NOT EXISTS telefono_e164 VARCHAR(20)"))
+        conexion.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_usuarios_telefono_e164 ON usuarios (telefono_e164) "
+            "WHERE telefono_e164 IS NOT NULL"
+        ))
+    _COLUMNA_OK.add(clave)
+    return not existe
+
+
+# --- Índice en memoria por base ---
+
+class _Indice:
+    __slots__ = ('por_telefono', 'cargado')
+
+    def __init__(self, por_telefono: Dict[str, int]):
+        self.por_telefono = por_telefono
+        self.cargado = time.monotonic()
+
+
+_INDICES: Dict[str, _Indice] = {}
+_LOCK = threading.Lock()
+
+
+def _recargar_seg() -> float:
+    try:
+        return float(os.getenv('RESOLUTOR_TELEFONOS_RECARGAR_SEG', '600'))
+    except Exception:
+        return 600.0
+
+
+def invalidar_indice(clave: str) -> None:
+    with _LOCK:
+        _INDICES.pop(clave, None)
+
+
+def _anotar(clave: str, usuario_id: int, nuevo: Optional[str], anterior: Optional[str]) -> None:
+    with _LOCK:
+        indice = _INDICES.get(clave)
+        if indice is None:
+            return
+        if anterior and anterior != nuevo and indice.por_telefono.get(anterior) == usuario_id:
+            indice.por_telefono.pop(anterior, None)
+        if nuevo:
+            indice.por_telefono[nuevo] = usuario_id
+
+
+def _al_insertar(mapper, connection, target) -> None:
+    e164 = normalizar_telefono(target.telefono)
+    asegurar_columna_e164(connection)
+    if e164:
+        connection.execute(text("UPDATE usuarios SET telefono_e164 = :t WHERE id = :id"), {'t': e164, 'id': target.id})
+    _anotar(str(connection.engine.url), target.id, e164, None)
+
+
+def _al_actualizar(mapper, connection, target) -> None:
+    historial = inspect(target).attrs.telefono.history
+    if not historial.has_changes():
+        return
+    e164 = normalizar_telefono(target.telefono)
+    anterior = normalizar_telefono(historial.deleted[0]) if historial.deleted else None
+    asegurar_columna_e164(connection)
+    connection.execute(text("UPDATE usuarios SET telefono_e164 = :t WHERE id = :id"), {'t': e164, 'id': target.id})
+    _anotar(str(connection.engine.url), target.id, e164, anterior)
+
+
+def _al_eliminar(mapper, connection, target) -> None:
+    _anotar(str(connection.engine.url), target.id, None, normalizar_telefono(target.telefono))
+
+
+event.listen(Usuario, 'after_insert', _al_insertar)
+event.listen(Usuario, 'after_update', _al_actualizar)
+event.listen(Usuario, 'after_delete', _al_eliminar)
+
+
+class ResolutorTelefonos:
+    """Teléfono (en cualquier formato) -> id de usuario, desde memoria.
+
+    El índice de cada base se carga entero (una consulta) y se recarga cada
+    RESOLUTOR_TELEFONOS_RECARGAR_SEG (600 por defecto) para ver altas de otras instancias;
+    mientras tanto, lo que no está se busca por telefono_e164 y se agrega. Si varios usuarios
+    comparten teléfono gana el activo de menor id.
+    """
+
+    def __init__(self, db):
+        from .repositories.user_repository import UserRepository
+        self.db = db
+        self.repo = UserRepository(db, None, None)
+
+    def _clave(self) -> str:
+        try:
+            return str(self.db.get_bind().url)
+        except Exception:
+            return ''
+
+    def _indice(self, clave: str) -> _Indice:
+        with _LOCK:
+            indice = _INDICES.get(clave)
+        if indice is not None and time.monotonic() - indice.cargado < _recargar_seg():
+            return indice
+        indice = _Indice(self.repo.obtener_indice_telefonos_e164())
+        with _LOCK:
+            _INDICES[clave] = indice
+        return indice
+
+    def resolver_muchos(self, telefonos: Iterable[Any]) -> Dict[str, int]:
+        """{teléfono tal como vino: usuario_id} para los que corresponden a un usuario."""
+        normalizados = {str(t): normalizar_telefono(t) for t in telefonos if t}
+        normalizados = {t: e for t, e in normalizados.items() if e}
+        if not normalizados:
+            return {}
+        clave = self._clave()
+        indice = self._indice(clave)
+        with _LOCK:
+            encontrados = {e: indice.por_telefono[e] for e in set(normalizados.values()) if e in indice.por_telefono}
+        faltan = set(normalizados.values()) - set(encontrados)
+        if faltan:
+            nuevos = self.repo.obtener_ids_por_telefono_e164(list(faltan))
+            if nuevos:
+                with _LOCK:
+                    indice.por_telefono.update(nuevos)
+                encontrados.update(nuevos)
+        return {t: encontrados[e] for t, e in normalizados.items() if e in encontrados}
+
+    def resolver(self, telefono: Any) -> Optional[int]:
+        return self.resolver_muchos([telefono]).get(str(telefono))
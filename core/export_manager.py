@@ -26,20 +26,12 @@ class ExportManager:
     def exportar_reporte_pagos_excel(self, pagos: List[Pago], mes: int, año: int) -> str:
         try:
             if not pagos: raise ValueError("No hay pagos en el período seleccionado para exportar.")
-            pagos_data = []
-            for pago in pagos:
-                usuario = self.db_manager.obtener_usuario(pago.usuario_id)
-                pagos_data.append({"ID Pago": pago.id, "ID Usuario": pago.usuario_id, "Nombre Usuario": usuario.nombre if usuario else "N/A", "Monto": pago.monto, "Fecha de Pago": pago.fecha_pago.strftime('%Y-%m-%d') if hasattr(pago.fecha_pago, 'strftime') else pago.fecha_pago})
-            df_detalle = pd.DataFrame(pagos_data)
-            total_ingresos = df_detalle['Monto'].sum()
-            resumen_data = {"Concepto": ["Período del Reporte", "Total de Ingresos", "Cantidad de Pagos"], "Valor": [f"{mes:02d}/{año}", f"${total_ingresos:,.2f} ARS", len(df_detalle)]}
-            df_resumen = pd.DataFrame(resumen_data)
+            # Usuarios resueltos en la misma consulta y libro en modo write-only (ver PaymentExportService)
+            from core.services.payment_export_service import PaymentExportService
             filepath = os.path.join(self.export_dir, f"reporte_pagos_{año}_{mes:02d}.xlsx")
-            with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-                df_resumen.to_excel(writer, sheet_name='Resumen', index=False)
-                df_detalle.to_excel(writer, sheet_name='Detalle de Pagos', index=False)
-                workbook = writer.book; ws_resumen = workbook['Resumen']; ws_detalle = workbook['Detalle de Pagos']
-                ws_resumen.column_dimensions['A'].width = 30; ws_resumen.column_dimensions['B'].width = 25; ws_detalle.column_dimensions['C'].width = 30; ws_detalle.column_dimensions['D'].width = 15; ws_detalle.column_dimensions['E'].width = 15
+            PaymentExportService(self.db_manager.session).write_file(
+                filepath, 'xlsx', {'pago_ids': [p.id for p in pagos]}, period_label=f"{mes:02d}/{año}"
+            )
             logging.info(f"Reporte de pagos exportado exitosamente a {filepath}"); return filepath
         except Exception as e: logging.exception("Error al exportar reporte de pagos a Excel."); raise e
     def exportar_rutina_excel(self, rutina: Rutina, exercises_by_day: Dict[int, List[RutinaEjercicio]]) -> str:
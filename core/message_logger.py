@@ -9,6 +9,10 @@ import logging
 from datetime import datetime, timedelta
 from typing import Dict, Any, Optional, List
 from .database import DatabaseManager
+from .antispam import MotorAntispam, CONFIG_POR_DEFECTO, CLAVES_CONFIGURACION
+from .database.telefonos import ResolutorTelefonos
+from .database.estadisticas_whatsapp import EstadisticasWhatsapp
+from . import whatsapp_clientes
 
 class MessageLogger:
     """Gestor de registro y control anti-spam de mensajes WhatsApp"""
@@ -16,33 +20,25 @@ class MessageLogger:
     def __init__(self, database_manager: DatabaseManager):
         self.db = database_manager
         self.config_antispam = self._cargar_configuracion_antispam()
+        self.antispam = MotorAntispam(self.db.whatsapp, self.config_antispam)
+        self.estadisticas = EstadisticasWhatsapp(self.db.session)
     
     def _cargar_configuracion_antispam(self) -> Dict[str, int]:
         """Carga la configuración anti-spam desde la base de datos"""
+        config = dict(CONFIG_POR_DEFECTO)
         try:
-            return {
-                'max_mensajes_por_hora': int(self.db.obtener_configuracion('whatsapp_max_mensajes_hora') or 10),
-                'max_mensajes_por_dia': int(self.db.obtener_configuracion('whatsapp_max_mensajes_dia') or 50),
-                'intervalo_minimo_minutos': int(self.db.obtener_configuracion('whatsapp_intervalo_minimo') or 5),
-                'max_intentos_fallidos': int(self.db.obtener_configuracion('whatsapp_max_intentos_fallidos') or 5)
-            }
+            valores = whatsapp_clientes.configuracion(self.db.session)
+            for campo, clave in CLAVES_CONFIGURACION.items():
+                if valores.get(clave):
+                    config[campo] = int(valores[clave])
         except Exception as e:
             logging.error(f"Error cargando configuración anti-spam: {e}")
-            return {
-                'max_mensajes_por_hora': 10,
-                'max_mensajes_por_dia': 50,
-                'intervalo_minimo_minutos': 5
-            }
+        return config
     
     def _obtener_user_id_por_telefono(self, telefono: str) -> int:
-        """Obtiene el ID de usuario por número de teléfono"""
+        """Obtiene el ID de usuario por número de teléfono (en cualquier formato)"""
         try:
-            with self.db.get_connection_context() as conn:
-                with conn.cursor() as cursor:
-                    # Intentar buscar como string primero, luego como integer
-                    cursor.execute("SELECT id FROM usuarios WHERE telefono = %s", (str(telefono),))
-                    result = cursor.fetchone()
-                    return result[0] if result else None
+            return ResolutorTelefonos(self.db.session).resolver(telefono)
         except Exception as e:
             logging.error(f"Error obteniendo user_id por teléfono: {e}")
             return None
@@ -58,7 +54,7 @@ class MessageLogger:
             if tipo_mensaje not in tipos_validos:
                 tipo_mensaje = 'welcome'
             
-            return self.db.registrar_mensaje_whatsapp(
+            ok = self.db.whatsapp.registrar_mensaje_whatsapp(
                 user_id=user_id,
                 message_type=tipo_mensaje,
                 template_name="manual",
@@ -67,6 +63,9 @@ class MessageLogger:
                 status="sent",
                 message_id=message_id
             )
+            if ok:
+                self.antispam.registrar(telefono, tipo_mensaje)
+            return ok
         except Exception as e:
             logging.error(f"Error al registrar mensaje enviado: {e}")
             return False
@@ -81,7 +80,7 @@ class MessageLogger:
             if tipo_mensaje not in tipos_validos:
                 tipo_mensaje = 'welcome'
             
-            return self.db.registrar_mensaje_whatsapp(
+            return self.db.whatsapp.registrar_mensaje_whatsapp(
                 user_id=user_id,
                 message_type=tipo_mensaje,
                 template_name="incoming",
@@ -104,7 +103,7 @@ class MessageLogger:
             if tipo_mensaje not in tipos_validos:
                 tipo_mensaje = 'welcome'
             
-            return self.db.registrar_mensaje_whatsapp(
+            ok = self.db.whatsapp.registrar_mensaje_whatsapp(
                 user_id=user_id,
                 message_type=tipo_mensaje,
                 template_name="failed",
@@ -112,6 +111,9 @@ class MessageLogger:
                 message_content=f"{mensaje} - Error: {error}",
                 status="failed"
             )
+            if ok:
+                self.antispam.registrar(telefono, tipo_mensaje, fallido=True)
+            return ok
         except Exception as e:
             logging.error(f"Error al registrar mensaje fallido: {e}")
             return False
@@ -119,115 +121,26 @@ class MessageLogger:
     def puede_enviar_mensaje(self, telefono: str, tipo_mensaje: str = None) -> bool:
         """Verifica si se puede enviar un mensaje según las reglas anti-spam"""
         try:
-            # Verificar mensajes por hora
-            if not self._verificar_limite_por_hora(telefono):
-                logging.warning(f"Límite por hora excedido para {telefono}")
-                return False
-            
-            # Verificar mensajes por día
-            if not self._verificar_limite_por_dia(telefono):
-                logging.warning(f"Límite diario excedido para {telefono}")
-                return False
-            
-            # Verificar intervalo mínimo
-            if not self._verificar_intervalo_minimo(telefono):
-                logging.warning(f"Intervalo mínimo no cumplido para {telefono}")
-                return False
-            
-            # Verificar intentos fallidos
-            if not self._verificar_intentos_fallidos(telefono):
-                logging.warning(f"Demasiados intentos fallidos para {telefono}")
+            motivo = self.antispam.motivo(telefono)
+            if motivo:
+                logging.warning(f"Anti-spam ({motivo}) para {telefono}")
                 return False
-            
             return True
-            
         except Exception as e:
             logging.error(f"Error al verificar si puede enviar mensaje: {e}")
             return False
     
-    def _verificar_limite_por_hora(self, telefono: str) -> bool:
-        """Verifica el límite de mensajes por hora"""
-        try:
-            hora_limite = datetime.now() - timedelta(hours=1)
-            mensajes_hora = self.db.contar_mensajes_whatsapp_periodo(
-                telefono=telefono,
-                direccion='enviado',
-                fecha_desde=hora_limite
-            )
-            return mensajes_hora < self.config_antispam['max_mensajes_por_hora']
-        except Exception as e:
-            logging.error(f"Error al verificar límite por hora: {e}")
-            return True  # En caso de error, permitir envío
-    
-    def _verificar_limite_por_dia(self, telefono: str) -> bool:
-        """Verifica el límite de mensajes por día"""
-        try:
-            dia_limite = datetime.now() - timedelta(days=1)
-            mensajes_dia = self.db.contar_mensajes_whatsapp_periodo(
-                telefono=telefono,
-                direccion='enviado',
-                fecha_desde=dia_limite
-            )
-            return mensajes_dia < self.config_antispam['max_mensajes_por_dia']
-        except Exception as e:
-            logging.error(f"Error al verificar límite por día: {e}")
-            return True
-    
-    def _verificar_intervalo_minimo(self, telefono: str) -> bool:
-        """Verifica el intervalo mínimo entre mensajes"""
-        try:
-            ultimo_mensaje = self.db.obtener_ultimo_mensaje_whatsapp(
-                telefono=telefono,
-                direccion='enviado'
-            )
-            
-            if not ultimo_mensaje:
-                return True
-            
-            # Asegurar que ambos datetime sean naive para evitar errores de timezone
-            fecha_envio = ultimo_mensaje['fecha_envio']
-            if hasattr(fecha_envio, 'replace') and fecha_envio.tzinfo is not None:
-                fecha_envio = fecha_envio.replace(tzinfo=None)
-            
-            tiempo_transcurrido = datetime.now() - fecha_envio
-            intervalo_minimo = timedelta(minutes=self.config_antispam['intervalo_minimo_minutos'])
-            
-            return tiempo_transcurrido >= intervalo_minimo
-            
-        except Exception as e:
-            logging.error(f"Error al verificar intervalo mínimo: {e}")
-            return True
-    
-    def _verificar_intentos_fallidos(self, telefono: str) -> bool:
-        """Verifica si hay demasiados intentos fallidos recientes"""
-        try:
-            # Verificar intentos fallidos en las últimas 24 horas
-            dia_limite = datetime.now() - timedelta(days=1)
-            intentos_fallidos = self.db.contar_mensajes_whatsapp_periodo(
-                telefono=telefono,
-                direccion='enviado',
-                estado='fallido',
-                fecha_desde=dia_limite
-            )
-            
-            return intentos_fallidos < self.config_antispam['max_intentos_fallidos']
-            
-        except Exception as e:
-            logging.error(f"Error al verificar intentos fallidos: {e}")
-            return True
+    def evaluar_antispam(self, telefonos: List[str], tipo_mensaje: str = None,
+                         horas: int = 24) -> Dict[str, Optional[str]]:
+        """Evalúa muchos teléfonos a la vez (una consulta para los que no están en memoria).
+        Devuelve el motivo de bloqueo por teléfono o None si se puede enviar; con `tipo_mensaje`
+        incluye la regla de verificar_mensaje_enviado_reciente con ventana `horas`."""
+        return self.antispam.evaluar(telefonos, tipo_mensaje, horas)
     
     def verificar_mensaje_enviado_reciente(self, telefono: str, tipo_mensaje: str, horas: int = 24) -> bool:
         """Verifica si ya se envió un mensaje del tipo especificado recientemente"""
         try:
-            user_id = self._obtener_user_id_por_telefono(telefono)
-            if not user_id:
-                return False
-            
-            return self.db.verificar_mensaje_enviado_reciente(
-                user_id=user_id,
-                message_type=tipo_mensaje,
-                horas_limite=horas
-            )
+            return self.antispam.motivo(telefono, tipo_mensaje, horas) == 'reciente'
         except Exception as e:
             logging.error(f"Error al verificar mensaje reciente: {e}")
             return False
@@ -251,44 +164,7 @@ class MessageLogger:
     def obtener_estadisticas_diarias(self, fecha: datetime = None) -> Dict[str, int]:
         """Obtiene estadísticas de mensajes del día"""
         try:
-            if not fecha:
-                fecha = datetime.now()
-            
-            inicio_dia = fecha.replace(hour=0, minute=0, second=0, microsecond=0)
-            fin_dia = inicio_dia + timedelta(days=1)
-            
-            enviados = self.db.contar_mensajes_whatsapp_periodo(
-                direccion='enviado',
-                fecha_desde=inicio_dia,
-                fecha_hasta=fin_dia
-            )
-            
-            recibidos = self.db.contar_mensajes_whatsapp_periodo(
-                direccion='recibido',
-                fecha_desde=inicio_dia,
-                fecha_hasta=fin_dia
-            )
-            
-            fallidos = self.db.contar_mensajes_whatsapp_periodo(
-                direccion='enviado',
-                estado='fallido',
-                fecha_desde=inicio_dia,
-                fecha_hasta=fin_dia
-            )
-            
-            total_intentos = enviados + fallidos
-            tasa_exito = 0
-            if total_intentos > 0:
-                tasa_exito = round((enviados / total_intentos) * 100, 2)
-            
-            return {
-                'enviados': enviados,
-                'recibidos': recibidos,
-                'fallidos': fallidos,
-                'total': enviados + recibidos,
-                'tasa_exito': tasa_exito
-            }
-            
+            return self.estadisticas.diarias(fecha)
         except Exception as e:
             logging.error(f"Error al obtener estadísticas diarias: {e}")
             return {
@@ -297,49 +173,9 @@ class MessageLogger:
             }
     
     def obtener_estadisticas_semanales(self, fecha: datetime = None) -> Dict[str, int]:
-        """Obtiene estadísticas de mensajes de la semana"""
+        """Obtiene estadísticas de mensajes de la semana (lunes a domingo)"""
         try:
-            if not fecha:
-                fecha = datetime.now()
-            
-            # Calcular inicio de la semana (lunes)
-            dias_desde_lunes = fecha.weekday()
-            inicio_semana = fecha - timedelta(days=dias_desde_lunes)
-            inicio_semana = inicio_semana.replace(hour=0, minute=0, second=0, microsecond=0)
-            fin_semana = inicio_semana + timedelta(days=7)
-            
-            enviados = self.db.contar_mensajes_whatsapp_periodo(
-                direccion='enviado',
-                fecha_desde=inicio_semana,
-                fecha_hasta=fin_semana
-            )
-            
-            recibidos = self.db.contar_mensajes_whatsapp_periodo(
-                direccion='recibido',
-                fecha_desde=inicio_semana,
-                fecha_hasta=fin_semana
-            )
-            
-            fallidos = self.db.contar_mensajes_whatsapp_periodo(
-                direccion='enviado',
-                estado='fallido',
-                fecha_desde=inicio_semana,
-                fecha_hasta=fin_semana
-            )
-            
-            total_intentos = enviados + fallidos
-            tasa_exito = 0
-            if total_intentos > 0:
-                tasa_exito = round((enviados / total_intentos) * 100, 2)
-            
-            return {
-                'enviados': enviados,
-                'recibidos': recibidos,
-                'fallidos': fallidos,
-                'total': enviados + recibidos,
-                'tasa_exito': tasa_exito
-            }
-            
+            return self.estadisticas.semanales(fecha)
         except Exception as e:
             logging.error(f"Error al obtener estadísticas semanales: {e}")
             return {
@@ -350,37 +186,7 @@ class MessageLogger:
     def obtener_estadisticas_por_tipo(self, dias: int = 7) -> Dict[str, Dict[str, int]]:
         """Obtiene estadísticas de mensajes por tipo en los últimos días"""
         try:
-            fecha_limite = datetime.now() - timedelta(days=dias)
-            
-            tipos_mensaje = ['welcome', 'payment', 'overdue', 'deactivation', 'class_reminder', 'waitlist']
-            estadisticas = {}
-            
-            for tipo in tipos_mensaje:
-                # Obtener mensajes enviados
-                enviados = self.db.contar_mensajes_whatsapp_periodo(
-                    tipo_mensaje=tipo,
-                    direccion='enviado',
-                    fecha_desde=fecha_limite
-                )
-                
-                # Obtener mensajes fallidos
-                fallidos = self.db.contar_mensajes_whatsapp_periodo(
-                    tipo_mensaje=tipo,
-                    direccion='fallido',
-                    fecha_desde=fecha_limite
-                )
-                
-                # Asegurar que los valores sean enteros
-                enviados = enviados if isinstance(enviados, int) else 0
-                fallidos = fallidos if isinstance(fallidos, int) else 0
-                
-                estadisticas[tipo] = {
-                    'enviados': enviados,
-                    'fallidos': fallidos
-                }
-            
-            return estadisticas
-            
+            return self.estadisticas.por_tipo(dias)
         except Exception as e:
             logging.error(f"Error al obtener estadísticas por tipo: {e}")
             return {}
@@ -415,16 +221,11 @@ class MessageLogger:
             # Usuarios con demasiados intentos fallidos en las últimas 24 horas
             fecha_limite = datetime.now() - timedelta(days=1)
             
-            usuarios_bloqueados = []
-            
             # Obtener todos los teléfonos únicos con mensajes fallidos recientes
-            telefonos_con_fallos = self.db.obtener_telefonos_con_mensajes_fallidos(fecha_limite)
+            telefonos_con_fallos = self.db.whatsapp.obtener_telefonos_con_mensajes_fallidos(fecha_limite)
+            motivos = self.antispam.evaluar(telefonos_con_fallos)
             
-            for telefono in telefonos_con_fallos:
-                if not self._verificar_intentos_fallidos(telefono):
-                    usuarios_bloqueados.append(telefono)
-            
-            return usuarios_bloqueados
+            return [t for t, motivo in motivos.items() if motivo == 'intentos_fallidos']
             
         except Exception as e:
             logging.error(f"Error al obtener usuarios bloqueados: {e}")
@@ -434,7 +235,9 @@ class MessageLogger:
         """Desbloquea un usuario eliminando sus mensajes fallidos recientes"""
         try:
             fecha_limite = datetime.now() - timedelta(hours=1)
-            return self.db.limpiar_mensajes_fallidos_usuario(telefono, fecha_limite)
+            ok = self.db.limpiar_mensajes_fallidos_usuario(telefono, fecha_limite)
+            self.antispam.invalidar(telefono)
+            return ok
         except Exception as e:
             logging.error(f"Error al desbloquear usuario {telefono}: {e}")
             return False
@@ -456,20 +259,16 @@ class MessageLogger:
                     )
 
             # Mapear a claves almacenadas en `configuracion`
-            mapping = {
-                'max_mensajes_por_hora': 'whatsapp_max_mensajes_hora',
-                'max_mensajes_por_dia': 'whatsapp_max_mensajes_dia',
-                'intervalo_minimo_minutos': 'whatsapp_intervalo_minimo',
-                'max_intentos_fallidos': 'whatsapp_max_intentos_fallidos',
-            }
+            mapping = CLAVES_CONFIGURACION
 
             # Actualizar configuración en base de datos (tabla genérica)
-            for campo, valor in nueva_config.items():
-                if campo in mapping:
-                    self.db.actualizar_configuracion(mapping[campo], str(int(valor)))
+            whatsapp_clientes.guardar_configuracion(self.db.session, valores={
+                mapping[campo]: str(int(valor)) for campo, valor in nueva_config.items() if campo in mapping
+            })
 
             # Recargar configuración local
             self.config_antispam = self._cargar_configuracion_antispam()
+            self.antispam.config.update(self.config_antispam)
 
             logging.info("Configuración anti-spam actualizada exitosamente")
             return True
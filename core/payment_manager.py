@@ -36,11 +36,14 @@ except Exception:
             return None
     alert_manager = _StubAlertManager()
 from .database import DatabaseManager, database_retry
+from .database.date_ranges import hoy_gym, rango_ultimos_meses
+from .database.repositories.payment_repository import PaymentRepository, asegurar_resumen_ingresos
+from .services.catalog_service import CatalogService
 
 # Importar módulos WhatsApp (importación condicional para evitar errores si no están disponibles)
 try:
     from .whatsapp_manager import WhatsAppManager
-    from .message_logger import MessageLogger
+    from . import whatsapp_clientes
     WHATSAPP_AVAILABLE = True
 except ImportError:
     WHATSAPP_AVAILABLE = False
@@ -57,9 +60,9 @@ class PaymentManager:
         
         if WHATSAPP_AVAILABLE:
             try:
-                # Inicializar logger de mensajes y gestor WhatsApp en modo perezoso
-                self.message_logger = MessageLogger(db_manager)
+                # Gestor WhatsApp en modo perezoso; su logger de mensajes es el mismo que usa este manager
                 self.whatsapp_manager = WhatsAppManager(db_manager, defer_init=True)
+                self.message_logger = self.whatsapp_manager.message_logger
                 # Vincular referencias cruzadas para delegación correcta
                 try:
                     setattr(self.whatsapp_manager, 'payment_manager', self)
@@ -94,9 +97,16 @@ class PaymentManager:
         if not usuario:
             raise ValueError(f"No existe usuario con ID: {usuario_id}")
         try:
+            asegurar_resumen_ingresos(self.db_manager.session)
             # Usar transacción atómica para garantizar consistencia de pago y actualización de usuario
             with self.db_manager.atomic_transaction(isolation_level="REPEATABLE READ") as conn:
                 cursor = conn.cursor()
+                # Si el período ya tenía pago, sale del resumen de ingresos con sus valores actuales
+                cursor.execute(
+                    "SELECT usuario_id, fecha_pago, metodo_pago_id, monto FROM pagos WHERE usuario_id = %s AND mes = %s AND año = %s FOR UPDATE",
+                    (usuario_id, mes, año)
+                )
+                PaymentRepository.acumular_resumen_ingresos_cursor(cursor, cursor.fetchall(), signo=-1)
                 # Crear o actualizar pago idempotentemente por (usuario_id, mes, año)
                 cursor.execute(
                     """
@@ -106,7 +116,7 @@ class PaymentManager:
                     SET monto = EXCLUDED.monto,
                         metodo_pago_id = COALESCE(EXCLUDED.metodo_pago_id, pagos.metodo_pago_id),
                         fecha_pago = CURRENT_TIMESTAMP
-                    RETURNING id
+                    RETURNING id, usuario_id, fecha_pago, metodo_pago_id, monto
                     """,
                     (usuario_id, monto, mes, año, metodo_pago_id)
                 )
@@ -114,6 +124,7 @@ class PaymentManager:
                 if not result:
                     raise ValueError("Error al crear el pago: no se obtuvo ID")
                 pago_id = result[0]
+                PaymentRepository.acumular_resumen_ingresos_cursor(cursor, [result[1:]])
 
                 # Calcular próximo vencimiento usando duracion_dias del tipo de cuota del usuario
                 cursor.execute(
@@ -190,7 +201,7 @@ class PaymentManager:
             raise
 
     def modificar_pago(self, pago: Pago):
-        self.db_manager.modificar_pago(pago)
+        self.db_manager.pagos.modificar_pago(pago)
         # Generar alerta de pago modificado
         try:
             usuario = self.db_manager.obtener_usuario(pago.usuario_id)
@@ -262,9 +273,16 @@ class PaymentManager:
                 comision = self.calcular_comision(float(total_conceptos), metodo_pago_id)
                 total_final = float(total_conceptos) + comision
 
+            asegurar_resumen_ingresos(self.db_manager.session)
             with self.db_manager.get_connection_context() as conn:
                 cursor = conn.cursor()
 
+                cursor.execute(
+                    "SELECT usuario_id, fecha_pago, metodo_pago_id, monto FROM pagos WHERE id = %s FOR UPDATE",
+                    (pago_id,)
+                )
+                PaymentRepository.acumular_resumen_ingresos_cursor(cursor, cursor.fetchall(), signo=-1)
+
                 # Actualizar pago principal, incluyendo mes/año para mantener consistencia con fecha
                 cursor.execute(
                     """
@@ -276,9 +294,11 @@ class PaymentManager:
                         mes = %s,
                         año = %s
                     WHERE id = %s
+                    RETURNING usuario_id, fecha_pago, metodo_pago_id, monto
                     """,
                     (usuario_id, total_final, fecha_pago, metodo_pago_id, mes, año, pago_id)
                 )
+                PaymentRepository.acumular_resumen_ingresos_cursor(cursor, cursor.fetchall())
 
                 # Reemplazar detalles
                 cursor.execute("DELETE FROM pago_detalles WHERE pago_id = %s", (pago_id,))
@@ -349,7 +369,7 @@ class PaymentManager:
     def eliminar_pago(self, pago_id: int):
         # Obtener información del pago antes de eliminar para construir la alerta
         pago = self.obtener_pago(pago_id)
-        self.db_manager.eliminar_pago(pago_id)
+        self.db_manager.pagos.eliminar_pago(pago_id)
         # Generar alerta de pago eliminado
         try:
             if pago:
@@ -428,145 +448,80 @@ class PaymentManager:
             row = cursor.fetchone()
             return self._crear_pago_desde_fila(row) if row else None
 
-    def _recalcular_estado_usuario(self, usuario_id: int) -> Dict[str, Any]:
-        """Recalcula fecha_proximo_vencimiento, ultimo_pago y cuotas_vencidas del usuario.
-        - Usa el último pago si existe; si no, usa fecha_registro para calcular vencimiento.
-        - No dispara notificaciones; solo actualiza estado. Desactiva si alcanza 3 cuotas vencidas.
-        Devuelve un resumen con los valores aplicados.
+    def recalcular_estados_usuarios(self, usuario_ids: Optional[List[int]] = None,
+                                    solo_activos: bool = False) -> List[Dict[str, Any]]:
+        """Recalcula fecha_proximo_vencimiento, ultimo_pago, cuotas_vencidas y activo de todos
+        los usuarios (o de `usuario_ids`) con una sola sentencia en base de datos.
+
+        Sobre el diff devuelto registra la auditoría en un único INSERT y notifica la
+        desactivación sólo a quienes cruzaron el umbral de 3 cuotas vencidas.
         """
-        from datetime import date
-        with self.db_manager.get_connection_context() as conn:
-            cursor = conn.cursor()
+        cambios = self.db_manager.pagos.recalcular_estados_usuarios(usuario_ids, solo_activos=solo_activos)
+        if not cambios:
+            return []
 
-            # Obtener último pago
-            cursor.execute(
-                "SELECT fecha_pago FROM pagos WHERE usuario_id = %s ORDER BY fecha_pago DESC LIMIT 1",
-                (usuario_id,)
+        try:
+            self.db_manager.audit.registrar_audit_logs_batch([
+                {
+                    'user_id': None,
+                    'action': 'RECALCULO_ESTADO',
+                    'table_name': 'usuarios',
+                    'record_id': c['usuario_id'],
+                    'old_values': json.dumps({
+                        'activo': c['activo_anterior'],
+                        'cuotas_vencidas': c['cuotas_vencidas_anteriores'],
+                        'fecha_proximo_vencimiento': c['fecha_proximo_vencimiento_anterior'],
+                    }, default=str),
+                    'new_values': json.dumps({
+                        'activo': c['activo'],
+                        'cuotas_vencidas': c['cuotas_vencidas'],
+                        'fecha_proximo_vencimiento': c['fecha_proximo_vencimiento'],
+                    }, default=str),
+                }
+                for c in cambios
+            ])
+        except Exception as e:
+            logging.error(f"Error registrando auditoría de recálculo de estados: {e}")
+
+        desactivados = [
+            c for c in cambios
+            if c['desactivado'] and c['cuotas_vencidas_anteriores'] < 3 <= c['cuotas_vencidas']
+        ]
+        for c in desactivados:
+            self._verificar_y_procesar_morosidad(
+                c['usuario_id'], c['cuotas_vencidas_anteriores'], c['cuotas_vencidas'], ya_desactivado=True
             )
-            row_pago = cursor.fetchone()
-            ultimo_pago_dt = row_pago[0] if row_pago else None
 
-            # Obtener fecha de registro (fallback), tipo de cuota y cuotas_vencidas previas
-            cursor.execute(
-                "SELECT fecha_registro, tipo_cuota, COALESCE(cuotas_vencidas, 0), rol FROM usuarios WHERE id = %s",
-                (usuario_id,)
-            )
-            row_usr = cursor.fetchone()
-            fecha_registro_dt = row_usr[0] if row_usr else None
-            tipo_raw = row_usr[1] if row_usr else None
-            cuotas_previas = int(row_usr[2]) if row_usr and row_usr[2] is not None else 0
-            rol_lower = str(row_usr[3] if row_usr and len(row_usr) > 3 and row_usr[3] is not None else "").lower()
-            exento = rol_lower in ("profesor", "dueño", "owner")
-
-            # Obtener duracion_dias desde tipos_cuota (acepta nombre o id)
-            cursor.execute(
-                """
-                SELECT COALESCE(tc.duracion_dias, 30)
-                FROM tipos_cuota tc
-                WHERE tc.nombre = %s OR tc.id::text = %s
-                LIMIT 1
-                """,
-                (tipo_raw, str(tipo_raw) if tipo_raw is not None else None)
+        try:
+            alert_manager.generate_alert(
+                level=AlertLevel.INFO,
+                category=AlertCategory.PAYMENT,
+                title="Estados de usuarios recalculados",
+                message=f"{len(cambios)} usuarios actualizados, {len(desactivados)} desactivados por morosidad",
+                source="payment_manager"
             )
-            row_tc = cursor.fetchone()
-            duracion_dias = int(row_tc[0]) if row_tc and row_tc[0] is not None else 30
-
-            # Base para cálculo de vencimiento
-            base_date = None
-            if ultimo_pago_dt is not None:
-                try:
-                    base_date = (ultimo_pago_dt.date() if hasattr(ultimo_pago_dt, 'date') else datetime.fromisoformat(str(ultimo_pago_dt)).date())
-                except Exception:
-                    base_date = date.today()
-            else:
-                # Sin pagos: usar fecha_registro si existe, sino hoy
-                try:
-                    base_date = (fecha_registro_dt.date() if hasattr(fecha_registro_dt, 'date') else datetime.fromisoformat(str(fecha_registro_dt)).date()) if fecha_registro_dt else date.today()
-                except Exception:
-                    base_date = date.today()
-
-            # Calcular próximo vencimiento avanzando por ciclos completos hasta el próximo futuro
-            primer_vencimiento = base_date + timedelta(days=duracion_dias)
-            hoy = date.today()
-            if hoy <= primer_vencimiento:
-                proximo_vencimiento = primer_vencimiento
-                nuevas_cuotas_vencidas = 0
-            else:
-                # Ciclos vencidos completos desde el primer vencimiento
-                dias_desde_primer_venc = (hoy - primer_vencimiento).days
-                ciclos_vencidos = (dias_desde_primer_venc + max(duracion_dias, 1) - 1) // max(duracion_dias, 1)  # ceil
-                nuevas_cuotas_vencidas = max(ciclos_vencidos, 1)
-                proximo_vencimiento = primer_vencimiento + timedelta(days=duracion_dias * ciclos_vencidos)
-
-            # Exención: dueños y profesores no acumulan cuotas vencidas ni se desactivan por morosidad
-            if exento:
-                nuevas_cuotas_vencidas = 0
-                cursor.execute(
-                    """
-                    UPDATE usuarios
-                    SET fecha_proximo_vencimiento = %s,
-                        ultimo_pago = %s,
-                        cuotas_vencidas = 0
-                    WHERE id = %s
-                    """,
-                    (
-                        proximo_vencimiento,
-                        ultimo_pago_dt.date() if (ultimo_pago_dt is not None and hasattr(ultimo_pago_dt, 'date')) else None,
-                        usuario_id,
-                    )
-                )
-            else:
-                # No forzar activación; solo desactivar si cruza umbral
-                cursor.execute(
-                    """
-                    UPDATE usuarios
-                    SET fecha_proximo_vencimiento = %s,
-                        ultimo_pago = %s,
-                        cuotas_vencidas = %s,
-                        activo = CASE WHEN %s >= 3 THEN FALSE ELSE activo END
-                    WHERE id = %s
-                    """,
-                    (
-                        proximo_vencimiento,
-                        ultimo_pago_dt.date() if (ultimo_pago_dt is not None and hasattr(ultimo_pago_dt, 'date')) else None,
-                        nuevas_cuotas_vencidas,
-                        nuevas_cuotas_vencidas,
-                        usuario_id,
-                    )
-                )
-            conn.commit()
+        except Exception:
+            pass
+        return cambios
 
-            # Verificación post-operación: si cruza umbral de morosidad, disparar revisión
-            try:
-                self._verificar_y_procesar_morosidad(usuario_id, cuotas_previas, nuevas_cuotas_vencidas)
-            except Exception as e:
-                logging.error(f"Error verificando morosidad post-recalculo: {e}")
-
-            resumen = {
-                'usuario_id': usuario_id,
-                'duracion_dias': duracion_dias,
-                'base_date': base_date,
-                'fecha_proximo_vencimiento': proximo_vencimiento,
-                'ultimo_pago': (ultimo_pago_dt.date() if (ultimo_pago_dt is not None and hasattr(ultimo_pago_dt, 'date')) else None),
-                'cuotas_vencidas': nuevas_cuotas_vencidas,
-                'desactivado': nuevas_cuotas_vencidas >= 3
-            }
-            try:
-                alert_manager.generate_alert(
-                    level=AlertLevel.INFO,
-                    category=AlertCategory.PAYMENT,
-                    title="Estado de usuario recalculado",
-                    message=(
-                        f"Usuario {usuario_id}: cv={nuevas_cuotas_vencidas}, "
-                        f"próximo={proximo_vencimiento}, último_pago={resumen['ultimo_pago']}"
-                    ),
-                    source="payment_manager"
-                )
-            except Exception:
-                pass
-            return resumen
+    def _recalcular_estado_usuario(self, usuario_id: int) -> Dict[str, Any]:
+        """Recalcula el estado de un usuario (ver recalcular_estados_usuarios).
+        Devuelve un resumen con los valores aplicados; vacío si no hubo cambios.
+        """
+        cambios = self.recalcular_estados_usuarios([usuario_id])
+        if not cambios:
+            return {}
+        c = cambios[0]
+        return {
+            'usuario_id': usuario_id,
+            'fecha_proximo_vencimiento': c['fecha_proximo_vencimiento'],
+            'ultimo_pago': c['ultimo_pago'],
+            'cuotas_vencidas': c['cuotas_vencidas'],
+            'desactivado': c['desactivado'],
+        }
 
-    def _verificar_y_procesar_morosidad(self, usuario_id: int, cuotas_previas: int, cuotas_actuales: int) -> bool:
+    def _verificar_y_procesar_morosidad(self, usuario_id: int, cuotas_previas: int, cuotas_actuales: int,
+                                        ya_desactivado: bool = False) -> bool:
         """Si el usuario cruza el umbral de morosidad (de <3 a >=3 cuotas vencidas),
         dispara el flujo de revisión y desactivación correspondiente. El envío de WhatsApp
         queda delegado en el flujo dedicado (PaymentManager -> WhatsAppManager).
@@ -575,10 +530,11 @@ class PaymentManager:
         try:
             if cuotas_previas < 3 and cuotas_actuales >= 3:
                 # Desactivar en base de datos (maneja excepciones de roles como profesor/dueño)
-                try:
-                    self.db_manager.desactivar_usuario_por_cuotas_vencidas(usuario_id)
-                except Exception as e:
-                    logging.error(f"Error desactivando usuario {usuario_id} por cuotas vencidas: {e}")
+                if not ya_desactivado:
+                    try:
+                        self.db_manager.desactivar_usuario_por_cuotas_vencidas(usuario_id)
+                    except Exception as e:
+                        logging.error(f"Error desactivando usuario {usuario_id} por cuotas vencidas: {e}")
 
                 # Enviar notificación de desactivación con plantilla correcta
                 try:
@@ -689,6 +645,7 @@ class PaymentManager:
             total_final = float(total_conceptos) + comision
         
         try:
+            asegurar_resumen_ingresos(self.db_manager.session)
             with self.db_manager.get_connection_context() as conn:
                 cursor = conn.cursor()
                 
@@ -696,6 +653,11 @@ class PaymentManager:
                 mes = fecha_pago.month
                 año = fecha_pago.year
                 
+                cursor.execute(
+                    "SELECT usuario_id, fecha_pago, metodo_pago_id, monto FROM pagos WHERE usuario_id = %s AND mes = %s AND año = %s FOR UPDATE",
+                    (usuario_id, mes, año)
+                )
+                PaymentRepository.acumular_resumen_ingresos_cursor(cursor, cursor.fetchall(), signo=-1)
 # Crear el pago principal con UPSERT idempotente
                 cursor.execute(
                     """
@@ -705,7 +667,7 @@ class PaymentManager:
                         monto = EXCLUDED.monto,
                         metodo_pago_id = COALESCE(EXCLUDED.metodo_pago_id, pagos.metodo_pago_id),
                         fecha_pago = EXCLUDED.fecha_pago
-                    RETURNING id
+                    RETURNING id, usuario_id, fecha_pago, metodo_pago_id, monto
                     """,
                     (usuario_id, total_final, mes, año, fecha_pago, metodo_pago_id)
                 )
@@ -713,6 +675,7 @@ class PaymentManager:
                 if not result:
                     raise ValueError("Error al crear/actualizar el pago avanzado: no se obtuvo ID")
                 pago_id = result[0]
+                PaymentRepository.acumular_resumen_ingresos_cursor(cursor, [result[1:]])
                 # Crear los detalles de pago en lote
                 try:
                     filas = []
@@ -983,17 +946,8 @@ class PaymentManager:
         try:
             if not metodo_pago_id:
                 return 0.0
-            with self.db_manager.get_connection_context() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT comision FROM metodos_pago WHERE id = %s AND activo = TRUE", (metodo_pago_id,))
-                row = cursor.fetchone()
-                if not row or row[0] is None:
-                    return 0.0
-                porcentaje = float(row[0])
-                if porcentaje <= 0:
-                    return 0.0
-                # Redondear a 2 decimales para evitar diferencias por flotantes
-                return round(monto_base * (porcentaje / 100.0), 2)
+            # Catálogo en memoria: evita una consulta a metodos_pago por pago registrado
+            return CatalogService(self.db_manager.session).get_totals_with_commission(monto_base, metodo_pago_id)['comision']
         except Exception:
             # En caso de error, no bloquear el flujo de pago por comisión
             return 0.0
@@ -1405,108 +1359,43 @@ class PaymentManager:
             logging.error(f"Error al enviar notificación de pago: {e}")
 
     # --- NUEVO: PROCESAMIENTO DE MOROSOS (fuera de whatsapp_manager) ---
-    def procesar_usuarios_morosos(self) -> int:
-        """Procesa usuarios morosos: envía recordatorios, incrementa cuotas vencidas y desactiva si corresponde."""
+    def procesar_usuarios_morosos(self, dry_run: bool = False) -> int:
+        """Procesa usuarios morosos: recalcula cuotas vencidas y desactivaciones en bloque y envía recordatorios."""
         try:
-            usuarios_morosos = self.db_manager.obtener_usuarios_morosos()
-            mensajes_enviados = 0
-
-            for usuario in usuarios_morosos:
+            # Cuotas vencidas y desactivación salen del recálculo (idempotente), no de los envíos
+            if not dry_run:
                 try:
-                    telefono = usuario.get('telefono')
-                    if not telefono:
-                        logging.warning(f"Usuario {usuario.get('id')} sin teléfono registrado")
-                        continue
-
-                    # Anti-spam: no enviar más de un mensaje por 30 días
-                    if self.message_logger.verificar_mensaje_enviado_reciente(
-                        telefono, "overdue", 24 * 30
-                    ):
-                        logging.info(f"Mensaje anti-spam bloqueado para usuario {usuario.get('id')}")
-                        continue
-
-                    # Preparar datos y enviar mensaje de cuota vencida
-                    user_data = {
-                        'user_id': usuario['id'],
-                        'phone': telefono,
-                        'name': usuario.get('nombre', ''),
-                        'due_date': usuario.get('fecha_vencimiento', ''),
-                        'amount': usuario.get('monto', 0) or 0,
-                    }
-
-                    if self.whatsapp_enabled and self.whatsapp_manager.send_overdue_payment_notification(user_data):
-                        mensajes_enviados += 1
-                        # Incrementar cuotas vencidas
-                        self.db_manager.incrementar_cuotas_vencidas(usuario['id'])
-
-                        # Desactivar si alcanza 3 cuotas vencidas
-                        cuotas_vencidas = (usuario.get('cuotas_vencidas') or 0) + 1
-                        if cuotas_vencidas >= 3:
-                            self.db_manager.desactivar_usuario_por_cuotas_vencidas(usuario['id'])
-                            # Enviar notificación de desactivación (plantilla correcta)
-                            self.whatsapp_manager.enviar_notificacion_desactivacion(
-                                usuario_id=usuario['id'],
-                                motivo="3 cuotas vencidas",
-                                force_send=True
-                            )
-                    else:
-                        logging.error(f"Error al enviar recordatorio a {usuario.get('nombre', 'desconocido')}")
-
+                    self.recalcular_estados_usuarios(solo_activos=True)
                 except Exception as e:
-                    logging.error(f"Error procesando usuario moroso {usuario.get('id')}: {e}")
-                    continue
-
-            logging.info(f"Proceso morosos completado: {mensajes_enviados} recordatorios enviados")
-            return mensajes_enviados
+                    logging.error(f"Error recalculando estados antes de procesar morosos: {e}")
+            resultado = self.ejecutar_recordatorios('vencidos', dry_run=dry_run)
+            logging.info(f"Proceso morosos completado: {resultado.get('encolados', 0)} recordatorios encolados")
+            return int(resultado.get('encolados_estimados' if dry_run else 'encolados', 0))
         except Exception as e:
             logging.error(f"Error en procesar_usuarios_morosos (PaymentManager): {e}")
             return 0
 
     # --- NUEVO: RECORDATORIOS DE PRÓXIMOS VENCIMIENTOS ---
-    def procesar_recordatorios_proximos_vencimientos(self, dias_anticipacion: int = 3) -> int:
+    def procesar_recordatorios_proximos_vencimientos(self, dias_anticipacion: int = 3, dry_run: bool = False) -> int:
         """Envía recordatorios a usuarios cuyas cuotas vencen pronto."""
         try:
-            usuarios_por_vencer = self.db_manager.obtener_usuarios_con_cuotas_por_vencer(
-                dias_anticipacion=dias_anticipacion
-            )
-            mensajes_enviados = 0
-
-            for usuario in usuarios_por_vencer:
-                try:
-                    telefono = usuario.get('telefono')
-                    if not telefono:
-                        continue
-
-                    # Anti-spam: un recordatorio por semana
-                    if self.message_logger.verificar_mensaje_enviado_reciente(
-                        telefono, "overdue", 24 * 7
-                    ):
-                        logging.info(f"Recordatorio bloqueado por anti-spam para usuario {usuario.get('id')}")
-                        continue
-
-                    user_data = {
-                        'user_id': usuario['id'],
-                        'phone': telefono,
-                        'name': usuario.get('nombre', ''),
-                        'due_date': usuario.get('fecha_vencimiento', ''),
-                        'amount': usuario.get('monto', 0) or 0,
-                    }
-
-                    if self.whatsapp_enabled and self.whatsapp_manager.send_overdue_payment_notification(user_data):
-                        mensajes_enviados += 1
-                    else:
-                        logging.error(f"Error al enviar recordatorio a {usuario.get('nombre', 'desconocido')}")
-
-                except Exception as e:
-                    logging.error(f"Error procesando usuario por vencer {usuario.get('id')}: {e}")
-                    continue
-
-            logging.info(f"Recordatorios de próximos vencimientos enviados: {mensajes_enviados}")
-            return mensajes_enviados
+            resultado = self.ejecutar_recordatorios('por_vencer', dias_anticipacion=dias_anticipacion, dry_run=dry_run)
+            logging.info(f"Recordatorios de próximos vencimientos encolados: {resultado.get('encolados', 0)}")
+            return int(resultado.get('encolados_estimados' if dry_run else 'encolados', 0))
         except Exception as e:
             logging.error(f"Error en procesar_recordatorios_proximos_vencimientos (PaymentManager): {e}")
             return 0
-    
+
+    def ejecutar_recordatorios(self, modo: str, dias_anticipacion: int = 3, dry_run: bool = False,
+                               on_progreso=None) -> Dict[str, Any]:
+        """Recordatorios en bloque vía ReminderPipeline (ver core/reminder_pipeline.py).
+        Sin WhatsApp habilitado sólo puede ejecutarse en dry-run."""
+        from .reminder_pipeline import ReminderPipeline
+        if not dry_run and not self.whatsapp_enabled:
+            return {'modo': modo, 'dry_run': False, 'encolados': 0, 'mensaje': 'WhatsApp no habilitado'}
+        pipeline = ReminderPipeline(self.db_manager, self.whatsapp_manager, self.message_logger)
+        return pipeline.ejecutar(modo, dias_anticipacion=dias_anticipacion, dry_run=dry_run, on_progreso=on_progreso)
+
     def procesar_usuarios_morosos_whatsapp(self, enviar_recordatorios: bool = True) -> Dict[str, Any]:
         """Procesa usuarios morosos y opcionalmente envía recordatorios por WhatsApp"""
         try:
@@ -1524,6 +1413,11 @@ class PaymentManager:
                 resultado['mensaje'] = "WhatsApp no habilitado o envío desactivado"
                 return resultado
             
+            # Carga las ventanas anti-spam de todos en una consulta; el bucle las lee de memoria
+            self.message_logger.evaluar_antispam(
+                [m['usuario'].telefono for m in usuarios_morosos], 'overdue', 72
+            )
+            
             for moroso in usuarios_morosos:
                 usuario = moroso['usuario']
                 periodo = moroso['periodo_pendiente']
@@ -1626,28 +1520,25 @@ class PaymentManager:
             return False
     
     def obtener_estadisticas_whatsapp(self) -> Dict[str, Any]:
-        """Obtiene estadísticas del sistema WhatsApp"""
+        """Obtiene estadísticas del sistema WhatsApp (una lectura del tablero de EstadisticasWhatsapp)"""
         if not self.whatsapp_enabled:
             return {'error': 'Sistema WhatsApp no habilitado'}
         
         try:
-            # Estadísticas diarias
-            stats_diarias = self.message_logger.obtener_estadisticas_diarias()
-            
-            # Estadísticas semanales
-            stats_semanales = self.message_logger.obtener_estadisticas_semanales()
-            
-            # Estadísticas por tipo de mensaje
-            stats_por_tipo = self.message_logger.obtener_estadisticas_por_tipo(7)
+            resumen = self.message_logger.estadisticas.resumen()
             
             # Usuarios bloqueados
             usuarios_bloqueados = self.message_logger.obtener_usuarios_bloqueados()
             
             return {
                 'sistema_habilitado': True,
-                'estadisticas_diarias': stats_diarias,
-                'estadisticas_semanales': stats_semanales,
-                'estadisticas_por_tipo': stats_por_tipo,
+                'estadisticas_diarias': resumen['hoy'],
+                'estadisticas_semanales': resumen['esta_semana'],
+                'estadisticas_por_tipo': self.message_logger.obtener_estadisticas_por_tipo(7),
+                'estadisticas_periodo': resumen['periodo'],
+                'estadisticas_por_estado': resumen['por_estado'],
+                'serie_diaria': resumen['serie_diaria'],
+                'tasa_fallo_por_tipo': {t: v['tasa_fallo'] for t, v in resumen['por_tipo'].items()},
                 'usuarios_bloqueados': len(usuarios_bloqueados),
                 'lista_usuarios_bloqueados': usuarios_bloqueados
             }
@@ -1674,19 +1565,23 @@ class PaymentManager:
             if 'access_token' in configuracion:
                 access_token = str(configuracion.get('access_token') or '').strip() or None
 
-            if phone_id is not None or waba_id is not None or access_token is not None:
-                self.db_manager.actualizar_configuracion_whatsapp(phone_id=phone_id, waba_id=waba_id, access_token=access_token)
-
             # Otras preferencias se guardan en la tabla genérica `configuracion`
-            for k in ('allowlist_numbers', 'allowlist_enabled', 'enable_webhook', 'max_retries', 'retry_delay_seconds'):
+            valores = {}
+            for k in whatsapp_clientes.PREFERENCIAS:
                 if k in configuracion:
                     val = configuracion.get(k)
                     # Normalizar a cadena
                     try:
-                        val_str = str(val)
+                        valores[k] = str(val)
                     except Exception:
-                        val_str = ''
-                    self.db_manager.actualizar_configuracion(k, val_str)
+                        valores[k] = ''
+
+            # Guarda (token cifrado) e invalida la configuración y el cliente compartidos de la base
+            whatsapp_clientes.guardar_configuracion(
+                self.db_manager.session,
+                {'phone_id': phone_id, 'waba_id': waba_id, 'access_token': access_token},
+                valores,
+            )
             
             # Reinicializar WhatsApp manager si es necesario
             if self.whatsapp_manager:
@@ -1730,7 +1625,7 @@ class PaymentManager:
         try:
             cfg_full: Dict[str, Any] = {}
             try:
-                cfg_full = self.db_manager.obtener_configuracion_whatsapp_completa() or {}
+                cfg_full = whatsapp_clientes.configuracion(self.db_manager.session)
             except Exception:
                 cfg_full = {}
 
@@ -1738,8 +1633,8 @@ class PaymentManager:
             config_ui = {
                 'phone_number_id': cfg_full.get('phone_id') or '',
                 'whatsapp_business_account_id': cfg_full.get('waba_id') or '',
-                # Nota: el token puede no estar presente si se gestiona por entorno seguro
-                'access_token': cfg_full.get('access_token') or '',
+                # El token descifrado no sale del servidor; vacío al guardar conserva el actual
+                'access_token': '',
                 'allowlist_numbers': cfg_full.get('allowlist_numbers') or '',
                 'allowlist_enabled': cfg_full.get('allowlist_enabled'),
                 'enable_webhook': cfg_full.get('enable_webhook'),
@@ -1805,47 +1700,19 @@ class PaymentManager:
     def obtener_ingresos_ultimos_12_meses(self) -> Dict[str, float]:
         """Retorna un diccionario con los ingresos por mes para los últimos 12 meses.
         Claves en formato 'Mes Año' (ej: 'Ene 2024') y valores como montos float.
+        Lee del resumen de ingresos mensual (ingresos_mensuales), no de pagos.
         """
         try:
-            # Inicializar con los últimos 12 meses en 0 para asegurar continuidad en gráficos
-            from datetime import date
             meses_nombres = ['Ene', 'Feb', 'Mar', 'Abr', 'May', 'Jun', 'Jul', 'Ago', 'Sep', 'Oct', 'Nov', 'Dic']
-            hoy = date.today()
-            # Construir claves por defecto
+            hoy = hoy_gym()
+            inicio = rango_ultimos_meses(12).fecha_inicio
+            # Inicializar con los últimos 12 meses en 0 para asegurar continuidad en gráficos
             resultados: Dict[str, float] = {}
-            for i in range(11, -1, -1):
-                # retroceder i meses
-                year = hoy.year
-                month = hoy.month - i
-                # ajustar año/mes
-                while month <= 0:
-                    month += 12
-                    year -= 1
-                clave = f"{meses_nombres[month - 1]} {year}"
-                resultados[clave] = 0.0
-
-            # Consultar sumas reales desde la base de datos
-            with self.db_manager.get_connection_context() as conn:
-                cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                cursor.execute(
-                    """
-                    SELECT 
-                        EXTRACT(YEAR FROM fecha_pago) as año,
-                        EXTRACT(MONTH FROM fecha_pago) as mes,
-                        SUM(monto) as total
-                    FROM pagos 
-                    WHERE fecha_pago >= DATE_TRUNC('month', CURRENT_DATE - INTERVAL '11 months')
-                    GROUP BY EXTRACT(YEAR FROM fecha_pago), EXTRACT(MONTH FROM fecha_pago)
-                    ORDER BY año, mes
-                    """
-                )
-                rows = cursor.fetchall() or []
-                for row in rows:
-                    año = int(row['año']) if row.get('año') is not None else hoy.year
-                    mes = int(row['mes']) if row.get('mes') is not None else hoy.month
-                    total = float(row['total'] or 0.0)
-                    clave = f"{meses_nombres[mes - 1]} {año}"
-                    resultados[clave] = total
+            for i in range(12):
+                total_meses = inicio.year * 12 + inicio.month - 1 + i
+                resultados[f"{meses_nombres[total_meses % 12]} {total_meses // 12}"] = 0.0
+            for row in self.db_manager.pagos.obtener_ingresos_mensuales(inicio, hoy):
+                resultados[f"{meses_nombres[row['mes'] - 1]} {row['año']}"] = row['total']
             return resultados
         except Exception:
             return {}
@@ -1,5 +1,8 @@
+import io
 import os
+import hashlib
 import tempfile
+import threading
 from datetime import datetime
 from .models import Pago, Usuario, Rutina, PagoDetalle
 from reportlab.lib.pagesizes import letter
@@ -11,6 +14,38 @@ from reportlab.lib.enums import TA_RIGHT, TA_CENTER, TA_LEFT
 from typing import Optional, List, Dict
 from .utils import get_gym_name
 
+# Recursos compartidos entre renders: hoja de estilos y bytes de logos (por ruta + mtime)
+_ESTILOS = None
+_LOGOS: Dict[str, tuple] = {}
+_RECURSOS_LOCK = threading.Lock()
+
+
+def _estilos_base():
+    global _ESTILOS
+    if _ESTILOS is None:
+        with _RECURSOS_LOCK:
+            if _ESTILOS is None:
+                styles = getSampleStyleSheet()
+                styles.add(ParagraphStyle(name='RightInfo', parent=styles['Normal'], alignment=TA_RIGHT))
+                _ESTILOS = styles
+    return _ESTILOS
+
+
+def _logo_bytes(path: str) -> Optional[bytes]:
+    """Lee el logo una vez por proceso; se relee sólo si cambia su mtime."""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _LOGOS.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        data = f.read()
+    with _RECURSOS_LOCK:
+        _LOGOS[path] = (mtime, data)
+    return data
+
 class PDFGenerator:
     def __init__(self, branding_config=None):
         # Directorios de salida preferidos (permiten override por variable de entorno)
@@ -40,6 +75,26 @@ class PDFGenerator:
         # Usar gym_name del branding si está, sino cargarlo del sistema, con fallback a "Gimnasio"
         self.gym_name = self.branding_config.get('gym_name') or get_gym_name('Gimnasio')
         self.gym_address = self.branding_config.get('gym_address', 'Saavedra 2343, Santa Fe')
+
+    def huella_branding(self) -> str:
+        """Hash de todo lo que el branding aporta al PDF (nombre, dirección, colores y logo)."""
+        logo_mtime = None
+        try:
+            logo_mtime = os.path.getmtime(self.logo_path)
+        except OSError:
+            pass
+        cached = getattr(self, '_huella_branding', None)
+        if cached and cached[0] == logo_mtime:
+            return cached[1]
+        h = hashlib.sha256()
+        h.update(f"{self.gym_name}|{self.gym_address}|{self.logo_path}".encode('utf-8'))
+        for k in sorted(self.branding_config):
+            h.update(f"|{k}={self.branding_config.get(k)}".encode('utf-8'))
+        logo = _logo_bytes(self.logo_path)
+        if logo:
+            h.update(hashlib.sha256(logo).digest())
+        self._huella_branding = (logo_mtime, h.hexdigest()[:16])
+        return self._huella_branding[1]
     
     def _get_dynamic_color(self, color_key, fallback_color):
         """Obtiene un color del sistema de branding dinámico o usa el fallback"""
@@ -58,16 +113,68 @@ class PDFGenerator:
         fecha_str = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"recibo_{pago.id}_{fecha_str}.pdf"
         filepath = os.path.join(self.output_dir_recibos, filename)
+        with open(filepath, 'wb') as f:
+            f.write(self.generar_recibo_bytes(
+                pago, usuario, numero_comprobante, detalles=detalles, totales=totales, observaciones=observaciones,
+                emitido_por=emitido_por, titulo=titulo, gym_name=gym_name, gym_address=gym_address,
+                fecha_emision=fecha_emision, metodo_pago=metodo_pago, usuario_nombre=usuario_nombre,
+                usuario_dni=usuario_dni, detalles_override=detalles_override, mostrar_logo=mostrar_logo,
+                mostrar_metodo=mostrar_metodo, mostrar_dni=mostrar_dni, tipo_cuota=tipo_cuota, periodo=periodo,
+            ))
+        return filepath
 
+    def generar_recibo_bytes(self, pago: Pago, usuario: Usuario, numero_comprobante: str = None, detalles: Optional[List[PagoDetalle]] = None, totales: Optional[Dict[str, float]] = None, observaciones: Optional[str] = None, emitido_por: Optional[str] = None,
+                             titulo: Optional[str] = None, gym_name: Optional[str] = None, gym_address: Optional[str] = None, fecha_emision: Optional[str] = None,
+                             metodo_pago: Optional[str] = None, usuario_nombre: Optional[str] = None, usuario_dni: Optional[str] = None,
+                             detalles_override: Optional[List[Dict]] = None, mostrar_logo: Optional[bool] = True, mostrar_metodo: Optional[bool] = True, mostrar_dni: Optional[bool] = True,
+                             tipo_cuota: Optional[str] = None, periodo: Optional[str] = None) -> bytes:
+        """Renderiza el recibo en memoria (sin tocar disco) y devuelve los bytes del PDF."""
+        buffer = io.BytesIO()
         doc = SimpleDocTemplate(
-            filepath,
+            buffer,
             pagesize=letter,
             rightMargin=inch/2,
             leftMargin=inch/2,
             topMargin=inch/2,
             bottomMargin=inch/2,
         )
-        styles = getSampleStyleSheet()
+        elements = self._elementos_recibo(
+            pago, usuario, numero_comprobante=numero_comprobante, detalles=detalles, totales=totales,
+            observaciones=observaciones, emitido_por=emitido_por, titulo=titulo, gym_name=gym_name,
+            gym_address=gym_address, fecha_emision=fecha_emision, metodo_pago=metodo_pago,
+            usuario_nombre=usuario_nombre, usuario_dni=usuario_dni, detalles_override=detalles_override,
+            mostrar_logo=mostrar_logo, mostrar_metodo=mostrar_metodo, mostrar_dni=mostrar_dni,
+            tipo_cuota=tipo_cuota, periodo=periodo,
+        )
+        doc.build(elements, onFirstPage=self._footer, onLaterPages=self._footer)
+        return buffer.getvalue()
+
+    def generar_recibos_lote_bytes(self, recibos: List[Dict]) -> bytes:
+        """Renderiza varios recibos en un único PDF (uno por página). Cada item son los kwargs de generar_recibo_bytes."""
+        buffer = io.BytesIO()
+        doc = SimpleDocTemplate(
+            buffer,
+            pagesize=letter,
+            rightMargin=inch/2,
+            leftMargin=inch/2,
+            topMargin=inch/2,
+            bottomMargin=inch/2,
+        )
+        elements = []
+        for i, recibo in enumerate(recibos):
+            if i:
+                elements.append(PageBreak())
+            elements.extend(self._elementos_recibo(**recibo))
+        doc.build(elements, onFirstPage=self._footer, onLaterPages=self._footer)
+        return buffer.getvalue()
+
+    def _elementos_recibo(self, pago: Pago, usuario: Usuario, numero_comprobante: str = None, detalles: Optional[List[PagoDetalle]] = None, totales: Optional[Dict[str, float]] = None, observaciones: Optional[str] = None, emitido_por: Optional[str] = None,
+                          titulo: Optional[str] = None, gym_name: Optional[str] = None, gym_address: Optional[str] = None, fecha_emision: Optional[str] = None,
+                          metodo_pago: Optional[str] = None, usuario_nombre: Optional[str] = None, usuario_dni: Optional[str] = None,
+                          detalles_override: Optional[List[Dict]] = None, mostrar_logo: Optional[bool] = True, mostrar_metodo: Optional[bool] = True, mostrar_dni: Optional[bool] = True,
+                          tipo_cuota: Optional[str] = None, periodo: Optional[str] = None) -> list:
+        """Arma los flowables de un recibo; compartido por el render individual y por lote."""
+        styles = _estilos_base()
         elements = []
 
         # Colores consistentes con el branding
@@ -84,13 +191,13 @@ class PDFGenerator:
         except Exception:
             fecha_str_disp = (fecha_emision or datetime.now().strftime('%d/%m/%Y'))
 
-        right_info_style = ParagraphStyle(name='RightInfo', parent=styles['Normal'], alignment=TA_RIGHT)
-        right_info_para = Paragraph(f"Comprobante N°: {recibo_numero}<br/>Fecha: {fecha_str_disp}", right_info_style)
+        right_info_para = Paragraph(f"Comprobante N°: {recibo_numero}<br/>Fecha: {fecha_str_disp}", styles['RightInfo'])
 
         header_data = [['', header_text, right_info_para]]
-        if mostrar_logo is not False and os.path.exists(self.logo_path):
+        logo_data = _logo_bytes(self.logo_path) if mostrar_logo is not False else None
+        if logo_data:
             from reportlab.platypus import Image
-            logo = Image(self.logo_path, width=1*inch, height=1*inch)
+            logo = Image(io.BytesIO(logo_data), width=1*inch, height=1*inch)
             header_data[0][0] = logo
 
         header_table = Table(header_data, colWidths=[1.7*inch, 4.3*inch, 1.5*inch])
@@ -291,8 +398,7 @@ class PDFGenerator:
         elements.append(Paragraph(gym_name_disp, styles['Normal']))
         elements.append(Paragraph(gym_addr_disp, styles['Normal']))
 
-        doc.build(elements, onFirstPage=self._footer, onLaterPages=self._footer)
-        return filepath
+        return elements
 
     def _footer(self, canvas, doc):
         try:
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reminder Pipeline - Envío masivo de recordatorios de cuota por WhatsApp
+
+Etapas: candidatos (1 consulta) -> anti-spam (core/antispam.py, 1 consulta a lo sumo) -> render
+-> encolado en lotes en whatsapp_outbox. El envío lo hace WhatsAppDispatcher
+(core/whatsapp_dispatcher.py), que reparte la tasa por phone_number_id, reintenta y registra
+cada aviso en whatsapp_messages con el message_id real (sent o failed); la idempotency_key
+recordatorio:<modo>:<usuario>:<fecha> evita duplicar el aviso del día si el cron se repite.
+"""
+
+import os
+import time
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from .antispam import MotorAntispam
+from .database.date_ranges import hoy_gym
+
+TEMPLATE_CUOTA_VENCIDA = "aviso_de_vencimiento_de_cuota_gimnasio_para_usuario_especifico_en_sistema_de_management_de_gimnasios_profesional"
+
+# Ventana anti-spam por modo (mismo tipo de mensaje 'overdue' en ambos flujos)
+VENTANA_HORAS_POR_MODO = {'vencidos': 24 * 30, 'por_vencer': 24 * 7}
+
+
+def _env_int(nombre: str, defecto: int) -> int:
+    try:
+        return int(os.getenv(nombre, str(defecto)))
+    except Exception:
+        return defecto
+
+
+class ReminderPipeline:
+    """Recordatorios de cuota vencida / por vencer en bloque.
+
+    Configuración por entorno:
+    - WHATSAPP_LIMITE_TIER_24H: destinatarios distintos por 24 h según el tier de la cuenta.
+    - RECORDATORIOS_LOTE_REGISTRO: mensajes por INSERT en el outbox.
+    La tasa de envío es la del dispatcher (WHATSAPP_OUTBOX_MPS).
+    """
+
+    def __init__(self, db_manager, whatsapp_manager=None, message_logger=None):
+        self.db = db_manager
+        self.whatsapp_manager = whatsapp_manager
+        self.message_logger = message_logger or getattr(whatsapp_manager, 'message_logger', None)
+        self.antispam = getattr(self.message_logger, 'antispam', None) or MotorAntispam(db_manager.whatsapp)
+        self.limite_tier_24h = _env_int('WHATSAPP_LIMITE_TIER_24H', 1000)
+        self.lote_registro = max(1, _env_int('RECORDATORIOS_LOTE_REGISTRO', 200))
+
+    # --- Etapas ---
+
+    def _seleccionar(self, modo: str, dias_anticipacion: int, limite: Optional[int]) -> List[Dict[str, Any]]:
+        return self.db.whatsapp.obtener_candidatos_recordatorio(modo, dias_anticipacion, limite)
+    def _filtrar_antispam(self, candidatos: List[Dict[str, Any]], modo: str,
+                          resultado: Dict[str, Any]) -> List[Dict[str, Any]]:
+        motivos = self.antispam.evaluar(
+            [c['telefono'] for c in candidatos], 'overdue', VENTANA_HORAS_POR_MODO.get(modo, 24)
+        )
+        aptos, vistos = [], set()
+        for c in candidatos:
+            tel = str(c.get('telefono') or '').strip()
+            if not tel:
+                resultado['sin_telefono'] += 1
+                continue
+            if tel in vistos:
+                resultado['omitidos']['telefono_repetido'] = resultado['omitidos'].get('telefono_repetido', 0) + 1
+                continue
+            vistos.add(tel)
+            if self.whatsapp_manager is not None and not self.whatsapp_manager._numero_permitido(tel):
+                motivo = 'allowlist'
+            else:
+                motivo = motivos.get(tel)
+            if motivo:
+                resultado['omitidos'][motivo] = resultado['omitidos'].get(motivo, 0) + 1
+                continue
+            aptos.append(c)
+        return aptos
+
+    @staticmethod
+    def _renderizar(candidatos: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        mensajes = []
+        for c in candidatos:
+            venc = c.get('fecha_vencimiento')
+            venc_txt = venc.strftime('%d/%m/%Y') if hasattr(venc, 'strftime') else str(venc or 'No disponible')
+            monto_txt = f"{float(c.get('monto') or 0):,.0f}"
+            mensajes.append({
+                'usuario_id': c['id'],
+                'telefono': str(c['telefono']).strip(),
+                'params': [c.get('nombre') or '', venc_txt, monto_txt],
+                'contenido': f"Recordatorio cuota vencida - {c.get('nombre') or ''}",
+            })
+        return mensajes
+
+    def _encolar(self, mensajes: List[Dict[str, Any]], modo: str) -> int:
+        """Encola un lote en el outbox y devuelve cuántos avisos eran nuevos.
+
+        Solo los insertados en esta llamada cuentan para el anti-spam en memoria; el registro en
+        whatsapp_messages lo hace el dispatcher al enviar (ver PREFIJOS_REGISTRO_AL_ENVIAR).
+        """
+        from pywa.types.templates import TemplateLanguage
+        wm = self.whatsapp_manager
+        phone_number_id = str(wm.phone_number_id or '').strip()
+        fecha = hoy_gym().isoformat()
+        envios = []
+        for m in mensajes:
+            m['clave'] = f"recordatorio:{modo}:{m['usuario_id']}:{fecha}"
+            envios.append({
+                'idempotency_key': m['clave'], 'phone_number_id': phone_number_id, 'telefono': m['telefono'],
+                'payload': wm._payload_plantilla(TEMPLATE_CUOTA_VENCIDA, TemplateLanguage.SPANISH_ARG, m['params']),
+                'user_id': m['usuario_id'], 'message_type': 'overdue', 'contenido': m['contenido'],
+            })
+        nuevas = self.db.whatsapp.encolar_outbox_claves(envios)
+        for m in mensajes:
+            if m['clave'] in nuevas:
+                self.antispam.registrar(m['telefono'], 'overdue')
+        return len(nuevas)
+
+    # --- Orquestación ---
+
+    def ejecutar(self, modo: str = 'vencidos', dias_anticipacion: int = 3, dry_run: bool = False,
+                 limite: Optional[int] = None,
+                 on_progreso: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """Ejecuta el pipeline. `modo`: 'vencidos' | 'por_vencer'.
+
+        Con `dry_run` no encola ni registra: devuelve cuántos se encolarían y una muestra.
+        `on_progreso` recibe el resultado parcial después de cada lote encolado.
+        `duplicados` cuenta los avisos que ya estaban en el outbox con la misma clave del día.
+        """
+        if modo not in VENTANA_HORAS_POR_MODO:
+            raise ValueError("modo debe ser 'vencidos' o 'por_vencer'")
+        inicio = time.monotonic()
+        resultado: Dict[str, Any] = {
+            'modo': modo, 'dry_run': bool(dry_run), 'candidatos': 0, 'aptos': 0, 'sin_telefono': 0,
+            'omitidos': {}, 'encolados': 0, 'duplicados': 0, 'duracion_s': 0.0,
+        }
+
+        candidatos = self._seleccionar(modo, dias_anticipacion, limite)
+        resultado['candidatos'] = len(candidatos)
+        aptos = self._filtrar_antispam(candidatos, modo, resultado)
+        mensajes = self._renderizar(aptos)
+        resultado['aptos'] = len(mensajes)
+
+        cupo_tier = max(self.limite_tier_24h - self.db.whatsapp.contar_destinatarios_24h(), 0)
+        if len(mensajes) > cupo_tier:
+            resultado['omitidos']['limite_tier'] = len(mensajes) - cupo_tier
+            mensajes = mensajes[:cupo_tier]
+
+        if dry_run:
+            resultado['encolados_estimados'] = len(mensajes)
+            resultado['muestra'] = [{'usuario_id': m['usuario_id'], 'telefono': m['telefono'], 'params': m['params']}
+                                    for m in mensajes[:20]]
+            resultado['duracion_s'] = round(time.monotonic() - inicio, 3)
+            return resultado
+
+        if mensajes and (self.whatsapp_manager is None or not self.whatsapp_manager.access_token
+                         or not str(self.whatsapp_manager.phone_number_id or '').strip()):
+            raise RuntimeError("WhatsApp no configurado (access_token / phone_id)")
+
+        for i in range(0, len(mensajes), self.lote_registro):
+            lote = mensajes[i:i + self.lote_registro]
+            nuevos = self._encolar(lote, modo)
+            resultado['encolados'] += nuevos
+            resultado['duplicados'] += len(lote) - nuevos
+            resultado['duracion_s'] = round(time.monotonic() - inicio, 3)
+            if on_progreso:
+                try:
+                    on_progreso(dict(resultado))
+                except Exception:
+                    pass
+        logging.info(f"Recordatorios {modo}: {resultado['encolados']} encolados de {resultado['aptos']} aptos")
+
+        if resultado['encolados']:
+            from .whatsapp_dispatcher import despachar_en_segundo_plano
+            despachar_en_segundo_plano(self.whatsapp_manager._crear_dispatcher)
+        resultado['duracion_s'] = round(time.monotonic() - inicio, 3)
+        return resultado
@@ -4,3 +4,9 @@ from .gym_service import GymService
 from .attendance_service import AttendanceService
 from .teacher_service import TeacherService
 from .admin_service import AdminService
+from .receipt_service import ReceiptService
+from .receipt_batch_service import ReceiptBatchService
+from .receipt_numbering_service import ReceiptNumberingService
+from .catalog_service import CatalogService
+from .payment_export_service import PaymentExportService
+from .whatsapp_retention_service import WhatsappRetentionService
@@ -1,13 +1,16 @@
+import os
 from typing import List, Optional, Dict, Any
 from datetime import date, datetime
 from sqlalchemy.orm import Session
 from core.services.base import BaseService
 from core.database.repositories.attendance_repository import AttendanceRepository
+from core.database.repositories.attendance_partition_repository import AttendancePartitionRepository
 
 class AttendanceService(BaseService):
     def __init__(self, db: Session = None):
         super().__init__(db)
         self.attendance_repo = AttendanceRepository(self.db, None, None)
+        self.partition_repo = AttendancePartitionRepository(self.db, None, None)
 
     def register_attendance(self, user_id: int, attendance_date: Optional[date] = None) -> int:
         return self.attendance_repo.registrar_asistencia(user_id, attendance_date)
@@ -26,3 +29,93 @@ class AttendanceService(BaseService):
 
     def validate_checkin_token(self, token: str, user_id: int):
         return self.attendance_repo.validar_token_y_registrar_asistencia(token, user_id)
+
+    def get_daily_series(self, start: Optional[str] = None, end: Optional[str] = None, days: int = 30):
+        if start and end:
+            return self.attendance_repo.obtener_asistencias_por_rango_diario(start, end)
+        return self.attendance_repo.obtener_asistencias_por_dia(days)
+
+    def get_hourly_series(self, start: Optional[str] = None, end: Optional[str] = None, days: int = 30):
+        return self.attendance_repo.obtener_asistencias_por_hora(days, start, end)
+
+    def rebuild_rollups(self, since: Optional[date] = None) -> Dict[str, int]:
+        return self.attendance_repo.reconstruir_rollups_asistencias(since)
+
+    def register_class_roll_call(self, class_schedule_id: int, user_ids: List[int], class_date: Optional[date] = None,
+                                 registered_by: Optional[int] = None, allow_not_enrolled: bool = False,
+                                 mark_absent: bool = False) -> Dict[str, Any]:
+        return self.attendance_repo.registrar_pase_lista_clase(
+            class_schedule_id, user_ids, class_date, registered_by,
+            permitir_no_inscriptos=allow_not_enrolled, marcar_ausentes=mark_absent
+        )
+
+    def replay_offline_checkins(self, scans: List[Dict[str, Any]], reject_expired: bool = True) -> Dict[str, Any]:
+        return self.attendance_repo.procesar_checkins_offline(scans, rechazar_vencidos=reject_expired)
+
+    def list_partitions(self) -> Dict[str, Any]:
+        return {
+            'particionada': self.partition_repo.esta_particionada(),
+            'particiones': self.partition_repo.listar_particiones(),
+            'archivos': self.partition_repo.obtener_archivos(),
+        }
+
+    def _archive_writer(self, destination: str, local_dir: Optional[str], prefix: Optional[str]):
+        prefix = prefix or os.getenv('ASISTENCIAS_ARCHIVO_PREFIJO', 'asistencias')
+        if destination == 'local':
+            directory = local_dir or os.getenv('ASISTENCIAS_ARCHIVO_DIR', 'archivos_asistencias')
+            os.makedirs(directory, exist_ok=True)
+
+            def guardar(datos: bytes, nombre: str) -> Optional[str]:
+                ruta = os.path.join(directory, f"{prefix}_{nombre}")
+                with open(ruta, 'wb') as f:
+                    f.write(datos)
+                return ruta
+            return guardar
+
+        from core.services.storage_service import StorageService
+        storage = StorageService()
+
+        def subir(datos: bytes, nombre: str) -> Optional[str]:
+            return storage.upload_file(datos, f"{prefix}_{nombre}", 'application/gzip', subfolder='archivos_asistencias')
+        return subir
+
+    def maintain_partitions(self, future_months: int = 3, retention_months: Optional[int] = None,
+                            destination: Optional[str] = None, local_dir: Optional[str] = None,
+                            prefix: Optional[str] = None) -> Dict[str, Any]:
+        """Crea particiones futuras y archiva (exporta y elimina) las más viejas que la retención."""
+        if not self.partition_repo.esta_particionada():
+            return {'particionada': False, 'creadas': [], 'archivadas': [], 'fallidas': []}
+        retention_months = int(retention_months or os.getenv('ASISTENCIAS_RETENCION_MESES', '24'))
+        destination = (destination or os.getenv('ASISTENCIAS_ARCHIVO_DESTINO', 'b2')).lower()
+        if destination not in ('b2', 'local'):
+            raise ValueError("destino debe ser 'b2' o 'local'")
+        creadas = self.partition_repo.crear_particiones_futuras(future_months)
+        guardar = self._archive_writer(destination, local_dir, prefix)
+        archivadas, fallidas = [], []
+        for particion in self.partition_repo.particiones_a_archivar(retention_months):
+            res = self.partition_repo.archivar_particion(particion, destination, guardar)
+            if res:
+                archivadas.append(res)
+            else:
+                fallidas.append(particion['particion'])
+        return {'particionada': True, 'creadas': creadas, 'archivadas': archivadas, 'fallidas': fallidas}
+
+    def migrate_to_partitioned(self, batch_size: int = 20000, max_batches: Optional[int] = None,
+                               future_months: int = 3) -> Dict[str, Any]:
+        """Migra `asistencias` a tabla particionada por lotes; se puede reanudar con llamadas sucesivas."""
+        if self.partition_repo.esta_particionada():
+            return {'estado': 'particionada', 'copiadas': 0}
+        self.partition_repo.preparar_migracion(future_months)
+        copiadas, lotes, cursor = 0, 0, None
+        while True:
+            if max_batches is not None and lotes >= int(max_batches):
+                return {'estado': 'en_progreso', 'copiadas': copiadas, 'lotes': lotes}
+            filas, siguiente = self.partition_repo.copiar_lote_migracion(batch_size, cursor)
+            copiadas += filas
+            lotes += 1
+            # Sin filas por leer, o un lote que no avanzó el cursor: pasar al remanente
+            if siguiente is None or (cursor is not None and siguiente <= cursor):
+                break
+            cursor = siguiente
+        res = self.partition_repo.finalizar_migracion()
+        return {'estado': 'particionada', 'copiadas': copiadas + res['remanente'], 'lotes': lotes, **res}
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional
+from sqlalchemy.orm import Session
+from core.services.base import BaseService
+from core.database.repositories.payment_repository import PaymentRepository
+
+CATALOGOS = ('tipos_cuota', 'metodos_pago', 'conceptos_pago')
+
+
+def _revalidar_seg() -> float:
+    try:
+        return float(os.getenv('CATALOGOS_REVALIDAR_SEG', '30'))
+    except Exception:
+        return 30.0
+
+
+class _Catalogos:
+    """Copia en memoria de los catálogos de un tenant, con la versión con la que se cargó."""
+
+    def __init__(self, version: int, datos: Dict[str, List[Dict[str, Any]]]):
+        self.version = version
+        self.datos = datos
+        self.verificado = time.monotonic()
+        self.etags = {
+            nombre: hashlib.sha1(json.dumps(items, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+            for nombre, items in datos.items()
+        }
+        self.etags['bundle'] = hashlib.sha1(''.join(self.etags[n] for n in CATALOGOS).encode('ascii')).hexdigest()[:16]
+        self.metodos_por_id = {int(m['id']): m for m in datos['metodos_pago']}
+
+
+# Un juego de catálogos por tenant (o por base si no hay tenant en contexto)
+_CACHE: Dict[str, _Catalogos] = {}
+_CACHE_LOCK = threading.Lock()
+
+
+class CatalogService(BaseService):
+    """Tipos de cuota, métodos y conceptos de pago servidos desde memoria.
+
+    Los catálogos cambian pocas veces al año: se cargan completos (activos e inactivos) y se
+    revalidan contra configuracion['catalogos_version'] como mucho cada CATALOGOS_REVALIDAR_SEG
+    (30 por defecto). Las escrituras pasan por este servicio, que incrementa la versión en la
+    misma transacción y descarta la copia local; otras instancias la ven al revalidar.
+    """
+
+    def __init__(self, db: Session = None, tenant: Optional[str] = None):
+        super().__init__(db)
+        self.tenant = tenant
+        self.payment_repo = PaymentRepository(self.db, None, None)
+
+    def _clave(self) -> str:
+        if self.tenant:
+            return str(self.tenant)
+        try:
+            return str(self.db.get_bind().url)
+        except Exception:
+            return ''
+
+    def _cargar(self) -> _Catalogos:
+        version = self.payment_repo.obtener_version_catalogos()
+        datos = {
+            'tipos_cuota': self.payment_repo.obtener_tipos_cuota(solo_activos=False),
+            'metodos_pago': [
+                {k: v for k, v in m.items() if k != 'fecha_creacion'}
+                for m in self.payment_repo.obtener_metodos_pago(solo_activos=False)
+            ],
+            'conceptos_pago': [
+                {k: v for k, v in c.items() if k != 'fecha_creacion'}
+                for c in self.payment_repo.obtener_conceptos_pago(solo_activos=False)
+            ],
+        }
+        return _Catalogos(version, datos)
+
+    def _actual(self) -> _Catalogos:
+        clave = self._clave()
+        with _CACHE_LOCK:
+            entrada = _CACHE.get(clave)
+        if entrada is not None:
+            if time.monotonic() - entrada.verificado < _revalidar_seg():
+                return entrada
+            if self.payment_repo.obtener_version_catalogos() == entrada.version:
+                entrada.verificado = time.monotonic()
+                return entrada
+        entrada = self._cargar()
+        with _CACHE_LOCK:
+            _CACHE[clave] = entrada
+        return entrada
+
+    def invalidate(self) -> None:
+        with _CACHE_LOCK:
+            _CACHE.pop(self._clave(), None)
+
+    # --- Lectura ---
+
+    def get_bundle(self) -> Dict[str, Any]:
+        entrada = self._actual()
+        return dict(entrada.datos, version=entrada.version)
+
+    def get_catalog(self, name: str, only_active: bool = False) -> List[Dict[str, Any]]:
+        items = self._actual().datos[name]
+        return [i for i in items if i.get('activo')] if only_active else list(items)
+
+    def etag(self, name: str = 'bundle') -> str:
+        entrada = self._actual()
+        return f'W/"cat-{entrada.version}-{entrada.etags[name]}"'
+
+    def get_payment_method(self, method_id: Optional[int]) -> Optional[Dict[str, Any]]:
+        if not method_id:
+            return None
+        return self._actual().metodos_por_id.get(int(method_id))
+
+    def get_totals_with_commission(self, subtotal: float, method_id: Optional[int]) -> Dict[str, float]:
+        """Subtotal, comisión (porcentaje del método si está activo) y total, redondeados a 2 decimales."""
+        base = float(subtotal or 0.0)
+        metodo = self.get_payment_method(method_id)
+        pct = float(metodo.get('comision') or 0.0) if (metodo and metodo.get('activo')) else 0.0
+        comision = round(base * pct / 100.0, 2) if pct > 0 else 0.0
+        return {'subtotal': round(base, 2), 'comision': comision, 'total': round(base + comision, 2)}
+
+    # --- Escritura (invalida) ---
+
+    def create_item(self, name: str, data: Dict[str, Any]) -> int:
+        try:
+            return self.payment_repo.crear_item_catalogo(name, data)
+        finally:
+            self.invalidate()
+
+    def update_item(self, name: str, item_id: int, data: Dict[str, Any]) -> bool:
+        try:
+            return self.payment_repo.actualizar_item_catalogo(name, item_id, data)
+        finally:
+            self.invalidate()
+
+    def delete_item(self, name: str, item_id: int) -> bool:
+        try:
+            return self.payment_repo.eliminar_item_catalogo(name, item_id)
+        finally:
+            self.invalidate()
@@ -0,0 +1,151 @@
+import io
+import os
+import csv
+import logging
+import tempfile
+from datetime import date, datetime
+from typing import Any, Dict, Iterator, List, Optional
+from sqlalchemy.orm import Session
+from core.services.base import BaseService
+from core.database.repositories.payment_repository import PaymentRepository
+
+logger = logging.getLogger(__name__)
+
+FORMATOS = ('csv', 'xlsx')
+# (clave en la fila de PaymentRepository.iterar_pagos_exportacion, encabezado, ancho en Excel)
+COLUMNAS = (
+    ('id', 'ID Pago', 10),
+    ('fecha_pago', 'Fecha de Pago', 14),
+    ('usuario_id', 'ID Usuario', 10),
+    ('usuario_nombre', 'Nombre Usuario', 30),
+    ('dni', 'DNI', 14),
+    ('tipo_cuota', 'Tipo de Cuota', 18),
+    ('mes', 'Mes', 6),
+    ('año', 'Año', 8),
+    ('metodo_pago', 'Método de Pago', 18),
+    ('concepto_pago', 'Concepto', 30),
+    ('monto', 'Monto', 14),
+)
+CHUNK = 256 * 1024
+
+
+def _env_int(nombre: str, defecto: int) -> int:
+    try:
+        return int(os.getenv(nombre, str(defecto)))
+    except Exception:
+        return defecto
+
+
+def _valor(clave: str, valor: Any) -> Any:
+    if clave == 'fecha_pago' and isinstance(valor, datetime):
+        return valor.date()
+    if clave == 'monto':
+        return float(valor or 0)
+    return valor
+
+
+class PaymentExportService(BaseService):
+    """Exportación del historial de pagos a CSV o XLSX sin cargarlo entero en memoria.
+
+    Las filas llegan por lotes desde un cursor del lado del servidor (EXPORTACION_LOTE filas,
+    2000 por defecto) con usuario, método y concepto ya resueltos en la consulta. El CSV se
+    emite lote a lote; el XLSX se escribe con openpyxl en modo write-only a un archivo temporal
+    que pasa a disco por encima de EXPORTACION_MEMORIA_MB (8 por defecto) y se emite al cerrar
+    el libro, porque el contenedor zip recién es válido al final.
+    """
+
+    def __init__(self, db: Session = None):
+        super().__init__(db)
+        self.payment_repo = PaymentRepository(self.db, None, None)
+        self.batch_size = max(100, _env_int('EXPORTACION_LOTE', 2000))
+        self.spool_bytes = max(1, _env_int('EXPORTACION_MEMORIA_MB', 8)) * 1024 * 1024
+
+    def _lotes(self, filters: Dict[str, Any]) -> Iterator[List[List[Any]]]:
+        for filas in self.payment_repo.iterar_pagos_exportacion(tamano_lote=self.batch_size, **filters):
+            yield [[_valor(clave, fila.get(clave)) for clave, _, _ in COLUMNAS] for fila in filas]
+
+    def _csv(self, filters: Dict[str, Any]) -> Iterator[bytes]:
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow([titulo for _, titulo, _ in COLUMNAS])
+        # BOM: Excel abre el CSV como UTF-8 (mismo criterio que ExportManager.exportar_usuarios_csv)
+        yield buf.getvalue().encode('utf-8-sig')
+        for lote in self._lotes(filters):
+            buf.seek(0)
+            buf.truncate()
+            writer.writerows(
+                [v.strftime('%Y-%m-%d') if isinstance(v, date) else v for v in fila] for fila in lote
+            )
+            yield buf.getvalue().encode('utf-8')
+
+    def _xlsx(self, filters: Dict[str, Any], period_label: Optional[str] = None) -> Iterator[bytes]:
+        try:
+            from openpyxl import Workbook
+            from openpyxl.utils import get_column_letter
+        except ImportError:
+            raise RuntimeError("openpyxl no está instalado: no se puede exportar a Excel")
+        wb = Workbook(write_only=True)
+        # Resumen primero en el libro, pero se completa al final con los totales acumulados
+        ws_resumen = wb.create_sheet('Resumen')
+        ws_resumen.column_dimensions['A'].width = 30
+        ws_resumen.column_dimensions['B'].width = 25
+        ws_detalle = wb.create_sheet('Detalle de Pagos')
+        for i, (_, _, ancho) in enumerate(COLUMNAS, start=1):
+            ws_detalle.column_dimensions[get_column_letter(i)].width = ancho
+        ws_detalle.append([titulo for _, titulo, _ in COLUMNAS])
+        total, cantidad = 0.0, 0
+        for lote in self._lotes(filters):
+            for fila in lote:
+                ws_detalle.append(fila)
+                total += fila[-1]
+            cantidad += len(lote)
+        ws_resumen.append(['Concepto', 'Valor'])
+        ws_resumen.append(['Período del Reporte', period_label or self._periodo(filters)])
+        ws_resumen.append(['Total de Ingresos', f"${total:,.2f} ARS"])
+        ws_resumen.append(['Cantidad de Pagos', cantidad])
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_bytes, prefix='pagos_export_') as spool:
+            wb.save(spool)
+            spool.seek(0)
+            while True:
+                chunk = spool.read(CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+
+    @staticmethod
+    def _periodo(filters: Dict[str, Any]) -> str:
+        desde, hasta = filters.get('desde'), filters.get('hasta')
+        if not desde and not hasta:
+            return 'Todo el historial'
+        return f"{desde.isoformat() if desde else '…'} a {hasta.isoformat() if hasta else 'hoy'}"
+
+    def iter_export(self, fmt: str, filters: Dict[str, Any], period_label: Optional[str] = None) -> Iterator[bytes]:
+        """Bytes del archivo exportado, a medida que se generan. No cierra la sesión."""
+        if fmt not in FORMATOS:
+            raise ValueError("formato debe ser 'csv' o 'xlsx'")
+        if fmt == 'csv':
+            return self._csv(filters)
+        return self._xlsx(filters, period_label)
+
+    def write_file(self, path: str, fmt: str, filters: Dict[str, Any], period_label: Optional[str] = None) -> str:
+        with open(path, 'wb') as f:
+            for chunk in self.iter_export(fmt, filters, period_label):
+                f.write(chunk)
+        return path
+
+    def stream(self, fmt: str, filters: Dict[str, Any]) -> Iterator[bytes]:
+        """Generador para StreamingResponse; el servicio es dueño de su sesión y la cierra al terminar."""
+        try:
+            yield from self.iter_export(fmt, filters)
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            # Los encabezados ya salieron: sólo queda cortar la descarga y dejar registro
+            logger.error(f"Error exportando pagos ({fmt}): {e}")
+            raise
+        finally:
+            try:
+                self.db.rollback()
+            except Exception:
+                pass
+            self.close()
@@ -14,3 +14,29 @@ class PaymentService(BaseService):
 
     def register_payments_batch(self, items: List[Dict[str, Any]], skip_duplicates: bool = False) -> Dict[str, Any]:
         return self.payment_repo.registrar_pagos_batch(items, skip_duplicates=skip_duplicates)
+
+    def recalculate_membership_states(self, user_ids: Optional[List[int]] = None,
+                                      only_active: bool = False) -> List[Dict[str, Any]]:
+        return self.payment_repo.recalcular_estados_usuarios(user_ids, solo_activos=only_active)
+
+    def import_payments(self, items: List[Dict[str, Any]], skip_duplicates: bool = False,
+                        auto_create_methods: bool = False) -> Dict[str, Any]:
+        return self.payment_repo.importar_pagos_masivo(
+            items, skip_duplicates=skip_duplicates, auto_crear_metodos_pago=auto_create_methods
+        )
+
+    def search_payments(self, cursor: Optional[str] = None, limit: int = 50, total: Optional[str] = None,
+                        q: Optional[str] = None, **filters) -> Dict[str, Any]:
+        return self.payment_repo.buscar_pagos(cursor=cursor, limite=limit, total=total, q=q, **filters)
+
+    def get_monthly_revenue(self, since: date, until: date) -> List[Dict[str, Any]]:
+        return self.payment_repo.obtener_ingresos_mensuales(since, until)
+
+    def get_revenue_breakdown(self, year: int, month: int) -> List[Dict[str, Any]]:
+        return self.payment_repo.obtener_desglose_ingresos(year, month)
+
+    def verify_revenue_summary(self, since: Optional[date] = None) -> List[Dict[str, Any]]:
+        return self.payment_repo.verificar_resumen_ingresos(since)
+
+    def rebuild_revenue_summary(self, since: Optional[date] = None) -> Dict[str, int]:
+        return self.payment_repo.reconstruir_resumen_ingresos(since)
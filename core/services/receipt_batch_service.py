@@ -0,0 +1,331 @@
+import io
+import os
+import uuid
+import atexit
+import time
+import logging
+import tempfile
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional
+from sqlalchemy.orm import Session
+from core.services.base import BaseService
+from core.services.receipt_service import ReceiptService
+from core.database.repositories.payment_repository import PaymentRepository
+
+logger = logging.getLogger(__name__)
+
+FORMATOS = ('zip', 'pdf')
+# Trabajos terminados se conservan este tiempo para consultar el resultado/progreso
+TRABAJO_TTL = 3600
+
+
+def _env_int(nombre: str, defecto: int) -> int:
+    try:
+        return int(os.getenv(nombre, str(defecto)))
+    except Exception:
+        return defecto
+
+
+# --- Worker (proceso hijo): sin acceso a la base, sólo render ---
+
+# Generadores por branding: el pool se comparte entre pedidos (y bases), cada tarea trae el suyo
+_GENERADORES: Dict[str, Any] = {}
+
+
+def _generador(branding: Dict[str, Any]):
+    clave = repr(sorted(branding.items()))
+    gen = _GENERADORES.get(clave)
+    if gen is None:
+        from core.pdf_generator import PDFGenerator
+        if len(_GENERADORES) >= 32:
+            _GENERADORES.clear()
+        gen = _GENERADORES[clave] = PDFGenerator(branding)
+    return gen
+
+
+def _kwargs_recibo(item: Dict[str, Any]) -> Dict[str, Any]:
+    pago = SimpleNamespace(
+        id=item['id'], usuario_id=item['usuario_id'], monto=item['monto'], mes=item['mes'],
+        año=item['año'], fecha_pago=item['fecha_pago'], metodo_pago_id=item.get('metodo_pago_id'),
+        # Con el nombre ya resuelto el generador no consulta metodos_pago
+        metodo_pago_nombre=item.get('metodo_pago_nombre') or 'No especificado',
+    )
+    usuario = SimpleNamespace(
+        id=item['usuario_id'], nombre=item.get('usuario_nombre') or '',
+        dni=item.get('usuario_dni'), tipo_cuota=item.get('tipo_cuota'),
+    )
+    detalles = [SimpleNamespace(**d) for d in item.get('detalles') or []]
+    return {
+        'pago': pago, 'usuario': usuario, 'numero_comprobante': item.get('numero_comprobante') or str(item['id']),
+        'detalles': detalles, 'totales': item.get('totales'),
+    }
+
+
+def _render_tarea(formato: str, items: List[Dict[str, Any]], branding: Dict[str, Any]):
+    """Renderiza una tarea del lote. 'zip': [(nombre, bytes)]; 'pdf': bytes de un PDF multipágina."""
+    generador = _generador(branding)
+    if formato == 'pdf':
+        return generador.generar_recibos_lote_bytes([_kwargs_recibo(i) for i in items])
+    salida = []
+    for item in items:
+        kw = _kwargs_recibo(item)
+        nombre = f"recibo_{kw['numero_comprobante']}_{item['id']}.pdf".replace('/', '-')
+        salida.append((nombre, generador.generar_recibo_bytes(**kw)))
+    return salida
+
+
+class _SalidaZip:
+    """Destino sin seek para zipfile: acumula lo escrito hasta que el generador lo vacía."""
+
+    def __init__(self):
+        self._partes: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._partes.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def vaciar(self) -> bytes:
+        data = b''.join(self._partes)
+        self._partes.clear()
+        return data
+
+
+class _EjecutorSecuencial:
+    """Sustituto de ProcessPoolExecutor donde no hay multiprocessing (p.ej. Lambda sin /dev/shm)."""
+
+    def submit(self, fn, *args):
+        return SimpleNamespace(result=lambda: fn(*args), cancel=lambda: False)
+
+
+# Pool de procesos del proceso servidor: se crea la primera vez y lo reutilizan todos los
+# pedidos (arrancar workers spawn e importar ReportLab cuesta más que un lote chico).
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_WORKERS = 0
+_POOL_LOCK = threading.Lock()
+
+
+def _pool(workers: int):
+    """Pool compartido con `workers` procesos; si no hay multiprocessing, render secuencial."""
+    global _POOL, _POOL_WORKERS
+    if workers <= 1:
+        return _EjecutorSecuencial()
+    with _POOL_LOCK:
+        # Un worker caído deja el pool roto: se reemplaza en el pedido siguiente
+        if _POOL is not None and (_POOL_WORKERS != workers or getattr(_POOL, '_broken', False)):
+            _POOL.shutdown(wait=False, cancel_futures=True)
+            _POOL = None
+        if _POOL is None:
+            try:
+                import multiprocessing
+                # spawn: el servidor tiene hilos vivos y fork los copiaría a medio estado
+                _POOL = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+                _POOL_WORKERS = workers
+            except (OSError, NotImplementedError, ImportError) as e:
+                logger.warning(f"Recibos en lote sin pool de procesos, render secuencial: {e}")
+                return _EjecutorSecuencial()
+        return _POOL
+
+
+@atexit.register
+def _cerrar_pool() -> None:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(wait=False, cancel_futures=True)
+            _POOL = None
+
+
+class _Cancelado(Exception):
+    pass
+
+
+class TrabajoRecibos:
+    """Estado de un lote en curso; compartido entre la descarga y los endpoints de progreso/cancelación."""
+
+    def __init__(self, formato: str, total: int, job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.formato = formato
+        self.total = int(total)
+        self.hechos = 0
+        self.estado = 'pendiente'
+        self.error: Optional[str] = None
+        self.creado = time.time()
+        self.terminado: Optional[float] = None
+        self.cancelado = threading.Event()
+
+    def finalizar(self, estado: str, error: Optional[str] = None) -> None:
+        self.estado = estado
+        self.error = error
+        self.terminado = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'job_id': self.id, 'formato': self.formato, 'estado': self.estado,
+            'total': self.total, 'hechos': self.hechos,
+            'progreso': round(self.hechos * 100.0 / self.total, 1) if self.total else 100.0,
+            'error': self.error,
+        }
+
+
+# Registro en memoria del proceso: en serverless el progreso sólo es visible desde la misma instancia
+_TRABAJOS: Dict[str, TrabajoRecibos] = {}
+_TRABAJOS_LOCK = threading.Lock()
+
+
+class ReceiptBatchService(BaseService):
+    """Emisión de recibos en bloque (ZIP con un PDF por pago o un único PDF combinado).
+
+    Los datos se cargan por lotes paginados desde PaymentRepository y el render corre en un
+    pool de procesos compartido (ReportLab es CPU y retiene el GIL). Se mantiene una ventana
+    acotada de tareas en vuelo y la salida se emite a medida que avanza, así la memoria no
+    crece con el tamaño del lote. El PDF combinado sí arma el documento entero antes de
+    emitirlo, por eso tiene tope (RECIBOS_LOTE_PDF_MAX); más allá, ZIP.
+    Configuración: RECIBOS_LOTE_WORKERS, RECIBOS_LOTE_POR_TAREA, RECIBOS_LOTE_PDF_MAX.
+
+    El servicio es dueño de su sesión (la descarga sobrevive a la request) y la cierra al terminar.
+    """
+
+    def __init__(self, db: Session = None, tenant: Optional[str] = None):
+        super().__init__(db)
+        self.tenant = tenant
+        self.payment_repo = PaymentRepository(self.db, None, None)
+        self.workers = max(1, _env_int('RECIBOS_LOTE_WORKERS', os.cpu_count() or 1))
+        self.por_tarea = max(1, _env_int('RECIBOS_LOTE_POR_TAREA', 25))
+        self.pdf_max = max(1, _env_int('RECIBOS_LOTE_PDF_MAX', 2000))
+
+    # --- Registro de trabajos ---
+
+    @staticmethod
+    def get_job(job_id: str) -> Optional[TrabajoRecibos]:
+        return _TRABAJOS.get(job_id)
+
+    @staticmethod
+    def cancel_job(job_id: str) -> bool:
+        trabajo = _TRABAJOS.get(job_id)
+        if trabajo is None:
+            return False
+        trabajo.cancelado.set()
+        return True
+
+    @staticmethod
+    def _purgar_trabajos() -> None:
+        limite = time.time() - TRABAJO_TTL
+        with _TRABAJOS_LOCK:
+            for job_id in [k for k, t in _TRABAJOS.items() if t.terminado and t.terminado < limite]:
+                _TRABAJOS.pop(job_id, None)
+
+    def start_job(self, formato: str, filtro: Dict[str, Any], job_id: Optional[str] = None) -> TrabajoRecibos:
+        if formato not in FORMATOS:
+            raise ValueError("formato debe ser 'zip' o 'pdf'")
+        if job_id and job_id in _TRABAJOS and _TRABAJOS[job_id].terminado is None:
+            raise ValueError("job_id en uso")
+        self._purgar_trabajos()
+        trabajo = TrabajoRecibos(formato, self.payment_repo.contar_pagos_recibos(**filtro), job_id)
+        if formato == 'pdf' and trabajo.total > self.pdf_max:
+            raise ValueError(f"El PDF combinado admite hasta {self.pdf_max} recibos ({trabajo.total} pedidos): usar formato 'zip'")
+        with _TRABAJOS_LOCK:
+            _TRABAJOS[trabajo.id] = trabajo
+        return trabajo
+
+    # --- Render ---
+
+    def _branding(self) -> Dict[str, Any]:
+        gen = ReceiptService(self.db, self.tenant).get_generator()
+        return dict(gen.branding_config, gym_name=gen.gym_name, gym_address=gen.gym_address,
+                    main_logo_path=gen.logo_path)
+
+    def _tareas(self, filtro: Dict[str, Any]) -> Iterator[List[Dict[str, Any]]]:
+        for lote in self.payment_repo.iterar_pagos_recibos(**filtro):
+            for i in range(0, len(lote), self.por_tarea):
+                yield lote[i:i + self.por_tarea]
+
+    def _resultados(self, trabajo: TrabajoRecibos, filtro: Dict[str, Any]) -> Iterator[Any]:
+        """Resultados de las tareas en orden, con como mucho 2 tareas en vuelo por worker."""
+        ejecutor = _pool(self.workers)
+        branding = self._branding()
+        en_vuelo = deque()
+        tareas = self._tareas(filtro)
+        try:
+            agotado = False
+            while en_vuelo or not agotado:
+                while not agotado and len(en_vuelo) < self.workers * 2:
+                    items = next(tareas, None)
+                    if items is None:
+                        agotado = True
+                        break
+                    en_vuelo.append((len(items), ejecutor.submit(_render_tarea, trabajo.formato, items, branding)))
+                if not en_vuelo:
+                    break
+                if trabajo.cancelado.is_set():
+                    raise _Cancelado()
+                n, futuro = en_vuelo.popleft()
+                resultado = futuro.result()
+                trabajo.hechos += n
+                yield resultado
+        finally:
+            # El pool sigue vivo para otros pedidos: sólo se descartan las tareas de éste
+            for _, futuro in en_vuelo:
+                futuro.cancel()
+
+    def _zip(self, trabajo: TrabajoRecibos, filtro: Dict[str, Any]) -> Iterator[bytes]:
+        salida = _SalidaZip()
+        with zipfile.ZipFile(salida, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            for archivos in self._resultados(trabajo, filtro):
+                for nombre, data in archivos:
+                    zf.writestr(nombre, data)
+                chunk = salida.vaciar()
+                if chunk:
+                    yield chunk
+        yield salida.vaciar()
+
+    def _pdf(self, trabajo: TrabajoRecibos, filtro: Dict[str, Any]) -> Iterator[bytes]:
+        try:
+            from pypdf import PdfWriter
+        except ImportError:
+            raise RuntimeError("pypdf no está instalado: no se puede combinar el PDF")
+        # Cada parte se incorpora al llegar (sin guardarlas todas); el combinado se escribe a un
+        # temporal que pasa a disco al superar RECIBOS_LOTE_PDF_MEMORIA_MB y se emite desde ahí
+        writer = PdfWriter()
+        for data in self._resultados(trabajo, filtro):
+            writer.append(io.BytesIO(data))
+        # El logo y las fuentes se repiten en cada parte
+        if hasattr(writer, 'compress_identical_objects'):
+            writer.compress_identical_objects()
+        limite = max(1, _env_int('RECIBOS_LOTE_PDF_MEMORIA_MB', 8)) * 1024 * 1024
+        with tempfile.SpooledTemporaryFile(max_size=limite, prefix='recibos_lote_') as f:
+            writer.write(f)
+            writer.close()
+            del writer
+            f.seek(0)
+            while True:
+                chunk = f.read(256 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+
+    def stream(self, trabajo: TrabajoRecibos, filtro: Dict[str, Any]) -> Iterator[bytes]:
+        """Generador de bytes del resultado; si el cliente corta la descarga el trabajo se cancela."""
+        trabajo.estado = 'renderizando'
+        try:
+            generador = self._zip(trabajo, filtro) if trabajo.formato == 'zip' else self._pdf(trabajo, filtro)
+            yield from generador
+            trabajo.finalizar('completado')
+        except _Cancelado:
+            trabajo.finalizar('cancelado')
+        except GeneratorExit:
+            trabajo.cancelado.set()
+            trabajo.finalizar('cancelado')
+            raise
+        except Exception as e:
+            logger.error(f"Error generando recibos en lote {trabajo.id}: {e}")
+            trabajo.finalizar('error', str(e))
+        finally:
+            self.close()
+
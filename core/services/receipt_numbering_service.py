@@ -0,0 +1,42 @@
+import os
+from typing import Any, Dict, Optional
+from sqlalchemy.orm import Session
+from core.services.base import BaseService
+from core.database.repositories.receipt_numbering_repository import ReceiptNumberingRepository, TIPO_RECIBO
+
+
+class ReceiptNumberingService(BaseService):
+    """Numeración de comprobantes separada del render: el número se asigna y el comprobante se
+    inserta en una transacción corta que termina antes de generar el PDF.
+
+    En modo secuencia cada proceso reserva bloques de NUMERACION_BLOQUE números (20 por defecto);
+    con modo_estricto la numeración es correlativa sin huecos.
+    """
+
+    def __init__(self, db: Session = None):
+        super().__init__(db)
+        self.numbering_repo = ReceiptNumberingRepository(self.db, None, None)
+        try:
+            self.block_size = max(1, int(os.getenv('NUMERACION_BLOQUE', '20')))
+        except Exception:
+            self.block_size = 20
+
+    def get_config(self, kind: str = TIPO_RECIBO) -> Dict[str, Any]:
+        return self.numbering_repo.obtener_config(kind)
+
+    def save_config(self, data: Dict[str, Any], kind: str = TIPO_RECIBO) -> bool:
+        return self.numbering_repo.guardar_config(data, kind)
+
+    def peek_next_number(self, kind: str = TIPO_RECIBO) -> str:
+        return self.numbering_repo.proximo_numero(kind)
+
+    def issue_receipt(self, payment_id: Optional[int], user_id: Optional[int], total: float,
+                      issued_by: Optional[str] = None, pdf_path: Optional[str] = None,
+                      kind: str = TIPO_RECIBO) -> Dict[str, Any]:
+        return self.numbering_repo.emitir_comprobante(
+            payment_id, user_id, total, tipo=kind, emitido_por=issued_by,
+            archivo_pdf=pdf_path, tamano_bloque=self.block_size,
+        )
+
+    def find_gaps(self, period: Optional[int] = None, kind: str = TIPO_RECIBO) -> Dict[str, Any]:
+        return self.numbering_repo.obtener_huecos(kind, period)
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+from sqlalchemy.orm import Session
+from core.services.base import BaseService
+from core.database.repositories.payment_repository import PaymentRepository
+
+
+class ReceiptMemoryCache:
+    """LRU en memoria acotado por tamaño total en bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max(int(max_bytes), 0)
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes and self._items:
+                _, dropped = self._items.popitem(last=False)
+                self._size -= len(dropped)
+
+
+class ReceiptDiskCache:
+    """Caché en disco (un archivo por clave) con tope de tamaño; desaloja por último acceso (mtime)."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max(int(max_bytes), 0)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+            return data
+        except OSError:
+            return None
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self._evict()
+
+    def _evict(self) -> None:
+        with self._lock:
+            try:
+                entries = []
+                for name in os.listdir(self.directory):
+                    if name.endswith('.pdf'):
+                        st = os.stat(os.path.join(self.directory, name))
+                        entries.append((st.st_mtime, st.st_size, name))
+            except OSError:
+                return
+            total = sum(e[1] for e in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    total -= size
+                except OSError:
+                    pass
+
+
+def _build_cache():
+    mode = (os.getenv('RECIBOS_CACHE_MODO') or 'memoria').strip().lower()
+    try:
+        max_bytes = int(float(os.getenv('RECIBOS_CACHE_MAX_MB', '64')) * 1024 * 1024)
+    except Exception:
+        max_bytes = 64 * 1024 * 1024
+    if mode == 'disco':
+        directory = os.getenv('RECIBOS_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'recibos_cache')
+        try:
+            return ReceiptDiskCache(directory, max_bytes)
+        except OSError:
+            pass
+    if mode == 'off':
+        return None
+    return ReceiptMemoryCache(max_bytes)
+
+
+_CACHE = _build_cache()
+# PDFGenerator por tenant: fuentes/estilos/logo ya resueltos; se refresca cada GENERATOR_TTL segundos
+_GENERATORS: Dict[str, Tuple[float, Any]] = {}
+_GENERATORS_LOCK = threading.Lock()
+GENERATOR_TTL = 300
+
+
+class ReceiptService(BaseService):
+    """Render de recibos con caché de PDFs terminados.
+
+    La clave combina la firma del pago en base (monto, fecha, método, usuario, detalles y
+    número de comprobante), la huella del branding del tenant y los parámetros de render,
+    así que cualquier cambio produce una clave nueva y no hace falta invalidar.
+    """
+
+    def __init__(self, db: Session = None, tenant: Optional[str] = None):
+        super().__init__(db)
+        self.payment_repo = PaymentRepository(self.db, None, None)
+        self.tenant = tenant or '-'
+
+    def get_generator(self):
+        now = time.monotonic()
+        cached = _GENERATORS.get(self.tenant)
+        if cached and now - cached[0] < GENERATOR_TTL:
+            return cached[1]
+        from core.pdf_generator import PDFGenerator
+        generator = PDFGenerator()
+        with _GENERATORS_LOCK:
+            _GENERATORS[self.tenant] = (now, generator)
+        return generator
+
+    def get_receipt_signature(self, pago_id: int) -> Optional[Dict[str, Any]]:
+        try:
+            return self.payment_repo.obtener_firma_recibo(pago_id)
+        except Exception:
+            self.db.rollback()
+            return None
+
+    def cache_key(self, signature: Dict[str, Any], numero: Optional[str], render_params: Dict[str, Any]) -> str:
+        payload = json.dumps({
+            't': self.tenant,
+            'firma': {k: v for k, v in signature.items() if k not in ('comprobante_id', 'numero_comprobante')},
+            'numero': numero,
+            'branding': self.get_generator().huella_branding(),
+            'params': render_params,
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def etag_for(key: str) -> str:
+        return f'"{key[:32]}"'
+
+    def get_cached(self, key: str) -> Optional[bytes]:
+        if _CACHE is None:
+            return None
+        try:
+            return _CACHE.get(key)
+        except Exception:
+            return None
+
+    def render(self, key: Optional[str], render_fn: Callable[[Any], bytes]) -> bytes:
+        """Renderiza con el generador del tenant y guarda el resultado en caché si hay clave."""
+        data = render_fn(self.get_generator())
+        if key and _CACHE is not None:
+            try:
+                _CACHE.put(key, data)
+            except Exception:
+                pass
+        return data
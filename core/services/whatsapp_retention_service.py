@@ -0,0 +1,119 @@
+import os
+from typing import Optional, Dict, Any, Tuple
+from sqlalchemy.orm import Session
+from core.services.base import BaseService
+from core.database.repositories.whatsapp_retention_repository import WhatsappRetentionRepository
+
+
+def retenciones_configuradas() -> Tuple[int, Dict[str, int]]:
+    """(días por defecto, días por message_type) desde WHATSAPP_RETENCION_DIAS (365) y
+    WHATSAPP_RETENCION_DIAS_POR_TIPO ("received:90,payment:730")."""
+    try:
+        defecto = int(os.getenv('WHATSAPP_RETENCION_DIAS', '365'))
+    except Exception:
+        defecto = 365
+    por_tipo: Dict[str, int] = {}
+    for item in (os.getenv('WHATSAPP_RETENCION_DIAS_POR_TIPO') or '').split(','):
+        tipo, _, dias = item.partition(':')
+        try:
+            if tipo.strip():
+                por_tipo[tipo.strip()] = max(int(dias), 1)
+        except Exception:
+            continue
+    return max(defecto, 1), por_tipo
+
+
+class WhatsappRetentionService(BaseService):
+    def __init__(self, db: Session = None):
+        super().__init__(db)
+        self.retention_repo = WhatsappRetentionRepository(self.db, None, None)
+
+    def list_partitions(self) -> Dict[str, Any]:
+        defecto, por_tipo = retenciones_configuradas()
+        return {
+            'particionada': self.retention_repo.esta_particionada(),
+            'particiones': self.retention_repo.listar_particiones(),
+            'archivos': self.retention_repo.obtener_archivos(),
+            'retencion_dias': defecto,
+            'retencion_dias_por_tipo': por_tipo,
+        }
+
+    def refresh_summary(self, max_batches: Optional[int] = None) -> Dict[str, Any]:
+        try:
+            grace = float(os.getenv('WHATSAPP_RESUMEN_GRACIA_S', '60'))
+        except Exception:
+            grace = 60.0
+        return self.retention_repo.actualizar_resumen_telefonos(gracia_s=grace, max_lotes=max_batches)
+
+    def _archive_writer(self, destination: str, local_dir: Optional[str], prefix: Optional[str]):
+        prefix = prefix or os.getenv('WHATSAPP_ARCHIVO_PREFIJO', 'whatsapp')
+        if destination == 'local':
+            directory = local_dir or os.getenv('WHATSAPP_ARCHIVO_DIR', 'archivos_whatsapp')
+            os.makedirs(directory, exist_ok=True)
+
+            def guardar(datos: bytes, nombre: str) -> Optional[str]:
+                ruta = os.path.join(directory, f"{prefix}_{nombre}")
+                with open(ruta, 'wb') as f:
+                    f.write(datos)
+                return ruta
+            return guardar
+
+        from core.services.storage_service import StorageService
+        storage = StorageService()
+
+        def subir(datos: bytes, nombre: str) -> Optional[str]:
+            return storage.upload_file(datos, f"{prefix}_{nombre}", 'application/gzip', subfolder='archivos_whatsapp')
+        return subir
+
+    def maintain(self, future_months: int = 3, destination: Optional[str] = None, local_dir: Optional[str] = None,
+                 prefix: Optional[str] = None, max_batches: Optional[int] = None) -> Dict[str, Any]:
+        """Mantenimiento diario de whatsapp_messages: resumen por teléfono, particiones futuras,
+        borrado por tipo, compactación de contenido y archivo de los meses fuera de retención."""
+        destination = (destination or os.getenv('WHATSAPP_ARCHIVO_DESTINO', 'b2')).lower()
+        if destination not in ('b2', 'local'):
+            raise ValueError("destino debe ser 'b2' o 'local'")
+        defecto, por_tipo = retenciones_configuradas()
+        try:
+            compact_days = int(os.getenv('WHATSAPP_COMPACTAR_DIAS', '90'))
+        except Exception:
+            compact_days = 90
+        # El resumen primero: lo que se borre o archive después ya quedó contado
+        resumen = self.refresh_summary(max_batches)
+        particionada = self.retention_repo.esta_particionada()
+        creadas = self.retention_repo.crear_particiones_futuras(future_months) if particionada else []
+        borradas = self.retention_repo.purgar_por_tipo(por_tipo, defecto, max_lotes=max_batches)
+        compactadas = self.retention_repo.compactar_contenido(compact_days, max_lotes=max_batches) if compact_days > 0 else 0
+        archivadas, fallidas = [], []
+        if particionada:
+            guardar = self._archive_writer(destination, local_dir, prefix)
+            horizonte = max([defecto] + list(por_tipo.values()))
+            for particion in self.retention_repo.particiones_a_archivar(horizonte):
+                res = self.retention_repo.archivar_particion(particion, destination, guardar)
+                if res:
+                    archivadas.append(res)
+                else:
+                    fallidas.append(particion['particion'])
+        return {
+            'particionada': particionada, 'resumen': resumen, 'creadas': creadas, 'borradas': borradas,
+            'compactadas': compactadas, 'archivadas': archivadas, 'fallidas': fallidas,
+        }
+
+    def migrate_to_partitioned(self, batch_size: int = 20000, max_batches: Optional[int] = None,
+                               future_months: int = 3) -> Dict[str, Any]:
+        """Migra `whatsapp_messages` a tabla particionada por lotes; se puede reanudar con llamadas sucesivas."""
+        if self.retention_repo.esta_particionada():
+            return {'estado': 'particionada', 'copiadas': 0}
+        self.retention_repo.preparar_migracion(future_months)
+        copiadas, lotes, cursor = 0, 0, None
+        while True:
+            if max_batches is not None and lotes >= int(max_batches):
+                return {'estado': 'en_progreso', 'copiadas': copiadas, 'lotes': lotes}
+            filas, siguiente = self.retention_repo.copiar_lote_migracion(batch_size, cursor)
+            copiadas += filas
+            lotes += 1
+            # Sin filas por leer, o un lote que no avanzó el cursor: pasar al remanente
+            if siguiente is None or (cursor is not None and siguiente <= cursor):
+                break
+            cursor = siguiente
+        res = self.retention_repo.finalizar_migracion()
+        return {'estado': 'particionada', 'copiadas': copiadas + res['remanente'], 'lotes': lotes, **res}
@@ -6,21 +6,152 @@ Maneja el procesamiento de plantillas con variables dinámicas
 """
 
 import re
+import time
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple, Union
 from .database import DatabaseManager
 from .utils import get_gym_name
 
+# --- Compilación de plantillas ---
+# Una plantilla se parsea una sola vez a una lista de operaciones: texto literal (str) o una
+# tupla (función, argumentos...). Renderizar es recorrer esa lista, sin regex por mensaje.
+
+Operacion = Union[str, Tuple[str, ...]]
+
+_PATRON_TOKEN = re.compile(r'\{\{\s*([^}]+)\s*\}\}')
+_FORMATOS_FECHA = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y')
+
+# Plantillas compiladas por hash de su contenido, en orden de uso
+_PLANTILLAS: 'OrderedDict[str, Tuple[Operacion, ...]]' = OrderedDict()
+_PLANTILLAS_MAX = 512
+_LOCK = threading.Lock()
+
+
+def _operacion_token(token: str, crudo: str) -> Operacion:
+    """Operación de un {{...}}; `crudo` es el interior tal cual (las funciones no admiten
+    espacios tras las llaves: {{ fecha:%d }} queda literal)."""
+    variable = token.strip()
+    if ':' not in variable:
+        return ('var', variable)
+    funcion, _, resto = crudo.partition(':')
+    if not resto:
+        return crudo.join(('{{', '}}'))
+    if funcion == 'fecha':
+        return ('fecha', resto.strip())
+    if funcion == 'monto':
+        return ('monto', resto.strip())
+    if funcion == 'dias_desde':
+        return ('dias_desde', resto.strip())
+    if funcion == 'si':
+        partes = resto.split(':')
+        if len(partes) < 3:
+            return crudo.join(('{{', '}}'))
+        return ('si', partes[0].strip(), partes[1].strip(), partes[2].strip())
+    return crudo.join(('{{', '}}'))
+
+
+def _parsear_plantilla(contenido: str) -> Tuple[Operacion, ...]:
+    ops: List[Operacion] = []
+    pos = 0
+    for m in _PATRON_TOKEN.finditer(contenido):
+        if m.start() > pos:
+            ops.append(contenido[pos:m.start()])
+        ops.append(_operacion_token(m.group(1), contenido[m.start() + 2:m.end() - 2]))
+        pos = m.end()
+    if pos < len(contenido):
+        ops.append(contenido[pos:])
+    # Unir literales consecutivos (funciones desconocidas quedan como texto)
+    unidas: List[Operacion] = []
+    for op in ops:
+        if isinstance(op, str) and unidas and isinstance(unidas[-1], str):
+            unidas[-1] += op
+        else:
+            unidas.append(op)
+    return tuple(unidas)
+
+
+def compilar_plantilla(contenido: str) -> Tuple[Operacion, ...]:
+    """Operaciones de la plantilla, parseada una vez por proceso (caché LRU por hash)."""
+    clave = hashlib.sha1(contenido.encode('utf-8')).hexdigest()
+    with _LOCK:
+        ops = _PLANTILLAS.get(clave)
+        if ops is not None:
+            _PLANTILLAS.move_to_end(clave)
+            return ops
+    ops = _parsear_plantilla(contenido)
+    with _LOCK:
+        _PLANTILLAS[clave] = ops
+        while len(_PLANTILLAS) > _PLANTILLAS_MAX:
+            _PLANTILLAS.popitem(last=False)
+    return ops
+
+
+@lru_cache(maxsize=4096)
+def _parsear_fecha(valor: str) -> Optional[datetime]:
+    # strptime es lo más caro del render: las fechas se repiten mucho entre mensajes
+    for formato in _FORMATOS_FECHA:
+        try:
+            return datetime.strptime(valor, formato)
+        except Exception:
+            continue
+    return None
+
+
+def _dias_desde(valor: Any, ahora: datetime) -> str:
+    fecha = _parsear_fecha(str(valor))
+    return str((ahora - fecha).days) if fecha else "0"
+
+
+def renderizar(ops: Tuple[Operacion, ...], variables: Dict[str, Any], ahora: datetime) -> str:
+    """Aplica las operaciones compiladas con `variables` en una sola pasada.
+
+    Los valores de las variables se insertan tal cual: ya no se vuelven a interpretar como
+    plantilla (un {{fecha:...}} dentro de un nombre, por ejemplo, queda literal)."""
+    partes: List[str] = []
+    for op in ops:
+        if isinstance(op, str):
+            partes.append(op)
+            continue
+        tipo = op[0]
+        if tipo == 'var':
+            valor = variables.get(op[1], f"{{{{VARIABLE_NO_ENCONTRADA: {op[1]}}}}}")
+            partes.append(str(valor) if valor is not None else "")
+        elif tipo == 'fecha':
+            try:
+                partes.append(ahora.strftime(op[1]))
+            except Exception:
+                partes.append(ahora.strftime('%d/%m/%Y'))
+        elif tipo == 'monto':
+            valor = variables.get(op[1], 0)
+            try:
+                partes.append(f"${float(valor):,.0f}")
+            except Exception:
+                partes.append(str(valor))
+        elif tipo == 'si':
+            valor = variables.get(op[1], False)
+            # Verdadero si no es None, 0, False o string vacío
+            partes.append(op[2] if (bool(valor) and valor != "" and valor != 0) else op[3])
+        elif tipo == 'dias_desde':
+            partes.append(_dias_desde(variables.get(op[1], ''), ahora))
+    return "".join(partes)
+
+
+DIAS_SEMANA = ('Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo')
+
 class TemplateProcessor:
     """Procesador de plantillas de mensajes con variables dinámicas"""
     
     def __init__(self, database_manager: DatabaseManager):
         self.db = database_manager
-        self.variables_sistema = self._cargar_variables_sistema()
+        self.variables_gimnasio = self._cargar_variables_sistema()
     
     def _cargar_variables_sistema(self) -> Dict[str, Any]:
-        """Carga variables del sistema desde la configuración"""
+        """Carga los datos fijos del gimnasio; fecha y hora se calculan en cada render"""
         try:
             # Usar datos reales del gimnasio
             return {
@@ -32,47 +163,52 @@ class TemplateProcessor:
                 'moneda': 'ARS',
                 'simbolo_moneda': '$',
                 'sitio_web': 'www.gimnasiozurka.com',
-                'fecha_actual': datetime.now().strftime('%d/%m/%Y'),
-                'hora_actual': datetime.now().strftime('%H:%M'),
-                'año_actual': datetime.now().year,
-                'mes_actual': datetime.now().strftime('%B'),
-                'dia_semana': self._obtener_dia_semana()
             }
         except Exception as e:
             logging.error(f"Error al cargar variables del sistema: {e}")
             return {}
     
-    def _obtener_dia_semana(self) -> str:
-        """Obtiene el día de la semana en español"""
-        dias = {
-            0: 'Lunes', 1: 'Martes', 2: 'Miércoles', 3: 'Jueves',
-            4: 'Viernes', 5: 'Sábado', 6: 'Domingo'
+    def _variables_fecha(self, ahora: datetime) -> Dict[str, Any]:
+        return {
+            'fecha_actual': ahora.strftime('%d/%m/%Y'),
+            'hora_actual': ahora.strftime('%H:%M'),
+            'año_actual': ahora.year,
+            'mes_actual': ahora.strftime('%B'),
+            'dia_semana': self._obtener_dia_semana(ahora),
         }
-        return dias.get(datetime.now().weekday(), 'Desconocido')
+    
+    @property
+    def variables_sistema(self) -> Dict[str, Any]:
+        """Variables del sistema con fecha y hora actuales"""
+        return {**self.variables_gimnasio, **self._variables_fecha(datetime.now())}
+    
+    def _obtener_dia_semana(self, ahora: Optional[datetime] = None) -> str:
+        """Obtiene el día de la semana en español"""
+        return DIAS_SEMANA[(ahora or datetime.now()).weekday()]
     
     def procesar_plantilla(self, contenido: str, variables: Dict[str, Any] = None) -> str:
         """Procesa una plantilla reemplazando variables dinámicas"""
         try:
             if not contenido:
                 return ""
-            
-            # Combinar variables del sistema con variables específicas
-            todas_variables = self.variables_sistema.copy()
-            if variables:
-                todas_variables.update(variables)
-            
-            # Procesar variables con formato {{variable}}
-            contenido_procesado = self._reemplazar_variables(contenido, todas_variables)
-            
-            # Procesar funciones especiales
-            contenido_procesado = self._procesar_funciones_especiales(contenido_procesado, todas_variables)
-            
-            return contenido_procesado
-            
+            return self.render_many(contenido, [variables or {}])[0]
         except Exception as e:
             logging.error(f"Error al procesar plantilla: {e}")
             return contenido  # Devolver contenido original en caso de error
     
+    def render_many(self, contenido: str, filas: List[Dict[str, Any]]) -> List[str]:
+        """Renderiza la misma plantilla para muchas filas de variables (recordatorios masivos).
+
+        La plantilla se compila una vez (ver compilar_plantilla) y las variables del sistema
+        se calculan una vez por llamada; cada fila pisa las del sistema con las suyas.
+        """
+        if not contenido:
+            return ["" for _ in filas]
+        ops = compilar_plantilla(contenido)
+        ahora = datetime.now()
+        base = {**self.variables_gimnasio, **self._variables_fecha(ahora)}
+        return [renderizar(ops, {**base, **fila} if fila else base, ahora) for fila in filas]
+    
     def procesar_plantilla_whatsapp(self, template_name: str, parametros: List[str]) -> Dict[str, Any]:
         """Procesa plantillas de WhatsApp con variables {{1}}, {{2}}, {{3}} del archivo SISTEMA WHATSAPP.txt"""
         try:
@@ -102,113 +238,6 @@ class TemplateProcessor:
             logging.error(f"Error al procesar plantilla WhatsApp {template_name}: {e}")
             return None
     
-    def _reemplazar_variables(self, contenido: str, variables: Dict[str, Any]) -> str:
-        """Reemplaza variables con formato {{variable}}"""
-        def reemplazar(match):
-            variable = match.group(1).strip()
-            # Skip variables that contain colons (special functions)
-            if ':' in variable:
-                return match.group(0)
-            valor = variables.get(variable, f"{{{{VARIABLE_NO_ENCONTRADA: {variable}}}}}")
-            return str(valor) if valor is not None else ""
-        
-        # Patrón para variables: {{variable}}
-        patron = r'\{\{\s*([^}]+)\s*\}\}'
-        return re.sub(patron, reemplazar, contenido)
-    
-    def _procesar_funciones_especiales(self, contenido: str, variables: Dict[str, Any]) -> str:
-        """Procesa funciones especiales en las plantillas"""
-        # Función para formatear fechas: {{fecha:formato}}
-        contenido = self._procesar_funcion_fecha(contenido)
-        
-        # Función para formatear montos: {{monto:variable}}
-        contenido = self._procesar_funcion_monto(contenido, variables)
-        
-        # Función condicional: {{si:variable:texto_si_true:texto_si_false}}
-        contenido = self._procesar_funcion_condicional(contenido, variables)
-        
-        # Función para días transcurridos: {{dias_desde:fecha}}
-        contenido = self._procesar_funcion_dias_desde(contenido, variables)
-        
-        return contenido
-    
-    def _procesar_funcion_fecha(self, contenido: str) -> str:
-        """Procesa funciones de fecha: {{fecha:dd/mm/yyyy}}"""
-        def reemplazar_fecha(match):
-            formato = match.group(1).strip()
-            try:
-                return datetime.now().strftime(formato)
-            except:
-                return datetime.now().strftime('%d/%m/%Y')
-        
-        patron = r'\{\{fecha:([^}]+)\}\}'
-        return re.sub(patron, reemplazar_fecha, contenido)
-    
-    def _procesar_funcion_monto(self, contenido: str, variables: Dict[str, Any]) -> str:
-        """Procesa funciones de monto: {{monto:variable}}"""
-        def reemplazar_monto(match):
-            variable = match.group(1).strip()
-            valor = variables.get(variable, 0)
-            try:
-                monto = float(valor)
-                return f"${monto:,.0f}"
-            except:
-                return str(valor)
-        
-        patron = r'\{\{monto:([^}]+)\}\}'
-        return re.sub(patron, reemplazar_monto, contenido)
-    
-    def _procesar_funcion_condicional(self, contenido: str, variables: Dict[str, Any]) -> str:
-        """Procesa funciones condicionales: {{si:variable:texto_true:texto_false}}"""
-        def reemplazar_condicional(match):
-            partes = match.group(1).split(':')
-            if len(partes) < 3:
-                return match.group(0)  # Devolver original si formato incorrecto
-            
-            variable = partes[0].strip()
-            texto_true = partes[1].strip()
-            texto_false = partes[2].strip() if len(partes) > 2 else ""
-            
-            valor = variables.get(variable, False)
-            # Evaluar como verdadero si no es None, 0, False, o string vacío
-            es_verdadero = bool(valor) and valor != "" and valor != 0
-            
-            return texto_true if es_verdadero else texto_false
-        
-        patron = r'\{\{si:([^}]+)\}\}'
-        return re.sub(patron, reemplazar_condicional, contenido)
-    
-    def _procesar_funcion_dias_desde(self, contenido: str, variables: Dict[str, Any]) -> str:
-        """Procesa función de días transcurridos: {{dias_desde:variable_fecha}}"""
-        def reemplazar_dias(match):
-            variable = match.group(1).strip()
-            fecha_str = variables.get(variable, '')
-            
-            try:
-                # Intentar parsear diferentes formatos de fecha
-                formatos = ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y']
-                fecha = None
-                
-                for formato in formatos:
-                    try:
-                        fecha = datetime.strptime(str(fecha_str), formato)
-                        break
-                    except:
-                        continue
-                
-                if fecha:
-                    dias = (datetime.now() - fecha).days
-                    return str(dias)
-                else:
-                    return "0"
-                    
-            except Exception as e:
-                logging.error(f"Error al calcular días desde {fecha_str}: {e}")
-                return "0"
-        
-        patron = r'\{\{dias_desde:([^}]+)\}\}'
-        return re.sub(patron, reemplazar_dias, contenido)
-    
     def validar_plantilla(self, contenido: str) -> Dict[str, Any]:
         """Valida una plantilla y devuelve información sobre variables encontradas"""
         try:
@@ -352,4 +381,51 @@ class TemplateProcessor:
 def crear_template_processor(database_manager: DatabaseManager) -> \
         TemplateProcessor:
     """Crea una instancia del procesador de plantillas"""
-    return TemplateProcessor(database_manager)
\ No newline at end of file
+    return TemplateProcessor(database_manager)
+
+def medir_rendimiento(mensajes: int = 5000) -> Dict[str, float]:
+    """Micro-benchmark del render: segundos para `mensajes` mensajes de un recordatorio típico.
+
+    - compilar_cada_vez: parsea en cada mensaje (costo sin caché).
+    - cacheado: compilar_plantilla + renderizar por mensaje (procesar_plantilla).
+    - render_many: una compilación y variables del sistema para todo el lote.
+    Uso: python -m core.template_processor [mensajes]
+    """
+    plantilla = (
+        "Hola {{nombre_usuario}}, tu cuota de {{tipo_cuota}} venció el {{fecha_vencimiento}} "
+        "(hace {{dias_desde:fecha_vencimiento}} días). Monto: {{monto:monto_cuota}}. "
+        "{{si:descuento:Tenés descuento por pago anticipado:Aboná antes del 10 para evitar recargos}}. "
+        "{{nombre_gimnasio}} - {{fecha:%d/%m/%Y}}"
+    )
+    filas = [
+        {'nombre_usuario': f"Socio {i}", 'tipo_cuota': 'Mensual', 'fecha_vencimiento': '01/03/2024',
+         'monto_cuota': 15000 + i, 'descuento': i % 2, 'nombre_gimnasio': 'Gimnasio'}
+        for i in range(mensajes)
+    ]
+    ahora = datetime.now()
+    resultados: Dict[str, float] = {}
+
+    inicio = time.perf_counter()
+    for fila in filas:
+        renderizar(_parsear_plantilla(plantilla), fila, ahora)
+    resultados['compilar_cada_vez'] = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    for fila in filas:
+        renderizar(compilar_plantilla(plantilla), fila, datetime.now())
+    resultados['cacheado'] = time.perf_counter() - inicio
+
+    procesador = TemplateProcessor.__new__(TemplateProcessor)
+    procesador.db = None
+    procesador.variables_gimnasio = {'nombre_gimnasio': 'Gimnasio'}
+    inicio = time.perf_counter()
+    procesador.render_many(plantilla, filas)
+    resultados['render_many'] = time.perf_counter() - inicio
+    return resultados
+
+
+if __name__ == "__main__":
+    import sys
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    for nombre, segundos in medir_rendimiento(n).items():
+        print(f"{nombre:>18}: {segundos * 1000:8.1f} ms  ({n / segundos:,.0f} msg/s)")
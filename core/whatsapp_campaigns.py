@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WhatsApp Campaigns - Envíos masivos a segmentos de socios
+
+Al crear una campaña sus destinatarios se eligen y guardan en una sola consulta (socios por
+etiquetas, clases, horarios o ids; ver WhatsappCampaignRepository.crear_campania) y el
+pedido HTTP termina ahí. Después, cada paso de MotorCampanias.avanzar toma de cada campaña en
+curso tantos pendientes como permite su tasa (mensajes_por_minuto) desde el paso anterior,
+aplica anti-spam (core/antispam.py) y allowlist, renderiza el lote con una sola compilación
+de la plantilla y lo encola en whatsapp_outbox, que envía WhatsAppDispatcher. En horario de
+silencio no se encola y lo que quedó en el outbox se posterga hasta el final del silencio.
+
+Los pasos corren en un hilo de fondo por proceso (avanzar_en_segundo_plano) y en el cron del
+outbox; el FOR UPDATE SKIP LOCKED de cada campaña evita que dos instancias la avancen a la vez.
+El estado de cada destinatario lo actualizan el outbox (enviado / fallido) y los webhooks de
+entrega (entregado / leido), por el biz_opaque_callback_data 'campania:<id>:<destinatario>'.
+"""
+
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta, time as dtime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .antispam import MotorAntispam
+from .database.date_ranges import ahora_gym
+from .database.repositories.whatsapp_repository import TIPO_CAMPANIA
+from .database.repositories.whatsapp_campaign_repository import WhatsappCampaignRepository, clave_envio
+
+logger = logging.getLogger(__name__)
+
+ACCIONES = ('pausar', 'reanudar', 'cancelar')
+
+
+def _env_int(nombre: str, defecto: int) -> int:
+    try:
+        return int(os.getenv(nombre, str(defecto)))
+    except Exception:
+        return defecto
+
+
+def _env_float(nombre: str, defecto: float) -> float:
+    try:
+        return float(os.getenv(nombre, str(defecto)))
+    except Exception:
+        return defecto
+
+
+def parsear_silencio(valor: Any) -> Tuple[Optional[dtime], Optional[dtime]]:
+    """"HH:MM-HH:MM" -> (desde, hasta); vacío -> sin silencio. Puede cruzar la medianoche."""
+    texto = str(valor or '').strip()
+    if not texto:
+        return None, None
+    try:
+        desde, hasta = (datetime.strptime(p.strip(), '%H:%M').time() for p in texto.split('-', 1))
+    except ValueError:
+        raise ValueError("silencio debe tener el formato HH:MM-HH:MM")
+    return (desde, hasta) if desde != hasta else (None, None)
+
+
+def segundos_de_silencio(desde: Optional[dtime], hasta: Optional[dtime], ahora: datetime) -> Optional[float]:
+    """Segundos hasta el fin del horario de silencio si `ahora` cae dentro; None si no."""
+    if desde is None or hasta is None or desde == hasta:
+        return None
+    t = ahora.time()
+    if desde < hasta:
+        dentro, manana = desde <= t < hasta, False
+    else:
+        dentro, manana = t >= desde or t < hasta, t >= desde
+    if not dentro:
+        return None
+    fin = datetime.combine(ahora.date() + timedelta(days=1 if manana else 0), hasta)
+    return max((fin - ahora).total_seconds(), 1.0)
+
+
+class MotorCampanias:
+    """Alta, avance y control de campañas de WhatsApp.
+
+    Configuración por entorno:
+    - WHATSAPP_CAMPANIAS_POR_MINUTO: tasa por defecto de una campaña (60).
+    - WHATSAPP_CAMPANIAS_SILENCIO: horario de silencio por defecto, HH:MM-HH:MM (21:00-09:00).
+    - WHATSAPP_CAMPANIAS_VENTANA_HORAS: no repetir campaña al mismo teléfono dentro de estas horas (0 = no aplica).
+    - WHATSAPP_CAMPANIAS_LOTE: máximo de destinatarios por campaña en cada paso (500).
+    - WHATSAPP_CAMPANIAS_RAFAGA_S: cupo acumulable como máximo, en segundos de tasa (60).
+    - WHATSAPP_CAMPANIAS_PASO_S: espera entre pasos del hilo de fondo (5).
+    - WHATSAPP_LIMITE_TIER_24H: destinatarios distintos por 24 h según el tier de la cuenta.
+    """
+
+    def __init__(self, db_manager, whatsapp_manager=None, message_logger=None):
+        self.db = db_manager
+        self.whatsapp_manager = whatsapp_manager
+        self.message_logger = message_logger or getattr(whatsapp_manager, 'message_logger', None)
+        self.repo = WhatsappCampaignRepository(db_manager.session, None, logger)
+        self.antispam = getattr(self.message_logger, 'antispam', None) or MotorAntispam(db_manager.whatsapp)
+        self.por_minuto = max(1, _env_int('WHATSAPP_CAMPANIAS_POR_MINUTO', 60))
+        self.silencio = os.getenv('WHATSAPP_CAMPANIAS_SILENCIO', '21:00-09:00')
+        self.ventana_horas = max(0.0, _env_float('WHATSAPP_CAMPANIAS_VENTANA_HORAS', 0.0))
+        self.lote = max(1, _env_int('WHATSAPP_CAMPANIAS_LOTE', 500))
+        self.rafaga_s = max(1.0, _env_float('WHATSAPP_CAMPANIAS_RAFAGA_S', 60.0))
+        self.paso_s = max(0.5, _env_float('WHATSAPP_CAMPANIAS_PASO_S', 5.0))
+        self.limite_tier_24h = _env_int('WHATSAPP_LIMITE_TIER_24H', 1000)
+        self._procesador = None
+
+    # --- Alta y control ---
+
+    def crear(self, nombre: str, segmento: Dict[str, Any], contenido: Optional[str] = None,
+              template_name: Optional[str] = None, idioma: Optional[str] = None,
+              parametros: Optional[List[str]] = None, mensajes_por_minuto: Optional[int] = None,
+              silencio: Any = None, creada_por: Optional[int] = None) -> Dict[str, Any]:
+        """Crea la campaña (texto con `contenido` o plantilla aprobada `template_name` con
+        `parametros`; ambos admiten {{variables}}) y arranca su envío en segundo plano.
+
+        `silencio` None usa WHATSAPP_CAMPANIAS_SILENCIO; "" lo desactiva."""
+        nombre = str(nombre or '').strip()
+        if not nombre:
+            raise ValueError("nombre requerido")
+        if not template_name and not str(contenido or '').strip():
+            raise ValueError("contenido o template_name requerido")
+        if not isinstance(segmento, dict):
+            raise ValueError("segmento debe ser un objeto")
+        desde, hasta = parsear_silencio(self.silencio if silencio is None else silencio)
+        tasa = int(mensajes_por_minuto or self.por_minuto)
+        if tasa < 1:
+            raise ValueError("mensajes_por_minuto debe ser mayor a 0")
+        resultado = self.repo.crear_campania({
+            'nombre': nombre[:200],
+            'tipo': 'plantilla' if template_name else 'texto',
+            'contenido': contenido,
+            'template_name': template_name or None,
+            'idioma': (idioma or 'es_AR') if template_name else None,
+            'parametros': [str(p) for p in parametros or []] if template_name else None,
+            'mensajes_por_minuto': tasa,
+            'silencio_desde': desde,
+            'silencio_hasta': hasta,
+            'creada_por': creada_por,
+        }, segmento)
+        logger.info(f"Campaña WhatsApp {resultado['id']} '{nombre}': {resultado}")
+        avanzar_en_segundo_plano(self._recrear)
+        return resultado
+
+    def cambiar_estado(self, campania_id: int, accion: str) -> bool:
+        if accion not in ACCIONES:
+            raise ValueError(f"accion debe ser una de {', '.join(ACCIONES)}")
+        cambiada = self.repo.cambiar_estado(campania_id, accion)
+        if cambiada and accion == 'reanudar':
+            avanzar_en_segundo_plano(self._recrear)
+        return cambiada
+
+    def progreso(self, campania_id: int) -> Optional[Dict[str, Any]]:
+        """Estado de la campaña con sus destinatarios por estado, porcentaje y tiempo estimado."""
+        p = self.repo.obtener_progreso(campania_id)
+        if p is None:
+            return None
+        por_estado = p['por_estado']
+        pendientes = por_estado.get('pendiente', 0) + por_estado.get('encolado', 0)
+        total = int(p['total'] or 0)
+        p['procesados'] = total - pendientes
+        p['porcentaje'] = round(p['procesados'] / total * 100, 1) if total else 100.0
+        p['eta_s'] = round(por_estado.get('pendiente', 0) * 60.0 / max(int(p['mensajes_por_minuto'] or 1), 1)) \
+            if p['estado'] == 'en_curso' else None
+        for k in ('silencio_desde', 'silencio_hasta'):
+            p[k] = p[k].strftime('%H:%M') if p[k] else None
+        for k in ('creado', 'finalizado'):
+            p[k] = p[k].isoformat() if p[k] else None
+        return p
+
+    def listar(self, limite: int = 50) -> List[Dict[str, Any]]:
+        filas = self.repo.listar_campanias(limite)
+        for f in filas:
+            for k in ('creado', 'finalizado'):
+                f[k] = f[k].isoformat() if f[k] else None
+        return filas
+
+    def _recrear(self) -> 'MotorCampanias':
+        return MotorCampanias(self.db, self.whatsapp_manager, self.message_logger)
+
+    # --- Pasos ---
+
+    def _render(self):
+        if self._procesador is None:
+            from .template_processor import TemplateProcessor
+            self._procesador = TemplateProcessor(self.db)
+        return self._procesador
+
+    def _payloads(self, campania: Dict[str, Any], destinatarios: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], str]]:
+        """(cuerpo Graph API, contenido para el registro) por destinatario, en orden."""
+        filas = [
+            {
+                'nombre': d.get('nombre') or '', 'nombre_usuario': d.get('nombre') or '',
+                'telefono_usuario': d.get('telefono') or '', 'dni_usuario': d.get('dni') or '',
+                'tipo_cuota': d.get('tipo_cuota') or '',
+            }
+            for d in destinatarios
+        ]
+        procesador = self._render()
+        if campania['tipo'] != 'plantilla':
+            textos = procesador.render_many(campania['contenido'] or '', filas)
+            return [({'type': 'text', 'text': {'body': t, 'preview_url': False}}, t) for t in textos]
+        # Cada parámetro se compila una vez y se renderiza para todo el lote
+        columnas = [procesador.render_many(p, filas) for p in campania['parametros'] or []]
+        out = []
+        for i in range(len(destinatarios)):
+            valores = [col[i] for col in columnas]
+            template = {'name': campania['template_name'], 'language': {'code': campania['idioma'] or 'es_AR'}}
+            if valores:
+                template['components'] = [{'type': 'body', 'parameters': [{'type': 'text', 'text': v} for v in valores]}]
+            out.append(({'type': 'template', 'template': template},
+                        f"{campania['nombre']}: {' | '.join(valores)}" if valores else campania['nombre']))
+        return out
+
+    def _avanzar_campania(self, campania_id: int, cupo_tier: int, resultado: Dict[str, Any]) -> int:
+        """Un paso de una campaña; devuelve cuántos encoló."""
+        c = self.repo.bloquear_campania(campania_id)
+        if c is None:
+            return 0
+        ahora = c['ahora']
+        silencio_s = segundos_de_silencio(c['silencio_desde'], c['silencio_hasta'], ahora_gym())
+        if silencio_s:
+            resultado['en_silencio'] += 1
+            self.repo.cerrar_paso(campania_id, ahora, posponer_s=silencio_s)
+            return 0
+        # Cupo por tasa desde la marca; lo que no alcanza para un envío entero queda para el próximo paso
+        por_segundo = max(int(c['mensajes_por_minuto'] or 1), 1) / 60.0
+        transcurrido = (ahora - c['ultimo_avance']).total_seconds() if c['ultimo_avance'] else self.paso_s
+        transcurrido = min(max(transcurrido, 0.0), self.rafaga_s)
+        cupo = min(int(transcurrido * por_segundo), self.lote, cupo_tier)
+        if cupo < 1:
+            if cupo_tier < 1:
+                resultado['limite_tier'] = True
+                self.repo.cerrar_paso(campania_id, ahora)
+            else:
+                self.db.session.rollback()
+            return 0
+        marca = ahora - timedelta(seconds=max(transcurrido - cupo / por_segundo, 0.0))
+        destinatarios = self.repo.tomar_destinatarios(campania_id, cupo)
+        if not destinatarios:
+            self.repo.cerrar_paso(campania_id, ahora)
+            return 0
+
+        motivos = self.antispam.evaluar([d['telefono'] for d in destinatarios],
+                                        TIPO_CAMPANIA if self.ventana_horas else None, self.ventana_horas or 24)
+        wm = self.whatsapp_manager
+        aptos, omitidos = [], []
+        for d in destinatarios:
+            tel = str(d['telefono']).strip()
+            if d.get('baja'):
+                motivo = 'baja'
+            else:
+                motivo = 'allowlist' if not wm._numero_permitido(tel) else motivos.get(tel)
+            if motivo:
+                omitidos.append((d['id'], motivo))
+            else:
+                aptos.append(d)
+        phone_number_id = str(wm.phone_number_id or '').strip()
+        envios = [
+            {
+                'destinatario_id': d['id'], 'idempotency_key': clave_envio(campania_id, d['id']),
+                'phone_number_id': phone_number_id, 'telefono': str(d['telefono']).strip(), 'payload': payload,
+                'user_id': d.get('usuario_id'), 'message_type': TIPO_CAMPANIA, 'contenido': contenido,
+            }
+            for d, (payload, contenido) in zip(aptos, self._payloads(c, aptos))
+        ]
+        encolados = self.repo.cerrar_paso(campania_id, marca, envios, omitidos)
+        resultado['omitidos'] += len(omitidos)
+        return encolados
+
+    def avanzar(self) -> Dict[str, Any]:
+        """Un paso de todas las campañas en curso. Dispara el outbox si encoló algo."""
+        inicio = time.monotonic()
+        resultado = {'activas': 0, 'encolados': 0, 'omitidos': 0, 'en_silencio': 0, 'limite_tier': False,
+                     'completadas': [], 'duracion_s': 0.0}
+        activas = self.repo.obtener_campanias_activas()
+        resultado['activas'] = len(activas)
+        wm = self.whatsapp_manager
+        if activas and (wm is None or not wm.access_token or not str(wm.phone_number_id or '').strip()):
+            self.db.session.rollback()
+            raise RuntimeError("WhatsApp no configurado (access_token / phone_id)")
+        if activas:
+            cupo_tier = max(self.limite_tier_24h - self.db.whatsapp.contar_destinatarios_24h(), 0)
+            for campania_id in activas:
+                try:
+                    n = self._avanzar_campania(campania_id, cupo_tier, resultado)
+                except Exception as e:
+                    logger.error(f"Campaña WhatsApp {campania_id}: error en el paso: {e}")
+                    self.db.session.rollback()
+                    continue
+                resultado['encolados'] += n
+                cupo_tier = max(cupo_tier - n, 0)
+        resultado['completadas'] = self.repo.cerrar_completadas()
+        if resultado['encolados']:
+            from .whatsapp_dispatcher import despachar_en_segundo_plano
+            despachar_en_segundo_plano(wm._crear_dispatcher)
+        resultado['duracion_s'] = round(time.monotonic() - inicio, 3)
+        if resultado['encolados'] or resultado['omitidos'] or resultado['completadas']:
+            logger.info(f"Campañas WhatsApp: {resultado}")
+        return resultado
+
+    def ejecutar(self, tiempo_maximo_s: Optional[float] = None) -> Dict[str, Any]:
+        """Pasos cada WHATSAPP_CAMPANIAS_PASO_S hasta que no queden campañas en curso o se
+        agote `tiempo_maximo_s` (sin límite si es None)."""
+        limite = None if tiempo_maximo_s is None else time.monotonic() + float(tiempo_maximo_s)
+        total = {'pasos': 0, 'encolados': 0, 'omitidos': 0, 'completadas': []}
+        while True:
+            r = self.avanzar()
+            total['pasos'] += 1
+            total['encolados'] += r['encolados']
+            total['omitidos'] += r['omitidos']
+            total['completadas'].extend(r['completadas'])
+            if not r['activas'] or r['activas'] == len(r['completadas']):
+                return total
+            if limite is not None and time.monotonic() + self.paso_s > limite:
+                return total
+            time.sleep(self.paso_s)
+
+
+# Un solo hilo de avance por proceso, como el despachador del outbox: lo que se pida mientras
+# corre (campaña nueva, reanudada) lo toma en su próximo paso o en la vuelta siguiente.
+_HILO: Optional[threading.Thread] = None
+_HILO_LOCK = threading.Lock()
+_PEDIDO = threading.Event()
+
+
+def avanzar_en_segundo_plano(crear: Callable[[], MotorCampanias]) -> None:
+    """Avanza las campañas en curso sin bloquear a quien las creó o reanudó."""
+    global _HILO
+    with _HILO_LOCK:
+        _PEDIDO.set()
+        if _HILO is not None and _HILO.is_alive():
+            return
+
+        def _runner():
+            global _HILO
+            while True:
+                with _HILO_LOCK:
+                    if not _PEDIDO.is_set():
+                        _HILO = None
+                        return
+                    _PEDIDO.clear()
+                motor = None
+                try:
+                    motor = crear()
+                    motor.ejecutar()
+                except Exception as e:
+                    logger.error(f"Campañas WhatsApp: error en el avance en segundo plano: {e}")
+                finally:
+                    # El hilo usa su propia sesión (scoped_session): liberarla
+                    try:
+                        if motor is not None:
+                            motor.db.session.remove()
+                    except Exception:
+                        pass
+
+        _HILO = threading.Thread(target=_runner, name='WA-Campanias', daemon=True)
+        _HILO.start()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WhatsApp Clientes - Configuración y cliente de WhatsApp compartidos por base
+
+Cada base (tenant) tiene una instalación con la configuración ya decodificada (la fila activa
+de whatsapp_config con el token descifrado con WABA_ENCRYPTION_KEY, más las preferencias y las
+reglas anti-spam de `configuracion`), la sesión HTTP hacia graph.facebook.com y el cliente
+PyWa, que se crea una sola vez. WhatsAppManager y MessageLogger leen de aquí en lugar de
+consultar la base cada vez que se construyen.
+
+La configuración se relee cada WHATSAPP_CONFIG_TTL_SEG segundos (300) para ver lo que guardan
+otras instancias; guardar_configuracion (POST /api/whatsapp/config) la invalida en el momento.
+Al salir del proceso se cierran las sesiones HTTP.
+"""
+
+import os
+import time
+import atexit
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from .antispam import CLAVES_CONFIGURACION
+from .secure_config import SecureConfig
+from .database.estadisticas_whatsapp import clave_base
+try:
+    import requests  # type: ignore
+except Exception:
+    requests = None  # type: ignore
+
+# Preferencias de WhatsApp guardadas en la tabla configuracion
+PREFERENCIAS = ('allowlist_numbers', 'allowlist_enabled', 'enable_webhook', 'max_retries', 'retry_delay_seconds')
+CREDENCIALES = ('phone_id', 'waba_id', 'access_token')
+
+
+class _Instalacion:
+    __slots__ = ('config', 'cargado', 'cliente', 'http', 'lock')
+
+    def __init__(self):
+        self.config: Optional[Dict[str, Any]] = None
+        self.cargado = 0.0
+        self.cliente = None
+        self.http = None
+        self.lock = threading.Lock()
+
+
+_INSTALACIONES: Dict[str, _Instalacion] = {}
+_LOCK = threading.Lock()
+
+
+def _ttl_s() -> float:
+    try:
+        return max(0.0, float(os.getenv('WHATSAPP_CONFIG_TTL_SEG', '300')))
+    except Exception:
+        return 300.0
+
+
+def _instalacion(db) -> _Instalacion:
+    clave = clave_base(db)
+    with _LOCK:
+        inst = _INSTALACIONES.get(clave)
+        if inst is None:
+            inst = _INSTALACIONES[clave] = _Instalacion()
+    return inst
+
+
+def _descifrar(valor: Optional[str]) -> str:
+    valor = str(valor or '').strip()
+    if not valor:
+        return ''
+    claro = SecureConfig.decrypt_waba_secret(valor)
+    # Los tokens guardados antes de configurar WABA_ENCRYPTION_KEY quedaron en claro
+    if not claro and not valor.startswith('gAAAAA'):
+        return valor
+    return claro
+
+
+def _cargar(db) -> Dict[str, Any]:
+    """Configuración de la base con el token descifrado; sin fila en whatsapp_config se usa el entorno."""
+    from .database.repositories.whatsapp_repository import WhatsappRepository
+    claves = list(PREFERENCIAS) + list(CLAVES_CONFIGURACION.values())
+    cfg = WhatsappRepository(db, None, None).obtener_configuracion_whatsapp_completa(claves)
+    cfg['phone_id'] = str(cfg.get('phone_id') or os.getenv('WHATSAPP_PHONE_ID') or '').strip()
+    cfg['waba_id'] = str(cfg.get('waba_id') or os.getenv('WHATSAPP_BUSINESS_ACCOUNT_ID') or '').strip()
+    cfg['access_token'] = _descifrar(cfg.get('access_token')) or SecureConfig.get_whatsapp_access_token() or ''
+    cfg['allowlist'] = frozenset(n.strip() for n in str(cfg.get('allowlist_numbers') or '').split(',') if n.strip())
+    return cfg
+
+
+def configuracion(db) -> Dict[str, Any]:
+    """Copia de la configuración de WhatsApp de la base (ver _cargar), recargada pasado el TTL.
+
+    Si cambian las credenciales se descarta el cliente PyWa para que el próximo se cree con las nuevas.
+    """
+    inst = _instalacion(db)
+    with inst.lock:
+        if inst.config is None or time.monotonic() - inst.cargado >= _ttl_s():
+            try:
+                nueva = _cargar(db)
+            except Exception as e:
+                logging.error(f"Error cargando configuración de WhatsApp: {e}")
+                return dict(inst.config or {})
+            if inst.config is not None and any(nueva[k] != inst.config.get(k) for k in CREDENCIALES):
+                inst.cliente = None
+            inst.config, inst.cargado = nueva, time.monotonic()
+        return dict(inst.config)
+
+
+def cliente(db):
+    """Cliente PyWa de la base, creado la primera vez que se pide; None si no hay token."""
+    configuracion(db)
+    inst = _instalacion(db)
+    with inst.lock:
+        cfg = inst.config or {}
+        if inst.cliente is None and cfg.get('access_token'):
+            from pywa import WhatsApp
+            inst.cliente = WhatsApp(
+                phone_id=cfg['phone_id'], token=cfg['access_token'], business_account_id=cfg['waba_id'],
+            )
+            logging.info(f"WhatsApp client inicializado | Phone ID: {cfg['phone_id']} | WABA ID: {cfg['waba_id']}")
+        return inst.cliente
+
+
+def cliente_existente(db):
+    """Cliente PyWa ya creado para la base, sin crearlo ni leer la configuración."""
+    with _LOCK:
+        inst = _INSTALACIONES.get(clave_base(db))
+    return inst.cliente if inst is not None else None
+
+
+def sesion_http(db):
+    """Sesión HTTP de la base: reutiliza conexiones (keep-alive/TLS) con graph.facebook.com."""
+    inst = _instalacion(db)
+    with inst.lock:
+        if inst.http is None:
+            inst.http = requests.Session()
+        return inst.http
+
+
+def invalidar(db) -> None:
+    """Descarta la configuración y el cliente de la base; la sesión HTTP no lleva credenciales y se conserva."""
+    with _LOCK:
+        inst = _INSTALACIONES.get(clave_base(db))
+    if inst is not None:
+        with inst.lock:
+            inst.config = None
+            inst.cliente = None
+
+
+def guardar_configuracion(db, credenciales: Dict[str, Optional[str]] = None, valores: Dict[str, Any] = None) -> None:
+    """Guarda credenciales (phone_id, waba_id, access_token; las None no se tocan) y valores de
+    `configuracion`, con el token cifrado, e invalida la instalación de la base."""
+    from .database.repositories.whatsapp_repository import WhatsappRepository
+    credenciales = {k: str(v).strip() for k, v in (credenciales or {}).items() if k in CREDENCIALES and v is not None}
+    if credenciales.get('access_token'):
+        credenciales['access_token'] = SecureConfig.encrypt_waba_secret(credenciales['access_token'])
+    WhatsappRepository(db, None, None).guardar_configuracion_whatsapp(credenciales, valores or {})
+    invalidar(db)
+
+
+def cerrar() -> None:
+    """Cierra las sesiones HTTP y suelta los clientes de todas las bases (al salir del proceso)."""
+    with _LOCK:
+        instalaciones = list(_INSTALACIONES.values())
+        _INSTALACIONES.clear()
+    for inst in instalaciones:
+        with inst.lock:
+            http, inst.http, inst.cliente, inst.config = inst.http, None, None, None
+        if http is not None:
+            try:
+                http.close()
+            except Exception:
+                pass
+
+
+atexit.register(cerrar)
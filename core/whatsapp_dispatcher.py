@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WhatsApp Dispatcher - Envío de mensajes desde el outbox persistido
+
+Los mensajes se encolan en whatsapp_outbox (misma base del gimnasio) y un pool fijo de
+workers asyncio los envía por un único cliente HTTP con keep-alive hacia Graph API,
+con un token bucket por phone_number_id compartido por todo el proceso, backoff
+exponencial ante 429/5xx y una idempotency_key por mensaje que evita encolar (y
+enviar) dos veces lo mismo.
+Toda la base de datos se usa desde un único hilo auxiliar; los workers sólo hacen HTTP.
+"""
+
+import os
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import httpx  # type: ignore
+except Exception:
+    httpx = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+GRAPH_URL = "https://graph.facebook.com"
+# Errores de Graph API que conviene reintentar aunque no vengan como 429/5xx
+# (130429: throughput del número, 131056: demasiados mensajes al mismo destinatario, 131000/131016: transitorios)
+CODIGOS_REINTENTABLES = {4, 80007, 130429, 131000, 131016, 131056}
+
+
+def _env_int(nombre: str, defecto: int) -> int:
+    try:
+        return int(os.getenv(nombre, str(defecto)))
+    except Exception:
+        return defecto
+
+
+def _env_float(nombre: str, defecto: float) -> float:
+    try:
+        return float(os.getenv(nombre, str(defecto)))
+    except Exception:
+        return defecto
+
+
+def clave_idempotencia(telefono: str, payload: Dict[str, Any], message_type: Optional[str] = None) -> str:
+    """Clave por defecto: mismo destinatario y mismo contenido dentro del mismo minuto.
+
+    Cubre dobles clics y reintentos tras un timeout sin impedir reenvíos posteriores; quien
+    tenga una clave natural (p.ej. 'audit:<id>') debe pasarla explícitamente.
+    """
+    import json
+    base = json.dumps([str(telefono), message_type or '', payload, datetime.now().strftime('%Y%m%d%H%M')],
+                      sort_keys=True, default=str)
+    return 'auto:' + hashlib.sha256(base.encode('utf-8')).hexdigest()[:40]
+
+
+class LimitadorTasaAsync:
+    """Token bucket para corrutinas: como máximo `por_segundo` envíos por segundo (con ráfaga).
+
+    El estado se protege con un lock de hilos y cada llamada reserva su turno antes de
+    dormir, así el mismo limitador sirve a despachadores de distintos hilos y event loops.
+    """
+
+    def __init__(self, por_segundo: float, rafaga: Optional[int] = None):
+        self.por_segundo = max(float(por_segundo), 0.1)
+        self.capacidad = float(rafaga or max(1, int(self.por_segundo)))
+        self._tokens = self.capacidad
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _recargar(self) -> None:
+        ahora = time.monotonic()
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.por_segundo)
+        self._ultimo = ahora
+
+    async def adquirir(self) -> None:
+        with self._lock:
+            self._recargar()
+            self._tokens -= 1
+            espera = -self._tokens / self.por_segundo if self._tokens < 0 else 0.0
+        if espera > 0:
+            await asyncio.sleep(espera)
+
+    def penalizar(self, segundos: float) -> None:
+        """Tras un 429 de throughput: vacía el bucket para frenar a todos los workers del número."""
+        with self._lock:
+            self._recargar()
+            self._tokens = min(self._tokens, 1 - max(float(segundos), 0.0) * self.por_segundo)
+
+
+# Un limitador por phone_number_id para todo el proceso: sobrevive entre corridas del
+# dispatcher (cron, despacho en segundo plano). El tope es por proceso; con varias
+# instancias cada una aplica el suyo, así que WHATSAPP_OUTBOX_MPS debe repartirse entre ellas.
+_LIMITADORES: Dict[str, LimitadorTasaAsync] = {}
+_LIMITADORES_LOCK = threading.Lock()
+
+
+def limitador_tasa(phone_number_id: str, por_segundo: float) -> LimitadorTasaAsync:
+    """Limitador compartido del número; si cambió la tasa configurada se crea uno nuevo."""
+    with _LIMITADORES_LOCK:
+        limitador = _LIMITADORES.get(phone_number_id)
+        if limitador is None or limitador.por_segundo != max(float(por_segundo), 0.1):
+            limitador = _LIMITADORES[phone_number_id] = LimitadorTasaAsync(por_segundo)
+        return limitador
+
+
+class WhatsAppDispatcher:
+    """Vacía el outbox de WhatsApp de una base.
+
+    Configuración por entorno:
+    - WHATSAPP_GRAPH_URL: base de Graph API (permite apuntar a un servidor local de prueba).
+    - WHATSAPP_OUTBOX_MPS: mensajes por segundo por phone_number_id y por proceso (80 en el tier
+      estándar de la Cloud API); con varias instancias, dividirlo entre ellas.
+    - WHATSAPP_OUTBOX_WORKERS: envíos concurrentes.
+    - WHATSAPP_OUTBOX_MAX_INTENTOS / WHATSAPP_OUTBOX_BACKOFF_S / WHATSAPP_OUTBOX_BACKOFF_MAX_S: reintentos.
+    - WHATSAPP_OUTBOX_TIEMPO_MAXIMO_S: presupuesto por corrida (timeout de la función serverless).
+    """
+
+    def __init__(self, session_factory: Callable[[], Any], access_token: Optional[str],
+                 api_version: str = 'v19.0', send_timeout_seconds: float = 10.0):
+        self.session_factory = session_factory
+        self.access_token = access_token
+        self.api_version = api_version
+        self.base_url = (os.getenv('WHATSAPP_GRAPH_URL') or GRAPH_URL).rstrip('/')
+        self.mensajes_por_segundo = _env_float('WHATSAPP_OUTBOX_MPS', 80.0)
+        self.workers = max(1, _env_int('WHATSAPP_OUTBOX_WORKERS', 8))
+        self.max_intentos = max(1, _env_int('WHATSAPP_OUTBOX_MAX_INTENTOS', 6))
+        self.backoff_base_s = max(0.1, _env_float('WHATSAPP_OUTBOX_BACKOFF_S', 2.0))
+        self.backoff_max_s = max(1.0, _env_float('WHATSAPP_OUTBOX_BACKOFF_MAX_S', 900.0))
+        self.tiempo_maximo_s = _env_float('WHATSAPP_OUTBOX_TIEMPO_MAXIMO_S', 50.0)
+        self.send_timeout_seconds = max(1.0, float(send_timeout_seconds or 10.0))
+        self.lote_registro = max(1, _env_int('WHATSAPP_OUTBOX_LOTE_REGISTRO', 50))
+
+    # --- Base de datos (siempre desde el mismo hilo auxiliar) ---
+
+    def _repo(self):
+        from .database.repositories.whatsapp_repository import WhatsappRepository
+        return WhatsappRepository(self.session_factory(), None, logger)
+
+    def _cerrar_sesion(self) -> None:
+        remove = getattr(self.session_factory, 'remove', None)
+        if callable(remove):
+            remove()
+
+    # --- Envío ---
+
+    def _limitador(self, phone_number_id: str) -> LimitadorTasaAsync:
+        return limitador_tasa(phone_number_id, self.mensajes_por_segundo)
+
+    def _demora(self, intentos: int, retry_after: Optional[str] = None) -> float:
+        try:
+            if retry_after:
+                return min(max(float(retry_after), 1.0), self.backoff_max_s)
+        except ValueError:
+            pass
+        demora = min(self.backoff_base_s * (2 ** max(intentos - 1, 0)), self.backoff_max_s)
+        return demora * random.uniform(0.5, 1.0)
+
+    def _resultado(self, item: Dict[str, Any], estado: str, **extra) -> Dict[str, Any]:
+        payload = item.get('payload') or {}
+        return {
+            'id': item['id'], 'estado': estado, 'telefono': item['telefono'], 'user_id': item.get('user_id'),
+            'idempotency_key': item.get('idempotency_key'), 'message_type': item.get('message_type'), 'contenido': item.get('contenido'),
+            'template_name': (payload.get('template') or {}).get('name') or payload.get('type'),
+            **extra,
+        }
+
+    def _fallo(self, item: Dict[str, Any], error: str, reintentable: bool,
+               retry_after: Optional[str] = None) -> Dict[str, Any]:
+        if reintentable and int(item.get('intentos') or 1) < self.max_intentos:
+            return self._resultado(item, 'pendiente', error=error,
+                                   demora_s=self._demora(int(item.get('intentos') or 1), retry_after))
+        return self._resultado(item, 'fallido', error=error)
+
+    async def _enviar(self, client, item: Dict[str, Any]) -> Dict[str, Any]:
+        limitador = self._limitador(item['phone_number_id'])
+        await limitador.adquirir()
+        cuerpo = dict(item['payload'] or {}, messaging_product='whatsapp', to=item['telefono'])
+        # Vuelve en los webhooks de estado: permite conciliar un envío con su fila del outbox
+        cuerpo.setdefault('biz_opaque_callback_data', item['idempotency_key'])
+        try:
+            resp = await client.post(f"/{self.api_version}/{item['phone_number_id']}/messages", json=cuerpo)
+        except httpx.HTTPError as e:
+            return self._fallo(item, f"{type(e).__name__}: {e}", reintentable=True)
+        try:
+            data = resp.json()
+        except Exception:
+            data = {'text': resp.text[:500]}
+        if 200 <= resp.status_code < 300:
+            mensajes = (data or {}).get('messages') or [{}]
+            return self._resultado(item, 'enviado', message_id=(mensajes[0] or {}).get('id'))
+        error = (data or {}).get('error') or {}
+        codigo = error.get('code') if isinstance(error, dict) else None
+        detalle = f"HTTP {resp.status_code}: {error.get('message') if isinstance(error, dict) else data}"
+        reintentable = resp.status_code == 429 or resp.status_code >= 500 or codigo in CODIGOS_REINTENTABLES
+        if resp.status_code == 429 or codigo == 130429:
+            limitador.penalizar(float(resp.headers.get('retry-after') or 1))
+        return self._fallo(item, detalle, reintentable, resp.headers.get('retry-after'))
+
+    async def _worker(self, client, cola: asyncio.Queue, resultados: List[Dict[str, Any]]) -> None:
+        while True:
+            item = await cola.get()
+            try:
+                if item is None:
+                    return
+                try:
+                    resultados.append(await self._enviar(client, item))
+                except Exception as e:
+                    logger.error(f"Outbox WhatsApp: error enviando {item.get('id')}: {e}")
+                    resultados.append(self._fallo(item, str(e), reintentable=True))
+            finally:
+                cola.task_done()
+
+    async def procesar_async(self, tiempo_maximo_s: Optional[float] = None) -> Dict[str, Any]:
+        """Envía lo que haya listo en el outbox hasta vaciarlo o agotar el presupuesto de tiempo."""
+        if httpx is None:
+            raise RuntimeError("httpx no está instalado: no se puede despachar el outbox")
+        if not self.access_token:
+            raise RuntimeError("WhatsApp no configurado (access_token)")
+        inicio = time.monotonic()
+        limite = inicio + (tiempo_maximo_s if tiempo_maximo_s is not None else self.tiempo_maximo_s)
+        loop = asyncio.get_running_loop()
+        db = ThreadPoolExecutor(max_workers=1, thread_name_prefix='WA-Outbox-DB')
+        repo = await loop.run_in_executor(db, self._repo)
+        resumen = {'enviados': 0, 'reintentos': 0, 'fallidos': 0, 'duracion_s': 0.0}
+        resultados: List[Dict[str, Any]] = []
+
+        async def _volcar():
+            if not resultados:
+                return
+            lote = list(resultados)
+            resultados.clear()
+            await loop.run_in_executor(db, repo.registrar_resultados_outbox, lote)
+            for r in lote:
+                resumen[{'enviado': 'enviados', 'pendiente': 'reintentos', 'fallido': 'fallidos'}[r['estado']]] += 1
+
+        cola: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        limites = httpx.Limits(max_connections=self.workers, max_keepalive_connections=self.workers)
+        try:
+            async with httpx.AsyncClient(
+                base_url=self.base_url, limits=limites, timeout=self.send_timeout_seconds,
+                headers={'Authorization': f"Bearer {self.access_token}"},
+            ) as client:
+                tareas = [asyncio.ensure_future(self._worker(client, cola, resultados)) for _ in range(self.workers)]
+                try:
+                    while time.monotonic() < limite:
+                        # El bloqueo cubre el tiempo que el lote puede esperar en cola más el envío
+                        lote = await loop.run_in_executor(
+                            db, repo.reclamar_outbox, self.workers * 2,
+                            int(self.send_timeout_seconds * 4 + 60),
+                        )
+                        if not lote:
+                            break
+                        for item in lote:
+                            await cola.put(item)
+                        if len(resultados) >= self.lote_registro:
+                            await _volcar()
+                    await cola.join()
+                finally:
+                    for _ in tareas:
+                        await cola.put(None)
+                    await asyncio.gather(*tareas, return_exceptions=True)
+            await _volcar()
+        finally:
+            await loop.run_in_executor(db, self._cerrar_sesion)
+            db.shutdown(wait=False)
+        resumen['duracion_s'] = round(time.monotonic() - inicio, 3)
+        if resumen['enviados'] or resumen['reintentos'] or resumen['fallidos']:
+            logger.info(f"Outbox WhatsApp: {resumen}")
+        return resumen
+
+    def procesar(self, tiempo_maximo_s: Optional[float] = None) -> Dict[str, Any]:
+        """Versión síncrona para hilos sin event loop (cron, scripts)."""
+        return asyncio.run(self.procesar_async(tiempo_maximo_s))
+
+
+# Un solo despachador en segundo plano por proceso: los envíos encolados mientras corre
+# quedan para la vuelta siguiente, que se dispara sola si hubo pedidos nuevos.
+_HILO: Optional[threading.Thread] = None
+_HILO_LOCK = threading.Lock()
+_PEDIDO = threading.Event()
+
+
+def despachar_en_segundo_plano(crear: Callable[[], WhatsAppDispatcher]) -> None:
+    """Dispara el vaciado del outbox sin bloquear a quien encoló."""
+    global _HILO
+    with _HILO_LOCK:
+        _PEDIDO.set()
+        if _HILO is not None and _HILO.is_alive():
+            return
+
+        def _runner():
+            global _HILO
+            while True:
+                with _HILO_LOCK:
+                    if not _PEDIDO.is_set():
+                        _HILO = None
+                        return
+                    _PEDIDO.clear()
+                try:
+                    crear().procesar()
+                except Exception as e:
+                    logger.error(f"Outbox WhatsApp: error en despacho en segundo plano: {e}")
+
+        _HILO = threading.Thread(target=_runner, name='WA-Outbox', daemon=True)
+        _HILO.start()
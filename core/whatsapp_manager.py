@@ -6,10 +6,10 @@ Gestiona el envío de mensajes automáticos para el gimnasio
 """
 
 import os
+import time
 import logging
 import asyncio
 import threading
-import psycopg2.extras
 import json
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any, List
@@ -19,31 +19,35 @@ from pywa.types.templates import TemplateLanguage, BodyText, HeaderImage, Header
 from .database import DatabaseManager
 from .template_processor import TemplateProcessor
 from .message_logger import MessageLogger
+from . import whatsapp_clientes
 from typing import Any, Dict, List, Optional
 try:
     import requests  # type: ignore
 except Exception:
     requests = None  # type: ignore
 
+# Tipo de mensaje (whatsapp_messages.message_type) según fragmento del nombre de plantilla
+TIPOS_POR_PLANTILLA = (
+    ('confirmacion_de_pago', 'payment'),
+    ('vencimiento_de_cuota', 'overdue'),
+    ('confirmacion_de_ingreso', 'welcome'),
+    ('bienvenida', 'welcome'),
+    ('desactivacion', 'deactivation'),
+    ('horario_de_clase', 'class_reminder'),
+    ('lista_de_espera', 'waitlist'),
+    ('lista_principal', 'waitlist'),
+)
+
 class WhatsAppManager:
     """Gestor de mensajes WhatsApp usando PyWa"""
     
     def __init__(self, database_manager: DatabaseManager, defer_init: bool = True):
         """Inicializa el gestor; permite diferir la creación del cliente para no bloquear la UI"""
-        # Cargar configuración desde base de datos y entorno (sin hardcodes)
+        # Configuración de la base ya decodificada, compartida por todas las instancias (whatsapp_clientes)
         self.db = database_manager
-        cfg = {}
-        try:
-            cfg = self.db.obtener_configuracion_whatsapp_completa() or {}
-        except Exception:
-            cfg = {}
-
-        # IDs de WhatsApp Business
-        self.phone_number_id = str(cfg.get('phone_id') or "")
-        self.whatsapp_business_account_id = str(cfg.get('waba_id') or "")
-
-        # Token de acceso
-        self.access_token = cfg.get('access_token')
+        self.phone_number_id = ""
+        self.whatsapp_business_account_id = ""
+        self.access_token = None
         
         self.template_processor = TemplateProcessor(database_manager)
         self.message_logger = MessageLogger(database_manager)
@@ -65,6 +69,8 @@ class WhatsAppManager:
             self._send_timeout_seconds = 1.5
         self._nonblocking_send = (os.getenv("NONBLOCKING_WHATSAPP_SEND", "1") == "1")
         self._send_max_blocking_retries = 0  # evitar duplicados si hay timeout
+        # Outbox persistido + despachador asíncrono (core/whatsapp_dispatcher.py) en lugar de un hilo por envío
+        self._outbox_habilitado = (os.getenv("WHATSAPP_OUTBOX", "1") == "1")
 
         # Preferencias avanzadas y listas
         self._allowlist_enabled = False
@@ -72,7 +78,9 @@ class WhatsAppManager:
         self._max_init_retries = 3
         self._retry_base_delay_seconds = 5
         self._init_lock = asyncio.Lock()
+        self._init_en_curso = False
         self._stop_init = False
+        self._aplicar_configuracion(whatsapp_clientes.configuracion(self.db.session))
         
         # Configurar logging
         logging.basicConfig(level=logging.INFO)
@@ -82,36 +90,37 @@ class WhatsAppManager:
         if not self._init_deferred:
             self._initialize_client()
 
+    def _aplicar_configuracion(self, cfg: Dict[str, Any]) -> None:
+        """Toma credenciales, allowlist y reintentos de la configuración de whatsapp_clientes."""
+        self._config = cfg
+        self.phone_number_id = str(cfg.get('phone_id') or "")
+        self.whatsapp_business_account_id = str(cfg.get('waba_id') or "")
+        self.access_token = cfg.get('access_token') or None
+
+        # Allowlist: números separados por comas en 'allowlist_numbers' y flag 'allowlist_enabled'
+        self._allowlist = set(cfg.get('allowlist') or ())
+        self._allowlist_enabled = str(cfg.get('allowlist_enabled', 'false')).lower() == 'true'
+
+        # Reintentos/backoff configurables
+        try:
+            self._max_init_retries = int(cfg.get('max_retries', self._max_init_retries))
+        except Exception:
+            pass
+        try:
+            self._retry_base_delay_seconds = int(cfg.get('retry_delay_seconds', self._retry_base_delay_seconds))
+        except Exception:
+            pass
+
     def reinicializar_configuracion(self) -> None:
         """Recarga configuración desde DB y aplica preferencias sin bloquear UI."""
         try:
-            cfg = None
-            try:
-                # Cargar configuración completa si está disponible
-                cfg = self.db.obtener_configuracion_whatsapp_completa()
-            except Exception:
-                cfg = {}
-
-            self._config = cfg or {}
+            credenciales = (self.phone_number_id, self.whatsapp_business_account_id, self.access_token)
+            self._aplicar_configuracion(whatsapp_clientes.configuracion(self.db.session))
 
-            # Allowlist: números separados por comas en 'allowlist_numbers' y flag 'allowlist_enabled'
-            raw_allow = str(self._config.get('allowlist_numbers', '') or '').strip()
-            numbers = [n.strip() for n in raw_allow.split(',') if n.strip()]
-            self._allowlist = set(numbers)
-            try:
-                self._allowlist_enabled = str(self._config.get('allowlist_enabled', 'false')).lower() == 'true'
-            except Exception:
-                self._allowlist_enabled = False
-
-            # Reintentos/backoff configurables
-            try:
-                self._max_init_retries = int(self._config.get('max_retries', self._max_init_retries))
-            except Exception:
-                pass
-            try:
-                self._retry_base_delay_seconds = int(self._config.get('retry_delay_seconds', self._retry_base_delay_seconds))
-            except Exception:
-                pass
+            # Con credenciales nuevas el cliente actual queda viejo: se toma el de la base al inicializar
+            if credenciales != (self.phone_number_id, self.whatsapp_business_account_id, self.access_token):
+                self.wa_client = None
+                self._client_initialized = False
 
             # Si ya hay cliente, no bloquear; solo actualizar handlers según config
             try:
@@ -139,6 +148,14 @@ class WhatsAppManager:
         max_r = max_retries if isinstance(max_retries, int) and max_retries >= 0 else self._max_init_retries
         base_delay = delay_seconds if (isinstance(delay_seconds, (int, float)) and delay_seconds >= 0) else self._retry_base_delay_seconds
 
+        # Si la base ya tiene cliente (u otro hilo lo está creando) no hace falta un hilo más
+        if self._client_initialized or self._init_en_curso:
+            return
+        if whatsapp_clientes.cliente_existente(self.db.session) is not None:
+            self._initialize_client()
+            return
+        self._init_en_curso = True
+
         def _runner():
             try:
                 # Evitar ejecuciones concurrentes
@@ -164,15 +181,18 @@ class WhatsAppManager:
                 loop.run_until_complete(_init_with_lock())
             except Exception as e:
                 logging.error(f"Error en initialize_async: {e}")
+            finally:
+                self._init_en_curso = False
 
         t = threading.Thread(target=_runner, daemon=True)
         t.start()
 
-    # --- Fallback cuando WhatsApp no está disponible: no-op sin gestor anterior ---
+    # --- Fallback cuando WhatsApp no está disponible ---
     def _enqueue_offline_op(self, func_name: str, kwargs: Dict[str, Any]) -> bool:
         """Registra la intención de enviar cuando WhatsApp no está disponible.
 
-        Se elimina el acoplamiento con el gestor anterior OfflineSyncManager.
+        Los mensajes ya compuestos se persisten en el outbox desde _send_message/_send_template;
+        aquí sólo llegan operaciones que fallaron antes de componerse, que no se reintentan.
         Retorna False para indicar que no se encoló.
         """
         try:
@@ -180,25 +200,58 @@ class WhatsAppManager:
         except Exception:
             pass
         return False
-    
+
+    # --- Outbox ---
+    def _envio_disponible(self) -> bool:
+        """True si hay cliente PyWa o, con outbox, credenciales para que el despachador envíe."""
+        if self.wa_client:
+            return True
+        return bool(self._outbox_habilitado and self.access_token and str(self.phone_number_id or '').strip())
+
+    def _crear_dispatcher(self):
+        from .whatsapp_dispatcher import WhatsAppDispatcher
+        return WhatsAppDispatcher(
+            self.db.session, self.access_token, api_version=self._api_version,
+            send_timeout_seconds=max(self._send_timeout_seconds, 10.0),
+        )
+
+    def encolar_mensaje(self, telefono: str, payload: Dict[str, Any], message_type: Optional[str] = None,
+                        user_id: Optional[int] = None, contenido: Optional[str] = None,
+                        idempotency_key: Optional[str] = None) -> bool:
+        """Persiste un mensaje (cuerpo Graph API sin 'to') en el outbox y dispara su envío en segundo plano.
+
+        Devuelve True si quedó encolado o ya lo estaba (misma idempotency_key).
+        """
+        from .whatsapp_dispatcher import clave_idempotencia, despachar_en_segundo_plano
+        clave = idempotency_key or clave_idempotencia(telefono, payload, message_type)
+        nuevos = self.db.whatsapp.encolar_outbox([{
+            'idempotency_key': clave, 'phone_number_id': str(self.phone_number_id or '').strip(),
+            'telefono': str(telefono).strip(), 'payload': payload, 'user_id': user_id,
+            'message_type': message_type, 'contenido': contenido,
+        }])
+        if not nuevos:
+            logging.info(f"WhatsApp outbox: mensaje ya encolado ({clave}), se omite duplicado")
+        despachar_en_segundo_plano(self._crear_dispatcher)
+        return True
+
+    async def procesar_outbox_async(self, tiempo_maximo_s: Optional[float] = None) -> Dict[str, Any]:
+        """Vacía el outbox desde un endpoint async (cron); ver WhatsAppDispatcher.procesar_async."""
+        return await self._crear_dispatcher().procesar_async(tiempo_maximo_s)
+
     def _initialize_client(self):
-        """Inicializa el cliente de WhatsApp con los datos configurados"""
+        """Toma el cliente PyWa de la base (whatsapp_clientes lo crea una sola vez por base)"""
         try:
+            # Credenciales vigentes antes de tomar el cliente, que se crea con ellas
+            self.reinicializar_configuracion()
             if not self.access_token:
                 logging.error("WhatsApp: Access Token no configurado")
                 return False
-            # Inicializar cliente PyWa con los parámetros correctos
-            self.wa_client = WhatsApp(
-                phone_id=self.phone_number_id,
-                token=self.access_token,
-                business_account_id=self.whatsapp_business_account_id
-            )
-            logging.info("WhatsApp client inicializado correctamente")
-            logging.info(f"Phone ID: {self.phone_number_id} | WABA ID: {self.whatsapp_business_account_id}")
+            self.wa_client = whatsapp_clientes.cliente(self.db.session)
+            if not self.wa_client:
+                return False
             self._client_initialized = True
-            # Cargar/actualizar configuración tras init
             try:
-                self.reinicializar_configuracion()
+                self._setup_message_handlers()
             except Exception:
                 pass
             return True
@@ -272,8 +325,12 @@ class WhatsAppManager:
         else:
             return False, result["err"]
 
-    def _send_message(self, to: str, text: str):
-        """Envía mensaje simple con política non-blocking/timeout."""
+    def _send_message(self, to: str, text: str, message_type: Optional[str] = None,
+                      user_id: Optional[int] = None, idempotency_key: Optional[str] = None):
+        """Envía mensaje simple: por el outbox si está habilitado, si no con política non-blocking/timeout."""
+        if self._outbox_habilitado and self._envio_disponible():
+            payload = {"type": "text", "text": {"body": text}}
+            return self.encolar_mensaje(to, payload, message_type, user_id, text, idempotency_key), None
         if not self.wa_client:
             raise RuntimeError("wa_client no inicializado")
         if self._nonblocking_send:
@@ -300,6 +357,40 @@ class WhatsAppManager:
         # Valor por defecto razonable
         return "es"
 
+    def _payload_plantilla(self, name: str, language: Any, body_params: List[Any],
+                           header_image_url: Optional[str] = None, header_text: Optional[str] = None) -> Dict[str, Any]:
+        """Cuerpo Graph API de una plantilla básica (sin messaging_product/to)."""
+        components: List[Dict[str, Any]] = []
+        # Header image o texto si aplica
+        if header_image_url:
+            components.append({
+                "type": "header",
+                "parameters": [
+                    {"type": "image", "image": {"link": header_image_url}}
+                ]
+            })
+        elif header_text:
+            components.append({
+                "type": "header",
+                "parameters": [
+                    {"type": "text", "text": header_text}
+                ]
+            })
+        # Body con parámetros de texto
+        if body_params and isinstance(body_params, list):
+            components.append({
+                "type": "body",
+                "parameters": [{"type": "text", "text": str(p)} for p in body_params]
+            })
+        return {
+            "type": "template",
+            "template": {
+                "name": name,
+                "language": {"code": self._get_language_code(language)},
+                "components": components
+            }
+        }
+
     def _send_template_http_basic(self, to: str, name: str, language: Any, body_params: List[str], header_image_url: Optional[str] = None, header_text: Optional[str] = None):
         """Fallback HTTP directo al Graph API para enviar una plantilla básica.
 
@@ -315,46 +406,19 @@ class WhatsAppManager:
             if not phone_id:
                 return False, {"error": "phone_number_id no configurado"}
 
-            url = f"https://graph.facebook.com/{self._api_version}/{phone_id}/messages"
+            base_url = (os.getenv('WHATSAPP_GRAPH_URL') or 'https://graph.facebook.com').rstrip('/')
+            url = f"{base_url}/{self._api_version}/{phone_id}/messages"
             headers = {
                 "Authorization": f"Bearer {self.access_token}",
                 "Content-Type": "application/json"
             }
-            components: List[Dict[str, Any]] = []
-            # Header image o texto si aplica
-            if header_image_url:
-                components.append({
-                    "type": "header",
-                    "parameters": [
-                        {"type": "image", "image": {"link": header_image_url}}
-                    ]
-                })
-            elif header_text:
-                components.append({
-                    "type": "header",
-                    "parameters": [
-                        {"type": "text", "text": header_text}
-                    ]
-                })
-            # Body con parámetros de texto
-            if body_params and isinstance(body_params, list):
-                components.append({
-                    "type": "body",
-                    "parameters": [{"type": "text", "text": str(p)} for p in body_params]
-                })
-
             payload = {
                 "messaging_product": "whatsapp",
                 "to": to,
-                "type": "template",
-                "template": {
-                    "name": name,
-                    "language": {"code": self._get_language_code(language)},
-                    "components": components
-                }
+                **self._payload_plantilla(name, language, body_params, header_image_url, header_text)
             }
 
-            resp = requests.post(url, headers=headers, json=payload, timeout=self._send_timeout_seconds)
+            resp = whatsapp_clientes.sesion_http(self.db.session).post(url, headers=headers, json=payload, timeout=self._send_timeout_seconds)
             ok = 200 <= int(getattr(resp, "status_code", 500)) < 300
             try:
                 data = resp.json() if hasattr(resp, "json") else {}
@@ -372,10 +436,23 @@ class WhatsAppManager:
             logging.error(f"Error en HTTP fallback de plantilla: {e}")
             return False, {"error": str(e)}
 
-    def _send_template(self, to: str, name: str, language: TemplateLanguage, params: list):
-        """Envía plantilla con política non-blocking/timeout."""
+    def _send_template(self, to: str, name: str, language: TemplateLanguage, body_params: List[Any],
+                       header_image_url: Optional[str] = None, header_text: Optional[str] = None,
+                       user_id: Optional[int] = None, idempotency_key: Optional[str] = None):
+        """Envía plantilla: por el outbox si está habilitado, si no por PyWa con política non-blocking/timeout."""
+        if self._outbox_habilitado and self._envio_disponible():
+            payload = self._payload_plantilla(name, language, body_params, header_image_url, header_text)
+            message_type = next((t for frag, t in TIPOS_POR_PLANTILLA if frag in name), None)
+            contenido = f"{name}: {', '.join(str(p) for p in body_params or [])}"
+            return self.encolar_mensaje(to, payload, message_type, user_id, contenido, idempotency_key), None
         if not self.wa_client:
             raise RuntimeError("wa_client no inicializado")
+        params: List[Any] = []
+        if header_image_url:
+            params.append(HeaderImage.params(image=header_image_url))
+        elif header_text:
+            params.append(HeaderText.params(header_text))
+        params.append(BodyText.params(*body_params))
         if self._nonblocking_send:
             import threading
             threading.Thread(
@@ -408,7 +485,7 @@ class WhatsAppManager:
 
     def enviar_mensaje_simple(self, telefono: str, mensaje: str) -> bool:
         """Envía un mensaje de texto simple"""
-        if not self.wa_client:
+        if not self._envio_disponible():
             # Fallback: encolar para envío posterior
             return self._enqueue_offline_op('enviar_mensaje_simple', {'telefono': telefono, 'mensaje': mensaje})
         
@@ -473,7 +550,7 @@ class WhatsAppManager:
     def enviar_confirmacion_pago(self, usuario_id: int, pago_info: Dict[str, Any], force_send: bool = False) -> bool:
         """Envía confirmación de pago recibido usando plantilla real del SISTEMA WHATSAPP.txt"""
         try:
-            if not self.wa_client:
+            if not self._envio_disponible():
                 # Registrar fallo por cliente no inicializado y encolar operación completa
                 try:
                     u = self.db.obtener_usuario(usuario_id)
@@ -539,12 +616,10 @@ class WhatsAppManager:
                     to=usuario.telefono,
                     name=template_name,
                     language=TemplateLanguage.SPANISH_ARG,
-                    params=[
-                        BodyText.params(
-                            usuario.nombre,
-                            f"{pago_info.get('monto', 0):,.0f}",
-                            pago_info.get('fecha', datetime.now().strftime('%d/%m/%Y'))
-                        )
+                    body_params=[
+                        usuario.nombre,
+                        f"{pago_info.get('monto', 0):,.0f}",
+                        pago_info.get('fecha', datetime.now().strftime('%d/%m/%Y'))
                     ]
                 )
                 if not ok:
@@ -620,7 +695,7 @@ class WhatsAppManager:
             template_name = "aviso_de_vencimiento_de_cuota_gimnasio_para_usuario_especifico_en_sistema_de_management_de_gimnasios_profesional"
             
             # Si no hay cliente, usar fallback HTTP directo
-            if not self.wa_client:
+            if not self._envio_disponible():
                 ok, resp = self._send_template_http_basic(
                     to=usuario.telefono,
                     name=template_name,
@@ -661,12 +736,10 @@ class WhatsAppManager:
                     to=usuario.telefono,
                     name=template_name,
                     language=TemplateLanguage.SPANISH_ARG,
-                    params=[
-                        BodyText.params(
-                            usuario.nombre,
-                            pago_actual.get('fecha_vencimiento', 'No disponible'),
-                            f"{pago_actual.get('monto', 0) or 0:,.0f}"
-                        )
+                    body_params=[
+                        usuario.nombre,
+                        pago_actual.get('fecha_vencimiento', 'No disponible'),
+                        f"{pago_actual.get('monto', 0) or 0:,.0f}"
                     ]
                 )
                 if not ok:
@@ -750,7 +823,7 @@ class WhatsAppManager:
             template_name = "aviso_de_confirmacion_de_ingreso_a_gimnasio_para_usuario_especifico_en_sistema_de_management_de_gimnasios_profesional"
             
             # Si no hay cliente, intentar fallback HTTP
-            if not self.wa_client:
+            if not self._envio_disponible():
                 ok, resp = self._send_template_http_basic(
                     to=usuario.telefono,
                     name=template_name,
@@ -787,11 +860,9 @@ class WhatsAppManager:
                     to=usuario.telefono,
                     name=template_name,
                     language=TemplateLanguage.SPANISH_ARG,
-                    params=[
-                        BodyText.params(
-                            usuario.nombre,
-                            gym_name
-                        )
+                    body_params=[
+                        usuario.nombre,
+                        gym_name
                     ]
                 )
                 if not ok:
@@ -847,7 +918,7 @@ class WhatsAppManager:
     def enviar_notificacion_desactivacion(self, usuario_id: int, motivo: str = "Falta de pago", fecha_desactivacion: Optional[str] = None, force_send: bool = False) -> bool:
         """Envía notificación de desactivación de usuario por falta de pago"""
         try:
-            if not self.wa_client:
+            if not self._envio_disponible():
                 try:
                     u = self.db.obtener_usuario(usuario_id)
                     tel = getattr(u, 'telefono', None) if u else None
@@ -897,16 +968,14 @@ class WhatsAppManager:
             fecha = fecha_desactivacion or datetime.now().strftime('%d/%m/%Y')
 
             try:
-                response = self.wa_client.send_template(
+                ok, response = self._send_template(
                     to=usuario.telefono,
                     name=template_name,
                     language=TemplateLanguage.SPANISH_ARG,
-                    params=[
-                        BodyText.params(
-                            usuario.nombre,  # {{1}}
-                            fecha,           # {{2}}
-                            motivo           # {{3}}
-                        )
+                    body_params=[
+                        usuario.nombre,  # {{1}}
+                        fecha,           # {{2}}
+                        motivo           # {{3}}
                     ]
                 )
 
@@ -959,7 +1028,7 @@ class WhatsAppManager:
     def enviar_recordatorio_horario_clase(self, usuario_id: int, clase_info: Dict[str, Any], force_send: bool = False) -> bool:
         """Envía recordatorio de horario de clase (tipo, fecha y hora)"""
         try:
-            if not self.wa_client:
+            if not self._envio_disponible():
                 return self._enqueue_offline_op('enviar_recordatorio_horario_clase', {
                     'usuario_id': usuario_id,
                     'clase_info': clase_info
@@ -994,17 +1063,15 @@ class WhatsAppManager:
             hora = _safe_text(clase_info.get('hora'), 'Por confirmar')
 
             try:
-                response = self.wa_client.send_template(
+                ok, response = self._send_template(
                     to=usuario.telefono,
                     name=template_name,
                     language=TemplateLanguage.SPANISH_ARG,
-                    params=[
-                        BodyText.params(
-                            _safe_text(getattr(usuario, 'nombre', None), 'Alumno'),  # {{1}}
-                            tipo_clase,      # {{2}}
-                            fecha,           # {{3}}
-                            hora             # {{4}}
-                        )
+                    body_params=[
+                        _safe_text(getattr(usuario, 'nombre', None), 'Alumno'),  # {{1}}
+                        tipo_clase,      # {{2}}
+                        fecha,           # {{3}}
+                        hora             # {{4}}
                     ]
                 )
 
@@ -1035,7 +1102,7 @@ class WhatsAppManager:
     def enviar_promocion_lista_espera(self, usuario_id: int, clase_info: Dict[str, Any], force_send: bool = False) -> bool:
         """Aviso a primer persona en lista de espera: se liberó un cupo"""
         try:
-            if not self.wa_client:
+            if not self._envio_disponible():
                 return self._enqueue_offline_op('enviar_promocion_lista_espera', {
                     'usuario_id': usuario_id,
                     'clase_info': clase_info
@@ -1071,17 +1138,15 @@ class WhatsAppManager:
             hora = _safe_text(clase_info.get('hora'), 'Por confirmar')
 
             try:
-                response = self.wa_client.send_template(
+                ok, response = self._send_template(
                     to=usuario.telefono,
                     name=template_name,
                     language=TemplateLanguage.SPANISH_ARG,
-                    params=[
-                        BodyText.params(
-                            _safe_text(getattr(usuario, 'nombre', None), 'Alumno'),  # {{1}}
-                            tipo_clase,      # {{2}}
-                            fecha,           # {{3}}
-                            hora             # {{4}}
-                        )
+                    body_params=[
+                        _safe_text(getattr(usuario, 'nombre', None), 'Alumno'),  # {{1}}
+                        tipo_clase,      # {{2}}
+                        fecha,           # {{3}}
+                        hora             # {{4}}
                     ]
                 )
 
@@ -1112,7 +1177,7 @@ class WhatsAppManager:
     def enviar_promocion_a_lista_principal(self, usuario_id: int, clase_info: Dict[str, Any], force_send: bool = False) -> bool:
         """Aviso cuando un usuario pasa de lista de espera a lista principal"""
         try:
-            if not self.wa_client:
+            if not self._envio_disponible():
                 # Reutilizamos el mismo op offline para no romper el manejador existente
                 return self._enqueue_offline_op('enviar_promocion_lista_espera', {
                     'usuario_id': usuario_id,
@@ -1149,17 +1214,15 @@ class WhatsAppManager:
             hora = _safe_text(clase_info.get('hora'), 'Por confirmar')
 
             try:
-                response = self.wa_client.send_template(
+                ok, response = self._send_template(
                     to=usuario.telefono,
                     name=template_name,
                     language=TemplateLanguage.SPANISH_ARG,
-                    params=[
-                        BodyText.params(
-                            _safe_text(getattr(usuario, 'nombre', None), 'Alumno'),  # {{1}}
-                            tipo_clase,      # {{2}}
-                            fecha,           # {{3}}
-                            hora             # {{4}}
-                        )
+                    body_params=[
+                        _safe_text(getattr(usuario, 'nombre', None), 'Alumno'),  # {{1}}
+                        tipo_clase,      # {{2}}
+                        fecha,           # {{3}}
+                        hora             # {{4}}
                     ]
                 )
 
@@ -1204,7 +1267,7 @@ class WhatsAppManager:
             bool: True si el mensaje se envió correctamente
         """
         try:
-            if not self.wa_client:
+            if not self._envio_disponible():
                 return self._enqueue_offline_op('send_overdue_payment_notification', {
                     'user_data': user_data,
                     'to': user_data.get('phone')
@@ -1221,16 +1284,14 @@ class WhatsAppManager:
             template_name = "aviso_de_vencimiento_de_cuota_gimnasio_para_usuario_especifico_en_sistema_de_management_de_gimnasios_profesional"
             
             # Usar PyWa para enviar plantilla
-            response = self.wa_client.send_template(
+            ok, response = self._send_template(
                 to=destino,
                 name=template_name,
                 language=TemplateLanguage.SPANISH_ARG,
-                params=[
-                    BodyText.params(
-                        user_data['name'],  # {{1}}
-                        user_data['due_date'],  # {{2}}
-                        f"{user_data['amount']:,.0f}"  # {{3}}
-                    )
+                body_params=[
+                    user_data['name'],  # {{1}}
+                    user_data['due_date'],  # {{2}}
+                    f"{user_data['amount']:,.0f}"  # {{3}}
                 ]
             )
             
@@ -1270,7 +1331,7 @@ class WhatsAppManager:
         try:
             template_name = "aviso_de_confirmacion_de_pago_de_cuota_gimnasio_para_usuario_especifico_en_sistema_de_management_de_gimnasios_profesional"
             # Si no hay cliente, intentar fallback HTTP
-            if not self.wa_client:
+            if not self._envio_disponible():
                 ok, resp = self._send_template_http_basic(
                     to=payment_data['phone'],
                     name=template_name,
@@ -1310,12 +1371,10 @@ class WhatsAppManager:
                 to=payment_data['phone'],
                 name=template_name,
                 language=TemplateLanguage.SPANISH_ARG,
-                params=[
-                    BodyText.params(
-                        payment_data['name'],
-                        f"{payment_data['amount']:,.0f}",
-                        payment_data['date']
-                    )
+                body_params=[
+                    payment_data['name'],
+                    f"{payment_data['amount']:,.0f}",
+                    payment_data['date']
                 ]
             )
             if not ok:
@@ -1387,7 +1446,7 @@ class WhatsAppManager:
             header_img = "https://scontent.whatsapp.net/v/t61.29466-34/534423186_1473851737199264_5735585923517038205_n.jpg?ccb=1-7&_nc_sid=8b1bef&_nc_eui2=AeFoE1d4rKfFrSN8BE7_b3tf3Y0fQUMBEBfdjR9BQwEQF8Ax0e3gytRS7qWnLKIi5oUH-QVMX592JK57XYymNeix&_nc_ohc=chf40SP38C8Q7kNvwEFl7nT&_nc_oc=AdmrcU6XgW2jmC-YWO7D1UiHeeCxuhGlR6EElDkYrPDAFG43PJ7eU0L02xt9QXDDItA&_nc_zt=3&_nc_ht=scontent.whatsapp.net&edm=AH51TzQEAAAA&_nc_gid=RGRikAJcMRz3oD800NMXOQ&oh=01_Q5Aa2gEnN1SVJBv_Df-egpMeF4jG_FmxGtFRkXy0zEZOkwtGow&oe=68EFCA3A"
 
             # Si no hay cliente, intentar fallback HTTP
-            if not self.wa_client:
+            if not self._envio_disponible():
                 ok, resp = self._send_template_http_basic(
                     to=user_data['phone'],
                     name=template_name,
@@ -1424,10 +1483,8 @@ class WhatsAppManager:
                 to=user_data['phone'],
                 name=template_name,
                 language=TemplateLanguage.SPANISH_ARG,
-                params=[
-                    HeaderImage.params(image=header_img),
-                    BodyText.params(user_data['name'], user_data['gym_name'])
-                ]
+                header_image_url=header_img,
+                body_params=[user_data['name'], user_data['gym_name']]
             )
             if not ok:
                 logging.warning(f"WhatsApp plantilla bienvenida no confirmada inmediatamente para {user_data['phone']}: {response}")
@@ -1517,7 +1574,7 @@ class WhatsAppManager:
             bool: True si el mensaje se envió correctamente
         """
         try:
-            if not self.wa_client:
+            if not self._envio_disponible():
                 logging.error("Cliente WhatsApp no inicializado")
                 return False
             
@@ -1643,19 +1700,10 @@ class WhatsAppManager:
             logging.error(f"Error al detener servidor WhatsApp: {e}")
             return False
 
-    def _mensaje_audit_ya_registrado(self, message_id: str) -> bool:
-        """Devuelve True si ya existe un registro de mensaje con ese message_id."""
-        try:
-            with self.db.get_connection_context() as conn:
-                cur = conn.cursor()
-                cur.execute("SELECT 1 FROM whatsapp_messages WHERE message_id = %s LIMIT 1", (message_id,))
-                return cur.fetchone() is not None
-        except Exception:
-            return False
-
-    def _componer_confirmacion_waitlist(self, action: str, usuario: Any, clase_info: Optional[Dict[str, Any]], new_values: Optional[str]) -> str:
+    def _componer_confirmacion_waitlist(self, action: str, nombre: Optional[str], clase_info: Optional[Dict[str, Any]],
+                                        new_values: Optional[str], inscripto: bool = True) -> str:
         """Crea el texto de confirmación para SI/NO basándose en acción y datos disponibles."""
-        nombre = str(getattr(usuario, 'nombre', None) or 'Alumno')
+        nombre = str(nombre or 'Alumno')
         tipo_clase = None
         fecha = None
         hora = None
@@ -1690,6 +1738,8 @@ class WhatsAppManager:
         fecha_s = str(fecha or 'por confirmar')
         hora_s = str(hora or 'por confirmar')
 
+        if action == 'auto_promote_waitlist' and not inscripto:
+            return f"¡{nombre}! Confirmaste tu lugar para {tipo} del {fecha_s} a las {hora_s}, pero el cupo no está disponible en este momento. Te mantenemos en lista de espera y te avisaremos ante la próxima disponibilidad."
         if action == 'auto_promote_waitlist':
             return f"¡{nombre}! Confirmamos tu promoción desde lista de espera a la clase de {tipo} del {fecha_s} a las {hora_s}. ¡Nos vemos!"
         elif action == 'decline_waitlist_promotion':
@@ -1697,135 +1747,111 @@ class WhatsAppManager:
         else:
             return "Actualización de lista de espera registrada."
 
-    def process_pending_sends(self) -> int:
-        """Procesa envíos pendientes basados en auditorías de la webapp (SI/NO lista de espera)."""
-        try:
-            with self.db.get_connection_context() as conn:
-                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                cur.execute(
-                    """
-                    SELECT id, user_id, action, table_name, record_id, new_values, timestamp
-                    FROM audit_logs
-                    WHERE action IN ('auto_promote_waitlist','decline_waitlist_promotion')
-                    ORDER BY id DESC
-                    LIMIT 200
-                    """
-                )
-                rows = cur.fetchall()
-        except Exception as e:
-            logging.error(f"Error consultando auditorías: {e}")
-            return 0
-
-        if not rows:
-            return 0
-
-        enviados = 0
-        for row in reversed(rows):
-            audit_id = row.get('id')
-            action = row.get('action')
-            user_id = row.get('user_id')
-            record_id = row.get('record_id')
-            new_values = row.get('new_values')
+    def _procesar_confirmaciones(self, filas: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Arma y cierra un lote de confirmaciones (ver process_pending_sends). Devuelve los envíos encolados."""
+        repo = self.db.whatsapp
+        phone_number_id = str(self.phone_number_id or '').strip()
+        intervalo_s = float(self.message_logger.config_antispam.get('intervalo_minimo_minutos') or 0) * 60
+        motivos = self.message_logger.evaluar_antispam([f['telefono'] for f in filas if f.get('telefono')])
+        envios: List[Dict[str, Any]] = []
+        registros: List[Dict[str, Any]] = []
+        ultimo_id, consecutivas = None, True
+
+        def _registro(f: Dict[str, Any], status: str, contenido: str) -> Dict[str, Any]:
+            return {
+                'user_id': f.get('user_id'), 'message_type': 'waitlist', 'template_name': 'waitlist_confirmacion',
+                'phone_number': str(f.get('telefono') or ''), 'message_content': contenido,
+                'status': status, 'message_id': f"audit:{f['id']}",
+            }
 
-            message_id = f"audit:{audit_id}"
-            if self._mensaje_audit_ya_registrado(message_id):
+        for f in filas:
+            # La marca sólo avanza sobre auditorías asentadas y consecutivas: una transacción
+            # todavía abierta puede confirmar después una auditoría con id menor
+            consecutivas = consecutivas and bool(f['asentada'])
+            if consecutivas:
+                ultimo_id = f['id']
+            telefono = str(f.get('telefono') or '').strip()
+            action = f['action']
+            if not telefono:
+                logging.warning(f"Auditoría {f['id']}: usuario {f.get('user_id')} sin teléfono, se omite")
+                registros.append(_registro(f, 'failed', f"[{action}] Confirmación no enviada: teléfono faltante"))
                 continue
-
-            try:
-                usuario = self.db.obtener_usuario(user_id)
-            except Exception:
-                usuario = None
-
-            if not usuario or not getattr(usuario, 'telefono', None):
-                logging.warning(f"Auditoría {audit_id}: usuario {user_id} sin teléfono, se omite")
-                try:
-                    self.message_logger.registrar_mensaje_fallido(
-                        telefono=getattr(usuario, 'telefono', '') or '',
-                        mensaje=f"[{action}] Confirmación no enviada: teléfono faltante",
-                        error="telefono_faltante",
-                        tipo_mensaje="waitlist",
-                        message_id=message_id
-                    )
-                except Exception:
-                    pass
+            if not self._numero_permitido(telefono):
+                logging.warning(f"Número no permitido por allowlist: {telefono}")
+                registros.append(_registro(f, 'failed', f"[{action}] Omitido por allowlist"))
                 continue
 
-            if not self._numero_permitido(usuario.telefono):
-                logging.warning(f"Número no permitido por allowlist: {usuario.telefono}")
-                try:
-                    self.message_logger.registrar_mensaje_fallido(
-                        telefono=usuario.telefono,
-                        mensaje=f"[{action}] Omitido por allowlist",
-                        error="allowlist_block",
-                        tipo_mensaje="waitlist",
-                        message_id=message_id
-                    )
-                except Exception:
-                    pass
+            inscripto = True
+            if action == 'auto_promote_waitlist' and f.get('record_id') and f.get('user_id'):
+                inscripto = repo.promover_lista_espera(int(f['user_id']), int(f['record_id']))
+            texto = self._componer_confirmacion_waitlist(action, f.get('nombre'), f, f.get('new_values'), inscripto)
+
+            motivo = motivos.get(telefono)
+            demora_s = None
+            if motivo == 'intervalo_minimo':
+                demora_s = intervalo_s
+            elif motivo == 'limite_hora':
+                demora_s = 3600.0
+            elif motivo:
+                logging.info(f"Anti-spam bloqueó confirmación para {telefono} ({motivo})")
+                registros.append(_registro(f, 'failed', f"{texto} - Error: antispam_{motivo}"))
                 continue
+            envios.append({
+                'idempotency_key': f"audit:{f['id']}", 'phone_number_id': phone_number_id, 'telefono': telefono,
+                'payload': {"type": "text", "text": {"body": texto}}, 'user_id': f.get('user_id'),
+                'message_type': 'waitlist', 'contenido': texto, 'demora_s': demora_s,
+            })
+            registros.append(_registro(f, 'sent', texto))
 
-            clase_info = None
-            try:
-                if record_id:
-                    clase_info = self.db.obtener_horario_por_id(int(record_id))
-            except Exception:
-                clase_info = None
+        repo.cerrar_lote_confirmaciones(ultimo_id or 0, envios, registros)
+        return envios
 
-            # Realizar promoción desde desktop según auditoría
-            texto = None
-            if action == 'auto_promote_waitlist' and record_id and user_id:
-                try:
-                    enrolled = bool(self.db.inscribir_usuario_en_clase(int(record_id), int(user_id)))
-                except Exception as e:
-                    logging.error(f"Error inscribiendo en auto-promoción audit_id={audit_id}: {e}")
-                    enrolled = False
-                if enrolled:
-                    try:
-                        self.db.quitar_de_lista_espera_completo(int(record_id), int(user_id))
-                    except Exception as e:
-                        logging.error(f"Error quitando de lista de espera audit_id={audit_id}: {e}")
-                    texto = self._componer_confirmacion_waitlist(action, usuario, clase_info, new_values)
-                else:
-                    nombre = str(getattr(usuario, 'nombre', None) or 'Alumno')
-                    tipo = str((clase_info or {}).get('tipo_clase_nombre') or (clase_info or {}).get('clase_nombre') or 'Clase')
-                    fecha_s = str((clase_info or {}).get('fecha') or (clase_info or {}).get('dia_semana') or 'por confirmar')
-                    h_in = (clase_info or {}).get('hora') or (clase_info or {}).get('hora_inicio')
-                    try:
-                        hora_s = str(h_in)[:5] if h_in is not None else 'por confirmar'
-                    except Exception:
-                        hora_s = str(h_in) if h_in is not None else 'por confirmar'
-                    texto = f"¡{nombre}! Confirmaste tu lugar para {tipo} del {fecha_s} a las {hora_s}, pero el cupo no está disponible en este momento. Te mantenemos en lista de espera y te avisaremos ante la próxima disponibilidad."
-            else:
-                texto = self._componer_confirmacion_waitlist(action, usuario, clase_info, new_values)
-
-            if not self.message_logger.puede_enviar_mensaje(usuario.telefono):
-                logging.info(f"Anti-spam bloqueó confirmación para {usuario.telefono}")
-                continue
+    def process_pending_sends(self, tiempo_maximo_s: Optional[float] = None) -> int:
+        """Encola las confirmaciones de SI/NO de lista de espera a partir de sus auditorías.
 
+        Consume audit_logs desde la marca del consumidor (whatsapp_consumidores) en lotes de
+        WHATSAPP_CONFIRMACIONES_LOTE; cada lote (promoción, mensajes al outbox, registro en
+        whatsapp_messages y avance de la marca) es una transacción. La marca se toma con
+        FOR UPDATE SKIP LOCKED: si otra instancia la tiene, no se hace nada. Las auditorías de
+        los últimos WHATSAPP_CONFIRMACIONES_GRACIA_S segundos se procesan pero no mueven la marca;
+        si reaparecen, su registro 'audit:<id>' en whatsapp_messages las descarta.
+        """
+        if not self._envio_disponible():
+            return 0
+        try:
+            lote = max(1, int(os.getenv("WHATSAPP_CONFIRMACIONES_LOTE", "100")))
+            gracia_s = float(os.getenv("WHATSAPP_CONFIRMACIONES_GRACIA_S", "60"))
+        except Exception:
+            lote, gracia_s = 100, 60.0
+        limite = time.monotonic() + (25.0 if tiempo_maximo_s is None else tiempo_maximo_s)
+        repo = self.db.whatsapp
+        encolados = 0
+        while time.monotonic() < limite:
             try:
-                ok, resp = self._send_message(to=usuario.telefono, text=texto)
-                self.message_logger.registrar_mensaje_enviado(
-                    telefono=usuario.telefono,
-                    mensaje=texto,
-                    tipo_mensaje="waitlist",
-                    message_id=message_id if ok else getattr(resp, 'id', None)
-                )
-                enviados += 1 if ok else 0
-            except Exception as send_err:
-                logging.error(f"Error enviando confirmación de auditoría {audit_id}: {send_err}")
+                tomado = repo.tomar_lote_confirmaciones(lote, gracia_s)
+                if tomado is None:
+                    break
+                _, filas = tomado
+                if not filas:
+                    repo.db.rollback()
+                    break
+                envios = self._procesar_confirmaciones(filas)
+            except Exception as e:
+                logging.error(f"Error procesando confirmaciones de lista de espera: {e}")
                 try:
-                    self.message_logger.registrar_mensaje_fallido(
-                        telefono=usuario.telefono,
-                        mensaje=texto,
-                        error=str(send_err),
-                        tipo_mensaje="waitlist",
-                        message_id=message_id
-                    )
+                    repo.db.rollback()
                 except Exception:
                     pass
-                continue
-
-        return enviados
+                break
+            for e in envios:
+                self.message_logger.antispam.registrar(e['telefono'], 'waitlist')
+            encolados += len(envios)
+            if len(filas) < lote:
+                break
+        if encolados:
+            from .whatsapp_dispatcher import despachar_en_segundo_plano
+            despachar_en_segundo_plano(self._crear_dispatcher)
+        return encolados
     
     def verificar_configuracion(self):
         """Verifica que la configuración de WhatsApp esté completa"""
@@ -1852,13 +1878,12 @@ class WhatsAppManager:
     def obtener_estadisticas(self) -> Dict[str, Any]:
         """Obtiene estadísticas del sistema de mensajería"""
         try:
-            stats_diarias = self.message_logger.obtener_estadisticas_diarias()
-            stats_semanales = self.message_logger.obtener_estadisticas_semanales()
+            resumen = self.message_logger.estadisticas.resumen()
             
             return {
-                'hoy': stats_diarias,
-                'esta_semana': stats_semanales,
-                'plantillas_activas': len(self.db.obtener_plantillas_whatsapp(activas_solo=True)),
+                'hoy': resumen['hoy'],
+                'esta_semana': resumen['esta_semana'],
+                'plantillas_activas': len(self.db.whatsapp.obtener_plantillas_whatsapp(activas_solo=True)),
                 'configuracion_valida': self.wa_client is not None
             }
         except Exception as e:
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WhatsApp Webhook - Ingesta diferida de los eventos de Meta
+
+El endpoint sólo verifica la firma, guarda el payload crudo en whatsapp_webhook_eventos y
+responde 200; así Meta no reintenta por lentitud ni se procesa dos veces el mismo envío.
+Un consumidor toma los eventos en orden de llegada y procesa cada lote en una transacción:
+- estados de entrega: uno por message_id (el más avanzado) y un solo UPDATE por lote;
+- estados de envíos de campañas: también por destinatario, con el biz_opaque_callback_data
+  ('campania:<id>:<destinatario>') que devuelve Meta;
+- mensajes entrantes: se ignoran los message_id ya registrados y se procesan en orden por
+  teléfono (respuestas SI/NO a la lista de espera con su auditoría, BAJA/ALTA de campañas).
+  El usuario de cada teléfono sale de ResolutorTelefonos (índice en memoria sobre
+  usuarios.telefono_e164).
+Un advisory lock deja un solo consumidor activo a la vez, por eso el orden se mantiene.
+Los eventos guardados se pueden reprocesar por rango (WebhookIngestor.reprocesar).
+"""
+
+import os
+import hmac
+import time
+import json
+import hashlib
+import logging
+import unicodedata
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from .database.repositories.whatsapp_repository import ESTADOS_ENTREGA
+from .database.telefonos import ResolutorTelefonos, normalizar_telefono
+
+logger = logging.getLogger(__name__)
+
+RANGO_ESTADO = {st: i for i, st in enumerate(ESTADOS_ENTREGA, start=1)}
+
+# Respuestas que dan de baja (o vuelven a dar de alta) un teléfono de las campañas
+PALABRAS_BAJA = {'baja', 'stop', 'desuscribir'}
+PALABRAS_ALTA = {'alta', 'start'}
+
+TEXTO_POR_TIPO = {
+    'image': '[imagen]',
+    'audio': '[audio]',
+    'video': '[video]',
+    'document': '[documento]',
+}
+
+
+def _env_int(nombre: str, defecto: int) -> int:
+    try:
+        return int(os.getenv(nombre, str(defecto)))
+    except Exception:
+        return defecto
+
+
+def _env_float(nombre: str, defecto: float) -> float:
+    try:
+        return float(os.getenv(nombre, str(defecto)))
+    except Exception:
+        return defecto
+
+
+def verificar_firma(raw: bytes, firma: str, app_secret: str) -> bool:
+    """Compara X-Hub-Signature-256 con el HMAC-SHA256 del cuerpo crudo."""
+    esperado = "sha256=" + hmac.new(app_secret.encode("utf-8"), raw, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(esperado, firma or "")
+
+
+def _sanitizar(s: str) -> str:
+    s = (s or "").strip()
+    s = "".join(c for c in unicodedata.normalize("NFD", s) if unicodedata.category(c) != "Mn")
+    s = s.lower()
+    # Quitar signos de puntuación comunes
+    for ch in [".", ",", ";", "!", "?", "¡", "¿"]:
+        s = s.replace(ch, "")
+    return s
+
+
+def _mensaje(msg: Dict[str, Any], orden: int) -> Optional[Dict[str, Any]]:
+    """Datos útiles de un mensaje entrante del payload de Meta."""
+    mid, wa_from = msg.get("id"), msg.get("from")
+    if not mid or not wa_from:
+        return None
+    mtype = msg.get("type")
+    texto = boton_id = boton_titulo = None
+    if mtype == "text":
+        texto = (msg.get("text") or {}).get("body")
+    elif mtype == "button":
+        texto = (msg.get("button") or {}).get("text")
+    elif mtype == "interactive":
+        ir = msg.get("interactive") or {}
+        br = ir.get("button_reply") or {}
+        lr = ir.get("list_reply") or {}
+        boton_id = br.get("id") or lr.get("id")
+        boton_titulo = br.get("title") or lr.get("title")
+        texto = boton_titulo
+    else:
+        texto = TEXTO_POR_TIPO.get(mtype)
+    try:
+        ts = int(msg.get("timestamp") or 0)
+    except Exception:
+        ts = 0
+    return {
+        'message_id': str(mid), 'telefono': str(wa_from), 'texto': texto or "",
+        'boton_id': boton_id or "", 'boton_titulo': boton_titulo or "", 'timestamp': ts, 'orden': orden,
+    }
+
+
+def extraer_eventos(payloads: List[Dict[str, Any]]) -> Tuple[Dict[str, str], List[Dict[str, Any]]]:
+    """Estados de entrega (el más avanzado por message_id) y mensajes entrantes sin repetir,
+    ordenados por teléfono y momento de envío."""
+    estados: Dict[str, str] = {}
+    mensajes: Dict[str, Dict[str, Any]] = {}
+    orden = 0
+    for payload in payloads:
+        for entry in (payload or {}).get("entry") or []:
+            for change in entry.get("changes") or []:
+                value = change.get("value") or {}
+                for st in value.get("statuses") or []:
+                    mid, estado = st.get("id"), st.get("status")
+                    if mid and estado in RANGO_ESTADO and RANGO_ESTADO[estado] > RANGO_ESTADO.get(estados.get(mid), 0):
+                        estados[str(mid)] = estado
+                for msg in value.get("messages") or []:
+                    orden += 1
+                    m = _mensaje(msg, orden)
+                    if m and m['message_id'] not in mensajes:
+                        mensajes[m['message_id']] = m
+    return estados, sorted(mensajes.values(), key=lambda m: (m['telefono'], m['timestamp'], m['orden']))
+
+
+def estados_campania(payloads: List[Dict[str, Any]]) -> Dict[int, str]:
+    """Estado más avanzado por destinatario de campaña, según el biz_opaque_callback_data
+    ('campania:<id>:<destinatario>') con que se envió cada mensaje."""
+    estados: Dict[int, str] = {}
+    for payload in payloads:
+        for entry in (payload or {}).get("entry") or []:
+            for change in entry.get("changes") or []:
+                for st in (change.get("value") or {}).get("statuses") or []:
+                    partes = str(st.get("biz_opaque_callback_data") or "").split(":")
+                    estado = st.get("status")
+                    if len(partes) != 3 or partes[0] != "campania" or estado not in RANGO_ESTADO:
+                        continue
+                    try:
+                        destinatario = int(partes[2])
+                    except ValueError:
+                        continue
+                    if RANGO_ESTADO[estado] > RANGO_ESTADO.get(estados.get(destinatario), 0):
+                        estados[destinatario] = estado
+    return estados
+
+
+def senal_baja(m: Dict[str, Any]) -> Optional[bool]:
+    """True si el mensaje pide la baja de campañas, False si pide volver, None si no es eso."""
+    texto = _sanitizar(m.get('boton_titulo') or m.get('texto') or "")
+    if texto in PALABRAS_BAJA:
+        return True
+    if texto in PALABRAS_ALTA:
+        return False
+    return None
+
+
+def senal_lista_espera(m: Dict[str, Any]) -> Tuple[Optional[str], Optional[int]]:
+    """('promote' | 'decline' | None, clase_horario_id si vino en el botón).
+
+    Botones WAITLIST_PROMOTE:<id> / WAITLIST_DECLINE:<id>, o texto SI/NO."""
+    bid = m.get('boton_id') or ""
+    try:
+        if bid.startswith("WAITLIST_PROMOTE:"):
+            return 'promote', int(bid.split(":", 1)[1])
+        if bid.startswith("WAITLIST_DECLINE:"):
+            return 'decline', int(bid.split(":", 1)[1])
+    except Exception:
+        pass
+    texto = _sanitizar(m.get('boton_titulo') or m.get('texto') or "")
+    if texto == "si":
+        return 'promote', None
+    if texto == "no":
+        return 'decline', None
+    return None, None
+
+
+class WebhookIngestor:
+    """Consumidor de whatsapp_webhook_eventos.
+
+    Configuración por entorno:
+    - WHATSAPP_WEBHOOK_LOTE: eventos por transacción (200).
+    - WHATSAPP_WEBHOOK_MAX_INTENTOS: errores antes de apartar un evento (5); se recupera con reprocesar.
+    - WHATSAPP_WEBHOOK_TIEMPO_MAXIMO_S: presupuesto de tiempo por corrida (25).
+    """
+
+    def __init__(self, db_manager):
+        self.db = db_manager
+        self.lote = max(1, _env_int('WHATSAPP_WEBHOOK_LOTE', 200))
+        self.max_intentos = max(1, _env_int('WHATSAPP_WEBHOOK_MAX_INTENTOS', 5))
+        self.tiempo_maximo_s = _env_float('WHATSAPP_WEBHOOK_TIEMPO_MAXIMO_S', 25.0)
+
+    def encolar(self, payload: Dict[str, Any]) -> int:
+        return self.db.whatsapp.guardar_evento_webhook(payload)
+
+    def _procesar_lote(self, eventos: List[Dict[str, Any]], resumen: Dict[str, Any]) -> None:
+        repo = self.db.whatsapp
+        payloads = [e['payload'] for e in eventos]
+        estados, mensajes = extraer_eventos(payloads)
+        resumen['estados'] += repo.aplicar_estados_entrega(estados)
+        resumen['campanias'] += repo.aplicar_estados_campanias(estados_campania(payloads))
+
+        auditorias: List[Dict[str, Any]] = []
+        if mensajes:
+            usuarios = ResolutorTelefonos(repo.db).resolver_muchos([m['telefono'] for m in mensajes])
+            nuevos = repo.insertar_mensajes_recibidos([
+                {
+                    'user_id': usuarios.get(m['telefono']), 'message_type': 'welcome', 'template_name': 'incoming',
+                    'phone_number': m['telefono'], 'message_content': m['texto'], 'message_id': m['message_id'],
+                }
+                for m in mensajes
+            ])
+            resumen['recibidos'] += len(nuevos)
+            resumen['duplicados'] += len(mensajes) - len(nuevos)
+            senales = []
+            bajas: Dict[str, Optional[int]] = {}
+            altas = set()
+            for m in mensajes:
+                if m['message_id'] not in nuevos:
+                    continue
+                baja = senal_baja(m)
+                e164 = normalizar_telefono(m['telefono']) if baja is not None else None
+                if e164:
+                    # En orden por teléfono: el último pedido de cada uno es el que vale
+                    if baja:
+                        bajas[e164] = usuarios.get(m['telefono'])
+                        altas.discard(e164)
+                    else:
+                        altas.add(e164)
+                        bajas.pop(e164, None)
+                    continue
+                accion, clase_id = senal_lista_espera(m)
+                uid = usuarios.get(m['telefono'])
+                if accion and uid:
+                    senales.append((m, accion, clase_id, uid))
+            sin_clase = [uid for _, _, clase_id, uid in senales if clase_id is None]
+            if bajas or altas:
+                repo.anotar_bajas(bajas, altas)
+                resumen['bajas'] += len(bajas)
+            primera = repo.obtener_primera_lista_espera(sin_clase) if sin_clase else {}
+            # `mensajes` ya viene en orden por teléfono: las auditorías respetan ese orden
+            for m, accion, clase_id, uid in senales:
+                clase_id = clase_id or primera.get(uid)
+                if not clase_id:
+                    continue
+                promover = accion == 'promote'
+                auditorias.append({
+                    'user_id': int(uid),
+                    'action': "auto_promote_waitlist" if promover else "decline_waitlist_promotion",
+                    'table_name': "clase_lista_espera",
+                    'record_id': int(clase_id),
+                    'new_values': json.dumps({"confirmado": True} if promover else {"declinado": True}),
+                    'user_agent': "whatsapp-webhook",
+                })
+                logger.info(f"WA lista de espera ({accion}): usuario_id={uid} clase_horario_id={clase_id} mid={m['message_id']}")
+        resumen['auditorias'] += len(auditorias)
+        repo.cerrar_lote_webhook([e['id'] for e in eventos], auditorias)
+
+    def procesar(self, tiempo_maximo_s: Optional[float] = None) -> Dict[str, Any]:
+        """Procesa eventos pendientes hasta vaciar la cola o agotar el tiempo.
+
+        Si un lote falla se deshace entero y sus eventos se reintentan de a uno, para que
+        sólo el que falla acumule intentos.
+        """
+        inicio = time.monotonic()
+        limite = inicio + (self.tiempo_maximo_s if tiempo_maximo_s is None else tiempo_maximo_s)
+        resumen = {'eventos': 0, 'estados': 0, 'campanias': 0, 'recibidos': 0, 'duplicados': 0, 'auditorias': 0,
+                   'bajas': 0, 'errores': 0, 'ocupado': False, 'duracion_s': 0.0}
+        repo = self.db.whatsapp
+        de_a_uno = 0
+        esperas = 0
+        while time.monotonic() < limite:
+            eventos = repo.tomar_lote_webhook(1 if de_a_uno else self.lote, self.max_intentos)
+            if eventos is None:
+                # Otro consumidor tiene el lock. Puede estar en su última vuelta, antes de ver
+                # lo que se acaba de guardar: se reintenta un par de veces antes de dejárselo.
+                if esperas >= 3:
+                    resumen['ocupado'] = True
+                    break
+                esperas += 1
+                time.sleep(0.2)
+                continue
+            if not eventos:
+                repo.db.rollback()
+                break
+            try:
+                self._procesar_lote(eventos, resumen)
+                resumen['eventos'] += len(eventos)
+            except Exception as e:
+                logger.error(f"Webhook WhatsApp: error procesando eventos {[ev['id'] for ev in eventos]}: {e}")
+                repo.marcar_error_webhook([ev['id'] for ev in eventos], str(e))
+                resumen['errores'] += len(eventos)
+                if len(eventos) > 1:
+                    de_a_uno = len(eventos)
+                    continue
+            if de_a_uno:
+                de_a_uno -= 1
+        resumen['duracion_s'] = round(time.monotonic() - inicio, 3)
+        if resumen['eventos'] or resumen['errores']:
+            logger.info(f"Webhook WhatsApp: {resumen}")
+        return resumen
+
+    def reprocesar(self, desde_id: Optional[int] = None, hasta_id: Optional[int] = None,
+                   desde: Optional[datetime] = None, hasta: Optional[datetime] = None) -> Dict[str, Any]:
+        """Reproduce los eventos guardados del rango (ids y/o fechas de recepción).
+
+        Es seguro repetirlo: los mensajes ya registrados se ignoran y los estados no retroceden;
+        sólo las auditorías de lista de espera de mensajes que no habían quedado registrados se
+        vuelven a escribir."""
+        reabiertos = self.db.whatsapp.reabrir_eventos_webhook(desde_id, hasta_id, desde, hasta)
+        return {'reabiertos': reabiertos, **self.procesar()}
+
+    def resumen(self) -> Dict[str, Any]:
+        return self.db.whatsapp.resumen_webhook(self.max_intentos)
+
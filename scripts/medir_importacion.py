@@ -0,0 +1,58 @@
+"""Benchmark de PaymentRepository.importar_pagos_masivo.
+
+Uso (no deja datos en la base): python scripts/medir_importacion.py [pagos]
+"""
+import os
+import sys
+import time
+from typing import Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+from core.database.connection import engine  # noqa: E402
+from core.database.repositories.payment_repository import PaymentRepository  # noqa: E402
+
+
+def medir_importacion(engine, pagos: int = 100_000, usuarios: int = 5_000) -> Dict[str, float]:
+    """Benchmark de importar_pagos_masivo: segundos para importar `pagos` filas sintéticas.
+
+    - alta: pagos nuevos para `usuarios` socios identificados por DNI (camino INSERT).
+    - reimportacion: el mismo archivo otra vez (camino ON CONFLICT DO UPDATE y resumen de ingresos).
+    Todo corre en una transacción que se descarta al final (los commit() del repositorio quedan
+    como savepoints), así que puede apuntarse a una base con datos sin dejar rastro.
+    """
+    usuarios = max(1, min(int(usuarios), int(pagos)))
+    items = [
+        {'dni': f"bench{i % usuarios:07d}", 'monto': 15000 + i % 100, 'mes': (i // usuarios) % 12 + 1,
+         'año': 1900 + (i // usuarios) // 12, 'fecha_pago': '2000-01-10 10:00:00'}
+        for i in range(int(pagos))
+    ]
+    resultados: Dict[str, float] = {}
+    with engine.connect() as conn:
+        externa = conn.begin()
+        sesion = Session(bind=conn, join_transaction_mode='create_savepoint')
+        try:
+            sesion.execute(text("INSERT INTO usuarios (nombre, dni, telefono, rol) VALUES (:nombre, :dni, '', 'socio')"),
+                           [{'nombre': f"Bench {i}", 'dni': f"bench{i:07d}"} for i in range(usuarios)])
+            repo = PaymentRepository(sesion, None, None)
+            for etapa in ('alta', 'reimportacion'):
+                inicio = time.perf_counter()
+                r = repo.importar_pagos_masivo(items)
+                resultados[etapa] = time.perf_counter() - inicio
+                if r['insertados'] + r['actualizados'] != len(items):
+                    raise RuntimeError(f"{etapa}: se esperaban {len(items)} pagos, resultado {r}")
+                # ON COMMIT DROP no se dispara: la transacción externa sigue abierta
+                sesion.execute(text("DROP TABLE IF EXISTS _pagos_import"))
+        finally:
+            sesion.close()
+            externa.rollback()
+    return resultados
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    for nombre, segundos in medir_importacion(engine, n).items():
+        print(f"{nombre:>14}: {segundos:8.2f} s  ({n / segundos:,.0f} pagos/s)")
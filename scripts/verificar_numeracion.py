@@ -0,0 +1,93 @@
+"""Prueba de concurrencia de la numeración de comprobantes (ReceiptNumberingRepository).
+
+Uso (contra una base de prueba; limpia lo que crea): python scripts/verificar_numeracion.py [emisiones] [hilos]
+"""
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+from core.database.connection import engine  # noqa: E402
+from core.database.repositories.receipt_numbering_repository import (  # noqa: E402
+    _BLOQUES, _BLOQUES_LOCK, _SECUENCIAS, ReceiptNumberingRepository,
+)
+
+
+def verificar_numeracion(engine, emisiones: int = 10_000, hilos: int = 16) -> Dict[str, Dict[str, Any]]:
+    """Prueba de concurrencia: `emisiones` comprobantes emitidos desde `hilos` conexiones a la vez.
+
+    Para cada modo usa un tipo de comprobante descartable y controla con obtener_huecos que no
+    haya números repetidos ni emisiones fallidas; en modo estricto, además, que la numeración
+    vaya de 1 a `emisiones` sin huecos. Al terminar borra los comprobantes, el contador, la
+    secuencia y la configuración del tipo.
+    """
+    resultados: Dict[str, Dict[str, Any]] = {}
+    for modo in ('estricto', 'secuencia'):
+        estricto = modo == 'estricto'
+        tipo = f"prueba_{modo}_{uuid.uuid4().hex[:8]}"
+        with Session(engine) as s:
+            ReceiptNumberingRepository(s, None, None).guardar_config({'modo_estricto': estricto, 'numero_inicial': 1}, tipo)
+        local = threading.local()
+        sesiones: List[Any] = []
+
+        def _emitir() -> None:
+            repo = getattr(local, 'repo', None)
+            if repo is None:
+                sesion = Session(engine)
+                sesiones.append(sesion)
+                repo = local.repo = ReceiptNumberingRepository(sesion, None, None)
+            repo.emitir_comprobante(None, None, 0, tipo=tipo, tamano_bloque=20)
+
+        errores = 0
+        try:
+            inicio = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=max(1, int(hilos))) as pool:
+                for futuro in [pool.submit(_emitir) for _ in range(int(emisiones))]:
+                    try:
+                        futuro.result()
+                    except Exception:
+                        errores += 1
+            segundos = time.perf_counter() - inicio
+            with Session(engine) as s:
+                control = ReceiptNumberingRepository(s, None, None).obtener_huecos(tipo, 0, limite=20)
+        finally:
+            for sesion in sesiones:
+                sesion.close()
+            nombre = ReceiptNumberingRepository._nombre_secuencia(tipo, 0)
+            with Session(engine) as s:
+                for tabla in ('comprobantes_pago', 'contadores_comprobantes', 'numeracion_comprobantes'):
+                    s.execute(text(f"DELETE FROM {tabla} WHERE tipo_comprobante = :tipo"), {'tipo': tipo})
+                s.execute(text(f"DROP SEQUENCE IF EXISTS {nombre}"))
+                s.commit()
+            with _BLOQUES_LOCK:
+                for clave in [k for k in _BLOQUES if k[1] == tipo]:
+                    _BLOQUES.pop(clave, None)
+            _SECUENCIAS.difference_update({k for k in _SECUENCIAS if k[1] == nombre})
+
+        ok = errores == 0 and control['duplicados'] == 0 and control['emitidos'] == int(emisiones)
+        if estricto:
+            ok = ok and control['desde'] == 1 and control['hasta'] == int(emisiones) and control['total_huecos'] == 0
+        resultados[modo] = {
+            'ok': ok, 'segundos': round(segundos, 3), 'errores': errores,
+            **{k: control[k] for k in ('emitidos', 'desde', 'hasta', 'duplicados', 'total_huecos')},
+        }
+    return resultados
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    h = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    resultado = verificar_numeracion(engine, n, h)
+    for modo, r in resultado.items():
+        print(f"{'OK ' if r['ok'] else 'MAL'} {modo:>9}: {r['emitidos']} emitidos en {r['segundos']:.1f} s "
+              f"({r['emitidos'] / max(r['segundos'], 1e-9):,.0f}/s), {r['errores']} errores, "
+              f"{r['duplicados']} duplicados, {r['total_huecos']} huecos ({r['desde']}..{r['hasta']})")
+    sys.exit(0 if all(r['ok'] for r in resultado.values()) else 1)
@@ -0,0 +1,161 @@
+"""Regresión de planes: los filtros de fecha de los repositorios deben resolverse con su índice.
+
+Siembra un conjunto de datos (usuarios, pagos, asistencias) dentro de una transacción que
+se descarta al final, ejecuta los métodos reales de los repositorios capturando las
+sentencias que mandan a la base y corre EXPLAIN (FORMAT JSON) de cada una con
+enable_seqscan=off. Cada chequeo exige que la tabla se lea con el índice esperado: un Seq
+Scan o un recorrido completo de otro índice (p.ej. la PK) fallan, que es lo que pasa si
+alguien vuelve a envolver la columna en DATE()/EXTRACT().
+
+Uso (contra una base de prueba; no deja datos): python scripts/verificar_planes.py
+"""
+import os
+import re
+import sys
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, text  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+from core.database.connection import engine  # noqa: E402
+from core.database.date_ranges import hoy_gym  # noqa: E402
+from core.database.repositories.payment_repository import PaymentRepository  # noqa: E402
+from core.database.repositories.reports_repository import ReportsRepository  # noqa: E402
+
+USUARIOS = 3000
+MESES_PAGOS = 24
+DIAS_ASISTENCIAS = 90
+PREFIJO = 'verificar-planes-'
+
+# Índice esperado por tabla; en asistencias particionada los índices de cada partición
+# los nombra Postgres (asistencias_pAAAAMM_fecha_idx)
+INDICE_PAGOS_FECHA = re.compile(r'^idx_pagos_fecha_id$')
+INDICE_PAGOS_USUARIO = re.compile(r'^idx_pagos_usuario_fecha_id$')
+INDICE_USUARIOS_REGISTRO = re.compile(r'^idx_usuarios_fecha_registro$')
+INDICE_ASISTENCIAS_FECHA = re.compile(r'^(idx_asistencias_fecha|asistencias_(p\d{6}|default)_fecha_idx)$')
+
+
+def _chequeos(usuario_id: int):
+    """(nombre, llamada al repositorio, tabla, índice esperado)."""
+    hoy = hoy_gym()
+    desde = hoy - timedelta(days=30)
+    return [
+        ('pagos_mes', lambda db: PaymentRepository(db).obtener_pagos_mes(hoy.month, hoy.year),
+         'pagos', INDICE_PAGOS_FECHA),
+        ('pagos_estadisticas_anio', lambda db: PaymentRepository(db).obtener_estadisticas_pagos(hoy.year),
+         'pagos', INDICE_PAGOS_FECHA),
+        ('pago_existe_usuario_mes',
+         lambda db: PaymentRepository(db).verificar_pago_existe(usuario_id, hoy.month, hoy.year),
+         'pagos', INDICE_PAGOS_USUARIO),
+        ('reporte_ingresos_30_dias',
+         lambda db: ReportsRepository(db).generar_reporte_automatico_periodo('ingresos', desde, hoy),
+         'pagos', INDICE_PAGOS_FECHA),
+        ('reporte_asistencias_30_dias',
+         lambda db: ReportsRepository(db).generar_reporte_automatico_periodo('asistencias', desde, hoy),
+         'asistencias', INDICE_ASISTENCIAS_FECHA),
+        ('reporte_usuarios_nuevos_30_dias',
+         lambda db: ReportsRepository(db).generar_reporte_automatico_periodo('usuarios_nuevos', desde, hoy),
+         'usuarios', INDICE_USUARIOS_REGISTRO),
+    ]
+
+
+def _sembrar(conexion) -> int:
+    """Inserta el conjunto de datos de prueba y devuelve el id de uno de los usuarios sembrados."""
+    conexion.execute(text("""
+        INSERT INTO usuarios (nombre, telefono, rol, activo, fecha_registro)
+        SELECT :prefijo || g, '0' || g, 'socio', TRUE, CURRENT_TIMESTAMP - (g % 730) * INTERVAL '1 day'
+        FROM generate_series(1, :n) g
+    """), {'prefijo': PREFIJO, 'n': USUARIOS})
+    conexion.execute(text("""
+        INSERT INTO pagos (usuario_id, monto, mes, "año", fecha_pago)
+        SELECT u.id, 1000, EXTRACT(MONTH FROM f)::int, EXTRACT(YEAR FROM f)::int,
+               f + (u.id % 28) * INTERVAL '1 day'
+        FROM usuarios u
+        CROSS JOIN generate_series(date_trunc('month', CURRENT_DATE) - (:meses - 1) * INTERVAL '1 month',
+                                   date_trunc('month', CURRENT_DATE), INTERVAL '1 month') f
+        WHERE u.nombre LIKE :prefijo || '%'
+        ON CONFLICT DO NOTHING
+    """), {'prefijo': PREFIJO, 'meses': MESES_PAGOS})
+    conexion.execute(text("""
+        INSERT INTO asistencias (usuario_id, fecha, hora_registro)
+        SELECT u.id, CURRENT_DATE - d, (CURRENT_DATE - d) + TIME '09:00'
+        FROM usuarios u
+        CROSS JOIN generate_series(0, :dias - 1) d
+        WHERE u.nombre LIKE :prefijo || '%' AND (u.id + d) % 4 = 0
+        ON CONFLICT DO NOTHING
+    """), {'prefijo': PREFIJO, 'dias': DIAS_ASISTENCIAS})
+    for tabla in ('usuarios', 'pagos', 'asistencias'):
+        conexion.execute(text(f"ANALYZE {tabla}"))
+    return int(conexion.execute(text("SELECT MIN(id) FROM usuarios WHERE nombre LIKE :p || '%'"),
+                                {'p': PREFIJO}).scalar())
+
+
+def _nodos_plan(plan: dict) -> list:
+    """(tipo, tabla, índice) de cada nodo; un Bitmap Heap Scan toma el índice de su Bitmap Index Scan."""
+    hijos = plan.get('Plans') or []
+    indice = plan.get('Index Name')
+    if plan.get('Node Type') == 'Bitmap Heap Scan':
+        indice = next((h.get('Index Name') for h in hijos if h.get('Node Type') == 'Bitmap Index Scan'), None)
+    nodos = [(plan.get('Node Type'), plan.get('Relation Name'), indice)]
+    for hijo in hijos:
+        nodos.extend(_nodos_plan(hijo))
+    return nodos
+
+
+def _tabla_de(relacion: str, tabla: str) -> bool:
+    # Las particiones de asistencias se llaman asistencias_pAAAAMM y asistencias_default
+    return relacion == tabla or bool(re.match(rf'^{tabla}_(p\d{{6}}|default)$', relacion or ''))
+
+
+def _evaluar(conexion, sentencias, tabla: str, indice) -> dict:
+    planes = []
+    ok = False
+    for sql, params in sentencias:
+        if not re.search(rf'\bFROM\s+"?{tabla}"?\b', sql, re.IGNORECASE):
+            continue
+        plan = conexion.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}", params).scalar()
+        nodos = [n for n in _nodos_plan((plan[0] if isinstance(plan, list) else plan)['Plan'])
+                 if _tabla_de(n[1], tabla)]
+        planes.extend(nodos)
+        ok = bool(nodos) and all(idx and indice.match(idx) for _, _, idx in nodos)
+        if not ok:
+            break
+    return {'ok': ok, 'nodos': planes}
+
+
+def verificar_planes() -> dict:
+    """Devuelve {chequeo: {'ok': bool, 'nodos': [(tipo, tabla, índice)]}}."""
+    resultados = {}
+    with engine.connect() as conexion:
+        transaccion = conexion.begin()
+        try:
+            usuario_id = _sembrar(conexion)
+            conexion.exec_driver_sql("SET LOCAL enable_seqscan = off")
+            # Los commits de los repositorios liberan un savepoint; la transacción externa se descarta
+            db = Session(bind=conexion, join_transaction_mode='create_savepoint')
+            for nombre, llamada, tabla, indice in _chequeos(usuario_id):
+                sentencias = []
+
+                def _capturar(_con, _cursor, sql, params, _contexto, _many):
+                    sentencias.append((sql, params))
+
+                event.listen(conexion, 'before_cursor_execute', _capturar)
+                try:
+                    llamada(db)
+                finally:
+                    event.remove(conexion, 'before_cursor_execute', _capturar)
+                resultados[nombre] = _evaluar(conexion, sentencias, tabla, indice)
+            db.close()
+        finally:
+            transaccion.rollback()
+    return resultados
+
+
+if __name__ == "__main__":
+    resultado = verificar_planes()
+    for nombre, r in resultado.items():
+        detalle = ', '.join(f"{t} {tabla or ''}{f' ({idx})' if idx else ''}".strip() for t, tabla, idx in r['nodos'])
+        print(f"{'OK ' if r['ok'] else 'MAL'} {nombre:>32}: {detalle or 'sin sentencias sobre la tabla'}")
+    sys.exit(0 if all(r['ok'] for r in resultado.values()) else 1)